@@ -20,6 +20,7 @@ setup(
                                         'onedrive-offsite-create-key=onedrive_offsite.app_setup:create_key',
                                         'onedrive-offsite-upload-backup-file=onedrive_offsite.file_ops:crypt_file_upload',
                                         'onedrive-offsite-build-and-upload=onedrive_offsite.file_ops:crypt_file_build_and_upload',
+                                        'onedrive-offsite-stream-build-and-upload=onedrive_offsite.file_ops:crypt_file_stream_upload',
                                         'onedrive-offsite-build-crypt-file=onedrive_offsite.file_ops:crypt_file_build',
                                         'onedrive-offsite-restore=onedrive_offsite.file_ops:restore',
                                         'onedrive-offsite-download=onedrive_offsite.file_ops:download']},
@@ -30,7 +31,9 @@ setup(
 
     extras_require={
         # To install requirements for dev work use 'pip install -e .[dev]'
-        'dev': ['coverage']
+        'dev': ['coverage'],
+        # To compress chunks with zstd instead of zlib use 'pip install -e .[zstd]'
+        'zstd': ['zstandard']
     },
 
     python_requires = '>=3.8, !=3.12.*',
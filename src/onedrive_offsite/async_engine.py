@@ -0,0 +1,319 @@
+from onedrive_offsite.onedrive import OneDriveLargeUpload, MSGraphCredMgr, OneDriveDirMgr, OneDriveGetItemDetails, OneDriveFileDownloadMgr
+from onedrive_offsite.utils import FilePartialRead, upload_fragment_sizer, upload_quick_xor
+from onedrive_offsite.config import Config
+from onedrive_offsite.concurrency import AimdController, upload_controller, download_controller, reset_controller
+from onedrive_offsite.cancellation import cancel_token
+from onedrive_offsite.workers import token_refresh_cycle, _token_refresh_get_offset, _lock_file_check, _write_to_lock_file, _make_download_dir, _remove_download_file, DownloadManager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import os, logging, asyncio, functools
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+UPLOAD_FILE_ATTEMPTS = 6        # same limits as upload_manager() and DownloadManager, they give up once a file has failed more than 5 and 2 times
+DOWNLOAD_FILE_ATTEMPTS = 3
+
+
+class AsyncTransferEngine:
+    # schedules uploads, downloads, and token refreshes as tasks on one asyncio event loop instead of five worker threads polling queues.
+    # the concurrency controllers decide how many files transfer at once, waiting transfers are woken instead of polling,
+    # and the first failure that can't be retried cancels every other task.
+    # this is a scheduler, not non-blocking i/o. requests is a blocking library, so every graph call runs through _call() on an executor
+    # with concurrency + 1 threads, and an upload_file_part() or download_file() call holds its thread for the whole fragment or file.
+    # download_file() with more than one range per file also starts range_count threads of its own
+
+    def __init__(self, concurrency: int=None):
+        # a fixed concurrency skips the shared adaptive controllers
+        if concurrency == None:
+            reset_controller(upload_controller)
+            reset_controller(download_controller)
+            self.upload_controller = upload_controller
+            self.download_controller = download_controller
+        else:
+            self.upload_controller = AimdController("upload", concurrency, concurrency, concurrency, Config.concurrency_window, Config.concurrency_max_error_rate)
+            self.download_controller = AimdController("download", concurrency, concurrency, concurrency, Config.concurrency_window, Config.concurrency_max_error_rate)
+        self.concurrency = max(self.upload_controller.max_limit, self.download_controller.max_limit)
+        self._executor = None
+        self._holds_lock = False
+
+    async def _call(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _run(self, coro) -> bool:
+        # one extra executor thread so token refreshes never wait behind long running fragment uploads
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency + 1, thread_name_prefix="transfer")
+        cancel_token.start()
+        try:
+            return asyncio.run(coro)
+        except Exception as e:
+            logger.error("problem running async transfer engine")
+            logger.error(e)
+            cancel_token.cancel("transfer engine failed")
+            return False
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            cancel_token.finish()
+
+    ### ------------------------------ TOKEN REFRESH ------------------------------
+
+    async def _start_token_refresh(self):
+        # lock the credentials file and refresh, the same way token_refresh_worker() does.
+        # while another process holds the lock it is keeping the tokens fresh, so like the threaded path the transfers go ahead with
+        # its tokens. that returns None, and _token_refresh_loop() takes over the refreshing once the lock is released
+        if await self._call(_lock_file_check) == True:
+            logger.info("engine - credentials are locked by another process, using the tokens it refreshes")
+            return None
+
+        if not await self._call(_write_to_lock_file, "locked"):
+            logger.error("engine - could not write to lock file")
+            await self._call(_write_to_lock_file, "not locked")
+            return False
+        self._holds_lock = True
+
+        msgcm_obj = await self._call(token_refresh_cycle)
+        if msgcm_obj == False:
+            logger.error("engine - failed to refresh tokens")
+            await self._release_lock()
+            return False
+        return msgcm_obj
+
+    async def _release_lock(self):
+        # only unlock the credentials file if this engine locked it, not while another process is refreshing
+        if not self._holds_lock:
+            return
+        self._holds_lock = False
+        if not await self._call(_write_to_lock_file, "not locked"):
+            logger.error("engine - could not write to lock file to unlock")
+
+    async def _token_refresh_loop(self, msgcm_obj) -> bool:
+        # keep the tokens fresh until cancelled, returns False if they can't be refreshed
+        retry = 0
+        while True:
+            await asyncio.sleep(60)
+            if msgcm_obj == None:
+                # another process had the lock, check whether it has let go so this engine can take over
+                msgcm_obj = await self._start_token_refresh()
+                if msgcm_obj == False:
+                    return False
+                continue
+            await self._call(msgcm_obj.read_tokens)
+            if datetime.now() > msgcm_obj.expires - timedelta(seconds=_token_refresh_get_offset(retry)):
+                check_refresh = await self._call(token_refresh_cycle)
+                if check_refresh == False and retry > 1:
+                    logger.error("engine - failed to refresh tokens")
+                    return False
+                if check_refresh == False:
+                    logger.warning("engine - failed to refresh tokens, need to retry, current retry: {0}".format(retry))
+                    retry = retry + 1
+                else:
+                    msgcm_obj = check_refresh
+                    retry = 0
+
+    async def _with_token_refresh(self, setup) -> bool:
+        # setup() does any one time work, like creating the onedrive directory, and returns the transfers to run or None
+        msgcm_obj = await self._start_token_refresh()
+        if msgcm_obj == False:
+            return False
+
+        token_task = asyncio.ensure_future(self._token_refresh_loop(msgcm_obj))
+        try:
+            transfers = await setup()
+            if transfers == None:
+                return False
+            return await self._all_or_cancel(transfers, token_task)
+        finally:
+            token_task.cancel()
+            await asyncio.gather(token_task, return_exceptions=True)
+            await self._release_lock()
+
+    async def _all_or_cancel(self, coros: list, token_task) -> bool:
+        # run the transfers, the first one that fails, or the token refresh failing, cancels the rest
+        pending = set([asyncio.ensure_future(coro) for coro in coros])
+        result = True
+        while pending and result == True:
+            done, _ = await asyncio.wait(pending | set([token_task]), return_when=asyncio.FIRST_COMPLETED)
+            if token_task in done:
+                result = False
+            for task in done - set([token_task]):
+                pending.discard(task)
+                if task.exception() != None or task.result() != True:
+                    result = False
+
+        if pending:
+            logger.error("engine - cancelling {0} transfer(s)".format(len(pending)))
+            cancel_token.cancel("a transfer failed")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return result
+
+    async def _acquire(self, controller: AimdController):
+        # the limit can change while a transfer waits, so a fixed size semaphore won't do. the controller wakes the waiting transfer
+        # when a slot is released or the limit changes, from whichever thread did it, and the transfer tries for the slot again
+        loop = asyncio.get_running_loop()
+        slot_changed = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(slot_changed.set)
+        # listen before the first try, so a release between the try and the wait isn't missed
+        controller.add_listener(wake)
+        try:
+            while not controller.try_acquire():
+                await slot_changed.wait()
+                slot_changed.clear()
+        finally:
+            controller.remove_listener(wake)
+
+    ### ------------------------------ UPLOADS ------------------------------
+
+    async def _create_dir(self) -> bool:
+        oddm = await self._call(OneDriveDirMgr, MSGraphCredMgr())
+        if oddm.dir_name == None:
+            logger.error("engine - problem retrieving dir_name")
+            return False
+        if not await self._call(oddm.create_dir):
+            logger.error("engine - unable to verify or create onedrive directory")
+            return False
+        return True
+
+    async def _upload_fragments(self, odlu, fpr, targz_file: str) -> bool:
+        # record_fragment() can replan the fragments after the current one, so upload_array is indexed instead of iterated
+        i = 0
+        while i < len(fpr.upload_array):
+            chunks = fpr.upload_array[i]
+            fpr.prefetch_fragments(i, Config.upload_prefetch_depth, int(Config.upload_prefetch_max_mb * 1000000))
+            reader = fpr.range_reader(chunks[1], chunks[0])
+            if reader == None:
+                return False
+
+            start_time = asyncio.get_running_loop().time()
+            upload_response = await self._call(odlu.upload_file_part, str(fpr.file_size), str(chunks[0]), chunks[2], reader)
+            if upload_response != "move-next" and upload_response != "upload-complete" and \
+                    (upload_response == False or (upload_response.status_code != 200 and upload_response.status_code != 201 and upload_response.status_code != 202)):
+                logger.error("engine - {0} upload not successful - attempt to cancel the upload".format(targz_file))
+                await self._call(odlu.cancel_upload_session)
+                return False
+            # a fragment that couldn't be fully hashed leaves the file's hash incomplete, so it can't be verified
+            if not await self._call(reader.finish_hash):
+                logger.error("engine - could not finish the quickxor hash of {0} bytes {1}".format(targz_file, chunks[2]))
+                return False
+            fpr.record_fragment(i, asyncio.get_running_loop().time() - start_time)
+            i = i + 1
+
+        # a file that doesn't match the hash onedrive has for it fails this attempt, so it's uploaded again
+        if fpr.quick_xor != None and not odlu.verify_upload(fpr.upload_hash()):
+            logger.error("engine - {0} does not match the onedrive hash after uploading".format(targz_file))
+            return False
+        return True
+
+    async def _upload_attempt(self, targz_file: str) -> bool:
+        odlu = OneDriveLargeUpload(targz_file)
+        msgcm = MSGraphCredMgr()
+        if await self._call(msgcm.read_tokens) == False:
+            logger.warning("engine - problem reading credentials file")
+            return False
+        if await self._call(odlu.open_upload_session, msgcm.access_token) == False:
+            logger.error("engine - unable to initiate upload session for {0}".format(targz_file))
+            return False
+
+        fpr = FilePartialRead(os.path.join(Config.crypt_tar_gz_dir, targz_file), Config.onedrive_upload_chunk_size_kb, sizer=upload_fragment_sizer(), quick_xor=upload_quick_xor())
+        await self._call(fpr.resume_from, odlu.next_byte)     # hashing the resumed part of the file reads it, so keep it off the event loop
+        try:
+            return await self._upload_fragments(odlu, fpr, targz_file)
+        except asyncio.CancelledError:
+            # don't leave a half finished upload session behind, the cancel token stops the fragment already being sent on its executor thread
+            logger.info("engine - upload of {0} cancelled, cancelling the upload session".format(targz_file))
+            self._executor.submit(odlu.cancel_upload_session)
+            raise
+        finally:
+            fpr.close()
+
+    async def _upload_file(self, targz_file: str) -> bool:
+        await self._acquire(self.upload_controller)
+        try:
+            for attempt in range(1, UPLOAD_FILE_ATTEMPTS + 1):
+                if await self._upload_attempt(targz_file):
+                    logger.info("engine - finished uploading {0} successfully".format(targz_file))
+                    return True
+                logger.warning("engine - upload attempt {0} of {1} failed for {2}".format(attempt, UPLOAD_FILE_ATTEMPTS, targz_file))
+            logger.error("engine - too many upload attempts for {0}".format(targz_file))
+            return False
+        finally:
+            self.upload_controller.release()
+
+    async def _upload_all(self, upload_file_list: list) -> bool:
+        async def setup():
+            if not await self._create_dir():
+                return None
+            return [self._upload_file(targz_file) for targz_file in upload_file_list]
+        return await self._with_token_refresh(setup)
+
+    def upload(self, upload_file_list: list) -> bool:
+        logger.info("starting async upload of {0} files with {1} to {2} at once".format(len(upload_file_list), self.upload_controller.min_limit, self.upload_controller.max_limit))
+        return self._run(self._upload_all(upload_file_list))
+
+    ### ------------------------------ DOWNLOADS ------------------------------
+
+    async def _download_attempt(self, item: dict) -> bool:
+        msgcm = MSGraphCredMgr()
+        if await self._call(msgcm.read_tokens) == False:
+            logger.error("engine - problem reading credentials file")
+            return False
+
+        file_download_info = await self._call(OneDriveGetItemDetails.get_details, item.get("id"), msgcm.access_token)
+        if not file_download_info:
+            return False
+
+        odfdm = OneDriveFileDownloadMgr(file_download_info.get("download_url"), file_download_info.get("size_bytes"), Config.download_chunk_size_b,
+                                        os.path.join(Config.download_dir, item.get("name")), file_download_info.get("sha256hash"), quick_xor_hash=file_download_info.get("quickxorhash"))
+        if await self._call(odfdm.download_file) == True:
+            return True
+
+        # None stops this transfer, and with it the others, the same way a failed removal floods the kill queue for the download threads
+        if await self._call(_remove_download_file, item.get("name")) == None:
+            return None
+        return False
+
+    async def _download_file(self, item: dict) -> bool:
+        await self._acquire(self.download_controller)
+        try:
+            for attempt in range(1, DOWNLOAD_FILE_ATTEMPTS + 1):
+                check_download = await self._download_attempt(item)
+                if check_download == True:
+                    logger.info("engine - finished downloading {0}".format(item.get("name")))
+                    return True
+                if check_download == None:
+                    logger.error("engine - could not clean up the failed download of {0}".format(item.get("name")))
+                    return False
+                logger.warning("engine - download attempt {0} of {1} failed for {2}".format(attempt, DOWNLOAD_FILE_ATTEMPTS, item.get("name")))
+            logger.error("engine - too many download attempts for {0}".format(item.get("name")))
+            return False
+        finally:
+            self.download_controller.release()
+
+    async def _download_all(self) -> bool:
+        async def setup():
+            if await self._call(_make_download_dir) == None:
+                return None
+            file_list = await self._call(DownloadManager._get_download_list)
+            if not file_list:
+                return None
+            logger.info("engine - file list retrieved  list: {0}".format(file_list))
+            return [self._download_file(item) for item in file_list]
+        return await self._with_token_refresh(setup)
+
+    def download(self) -> bool:
+        logger.info("starting async download with {0} to {1} files at once".format(self.download_controller.min_limit, self.download_controller.max_limit))
+        return self._run(self._download_all())
+
+
+def async_upload(upload_file_list: list) -> bool:
+    return AsyncTransferEngine().upload(upload_file_list)
+
+
+def async_download() -> bool:
+    return AsyncTransferEngine().download()
@@ -0,0 +1,68 @@
+import logging, threading
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+class CancelToken:
+    # shared by every thread working on an upload or download. once it is cancelled, every retry wait returns right away
+    # and fragment bodies still being sent or received stop at their next block, so a failed job lets go of its threads,
+    # connections, and scratch files in seconds instead of after the longest retry sleep.
+    # the token can only be cancelled or stopped between start() and finish(), so code running outside a job is never affected.
+    # stop() marks the job as shutting down, whether it worked or not, to wake threads that are only waiting for the end of the job
+    # without cancelling anything still in flight. a cancelled job is stopped too
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._active = False
+        self.reason = None
+
+    def start(self):
+        with self._lock:
+            self._active = True
+            self.reason = None
+            self._event.clear()
+            self._stop_event.clear()
+
+    def finish(self):
+        with self._lock:
+            self._active = False
+            self._event.clear()
+            self._stop_event.clear()
+
+    def stop(self):
+        with self._lock:
+            if self._active:
+                self._stop_event.set()
+
+    def cancel(self, reason: str) -> bool:
+        # returns True if this call cancelled the job
+        with self._lock:
+            if not self._active or self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            self._stop_event.set()
+        logger.info("cancelling transfers ({0})".format(reason))
+        return True
+
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, seconds: float) -> bool:
+        # sleep for up to seconds, returns True if the job was cancelled before or during the wait
+        return self._event.wait(seconds)
+
+    def wait_stopped(self, seconds: float) -> bool:
+        # sleep for up to seconds, returns True if the job was stopped or cancelled before or during the wait
+        return self._stop_event.wait(seconds)
+
+
+# the token shared by every thread
+cancel_token = CancelToken()
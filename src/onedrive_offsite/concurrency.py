@@ -0,0 +1,181 @@
+import logging, threading, math, statistics
+from datetime import datetime
+from onedrive_offsite.config import Config
+from onedrive_offsite.graph_client import graph
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+THROTTLE_STATUS_CODES = [429, 503]
+
+
+class AimdController:
+    # decides how many files can transfer at once, additive increase / multiplicative decrease like tcp congestion control.
+    # every fragment upload or ranged download is recorded, and after each window of them the limit is
+    #   - cut in half when graph throttled us or too many requests failed
+    #   - held when latency has doubled from the best window seen, or when the last increase didn't raise total throughput
+    #   - raised by one otherwise
+    # workers take a slot with acquire() before starting a file and give it back with release() when they are done with it.
+    # code that can't block on the condition, like the asyncio engine, registers a listener instead, it's called whenever a slot may have opened up.
+    # every decision is logged and kept in decisions
+
+    def __init__(self, name: str, start: int, min_limit: int, max_limit: int, window_size: int, max_error_rate: float):
+        self.name = name
+        self.window_size = window_size
+        self.max_error_rate = max_error_rate
+        self._cond = threading.Condition()
+        self._listeners = []
+        self.reset(start, min_limit, max_limit)
+
+    def reset(self, start: int, min_limit: int, max_limit: int):
+        # get ready for a new upload or download
+        with self._cond:
+            self.min_limit = max(1, min_limit)
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = max(self.min_limit, min(start, self.max_limit))
+            self.active = 0
+            self.decisions = []
+            self._samples = []
+            self._last_throughput = None    # total throughput and limit of the last window measured
+            self._last_limit = None
+            self._best_latency = None
+            self._notify()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.active < self.limit:
+                self.active = self.active + 1
+                return True
+            return False
+
+    def acquire(self, timeout: float=None) -> bool:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.active < self.limit, timeout):
+                return False
+            self.active = self.active + 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active = max(0, self.active - 1)
+            self._notify()
+
+    def record(self, status_code: int, seconds: float, transfer_bytes: int):
+        # status_code is None for a request that failed without a response (timeout, connection error)
+        with self._cond:
+            self._samples.append((status_code, seconds, transfer_bytes))
+            if len(self._samples) >= self.window_size:
+                self._decide()
+
+    def _decide(self):
+        samples = self._samples
+        self._samples = []
+
+        throttled = len([sample for sample in samples if sample[0] in THROTTLE_STATUS_CODES])
+        failed = len([sample for sample in samples if sample[0] == None or sample[0] >= 500])
+        succeeded = [sample for sample in samples if sample[0] != None and sample[0] < 400]
+
+        if throttled > 0 or failed / len(samples) > self.max_error_rate:
+            self._set_limit(math.floor(self.limit / 2), "{0} throttled and {1} failed of {2} requests".format(throttled, failed, len(samples)))
+            self._last_throughput = None
+            return
+
+        if not succeeded:
+            self._set_limit(self.limit, "no successful requests to measure")
+            return
+
+        latency = statistics.median([sample[1] for sample in succeeded])
+        per_transfer = sum([sample[2] for sample in succeeded]) / max(sum([sample[1] for sample in succeeded]), 0.001)
+        throughput = per_transfer * min(self.active, self.limit)
+        measured = "latency {0:.2f}s, {1:.1f} MB/s per transfer, {2:.1f} MB/s total".format(latency, per_transfer / 1000000, throughput / 1000000)
+
+        if self._best_latency == None or latency < self._best_latency:
+            self._best_latency = latency
+
+        measured_limit = self.limit
+        if latency > self._best_latency * 2:
+            self._set_limit(self.limit, "latency rising, " + measured)
+        elif self._last_throughput != None and self.limit > self._last_limit and throughput < self._last_throughput * 1.05:
+            self._set_limit(self.limit, "last increase did not raise throughput, " + measured)
+        else:
+            self._set_limit(self.limit + 1, measured)
+        self._last_throughput = throughput
+        self._last_limit = measured_limit
+
+    def _set_limit(self, new_limit: int, reason: str):
+        new_limit = max(self.min_limit, min(new_limit, self.max_limit))
+        self.decisions.append({"time": datetime.now().isoformat(), "from": self.limit, "to": new_limit, "reason": reason})
+        logger.info("{0} concurrency {1} -> {2} ({3})".format(self.name, self.limit, new_limit, reason))
+        self.limit = new_limit
+        self._notify()
+
+    def add_listener(self, callback):
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def _notify(self):
+        # called with the condition held, listeners must only schedule work and return, like loop.call_soon_threadsafe()
+        self._cond.notify_all()
+        for callback in self._listeners:
+            callback()
+
+
+def _new_controller(name: str) -> AimdController:
+    return AimdController(name, Config.transfer_concurrency, Config.transfer_concurrency, Config.transfer_concurrency, Config.concurrency_window, Config.concurrency_max_error_rate)
+
+
+upload_controller = _new_controller("upload")
+download_controller = _new_controller("download")
+
+
+def reset_controller(controller: AimdController, max_workers: int=None):
+    # called before each upload or download, max_workers caps the limit at the number of workers that can take a slot
+    if Config.adaptive_concurrency == True:
+        min_limit = Config.transfer_concurrency_min
+        max_limit = Config.transfer_concurrency_max
+    else:
+        min_limit = Config.transfer_concurrency
+        max_limit = Config.transfer_concurrency
+    if max_workers != None:
+        max_limit = min(max_limit, max_workers)
+        min_limit = min(min_limit, max_limit)
+    controller.reset(Config.transfer_concurrency, min_limit, max_limit)
+
+
+def _controller_for(method: str, headers) -> AimdController:
+    # fragment uploads are PUTs, ranged downloads are GETs with a Range header, everything else isn't a transfer
+    if method == "PUT":
+        return upload_controller
+    if method == "GET" and headers.get("Range") != None:
+        return download_controller
+    return None
+
+
+def _record_response(resp, *args, **kwargs):
+    # only uploads are recorded here, a PUT has sent its whole body by the time the response comes back.
+    # the hooks run before a ranged download's body is read, so OneDriveFileDownloadMgr._download_chunk() records downloads itself
+    try:
+        if resp.request.method == "PUT":
+            upload_controller.record(resp.status_code, resp.elapsed.total_seconds(), int(resp.request.headers.get("Content-Length", 0)))
+    except Exception as e:
+        logger.warning("problem recording transfer for concurrency control")
+        logger.warning(e)
+
+
+def _record_error(method: str, headers, exception):
+    controller = _controller_for(method, headers)
+    if controller != None:
+        controller.record(None, 0, 0)
+
+
+graph.add_response_hook(_record_response)
+graph.add_error_hook(_record_error)
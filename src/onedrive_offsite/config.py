@@ -14,8 +14,34 @@ class Config:
     else:
         onedrive_upload_default_filename = "onedrive_offsite_backup.tar.gz"
 
-    ### UPLOAD THEADING ###
-    upload_threads = 3
+    ### TRANSFER ENGINE ###
+    # "threads" (the default) uploads and downloads with five worker threads that poll queues.
+    # "asyncio" schedules the transfers from one event loop with up to transfer_concurrency files moving at once, see async_engine.py.
+    # the requests themselves still block, so each file moving holds a thread either way
+    if os.environ.get("ONEDRIVE_TRANSFER_ENGINE") == "asyncio":
+        transfer_engine = "asyncio"
+    else:
+        transfer_engine = "threads"
+    if os.environ.get("ONEDRIVE_TRANSFER_CONCURRENCY") != None:
+        transfer_concurrency = int(os.environ.get("ONEDRIVE_TRANSFER_CONCURRENCY"))
+    else:
+        transfer_concurrency = 5
+
+    ### ADAPTIVE CONCURRENCY ###
+    # when enabled, the number of files uploading or downloading at once starts at transfer_concurrency, goes up by one while adding
+    # transfers keeps raising throughput without raising latency, and is cut in half when graph throttles (429/503) or fails (5xx, timeouts).
+    # it stays between transfer_concurrency_min and transfer_concurrency_max, the threaded engine never goes above its five workers
+    if os.environ.get("ONEDRIVE_ADAPTIVE_CONCURRENCY") == "true":
+        adaptive_concurrency = True
+    else:
+        adaptive_concurrency = False
+    transfer_concurrency_min = 1
+    if os.environ.get("ONEDRIVE_TRANSFER_CONCURRENCY_MAX") != None:
+        transfer_concurrency_max = int(os.environ.get("ONEDRIVE_TRANSFER_CONCURRENCY_MAX"))
+    else:
+        transfer_concurrency_max = 16
+    concurrency_window = 20             # fragment uploads or ranged downloads measured between each decision
+    concurrency_max_error_rate = 0.05   # cut concurrency when more than 5% of the window failed
 
     ### WHERE TO FIND FILES AND FLASK DEBUG ###
     if os.environ.get("ONEDRIVE_ENV") == "dev":
@@ -43,13 +69,118 @@ class Config:
     crypt_tar_gz_path = os.path.join(var_basedir, onedrive_upload_default_filename)
     crypt_chunk_size_mb = 30
 
+    ### CHUNK FORMAT ###
+    # "aes-gcm" writes each encrypted chunk as binary AES-256-GCM ciphertext with a small versioned header, about the same size as the plain data
+    # "fernet" writes base64 fernet tokens, which are about 33% larger than the data they hold
+    # restores detect the format of each chunk, so backups made in either format can still be restored
+    if os.environ.get("ONEDRIVE_CHUNK_FORMAT") == "fernet":
+        crypt_chunk_format = "fernet"
+    else:
+        crypt_chunk_format = "aes-gcm"
+
+    ### ZERO RUNS ###
+    # chunks that are all zeros, common in uncompressed vma and raw disk images, are stored as a small record of their length
+    # instead of being encrypted and uploaded, restores leave them as sparse holes. Chunks are checked 1 MiB at a time, so a chunk that
+    # is only partly zeros leaves out its zero blocks. Streaming uploads always encrypt them.
+    if os.environ.get("ONEDRIVE_ELIDE_ZEROS") == "false":
+        crypt_elide_zeros = False
+    else:
+        crypt_elide_zeros = True
+
+    ### COMPRESSION ###
+    # "auto" test compresses samples of the backup file and only compresses chunks before they are encrypted when the samples shrink,
+    # so an uncompressed vma or tar gets smaller and a vma.zst is left alone. "on" always compresses, "off" (the default) never does.
+    # zstd is used when the zstandard package is installed, otherwise zlib. Each chunk records whether it was compressed for the restore.
+    # streaming uploads never compress since they need to know each part's size before it is built
+    if os.environ.get("ONEDRIVE_COMPRESSION") == "auto" or os.environ.get("ONEDRIVE_COMPRESSION") == "on":
+        crypt_compression = os.environ.get("ONEDRIVE_COMPRESSION")
+    else:
+        crypt_compression = "off"
+    crypt_compression_max_ratio = 0.9   # samples have to compress to 90% of their size or less for "auto" to turn compression on
+    crypt_zstd_level = 3
+
+    ### CONTAINER MODE ###
+    # "tar.gz" gzips the encrypted chunks. The ciphertext itself can't be compressed, but fernet tokens are base64 text,
+    # so gzip wins back most of the 33% base64 overhead at the cost of a cpu core.
+    # "tar" stores the encrypted chunks in plain tar files and skips that cpu time. Restores can read either format.
+    # when not set, binary aes-gcm chunks default to "tar" since gzip has nothing left to win back, fernet chunks default to "tar.gz"
+    # streaming uploads always use "tar" since they need to know each part's size before it is built
+    if os.environ.get("ONEDRIVE_CONTAINER_MODE") == "tar":
+        crypt_container_mode = "tar"
+    elif os.environ.get("ONEDRIVE_CONTAINER_MODE") == "tar.gz" or crypt_chunk_format == "fernet":
+        crypt_container_mode = "tar.gz"
+    else:
+        crypt_container_mode = "tar"
+
+    ### ENCRYPTION WORKERS ###
+    # number of processes used to encrypt chunks in parallel, and to verify and decrypt them in parallel during a restore
+    # 1 encrypts or decrypts one chunk at a time in the current process
+    if os.environ.get("ONEDRIVE_CRYPT_WORKERS") != None:
+        crypt_workers = int(os.environ.get("ONEDRIVE_CRYPT_WORKERS"))
+    else:
+        crypt_workers = 1
+    crypt_max_in_flight = crypt_workers * 2     # max chunks read and waiting on encryption or decryption at once, each one holds about 2.3 x crypt_chunk_size_mb of memory
+
+    ### UPLOAD READ-AHEAD ###
+    # while a fragment is uploading, the next upload_prefetch_depth fragments are read into the os page cache,
+    # so the disk reads overlap the network sends. upload_prefetch_max_mb caps how much each upload worker reads ahead, 0 turns read-ahead off
+    if os.environ.get("ONEDRIVE_UPLOAD_PREFETCH_DEPTH") != None:
+        upload_prefetch_depth = int(os.environ.get("ONEDRIVE_UPLOAD_PREFETCH_DEPTH"))
+    else:
+        upload_prefetch_depth = 1
+    upload_prefetch_max_mb = 64
+
+    ### STREAMING UPLOAD ###
+    # when enabled, the backup file is read once and encrypted tar parts are streamed straight into onedrive upload sessions
+    # instead of writing encrypted chunks and tar.gz files to disk first.
+    # this trades speed for disk space: parts are uploaded one at a time over a single upload session, where the staged upload runs 5
+    # upload workers at once, so on a fast connection streaming takes longer. the backup's sha256 is fed chunk by chunk in file order,
+    # and a part's fragments have to be sent in order, so a second part can't start until the one before it has been read
+    if os.environ.get("ONEDRIVE_STREAM_UPLOAD") == "true":
+        stream_upload = True
+    else:
+        stream_upload = False
+    stream_queue_depth = 4          # max upload fragments held in memory between the encrypting thread and the uploading thread
+    stream_part_retries = 5         # how many times to rebuild and resend a streamed part before giving up
+
+    ### DEDUP ###
+    # when enabled, the backup file is cut into content defined chunks and only the chunks that are not already in onedrive get uploaded.
+    # each backup directory gets an encrypted manifest listing every chunk of the backup file and the directory and tar part holding it.
+    # chunks are only reused from backups uploaded in the last dedup_max_age_days days, so keep older backup directories at least that long
+    if os.environ.get("ONEDRIVE_DEDUP") == "true":
+        dedup = True
+    else:
+        dedup = False
+    dedup_index_path = os.path.join(etc_basedir, "dedup_index.json")   # chunks that are already in onedrive, keyed by chunk id
+    dedup_min_chunk_mb = 1          # content defined chunks are between dedup_min_chunk_mb and crypt_chunk_size_mb
+    dedup_max_age_days = 30
+
+    ### UPLOAD SESSION JOURNAL ###
+    # upload sessions still in progress are recorded with the last byte onedrive confirmed, so uploading the same tar files again
+    # after a restart (onedrive-offsite-upload-backup-file) carries on from that byte instead of starting each part over.
+    # a recorded session that expires within upload_session_renew_minutes is replaced with a new session instead of resumed
+    upload_journal_path = os.path.join(etc_basedir, "upload_journal.json")
+    upload_session_renew_minutes = 60
+
     cred_mgr_lock_path = os.path.join(etc_basedir, "cred_mgr_lock")
 
     ### DOWNLOAD CONFIG
     download_info_path = os.path.join(etc_basedir, "download_info.json")
     download_dir = os.path.join(var_basedir, "download/")
     download_chunk_size_b = 10485760
+    # how many download_chunk_size_b chunks of one file download at once. Each file is preallocated and the chunks are written straight
+    # to their place in it, so a restore with only one or two large parts can still fill a fast link. 1 downloads one chunk at a time
+    if os.environ.get("ONEDRIVE_DOWNLOAD_RANGES") != None:
+        download_ranges_per_file = int(os.environ.get("ONEDRIVE_DOWNLOAD_RANGES"))
+    else:
+        download_ranges_per_file = 1
     extract_dir = os.path.join(var_basedir, "extracted_crypt")
+    # when enabled, downloaded parts are decrypted straight from the tar stream into the restored file and hashed as they are written,
+    # instead of being extracted to extract_dir, decrypted, and then read one more time to check the hash
+    if os.environ.get("ONEDRIVE_STREAM_RESTORE") == "true":
+        stream_restore = True
+    else:
+        stream_restore = False
 
     ### FILE SIZES ###
     if os.environ.get("TESTING_ENV") == "test" or os.environ.get("TESTING_ENV") == "test-dev" or os.environ.get("TESTING_ENV") == "test-live":
@@ -60,6 +191,42 @@ class Config:
         crypt_tar_gz_max_size_mb = 10000     # note: microsoft will only allow you upload a max file size of 268 GB.
         onedrive_upload_chunk_size_kb = 10485.76 # per microsoft's documentation, the optimal fragment size for high speed internet connections is 10,485,760 bytes
 
+    ### ADAPTIVE FRAGMENT SIZE ###
+    # when enabled, each upload session starts with onedrive_upload_chunk_size_kb fragments and then sizes the rest so each one takes about
+    # upload_fragment_target_seconds at the speed seen so far. sizes stay a multiple of 320 KiB between upload_fragment_min_kb and upload_fragment_max_kb.
+    # streaming uploads always use onedrive_upload_chunk_size_kb
+    if os.environ.get("ONEDRIVE_ADAPTIVE_FRAGMENT_SIZE") == "true":
+        adaptive_fragment_size = True
+    else:
+        adaptive_fragment_size = False
+    upload_fragment_min_kb = 327.68         # 320 KiB, the smallest fragment onedrive accepts in a multi fragment upload
+    upload_fragment_max_kb = 62586.88       # 191 x 320 KiB, each request has to be less than 60 MiB
+    upload_fragment_target_seconds = 10
+
+    ### UPLOAD VERIFICATION ###
+    # when enabled, the quickXorHash of each file is calculated from the fragments as they're sent and compared with the hash onedrive reports
+    # for the finished upload, a mismatch fails the upload so it's retried. streaming uploads aren't verified
+    if os.environ.get("ONEDRIVE_UPLOAD_VERIFY") == "true":
+        upload_verify_hash = True
+    else:
+        upload_verify_hash = False
+
+    ### RETRY POLICY ###
+    # a failed graph call waits before retrying, starting at a few seconds for each kind of call and growing retry_backoff_multiplier times
+    # after each failure, up to retry_max_seconds. up to retry_jitter of each wait is taken off at random.
+    # a Retry-After header from graph replaces the wait, up to retry_after_max_seconds, and a throttled (429) call retries up to retry_throttle_max times
+    retry_backoff_multiplier = 4
+    if os.environ.get("ONEDRIVE_RETRY_BACKOFF_MULTIPLIER") != None:
+        retry_backoff_multiplier = float(os.environ.get("ONEDRIVE_RETRY_BACKOFF_MULTIPLIER"))
+    retry_max_seconds = 1800
+    if os.environ.get("ONEDRIVE_RETRY_MAX_SECONDS") != None:
+        retry_max_seconds = float(os.environ.get("ONEDRIVE_RETRY_MAX_SECONDS"))
+    retry_jitter = 0.5
+    retry_after_max_seconds = 3600
+    retry_throttle_max = 8
+    if os.environ.get("ONEDRIVE_RETRY_THROTTLE_MAX") != None:
+        retry_throttle_max = int(os.environ.get("ONEDRIVE_RETRY_THROTTLE_MAX"))
+
     ### --- API PARAMETERS --- ###
     # some of these are used for automated testing with a test api not included with this repo
 
@@ -82,6 +249,10 @@ class Config:
                                     # 10 seconds or reading/sending data takes longer than 60 seconds. The typical upload request pushes
                                     # 10 MB to the onedrive api at a time. 60 seconds should be plenty for that to complete.
 
+    # connections are kept alive and shared by every thread, see graph_client.py
+    http_pool_connections = 4       # number of hosts to keep connection pools for (graph api, token api, upload and download urls)
+    http_pool_maxsize = max(10, transfer_concurrency, transfer_concurrency_max) * max(1, download_ranges_per_file) + 1   # max connections kept open per host, should be at least the number of concurrent requests
+
     
     ### --- LOG PARAMETERS --- ###
     LOG_PATH = os.path.join(etc_basedir, "onedrive-offsite.log")
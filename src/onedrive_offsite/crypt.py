@@ -1,8 +1,19 @@
-import os, math, logging, hashlib, threading
+import os, math, zlib, base64, tarfile, logging, hashlib, threading, multiprocessing, collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from onedrive_offsite.utils import leading_zeros
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from onedrive_offsite.config import Config
 
+# zstd is optional, chunks are compressed with zlib when it isn't installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Logging setup
 logger = logging.getLogger(__name__)
 logger.setLevel(Config.LOG_LEVEL)
@@ -10,9 +21,376 @@ logger.addHandler(Config.FILE_HANDLER)
 logger.addHandler(Config.STOUT_HANDLER)
 
 
+class AeadChunkCipher:
+    # binary chunk format: magic (4 bytes) + format version (1 byte) + algorithm id (1 byte) + nonce (12 bytes) + AES-256-GCM ciphertext + tag (16 bytes)
+    # the header is passed in as associated data, so the version, algorithm and nonce are covered by the tag too.
+    # a record behind a marker (a zero run or a compressed chunk) adds that marker to the associated data as well,
+    # so a marker that is added, removed or swapped fails the tag check instead of changing how the chunk is restored.
+    # the AES key is derived from the existing fernet key file with HKDF, so no new key has to be generated or stored.
+    MAGIC = b"ODOC"
+    VERSION = 1
+    ALG_AES_256_GCM = 1
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    HEADER_SIZE = len(MAGIC) + 2 + NONCE_SIZE
+    HKDF_INFO = b"onedrive-offsite chunk aes-256-gcm v1"
+
+    def __init__(self, key: bytes):
+        aes_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=self.HKDF_INFO).derive(base64.urlsafe_b64decode(key))
+        self.aesgcm = AESGCM(aes_key)
+
+    @classmethod
+    def is_aead_chunk(cls, data: bytes) -> bool:
+        # fernet tokens always start with "gAAAAA" (base64 of the 0x80 version byte), so the magic can't be mistaken for one
+        return data[:len(cls.MAGIC)] == cls.MAGIC
+
+    def encrypt(self, plain_bytes: bytes, record_type: bytes=b"") -> bytes:
+        # a random 96 bit nonce per chunk, we would need billions of chunks under one key before a repeat is a concern
+        nonce = os.urandom(self.NONCE_SIZE)
+        header = self.MAGIC + bytes([self.VERSION, self.ALG_AES_256_GCM]) + nonce
+        return header + self.aesgcm.encrypt(nonce, plain_bytes, header + record_type)
+
+    def decrypt(self, data: bytes, record_type: bytes=b"") -> bytes:
+        header = bytes(data[:self.HEADER_SIZE])
+        if len(data) < self.HEADER_SIZE + self.TAG_SIZE or not self.is_aead_chunk(data):
+            raise InvalidTag("not an aes-gcm encrypted chunk")
+        if header[len(self.MAGIC)] != self.VERSION or header[len(self.MAGIC) + 1] != self.ALG_AES_256_GCM:
+            raise InvalidTag("unsupported chunk format version {0} or algorithm {1}".format(header[len(self.MAGIC)], header[len(self.MAGIC) + 1]))
+        return self.aesgcm.decrypt(header[len(self.MAGIC) + 2:], memoryview(data)[self.HEADER_SIZE:], header + record_type)
+
+
+class FernetChunkCipher(Fernet):
+    # the original fernet chunk format. fernet has no associated data, so a record behind a marker is encrypted with a fernet key
+    # derived from the key file for that marker instead. a marker that is added, removed or swapped then fails the hmac check.
+    # plain chunks still use the key file's own fernet key, so older backups restore as they always have
+    HKDF_INFO = b"onedrive-offsite fernet record v1 "
+
+    def __init__(self, key: bytes):
+        super().__init__(key)
+        self.chunk_key = key
+        self.record_ciphers = {}
+
+    def record_cipher(self, record_type: bytes) -> Fernet:
+        if record_type not in self.record_ciphers:
+            record_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=self.HKDF_INFO + record_type).derive(base64.urlsafe_b64decode(self.chunk_key))
+            self.record_ciphers[record_type] = Fernet(base64.urlsafe_b64encode(record_key))
+        return self.record_ciphers[record_type]
+
+    def encrypt(self, plain_bytes: bytes, record_type: bytes=b"") -> bytes:
+        if record_type == b"":
+            return super().encrypt(plain_bytes)
+        return self.record_cipher(record_type).encrypt(plain_bytes)
+
+    def decrypt(self, token: bytes, record_type: bytes=b"") -> bytes:
+        if record_type == b"":
+            return super().decrypt(token)
+        return self.record_cipher(record_type).decrypt(token)
+
+
+def chunk_cipher(key: bytes, chunk_format: str):
+    # both cipher objects expose encrypt() and decrypt(), each taking the record's marker as record_type
+    if chunk_format == "fernet":
+        return FernetChunkCipher(key)
+    return AeadChunkCipher(key)
+
+
+# an all zero chunk is stored as this marker followed by its length encrypted with the chunk cipher. the marker is bound to the
+# encrypted length as its record_type, so a real chunk can't be passed off as a zero run, or a zero run as a real chunk
+ZERO_RUN_MAGIC = b"ODZ0"
+
+
+class ZeroRun(int):
+    # returned by decrypt_chunk() in place of an all zero chunk, the value is the number of zero bytes
+    pass
+
+
+# chunks are checked for zeros a block at a time, so a run of zeros that doesn't fill a whole chunk (free space in a disk image
+# rarely lines up with our 30 MB chunks) is still left out. 1 MiB is a multiple of the block and cluster sizes disk images use
+ZERO_BLOCK_BYTES = 1048576
+# one shared block of zeros, compared against in place to find zero blocks and fed to the hash for each zero run on restore
+_ZERO_BLOCK = bytes(ZERO_BLOCK_BYTES)
+
+
+def zero_blocks(plain_bytes: bytes) -> list:
+    # True for each ZERO_BLOCK_BYTES block of the chunk that is all zeros. startswith() compares the shared zero block in place
+    # with memcmp, which stops at the first non zero byte, so the chunk isn't copied and real data is rejected right away
+    zero_view = memoryview(_ZERO_BLOCK)
+    return [plain_bytes.startswith(zero_view[:min(ZERO_BLOCK_BYTES, len(plain_bytes) - start)], start) for start in range(0, len(plain_bytes), ZERO_BLOCK_BYTES)]
+
+
+def is_zero_block(plain_bytes: bytes) -> bool:
+    blocks = zero_blocks(plain_bytes)
+    return len(blocks) > 0 and all(blocks)
+
+
+# a chunk with some all zero blocks is stored as this marker followed by a record holding a map of its zero blocks and the bytes of the
+# rest, so only the blocks with data are encrypted and uploaded. the marker is bound to the record as its record_type, like the others
+ZERO_MAP_MAGIC = b"ODZM"
+_ZERO_MAP_CODECS = {None: 0, "zlib": 1, "zstd": 2}
+
+
+class SparseChunk(list):
+    # returned by decrypt_chunk() for a chunk stored with a zero map, the pieces of the chunk in order, bytes for the blocks with data
+    # and a ZeroRun for each run of zero blocks
+    pass
+
+
+def _hash_pieces(sha256_hash, decrypted):
+    # zero runs are hashed from the shared zero block a block at a time, rather than allocating a buffer of zeros as large as the run
+    if isinstance(decrypted, ZeroRun):
+        decrypted = [decrypted]
+    zero_view = memoryview(_ZERO_BLOCK)
+    for piece in decrypted:
+        if isinstance(piece, ZeroRun):
+            for start in range(0, int(piece), ZERO_BLOCK_BYTES):
+                sha256_hash.update(zero_view[:min(ZERO_BLOCK_BYTES, int(piece) - start)])
+        else:
+            sha256_hash.update(piece)
+
+
+# chunks that were compressed before they were encrypted start with one of these markers, so the restore knows to decompress them.
+# like the zero run marker, each one is bound to the encrypted record as its record_type, so it can't be swapped or stripped
+COMPRESSION_MAGIC = {"zlib": b"ODCZ", "zstd": b"ODCS"}
+
+
+def choose_compression(file_path: str, mode: str, sample_count: int=16, sample_size_bytes: int=65536) -> str:
+    # returns the codec to compress chunks with before they are encrypted, or None to leave them as they are
+    # in "auto" mode, blocks spread across the file are test compressed, high entropy files like vma.zst barely shrink and are skipped
+    if mode != "on" and mode != "auto":
+        return None
+
+    if zstandard != None:
+        codec = "zstd"
+    else:
+        codec = "zlib"
+
+    if mode == "on":
+        logger.info("compressing chunks with {0} before they are encrypted".format(codec))
+        return codec
+
+    try:
+        file_size = os.path.getsize(file_path)
+        sampled_bytes = 0
+        compressed_bytes = 0
+        with open(file_path, "rb") as sample_file:
+            for sample_num in range(sample_count):
+                sample_file.seek(int(file_size * sample_num / sample_count))
+                sample = sample_file.read(sample_size_bytes)
+                sampled_bytes = sampled_bytes + len(sample)
+                compressed_bytes = compressed_bytes + len(zlib.compress(sample, 1))
+    except Exception as e:
+        logger.warning("problem sampling {0} for compression, chunks will not be compressed".format(file_path))
+        logger.warning(e)
+        return None
+
+    if sampled_bytes == 0 or compressed_bytes / sampled_bytes > Config.crypt_compression_max_ratio:
+        logger.info("samples of {0} don't compress well, chunks will not be compressed".format(file_path))
+        return None
+
+    logger.info("samples of {0} compress to {1:.0%}, compressing chunks with {2} before they are encrypted".format(file_path, compressed_bytes / sampled_bytes, codec))
+    return codec
+
+
+_zstd_compressor = None
+
+def compress_block(codec: str, plain_bytes: bytes) -> bytes:
+    global _zstd_compressor
+    if codec == "zstd":
+        if _zstd_compressor == None:
+            # with a single encryption worker, let zstd use every core, otherwise the worker processes already keep them busy
+            _zstd_compressor = zstandard.ZstdCompressor(level=Config.crypt_zstd_level, threads=-1 if Config.crypt_workers <= 1 else 0)
+        return _zstd_compressor.compress(plain_bytes)
+    return zlib.compress(plain_bytes, 1)
+
+
+def decompress_block(codec: str, compressed_bytes: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard == None:
+            raise ImportError("this chunk was compressed with zstd, install the zstandard package to restore it")
+        return zstandard.ZstdDecompressor().decompress(compressed_bytes)
+    return zlib.decompress(compressed_bytes)
+
+
+def _zero_map_record(plain_bytes: bytes, blocks: list, compression: str) -> bytes:
+    # chunk length (8 bytes) + block size (4 bytes) + codec id (1 byte) + one bit per block, set for the zero blocks + the other blocks' bytes
+    zero_map = bytearray((len(blocks) + 7) // 8)
+    plain_view = memoryview(plain_bytes)
+    data_blocks = []
+    for block_num, is_zero in enumerate(blocks):
+        if is_zero:
+            zero_map[block_num // 8] |= 1 << (block_num % 8)
+        else:
+            data_blocks.append(plain_view[block_num * ZERO_BLOCK_BYTES:(block_num + 1) * ZERO_BLOCK_BYTES])
+    data = b"".join(data_blocks)
+
+    codec = None
+    if compression != None:
+        compressed = compress_block(compression, data)
+        if len(compressed) < len(data) * 0.97:
+            codec = compression
+            data = compressed
+
+    header = len(plain_bytes).to_bytes(8, "big") + ZERO_BLOCK_BYTES.to_bytes(4, "big") + bytes([_ZERO_MAP_CODECS[codec]])
+    return b"".join([header, zero_map, data])
+
+
+def _read_zero_map(record: bytes) -> SparseChunk:
+    chunk_size = int.from_bytes(record[0:8], "big")
+    block_size = int.from_bytes(record[8:12], "big")
+    codec = {codec_id: codec for codec, codec_id in _ZERO_MAP_CODECS.items()}[record[12]]
+    block_count = (chunk_size + block_size - 1) // block_size
+    zero_map = record[13:13 + (block_count + 7) // 8]
+    data = memoryview(record)[13 + len(zero_map):]
+    if codec != None:
+        data = memoryview(decompress_block(codec, data))
+
+    pieces = SparseChunk()
+    data_offset = 0
+    run_start = 0       # start of the current run of data blocks in data
+    for block_num in range(block_count):
+        size = min(block_size, chunk_size - block_num * block_size)
+        if zero_map[block_num // 8] >> (block_num % 8) & 1:
+            # blocks with data next to each other are handed back as one piece, copied out as bytes so the chunk can be
+            # returned from a decryption worker process
+            if data_offset > run_start:
+                pieces.append(bytes(data[run_start:data_offset]))
+            run_start = data_offset
+            if len(pieces) > 0 and isinstance(pieces[-1], ZeroRun):
+                pieces[-1] = ZeroRun(pieces[-1] + size)
+            else:
+                pieces.append(ZeroRun(size))
+        else:
+            data_offset = data_offset + size
+    if data_offset > run_start:
+        pieces.append(bytes(data[run_start:data_offset]))
+    if data_offset != len(data):
+        raise ValueError("zero map record holds {0} bytes of data, the map accounts for {1}".format(len(data), data_offset))
+    return pieces
+
+
+def encrypt_chunk(cipher, plain_bytes: bytes, elide_zeros: bool, compression: str=None) -> bytes:
+    if elide_zeros:
+        blocks = zero_blocks(plain_bytes)
+        if len(blocks) > 0 and all(blocks):
+            return ZERO_RUN_MAGIC + cipher.encrypt(len(plain_bytes).to_bytes(8, "big"), ZERO_RUN_MAGIC)
+        if any(blocks):
+            return ZERO_MAP_MAGIC + cipher.encrypt(_zero_map_record(plain_bytes, blocks, compression), ZERO_MAP_MAGIC)
+
+    if compression != None:
+        compressed = compress_block(compression, plain_bytes)
+        # only keep the compressed copy when it saves at least 3%, parts of the file that were already compressed are stored as they are
+        if len(compressed) < len(plain_bytes) * 0.97:
+            return COMPRESSION_MAGIC[compression] + cipher.encrypt(compressed, COMPRESSION_MAGIC[compression])
+
+    return cipher.encrypt(plain_bytes)
+
+
+def _decrypt_record(data: bytes, fernet: FernetChunkCipher, aead: AeadChunkCipher, record_type: bytes=b"") -> bytes:
+    # older backups are made of fernet tokens, newer ones use the binary aes-gcm format, check each chunk
+    if AeadChunkCipher.is_aead_chunk(data):
+        return aead.decrypt(data, record_type)
+    return fernet.decrypt(data, record_type)
+
+
+def decrypt_chunk(data: bytes, fernet: FernetChunkCipher, aead: AeadChunkCipher):
+    # returns the decrypted bytes, a ZeroRun if the chunk was all zeros, or a SparseChunk if some of its blocks were
+    if data[:len(ZERO_RUN_MAGIC)] == ZERO_RUN_MAGIC:
+        return ZeroRun(int.from_bytes(_decrypt_record(data[len(ZERO_RUN_MAGIC):], fernet, aead, ZERO_RUN_MAGIC), "big"))
+    if data[:len(ZERO_MAP_MAGIC)] == ZERO_MAP_MAGIC:
+        return _read_zero_map(_decrypt_record(data[len(ZERO_MAP_MAGIC):], fernet, aead, ZERO_MAP_MAGIC))
+    for codec, magic in COMPRESSION_MAGIC.items():
+        if data[:len(magic)] == magic:
+            return decompress_block(codec, _decrypt_record(data[len(magic):], fernet, aead, magic))
+    return _decrypt_record(data, fernet, aead)
+
+
+def decrypted_size(decrypted) -> int:
+    if isinstance(decrypted, ZeroRun):
+        return int(decrypted)
+    if isinstance(decrypted, SparseChunk):
+        return sum(decrypted_size(piece) for piece in decrypted)
+    return len(decrypted)
+
+
+def write_decrypted(combined_file, decrypted, chunk_hash=None, chunk_num: int=None):
+    # zero runs are skipped over with seek and left as a sparse hole, call truncate() on the file once every chunk is written
+    # so a hole at the very end still sets the file size
+    if isinstance(decrypted, ZeroRun) or isinstance(decrypted, SparseChunk):
+        for piece in ([decrypted] if isinstance(decrypted, ZeroRun) else decrypted):
+            if isinstance(piece, ZeroRun):
+                combined_file.seek(int(piece), os.SEEK_CUR)
+            else:
+                combined_file.write(piece)
+    else:
+        combined_file.write(decrypted)
+    if chunk_hash != None:
+        chunk_hash.update(chunk_num, decrypted)
+
+
+# --- process pool helpers for parallel encryption and decryption, these have to live at the module level so they can be pickled ---
+_pool_cipher = None
+_pool_fernet = None
+_pool_aead = None
+
+_pool_elide_zeros = False
+_pool_compression = None
+
+def _pool_init(key, chunk_format, elide_zeros=False, compression=None):
+    global _pool_cipher, _pool_elide_zeros, _pool_compression
+    _pool_cipher = chunk_cipher(key, chunk_format)
+    _pool_elide_zeros = elide_zeros
+    _pool_compression = compression
+
+def _pool_encrypt(plain_bytes: bytes) -> bytes:
+    return encrypt_chunk(_pool_cipher, plain_bytes, _pool_elide_zeros, _pool_compression)
+
+def _pool_decrypt_init(key):
+    global _pool_fernet, _pool_aead
+    _pool_fernet = FernetChunkCipher(key)
+    _pool_aead = AeadChunkCipher(key)
+
+def _pool_decrypt(data: bytes) -> bytes:
+    return decrypt_chunk(data, _pool_fernet, _pool_aead)
+
+def _ordered_pool_map(pool_func, items, workers: int, max_in_flight: int, initializer, initargs: tuple):
+    # items yields (label, argument), runs pool_func(argument) in a process pool and yields (label, result) in the same order as items
+    # at most max_in_flight items are pulled from items and held in memory at once
+    if max_in_flight == None or max_in_flight < workers:
+        max_in_flight = workers * 2
+
+    item_iter = iter(items)
+    in_flight = collections.deque()
+    # spawn, rather than fork, because we may be running inside one of several threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=initializer, initargs=initargs) as pool:
+        keep_reading = True
+        while keep_reading or len(in_flight) > 0:
+            while keep_reading and len(in_flight) < max_in_flight:
+                try:
+                    label, argument = next(item_iter)
+                except StopIteration:
+                    keep_reading = False
+                    break
+                in_flight.append((label, pool.submit(pool_func, argument)))
+
+            if len(in_flight) > 0:
+                # always wait on the oldest item so results come out in the same order they were read
+                label, future = in_flight.popleft()
+                yield label, future.result()
+
+
 class Crypt:
-    def __init__(self, key_path):
+    def __init__(self, key_path, chunk_format=None, elide_zeros=None, compression=None):
         self.key_path = key_path
+        # new chunks are written in this format, decrypting detects the format of each chunk
+        if chunk_format == None:
+            chunk_format = Config.crypt_chunk_format
+        self.chunk_format = chunk_format
+        # all zero chunks are stored as a small zero run record instead of being encrypted
+        if elide_zeros == None:
+            elide_zeros = Config.crypt_elide_zeros
+        self.elide_zeros = elide_zeros
+        # codec used to compress chunks before they are encrypted, set from choose_compression() for each backup
+        self.compression = compression
 
     def gen_key(self):
         try:
@@ -51,7 +429,105 @@ class Crypt:
             return True
         return False
 
-    def chunk_encrypt(self, file_to_encrypt, dir_for_chunks, chunk_size_mb):
+    @staticmethod
+    def max_chunk_count(file_size: int, chunk_size_bytes: int) -> int:
+        # the largest number with the same count of digits as the number of chunks we will create, used for leading zeros in chunk file names
+        return int(math.pow(10, math.ceil(math.log10(file_size/chunk_size_bytes + 1))) - 1)
+
+    @staticmethod
+    def chunk_name(chunk_num: int, max_file_count: int) -> str:
+        return leading_zeros(chunk_num, max_file_count) + str(chunk_num) + '_backup.crypt'
+
+    @staticmethod
+    def encrypted_chunk_size(plain_size_bytes: int, chunk_format: str=None) -> int:
+        if chunk_format == None:
+            chunk_format = Config.crypt_chunk_format
+        if chunk_format != "fernet":
+            # the aes-gcm chunk is the same size as the plain data plus the header and tag
+            return AeadChunkCipher.HEADER_SIZE + plain_size_bytes + AeadChunkCipher.TAG_SIZE
+
+        # a fernet token is version (1 byte) + timestamp (8 bytes) + iv (16 bytes) + AES-CBC ciphertext padded up to the next
+        # 16 byte block + hmac (32 bytes), all base64url encoded. This lets us know the size of a chunk before we encrypt it.
+        raw_size = 57 + (plain_size_bytes // 16 + 1) * 16
+        return 4 * math.ceil(raw_size / 3)
+
+    @staticmethod
+    def _read_blocks(backup_file, chunk_size_bytes: int, chunk_count: int=None):
+        # yield (plain bytes, plain bytes) so blocks can be labeled with their own contents in _ordered_pool_map()
+        blocks_read = 0
+        while chunk_count == None or blocks_read < chunk_count:
+            plain_bytes = backup_file.read(chunk_size_bytes)
+            if not plain_bytes:
+                break
+            blocks_read = blocks_read + 1
+            yield plain_bytes, plain_bytes
+
+    def _encrypt_blocks(self, backup_file, chunk_size_bytes: int, chunk_count: int=None, workers: int=1, max_in_flight: int=None):
+        # read blocks from an open file and yield (plain bytes, encrypted bytes) in file order
+        # with more than one worker, blocks are encrypted in a process pool with at most max_in_flight blocks read ahead
+        yield from self.encrypt_chunks(self._read_blocks(backup_file, chunk_size_bytes, chunk_count), workers, max_in_flight)
+
+    def encrypt_chunks(self, chunks, workers: int=1, max_in_flight: int=None):
+        # chunks yields (label, plain bytes), yields (label, encrypted bytes) in the same order
+        # with more than one worker, chunks are encrypted in a process pool with at most max_in_flight chunks read ahead
+        if workers <= 1:
+            cipher = chunk_cipher(self.key, self.chunk_format)
+            for label, plain_bytes in chunks:
+                yield label, encrypt_chunk(cipher, plain_bytes, self.elide_zeros, self.compression)
+            return
+
+        yield from _ordered_pool_map(_pool_encrypt, chunks, workers, max_in_flight, _pool_init, (self.key, self.chunk_format, self.elide_zeros, self.compression))
+
+    def decrypt_chunks(self, chunks, workers: int=1, max_in_flight: int=None):
+        # chunks yields (label, encrypted bytes), yields (label, decrypted bytes) in the same order
+        # with more than one worker, chunks are verified and decrypted in a process pool with at most max_in_flight chunks read ahead
+        if workers <= 1:
+            fernet = FernetChunkCipher(self.key)
+            aead = AeadChunkCipher(self.key)
+            for label, data in chunks:
+                yield label, decrypt_chunk(data, fernet, aead)
+            return
+
+        yield from _ordered_pool_map(_pool_decrypt, chunks, workers, max_in_flight, _pool_decrypt_init, (self.key,))
+
+    @staticmethod
+    def _read_chunk_files(dir_with_chunks: str):
+        for chunk_file in sorted(os.listdir(dir_with_chunks)):
+            with open(os.path.join(dir_with_chunks,chunk_file),'rb') as file:
+                yield chunk_file, file.read()
+
+    @staticmethod
+    def _read_tar_chunks(tar_paths: list):
+        # yield ((tar path, chunk name), encrypted bytes) for every chunk in the tar parts, reading each part front to back
+        last_chunk_name = None
+        for tar_path in tar_paths:
+            # "r|*" reads the part as a stream without seeking and detects gzip compression
+            with tarfile.open(tar_path, mode="r|*") as tar_file:
+                for member in tar_file:
+                    if not member.isfile():
+                        continue
+                    # chunk names have leading zeros, so they sort in chunk order, anything else means a part is missing or out of order
+                    chunk_name = os.path.basename(member.name)
+                    if last_chunk_name != None and chunk_name <= last_chunk_name:
+                        raise ValueError("encrypted chunk {0} in {1} is out of order".format(chunk_name, tar_path))
+                    last_chunk_name = chunk_name
+                    yield (tar_path, chunk_name), tar_file.extractfile(member).read()
+
+    def chunk_encrypt_stream(self, file_to_encrypt: str, chunk_size_mb, first_chunk: int=1, chunk_count: int=None, workers: int=1, max_in_flight: int=None):
+        # generator version of chunk_encrypt() that yields (chunk number, chunk name, plain bytes, encrypted bytes) instead of writing chunk files
+        # chunk numbers start at 1 and follow the same numbering and naming as the files created by chunk_encrypt()
+        # fetch_key() needs to be called before using this generator
+        chunk_size_bytes = int(chunk_size_mb * 1000000)
+        max_file_count = self.max_chunk_count(os.path.getsize(file_to_encrypt), chunk_size_bytes)
+
+        with open(file_to_encrypt, 'rb') as backup_file:
+            backup_file.seek((first_chunk - 1) * chunk_size_bytes, 0)
+            i = first_chunk
+            for plain_bytes, encrypted in self._encrypt_blocks(backup_file, chunk_size_bytes, chunk_count, workers, max_in_flight):
+                yield i, self.chunk_name(i, max_file_count), plain_bytes, encrypted
+                i = i + 1
+
+    def chunk_encrypt(self, file_to_encrypt, dir_for_chunks, chunk_size_mb, workers=1, max_in_flight=None, chunk_hash=None):
         # get the key
         logger.info("Fetch encryption key")
         if self.fetch_key() == False:
@@ -65,25 +541,29 @@ class Crypt:
         file_size = os.path.getsize(file_to_encrypt)
 
         # determine max file count number
-        max_file_count = int(math.pow(10, math.ceil(math.log10(file_size/chunk_size_bytes + 1))) - 1)
+        max_file_count = self.max_chunk_count(file_size, chunk_size_bytes)
 
        
         try:
-            with open(file_to_encrypt, 'rb') as backup_file:
-                # initialize keep_reading with True to start the while loop, will change over to file contents later
-                keep_reading = True
+            # if a ChunkSha256 object was provided, hash each chunk on a helper thread while the next chunk is being encrypted
+            # hashlib releases the GIL for large buffers, so this avoids a second full read of the file just to hash it
+            with open(file_to_encrypt, 'rb') as backup_file, ThreadPoolExecutor(max_workers=1) as hash_pool:
                 i = 1
-                fernet = Fernet(self.key)
-                logger.info("starting to create encrypted chunks")
-                while keep_reading:
-                    # read and encrypt data a chunk at a time
-                    keep_reading = backup_file.read(chunk_size_bytes)
-                    if keep_reading:
-                        encrypted = fernet.encrypt(keep_reading)
-                        with open(dir_for_chunks + '/' + leading_zeros(i,max_file_count) + str(i) + '_backup.crypt', 'wb') as chunk_file:
-                            chunk_file.write(encrypted)
-                            self.log_chunk(i, chunk_file.name) # log every 100 chunk files that are created to provide a hint that the process is stil running
-                            i = i + 1
+                hash_future = None
+                logger.info("starting to create encrypted chunks using {0} worker(s)".format(workers))
+                # read and encrypt data a chunk at a time, encrypted chunks come back in the order they were read
+                for plain_bytes, encrypted in self._encrypt_blocks(backup_file, chunk_size_bytes, workers=workers, max_in_flight=max_in_flight):
+                    if chunk_hash != None:
+                        if hash_future != None:
+                            hash_future.result()    # only one chunk waiting on the hash at a time, keeps memory bounded
+                        hash_future = hash_pool.submit(chunk_hash.update, i, plain_bytes)
+                    with open(dir_for_chunks + '/' + self.chunk_name(i, max_file_count), 'wb') as chunk_file:
+                        chunk_file.write(encrypted)
+                        self.log_chunk(i, chunk_file.name) # log every 100 chunk files that are created to provide a hint that the process is stil running
+                        i = i + 1
+
+                if hash_future != None:
+                    hash_future.result()
                 logger.info("done encrypting chunks")
                 return True
 
@@ -94,31 +574,31 @@ class Crypt:
 
 
 
-    def chunk_decrypt(self,dir_with_chunks, combined_unencrypted_file_path, removeorig=False):
+    def chunk_decrypt(self,dir_with_chunks, combined_unencrypted_file_path, removeorig=False, workers=1, max_in_flight=None):
         # get the key
         if self.fetch_key() == False:
             return False
 
-        fernet = Fernet(self.key)
-
         try:
-            with open(combined_unencrypted_file_path, 'ab') as combined_file:
-                for chunk_file in sorted(os.listdir(dir_with_chunks)):
-                    with open(os.path.join(dir_with_chunks,chunk_file),'rb') as file:
-                        data = file.read()
-
-                    decrypted = fernet.decrypt(data)
-                    combined_file.write(decrypted)
+            # not opened in append mode, so zero runs can be skipped with seek, but we still add on to the end of any existing file
+            with open(combined_unencrypted_file_path, 'ab'):
+                pass
+            with open(combined_unencrypted_file_path, 'r+b') as combined_file:
+                combined_file.seek(0, os.SEEK_END)
+                # chunks come back in order, so a single writer can just add them on
+                for chunk_file, decrypted in self.decrypt_chunks(self._read_chunk_files(dir_with_chunks), workers, max_in_flight):
+                    write_decrypted(combined_file, decrypted)
                     logger.info("decrypted {0}".format(chunk_file))
                     # if specified, remove encrypted file after its data is decrypted and stored in the combined restored file
                     if removeorig == True:
                         os.remove(os.path.join(dir_with_chunks, chunk_file))
                         logger.info("removed {0}".format(chunk_file))
+                combined_file.truncate()
 
             return True
         
-        except InvalidToken:
-            logger.error("invalid decrypt key, cannot decrypt")
+        except (InvalidToken, InvalidTag):
+            logger.error("invalid decrypt key or corrupted chunk, cannot decrypt")
             return False
 
         except Exception as e:
@@ -126,8 +606,57 @@ class Crypt:
             logger.error(e)
             return False
 
+
+    def chunk_decrypt_tars(self, tar_paths: list, combined_unencrypted_file_path: str, chunk_hash=None, removetars=False, workers=1, max_in_flight=None):
+        # streaming version of extracting every tar part and then calling chunk_decrypt(), each tar part is read as a stream
+        # and its chunks are decrypted straight into the combined file, so no extraction directory is needed
+        # tar_paths need to be in upload order, if a ChunkSha256 object is provided the restored file is hashed as it is written
+        if self.fetch_key() == False:
+            return False
+
+        try:
+            current_tar_path = None
+            i = 1
+
+            with open(combined_unencrypted_file_path, 'wb') as combined_file:
+                for (tar_path, chunk_name), decrypted in self.decrypt_chunks(self._read_tar_chunks(tar_paths), workers, max_in_flight):
+                    # a part is only removed once every chunk in it has been written, chunks from the next part may already be read ahead
+                    if tar_path != current_tar_path:
+                        self._finish_tar(current_tar_path, removetars)
+                        current_tar_path = tar_path
+
+                    write_decrypted(combined_file, decrypted, chunk_hash, i)
+                    if i%100 == 1:
+                        logger.info("decrypted chunk check-in - restored: {0}".format(chunk_name))
+                    i = i + 1
+
+                combined_file.truncate()
+                self._finish_tar(current_tar_path, removetars)
+
+            return True
+
+        except (InvalidToken, InvalidTag):
+            logger.error("invalid decrypt key or corrupted chunk, cannot decrypt")
+            return False
+
+        except Exception as e:
+            logger.error("problem decrypting encrypted tar parts in chunk_decrypt_tars()")
+            logger.error(e)
+            return False
+
+    @staticmethod
+    def _finish_tar(tar_path: str, removetars: bool):
+        if tar_path == None:
+            return
+        logger.info("decrypted chunks from {0}".format(tar_path))
+        if removetars == True:
+            os.remove(tar_path)
+            logger.info("removed {0}".format(tar_path))
+
         
 class Sha256Calc:
+    read_size_bytes = 1048576   # large reads so hashing isn't bound by per-call overhead
+
     def __init__(self, file_path: str):
         self.file_path = file_path
     
@@ -140,7 +669,7 @@ class Sha256Calc:
             with open(self.file_path, "rb") as file:
                 keep_reading = True
                 while keep_reading:
-                    file_bytes = file.read(4096)
+                    file_bytes = file.read(self.read_size_bytes)
                     if file_bytes:
                         sha256_hash.update(file_bytes)
                     else:
@@ -162,7 +691,72 @@ class Sha256Calc:
         return digest
 
 
+class ChunkSha256:
+    # sha256 hash of a file that is fed one chunk at a time while the file is being encrypted, so we don't have to read the file twice
+    # chunks have to be fed in order, chunks that were already hashed (ex: a part that is being retried) are skipped.
+    # a chunk can also be the ZeroRun or SparseChunk decrypt_chunk() returns, its zeros are hashed without being allocated
+    def __init__(self):
+        self.sha256_hash = hashlib.sha256()
+        self.next_chunk = 1
+        self.lock = threading.Lock()
+
+    def update(self, chunk_num: int, chunk_bytes: bytes) -> bool:
+        with self.lock:
+            if chunk_num < self.next_chunk:
+                return False
+            if chunk_num > self.next_chunk:
+                raise ValueError("chunk {0} is out of order, expecting chunk {1}".format(chunk_num, self.next_chunk))
+            if isinstance(chunk_bytes, ZeroRun) or isinstance(chunk_bytes, SparseChunk):
+                _hash_pieces(self.sha256_hash, chunk_bytes)
+            else:
+                self.sha256_hash.update(chunk_bytes)
+            self.next_chunk = self.next_chunk + 1
+            return True
+
+    def hexdigest(self) -> str:
+        with self.lock:
+            return self.sha256_hash.hexdigest()
+
+
+class OffsetSha256:
+    # sha256 hash of a file whose pieces can arrive out of order, like the ranges of a parallel download, so the file doesn't have to be
+    # read again once it's written. pieces past the next byte to hash wait in a reassembly buffer. once the buffer holds max_buffer_bytes,
+    # later pieces are only noted and read back with read_back(offset, length) when the bytes before them have been hashed
+    def __init__(self, start_offset: int=0, max_buffer_bytes: int=0, read_back=None):
+        self.sha256_hash = hashlib.sha256()
+        self.offset = start_offset      # next byte to hash
+        self.max_buffer_bytes = max_buffer_bytes
+        self.read_back = read_back
+        self.buffered_bytes = 0
+        self._pieces = {}               # offset -> bytes, or the length of a piece to read back
+        self.lock = threading.Lock()
 
+    def update(self, offset: int, piece_bytes: bytes):
+        with self.lock:
+            if offset < self.offset:
+                raise ValueError("bytes at offset {0} were already hashed, expecting offset {1} or later".format(offset, self.offset))
+            if offset > self.offset:
+                if self.read_back != None and self.buffered_bytes + len(piece_bytes) > self.max_buffer_bytes:
+                    self._pieces[offset] = len(piece_bytes)
+                else:
+                    self._pieces[offset] = piece_bytes
+                    self.buffered_bytes = self.buffered_bytes + len(piece_bytes)
+                return
+            self._hash(piece_bytes)
+            while self.offset in self._pieces:
+                piece = self._pieces.pop(self.offset)
+                if isinstance(piece, int):
+                    piece = self.read_back(self.offset, piece)
+                else:
+                    self.buffered_bytes = self.buffered_bytes - len(piece)
+                self._hash(piece)
 
+    def _hash(self, piece_bytes: bytes):
+        self.sha256_hash.update(piece_bytes)
+        self.offset = self.offset + len(piece_bytes)
 
-        
\ No newline at end of file
+    def hexdigest(self) -> str:
+        with self.lock:
+            if self._pieces:
+                raise ValueError("bytes before offset {0} never arrived".format(min(self._pieces)))
+            return self.sha256_hash.hexdigest()
@@ -0,0 +1,261 @@
+import os, re, json, hmac, base64, hashlib, logging, tarfile
+from datetime import datetime, timedelta
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from onedrive_offsite.crypt import Crypt, FernetChunkCipher, AeadChunkCipher, decrypt_chunk, decrypted_size, write_decrypted
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+MANIFEST_SUFFIX = "_manifest.crypt"
+CHUNK_SUFFIX = ".crypt"
+
+# anchors for content defined chunk boundaries. A boundary is placed right after the first anchor found past the minimum chunk size,
+# so inserting or removing data only moves the boundaries next to the change instead of every boundary after it.
+# On high entropy data, like a vma.zst file, each 3 byte anchor shows up about every 16 MiB, so two of them give an average
+# chunk of roughly the minimum size + 8 MiB. The regex engine scans for them at C speed, a per byte rolling hash in python would not keep up.
+_CDC_ANCHORS = re.compile(b"\x9e\x37\x79|\x85\xeb\xca")
+
+
+def cdc_chunks(file_obj, min_size_bytes: int, max_size_bytes: int):
+    # yield content defined chunks from an open file, every chunk but the last one is between min_size_bytes and max_size_bytes
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size_bytes:
+            data = file_obj.read(max_size_bytes - len(buffer))
+            if not data:
+                eof = True
+            else:
+                buffer += data
+
+        if not buffer:
+            return
+
+        anchor = _CDC_ANCHORS.search(buffer, min_size_bytes, max_size_bytes)
+        if anchor:
+            cut = anchor.end()
+        else:
+            cut = min(len(buffer), max_size_bytes)
+
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def chunk_id_key(key: bytes) -> bytes:
+    # chunk ids are keyed so that someone who can see the file names in onedrive can't confirm whether a known piece of data was backed up
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"onedrive-offsite dedup chunk id v1").derive(base64.urlsafe_b64decode(key))
+
+
+def chunk_id(id_key: bytes, plain_bytes: bytes) -> str:
+    return hmac.new(id_key, plain_bytes, hashlib.sha256).hexdigest()
+
+
+class DedupIndex:
+    # local record of the chunks already uploaded to onedrive: {chunk id: {"onedrive-dir": ..., "pack": ..., "added": ...}}
+
+    def __init__(self, index_path: str, max_age_days: int):
+        self.index_path = index_path
+        self.chunks = {}
+        # chunks uploaded before this are not reused, so a backup never depends on a directory much older than itself
+        self.reuse_after = datetime.now() - timedelta(days=max_age_days)
+
+    def load(self) -> bool:
+        if not os.path.isfile(self.index_path):
+            logger.info("no dedup index at {0}, starting a new one".format(self.index_path))
+            self.chunks = {}
+            return True
+
+        try:
+            with open(self.index_path, "r") as index_file:
+                self.chunks = json.load(index_file).get("chunks", {})
+            return True
+        except Exception as e:
+            logger.error("problem reading dedup index {0}".format(self.index_path))
+            logger.error(e)
+            return False
+
+    def save(self) -> bool:
+        # write to a temp file and swap it in, so a crash can't leave a half written index behind
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as index_file:
+                json.dump({"version": 1, "chunks": self.chunks}, index_file)
+            os.replace(tmp_path, self.index_path)
+            return True
+        except Exception as e:
+            logger.error("problem writing dedup index {0}".format(self.index_path))
+            logger.error(e)
+            return False
+
+    def lookup(self, chunk_id: str) -> dict:
+        entry = self.chunks.get(chunk_id)
+        if entry and datetime.fromisoformat(entry.get("added")) > self.reuse_after:
+            return entry
+        return None
+
+    def add(self, chunk_id: str, onedrive_dir: str, pack: str):
+        self.chunks[chunk_id] = {"onedrive-dir": onedrive_dir, "pack": pack, "added": datetime.now().isoformat()}
+
+
+def dedup_chunk_encrypt(crypt: Crypt, file_to_encrypt: str, dir_for_chunks: str, index: DedupIndex, chunk_hash=None, workers: int=1, max_in_flight: int=None) -> list:
+    # cut the file into content defined chunks, encrypting only the chunks that aren't in the index into dir_for_chunks/<chunk id>.crypt
+    # returns the [chunk id, plain size] of every chunk in file order, or None if there was a problem
+    if crypt.fetch_key() == False:
+        return None
+
+    min_size_bytes = int(Config.dedup_min_chunk_mb * 1000000)
+    max_size_bytes = int(Config.crypt_chunk_size_mb * 1000000)
+    manifest_chunks = []
+    new_chunk_ids = set()
+
+    try:
+        id_key = chunk_id_key(crypt.key)
+
+        with open(file_to_encrypt, "rb") as backup_file:
+
+            def new_chunks():
+                i = 1
+                for plain_bytes in cdc_chunks(backup_file, min_size_bytes, max_size_bytes):
+                    this_chunk_id = chunk_id(id_key, plain_bytes)
+                    manifest_chunks.append([this_chunk_id, len(plain_bytes)])
+                    if chunk_hash != None:
+                        chunk_hash.update(i, plain_bytes)
+                    i = i + 1
+                    # a chunk can repeat inside the same file too, it only needs to be stored once
+                    if this_chunk_id in new_chunk_ids or index.lookup(this_chunk_id) != None:
+                        continue
+                    new_chunk_ids.add(this_chunk_id)
+                    yield this_chunk_id, plain_bytes
+
+            logger.info("starting to create content defined encrypted chunks using {0} worker(s)".format(workers))
+            for this_chunk_id, encrypted in crypt.encrypt_chunks(new_chunks(), workers, max_in_flight):
+                with open(os.path.join(dir_for_chunks, this_chunk_id + CHUNK_SUFFIX), "wb") as chunk_file:
+                    chunk_file.write(encrypted)
+
+        logger.info("done encrypting chunks, {0} of {1} chunks are new".format(len(new_chunk_ids), len(manifest_chunks)))
+        return manifest_chunks
+
+    except Exception as e:
+        logger.error("problem creating content defined encrypted chunks in dedup_chunk_encrypt()")
+        logger.error(e)
+        return None
+
+
+def pack_locations(pack_dir: str) -> dict:
+    # map each chunk id to the tar part it was packed into
+    locations = {}
+    for pack in sorted(os.listdir(pack_dir)):
+        if pack.endswith(MANIFEST_SUFFIX):
+            continue
+        with tarfile.open(os.path.join(pack_dir, pack)) as tar_file:
+            for member_name in tar_file.getnames():
+                locations[os.path.basename(member_name)[:-len(CHUNK_SUFFIX)]] = pack
+    return locations
+
+
+def build_manifest(onedrive_dir: str, manifest_chunks: list, index: DedupIndex, locations: dict) -> dict:
+    # every chunk is either in one of this backup's tar parts or in the index from an earlier backup
+    chunks = []
+    for this_chunk_id, plain_size in manifest_chunks:
+        if this_chunk_id in locations:
+            chunks.append([this_chunk_id, plain_size, onedrive_dir, locations[this_chunk_id]])
+        else:
+            entry = index.lookup(this_chunk_id)
+            if entry == None:
+                logger.error("chunk {0} is not in a tar part or the dedup index".format(this_chunk_id))
+                return None
+            chunks.append([this_chunk_id, plain_size, entry.get("onedrive-dir"), entry.get("pack")])
+
+    return {"version": 1, "onedrive-dir": onedrive_dir, "chunks": chunks}
+
+
+def write_manifest(crypt: Crypt, manifest: dict, manifest_path: str) -> bool:
+    # the manifest is encrypted the same way as the chunks, fetch_key() needs to be called first
+    try:
+        encrypted = list(crypt.encrypt_chunks([(None, json.dumps(manifest).encode())]))[0][1]
+        with open(manifest_path, "wb") as manifest_file:
+            manifest_file.write(encrypted)
+        return True
+    except Exception as e:
+        logger.error("problem writing dedup manifest {0}".format(manifest_path))
+        logger.error(e)
+        return False
+
+
+def read_manifest(crypt: Crypt, manifest_path: str) -> dict:
+    if crypt.fetch_key() == False:
+        return None
+
+    try:
+        with open(manifest_path, "rb") as manifest_file:
+            data = manifest_file.read()
+        return json.loads(decrypt_chunk(data, FernetChunkCipher(crypt.key), AeadChunkCipher(crypt.key)))
+    except Exception as e:
+        logger.error("problem reading dedup manifest {0}".format(manifest_path))
+        logger.error(e)
+        return None
+
+
+def manifest_packs(manifest: dict) -> list:
+    # [onedrive dir, tar part] pairs needed to restore the backup, in the order they are first used
+    packs = []
+    for _, _, onedrive_dir, pack in manifest.get("chunks"):
+        if [onedrive_dir, pack] not in packs:
+            packs.append([onedrive_dir, pack])
+    return packs
+
+
+def commit_manifest(crypt: Crypt, manifest_path: str, index: DedupIndex) -> bool:
+    # after the upload succeeds, add the chunks that were uploaded with this backup to the index
+    manifest = read_manifest(crypt, manifest_path)
+    if not manifest:
+        return False
+
+    for this_chunk_id, _, onedrive_dir, pack in manifest.get("chunks"):
+        if onedrive_dir == manifest.get("onedrive-dir"):
+            index.add(this_chunk_id, onedrive_dir, pack)
+
+    return index.save()
+
+
+def restore_from_manifest(crypt: Crypt, manifest: dict, pack_dir: str, combined_unencrypted_file_path: str, chunk_hash=None) -> bool:
+    # rebuild the backup file from the chunks listed in the manifest, the tar parts are plain tar so chunks can be read in any order
+    if crypt.fetch_key() == False:
+        return False
+
+    open_packs = {}
+    try:
+        fernet = FernetChunkCipher(crypt.key)
+        aead = AeadChunkCipher(crypt.key)
+
+        with open(combined_unencrypted_file_path, "wb") as combined_file:
+            i = 1
+            for this_chunk_id, plain_size, _, pack in manifest.get("chunks"):
+                if pack not in open_packs:
+                    open_packs[pack] = tarfile.open(os.path.join(pack_dir, pack))
+                data = open_packs[pack].extractfile(this_chunk_id + CHUNK_SUFFIX).read()
+                decrypted = decrypt_chunk(data, fernet, aead)
+                if decrypted_size(decrypted) != plain_size:
+                    logger.error("chunk {0} is {1} bytes, expected {2}".format(this_chunk_id, decrypted_size(decrypted), plain_size))
+                    return False
+                write_decrypted(combined_file, decrypted, chunk_hash, i)
+                i = i + 1
+            combined_file.truncate()
+
+        logger.info("restored {0} chunks from {1} tar parts".format(len(manifest.get("chunks")), len(open_packs)))
+        return True
+
+    except Exception as e:
+        logger.error("problem restoring backup file from dedup manifest in restore_from_manifest()")
+        logger.error(e)
+        return False
+
+    finally:
+        for tar_file in open_packs.values():
+            tar_file.close()
@@ -1,11 +1,13 @@
-from onedrive_offsite.utils import make_tar_gz, file_cleanup, download_file_email, decrypt_email
-from onedrive_offsite.crypt import Crypt, Sha256Calc
+from onedrive_offsite.utils import make_tar_gz, file_cleanup, download_file_email, decrypt_email, leading_zeros, tar_part_size
+from onedrive_offsite.crypt import Crypt, ChunkSha256, choose_compression
 from onedrive_offsite.config import Config
-from onedrive_offsite.workers import token_refresh_worker, file_upload_worker, upload_manager, dir_manager, DownloadWorker, DownloadManager, DownloadDecrypter, write_to_error_q, flood_kill_queue
+from onedrive_offsite.dedup import DedupIndex, dedup_chunk_encrypt, pack_locations, build_manifest, write_manifest, commit_manifest, MANIFEST_SUFFIX
+from onedrive_offsite.async_engine import async_upload, async_download
+from onedrive_offsite.concurrency import upload_controller, download_controller, reset_controller
+from onedrive_offsite.cancellation import cancel_token
+from onedrive_offsite.workers import token_refresh_worker, file_upload_worker, upload_manager, dir_manager, stream_upload_worker, DownloadWorker, DownloadManager, DownloadDecrypter, write_to_error_q, flood_kill_queue
 
-from queue import Queue
-from time import sleep
-from datetime import datetime, timedelta
+from queue import Queue, Empty
 import os, json, logging, math, threading
 
 # Logging setup
@@ -15,6 +17,31 @@ logger.addHandler(Config.FILE_HANDLER)
 logger.addHandler(Config.STOUT_HANDLER)
 
 
+def _write_hash_file(backup_file_info: dict, hash_256: str) -> bool:
+    if hash_256:
+        # store the hash in a file
+        try:
+            with open(os.path.join(Config.etc_basedir, "sha256hash_" + backup_file_info.get("onedrive-dir")), "w") as hash_file:
+                hash_file.write(hash_256)
+                logger.info("hash written to file")
+            return True
+        except Exception as e:
+            logger.error("failed to write 256 hash file for {0}".format(backup_file_info.get("backup-file-path")))
+            logger.error(e)
+            return False
+
+    logger.warning("could not calculate the sha 256 hash for {0}".format(backup_file_info.get("backup-file-path")))
+    return False
+
+def _get_base_file_name() -> str:
+    if os.environ.get("ONEDRIVE_NAME") != None:
+        base_file_name = os.environ.get("ONEDRIVE_NAME")
+    else:
+        base_file_name = Config.onedrive_upload_default_filename
+    
+    logger.debug("Using base_file_name = {0}".format(base_file_name))
+    return base_file_name
+
 def crypt_file_build():
     logger.info("starting crypt file build")
     # calculate the max number of encrypted chunks we can include in our tar.gz file
@@ -52,29 +79,26 @@ def crypt_file_build():
             file_cleanup(error=True)
             return False
 
-    # capture the sha256 check sum for our backup file before we modify and upload it
-    hash_obj = Sha256Calc(backup_file_info.get("backup-file-path"))
-    hash_256 = hash_obj.calc()
-    if hash_256:
-        # store the hash in a file
-        try:
-            with open(os.path.join(Config.etc_basedir, "sha256hash_" + backup_file_info.get("onedrive-dir")), "w") as hash_file:
-                hash_file.write(hash_256)
-                logger.info("hash written to file")
-        except Exception as e:
-            logger.error("failed to write 256 hash file for {0}".format(backup_file_info.get("backup-file-path")))
-            logger.error(e)
-            
-    else:
-        logger.warning("could not calculate the sha 256 hash for {0}".format(backup_file_info.get("backup-file-path")))
-    
-    # break our backup file into encrypted chunks
+    # decide once per backup whether chunks get compressed before they are encrypted
+    crypt.compression = choose_compression(backup_file_info.get("backup-file-path"), Config.crypt_compression)
+
+    if Config.dedup == True:
+        if _dedup_build(crypt, backup_file_info, max_chunks_to_add) == False:
+            # bail out, cleanup files, and send notification email
+            file_cleanup(error=True)
+            return False
+        return True
+
+    # break our backup file into encrypted chunks, capturing the sha256 check sum of the backup file from the same reads
     logger.info("break backup file into encrypted chunks")
-    if crypt.chunk_encrypt(backup_file_info.get("backup-file-path"), Config.crypt_chunk_dir, Config.crypt_chunk_size_mb) == False:
+    chunk_hash = ChunkSha256()
+    if crypt.chunk_encrypt(backup_file_info.get("backup-file-path"), Config.crypt_chunk_dir, Config.crypt_chunk_size_mb, workers=Config.crypt_workers, max_in_flight=Config.crypt_max_in_flight, chunk_hash=chunk_hash) == False:
         # bail out, cleanup files, and send notification email
         file_cleanup(error=True)
         return False
     logger.info("done encrypting chunks")
+
+    _write_hash_file(backup_file_info, chunk_hash.hexdigest())
     
     # make sure our targz directory exists
     if os.path.isdir(Config.crypt_tar_gz_dir) == False:
@@ -82,40 +106,106 @@ def crypt_file_build():
         os.mkdir(Config.crypt_tar_gz_dir)
         logger.info("directory successfully created")
 
-    if os.environ.get("ONEDRIVE_NAME") != None:
-        base_file_name = os.environ.get("ONEDRIVE_NAME")
-    else:
-        base_file_name = Config.onedrive_upload_default_filename
-    
-    logger.debug("Using base_file_name = {0}".format(base_file_name))
+    base_file_name = _get_base_file_name()
 
-    logger.info("start combining encrypted chunks into tar.gz files")
+    logger.info("start combining encrypted chunks into {0} files".format(Config.crypt_container_mode))
     
-    # combine all of the encrypted chunks into tar.gz files - deleting the encrypted chunks as they are added to the tar.gz file
-    if make_tar_gz(Config.crypt_chunk_dir, os.path.join(Config.crypt_tar_gz_dir),max_chunks_to_add, base_file_name, removeorig=True) == False:
+    # combine all of the encrypted chunks into tar or tar.gz files - deleting the encrypted chunks as they are added to the archive
+    if make_tar_gz(Config.crypt_chunk_dir, os.path.join(Config.crypt_tar_gz_dir),max_chunks_to_add, base_file_name, removeorig=True, compress=(Config.crypt_container_mode == "tar.gz")) == False:
         # bail out, cleanup files, and send notification email
         file_cleanup(error=True)
         return False
 
     return True
 
-def _check_time(start_time, hrs):
-    if datetime.now() > start_time + timedelta(hours=hrs):
-        return True
-    else:
+# build the tar parts for a dedup backup, only chunks that aren't already in onedrive are encrypted and packed
+# an encrypted manifest listing where every chunk lives is written next to the tar parts so it gets uploaded with them
+def _dedup_build(crypt, backup_file_info: dict, max_chunks_to_add: int) -> bool:
+    onedrive_dir = backup_file_info.get("onedrive-dir")
+    index = DedupIndex(Config.dedup_index_path, Config.dedup_max_age_days)
+    if index.load() == False:
         return False
 
-def crypt_file_upload():
+    logger.info("break backup file into content defined encrypted chunks")
+    chunk_hash = ChunkSha256()
+    manifest_chunks = dedup_chunk_encrypt(crypt, backup_file_info.get("backup-file-path"), Config.crypt_chunk_dir, index, chunk_hash=chunk_hash,
+                                          workers=Config.crypt_workers, max_in_flight=Config.crypt_max_in_flight)
+    if manifest_chunks == None:
+        return False
 
+    _write_hash_file(backup_file_info, chunk_hash.hexdigest())
+
+    try:
+        if os.path.isdir(Config.crypt_tar_gz_dir) == False:
+            logger.info("{0} doesn't exist, attempt to make it".format(Config.crypt_tar_gz_dir))
+            os.mkdir(Config.crypt_tar_gz_dir)
+            logger.info("directory successfully created")
+    except Exception as e:
+        logger.error("problem creating crypt_tar_gz_dir in _dedup_build()")
+        logger.error(e)
+        return False
+
+    # tar parts are read in manifest order during a restore, not front to back, so they are never compressed
+    # their names start with the onedrive directory, so parts from different backups can be downloaded side by side
+    if os.listdir(Config.crypt_chunk_dir):
+        if make_tar_gz(Config.crypt_chunk_dir, Config.crypt_tar_gz_dir, max_chunks_to_add, onedrive_dir + "_" + _get_base_file_name(), removeorig=True, compress=False) == False:
+            return False
+
+    try:
+        locations = pack_locations(Config.crypt_tar_gz_dir)
+    except Exception as e:
+        logger.error("problem reading chunk names from tar parts in _dedup_build()")
+        logger.error(e)
+        return False
+
+    manifest = build_manifest(onedrive_dir, manifest_chunks, index, locations)
+    if not manifest:
+        return False
+
+    return write_manifest(crypt, manifest, os.path.join(Config.crypt_tar_gz_dir, onedrive_dir + MANIFEST_SUFFIX))
+
+
+# once a dedup backup is uploaded, record its new chunks so the next backup can reuse them
+def _dedup_commit() -> bool:
+    manifests = [file_name for file_name in os.listdir(Config.crypt_tar_gz_dir) if file_name.endswith(MANIFEST_SUFFIX)]
+    if not manifests:
+        logger.error("no dedup manifest found in {0}".format(Config.crypt_tar_gz_dir))
+        return False
+
+    index = DedupIndex(Config.dedup_index_path, Config.dedup_max_age_days)
+    if index.load() == False:
+        return False
+
+    return commit_manifest(Crypt(Config.key_path), os.path.join(Config.crypt_tar_gz_dir, manifests[0]), index)
+
+
+def _wait_for_dir_manager(dir_complete_q, kill_q, error_q):
+    # dir_manager() always puts a message on dir_complete_q when it finishes, whether or not it worked, so block until it does
+    try:
+        dir_complete_q.get(timeout=2*60*60)
+    except Empty:
+        logger.error("The directory manager thread is taking too long. Flooding the kill queue")
+        flood_kill_queue(kill_q, "directory manager timed out")
+        write_to_error_q(error_q)
+
+def _start_token_refresh(thread_name: str, kill_q, error_q):
+    # start the token refresh thread and wait until the tokens are ready to use, or the thread has given up and flooded the kill queue
+    tokens_ready = threading.Event()
+    credential_thread = threading.Thread(target=token_refresh_worker, name=thread_name, args=[kill_q, error_q, tokens_ready])
+    credential_thread.start()
+    tokens_ready.wait()
+    return credential_thread
+
+def _thread_upload(upload_file_list: list) -> bool:
+
+    reset_controller(upload_controller, max_workers=5)     # five upload worker threads below
+    cancel_token.start()
     to_upload_q = Queue()
     upload_attempted_q = Queue()
     kill_q = Queue()
     error_q = Queue()
     dir_complete_q = Queue()
 
-    upload_file_list = sorted(os.listdir(Config.crypt_tar_gz_dir))
-
-    credential_thread = threading.Thread(target=token_refresh_worker, name="cred-thread", args=[kill_q, error_q])
     directory_manager = threading.Thread(target=dir_manager, name="dir-manager", args=[kill_q, error_q, dir_complete_q])
     manager_thread = threading.Thread(target=upload_manager, name="manager-thread", args=[upload_file_list, to_upload_q, upload_attempted_q, kill_q, error_q])
     upload_thread_1 = threading.Thread(target=file_upload_worker, name="worker-thread-1", args=[to_upload_q, upload_attempted_q, kill_q])
@@ -124,42 +214,49 @@ def crypt_file_upload():
     upload_thread_4 = threading.Thread(target=file_upload_worker, name="worker-thread-4", args=[to_upload_q, upload_attempted_q, kill_q])
     upload_thread_5 = threading.Thread(target=file_upload_worker, name="worker-thread-5", args=[to_upload_q, upload_attempted_q, kill_q])
 
-    credential_thread.start()
-    sleep(10)
+    credential_thread = _start_token_refresh("cred-thread", kill_q, error_q)
     
     directory_manager.start()
-    start_time = datetime.now()
-
-    while dir_complete_q.empty():
-        if _check_time(start_time, 2) == True:
-            logger.error("The directory manager thread is taking too long. Flooding the kill queue")
-            flood_kill_queue(kill_q)
-            write_to_error_q(error_q)
-            break
-        else:
-            sleep(30) # wait for dir manager to finish
+    _wait_for_dir_manager(dir_complete_q, kill_q, error_q)
 
+    # the workers block on the to upload queue, so they can start right away and pick up files as soon as the manager queues them
     manager_thread.start()
-    sleep(2)
     upload_thread_1.start()
     upload_thread_2.start()
     upload_thread_3.start()
     upload_thread_4.start()
     upload_thread_5.start()
 
-    credential_thread.join()
     directory_manager.join()
     manager_thread.join()
+    to_upload_q.put(None)   # the manager is done, wake up any worker still waiting on the queue
+    credential_thread.join()
     upload_thread_1.join()
     upload_thread_2.join()
     upload_thread_3.join()
     upload_thread_4.join()
     upload_thread_5.join()
+    cancel_token.finish()
 
-    if not error_q.empty():
+    return error_q.empty()
+
+def crypt_file_upload():
+
+    upload_file_list = sorted(os.listdir(Config.crypt_tar_gz_dir))
+
+    if Config.transfer_engine == "asyncio":
+        upload_ok = async_upload(upload_file_list)
+    else:
+        upload_ok = _thread_upload(upload_file_list)
+
+    if not upload_ok:
         # bail out, cleanup files, and send notification email
         file_cleanup(error=True)
         return False
+
+    if Config.dedup == True and _dedup_commit() == False:
+        # the backup is in onedrive, the next backup will just upload these chunks again
+        logger.warning("uploaded chunks could not be added to the dedup index")
     
     # cleanup files and send notification emaisl
     cleanup_status = file_cleanup()
@@ -170,8 +267,102 @@ def crypt_file_upload():
         return True
 
 
+# work out the encrypted tar parts we will stream, using the same chunk numbering and part grouping as crypt_file_build()
+def _stream_part_plan(file_size: int, chunk_size_mb, max_chunks_to_add: int, base_file_name: str) -> list:
+    chunk_size_bytes = int(chunk_size_mb * 1000000)
+    chunk_total = math.ceil(file_size/chunk_size_bytes)
+
+    stream_parts = []
+    file_counter = 1
+    for first_chunk in range(1, chunk_total + 1, max_chunks_to_add):
+        chunk_count = min(max_chunks_to_add, chunk_total - first_chunk + 1)
+        member_sizes = []
+        for chunk_num in range(first_chunk, first_chunk + chunk_count):
+            plain_size = min(chunk_size_bytes, file_size - (chunk_num - 1) * chunk_size_bytes)
+            member_sizes.append(Crypt.encrypted_chunk_size(plain_size))
+
+        stream_parts.append({"name": leading_zeros(file_counter, 1000) + str(file_counter) + "_" + base_file_name,
+                             "first-chunk": first_chunk,
+                             "chunk-count": chunk_count,
+                             "size-bytes": tar_part_size(member_sizes)})
+        file_counter = file_counter + 1
+
+    return stream_parts
+
+
+# read the backup file once, streaming encrypted tar parts straight to onedrive without using scratch disk space
+def crypt_file_stream_upload():
+    logger.info("starting streaming crypt file build and upload")
+    max_chunks_to_add = math.floor(Config.crypt_tar_gz_max_size_mb/Config.crypt_chunk_size_mb)
+    if max_chunks_to_add == 0:
+        logger.error("Your max crypt tar gz file size is smaller than your crypt chunk file size. You need to adjust your configuration before streaming encrypted parts.")
+        # bail out, cleanup files, and send notification email
+        file_cleanup(error=True)
+        return False
+
+    try:
+        # fetch the backup file descriptive information
+        with open(Config.backup_file_info_path, "r") as file:
+            backup_file_info = json.load(file)
+        file_size = os.path.getsize(backup_file_info.get("backup-file-path"))
+    except Exception as e:
+        logger.error("problem reading backup file info in crypt_file_stream_upload()")
+        logger.error(e)
+        # bail out, cleanup files, and send notification email
+        file_cleanup(error=True)
+        return False
+
+    stream_parts = _stream_part_plan(file_size, Config.crypt_chunk_size_mb, max_chunks_to_add, _get_base_file_name())
+    if not stream_parts:
+        logger.error("nothing to stream for {0}".format(backup_file_info.get("backup-file-path")))
+        file_cleanup(error=True)
+        return False
+    logger.info("streaming {0} parts: {1}".format(len(stream_parts), stream_parts))
+
+    kill_q = Queue()
+    error_q = Queue()
+    dir_complete_q = Queue()
+    chunk_hash = ChunkSha256()
+
+    directory_manager = threading.Thread(target=dir_manager, name="dir-manager", args=[kill_q, error_q, dir_complete_q])
+    stream_thread = threading.Thread(target=stream_upload_worker, name="stream-thread", args=[backup_file_info.get("backup-file-path"), stream_parts, chunk_hash, kill_q, error_q])
+
+    cancel_token.start()
+    credential_thread = _start_token_refresh("cred-thread", kill_q, error_q)
+
+    directory_manager.start()
+    _wait_for_dir_manager(dir_complete_q, kill_q, error_q)
+
+    stream_thread.start()
+
+    credential_thread.join()
+    directory_manager.join()
+    stream_thread.join()
+    cancel_token.finish()
+
+    if not error_q.empty():
+        # bail out, cleanup files, and send notification email
+        file_cleanup(error=True)
+        return False
+
+    # the hash was calculated on the same bytes we encrypted, store it so the restore can be verified
+    _write_hash_file(backup_file_info, chunk_hash.hexdigest())
+
+    # cleanup files and send notification emails
+    cleanup_status = file_cleanup()
+
+    if cleanup_status == False:
+        return False
+    else:
+        return True
+
+
 # build the encrypted tar.gz file and upload it
 def crypt_file_build_and_upload():
+    # dedup needs to know which chunks are new before anything is packed, so it always uses the build then upload path
+    if Config.stream_upload == True and Config.dedup != True:
+        return crypt_file_stream_upload()
+
     if crypt_file_build() == False:
         return False
     else:
@@ -181,14 +372,15 @@ def crypt_file_build_and_upload():
             return True
 
 
-def download():
+def _thread_download() -> bool:
 
+    reset_controller(download_controller, max_workers=5)   # five download worker threads below
+    cancel_token.start()
     to_download_q = Queue()
     download_attempted_q = Queue()
     kill_q = Queue()
     error_q = Queue()
 
-    credential_thread = threading.Thread(target=token_refresh_worker, name="cred-thread-down", args=[kill_q, error_q])
     download_manager = threading.Thread(target=DownloadManager.manage_downloads, name="download-manager", args=[to_download_q, download_attempted_q, kill_q, error_q])
     download_thread_1 = threading.Thread(target=DownloadWorker.download_worker, name="download-1", args=[to_download_q, download_attempted_q, kill_q, error_q])
     download_thread_2 = threading.Thread(target=DownloadWorker.download_worker, name="download-2", args=[to_download_q, download_attempted_q, kill_q, error_q])
@@ -196,25 +388,36 @@ def download():
     download_thread_4 = threading.Thread(target=DownloadWorker.download_worker, name="download-4", args=[to_download_q, download_attempted_q, kill_q, error_q])
     download_thread_5 = threading.Thread(target=DownloadWorker.download_worker, name="download-5", args=[to_download_q, download_attempted_q, kill_q, error_q])
 
-    credential_thread.start()
-    sleep(5)
+    credential_thread = _start_token_refresh("cred-thread-down", kill_q, error_q)
+
+    # the workers block on the to download queue, so they can start right away and pick up files as soon as the manager queues them
     download_manager.start()
-    sleep(5)
     download_thread_1.start()
     download_thread_2.start()
     download_thread_3.start()
     download_thread_4.start()
     download_thread_5.start()
 
-    credential_thread.join()
     download_manager.join()
+    to_download_q.put(None) # the manager is done, wake up any worker still waiting on the queue
+    credential_thread.join()
     download_thread_1.join()
     download_thread_2.join()
     download_thread_3.join()
     download_thread_4.join()
     download_thread_5.join()
+    cancel_token.finish()
 
-    if not error_q.empty():
+    return error_q.empty()
+
+def download():
+
+    if Config.transfer_engine == "asyncio":
+        download_ok = async_download()
+    else:
+        download_ok = _thread_download()
+
+    if not download_ok:
         # bail out send notification email
         download_file_email(error=True)
         return None
@@ -0,0 +1,77 @@
+import requests, logging, threading
+from requests.adapters import HTTPAdapter
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+class GraphClient:
+    # every call to the graph and token apis goes through here, so connections are kept alive and reused across fragments and threads
+    # instead of paying for a new tcp connection, tls handshake, and dns lookup on every request.
+    # requests sessions aren't thread safe, so each thread gets its own session, but they all share one adapter and its connection pools.
+    # urllib3 keeps a pool per host, so the graph api, the token api, and the upload/download urls each get their own
+
+    def __init__(self, timeout=None, pool_connections: int=None, pool_maxsize: int=None):
+        if timeout == None:
+            timeout = Config.api_timeout
+        if pool_connections == None:
+            pool_connections = Config.http_pool_connections
+        if pool_maxsize == None:
+            pool_maxsize = Config.http_pool_maxsize
+
+        self.timeout = timeout
+        self.response_hooks = []    # functions called with each response, the same way as requests response hooks
+        self.error_hooks = []       # functions called with (method, headers, exception) when a request fails without a response
+        # retries are handled by the callers, so the adapter never retries on its own
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session == None:
+            session = requests.Session()
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            session.hooks["response"] = self.response_hooks
+            self._local.session = session
+        return session
+
+    def add_response_hook(self, hook):
+        self.response_hooks.append(hook)
+
+    def add_error_hook(self, hook):
+        self.error_hooks.append(hook)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        if kwargs.get("timeout") == None:
+            kwargs["timeout"] = self.timeout
+        try:
+            return self._session().request(method, url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            for hook in self.error_hooks:
+                hook(method, kwargs.get("headers") or {}, e)
+            raise
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        # closes the shared connection pools, any thread can keep using the client after this, it will just open new connections
+        self._adapter.close()
+
+
+# the client shared by every thread
+graph = GraphClient()
@@ -1,14 +1,26 @@
-import requests, json, logging, time, threading, os, mock, math
+import requests, json, logging, threading, os, time
 from onedrive_offsite.config import Config
-from onedrive_offsite.crypt import Sha256Calc
-from onedrive_offsite.utils import read_backup_file_info
+from onedrive_offsite.crypt import Sha256Calc, OffsetSha256
+from onedrive_offsite.utils import read_backup_file_info, FileRangeReader
+from onedrive_offsite.graph_client import graph
+from onedrive_offsite.cancellation import cancel_token
+from onedrive_offsite.concurrency import download_controller
+from onedrive_offsite.upload_journal import upload_journal, session_expires_soon
+from onedrive_offsite.quickxor import QuickXorHash, quick_xor_file
+from onedrive_offsite.retry_policy import upload_session_retry, upload_fragment_retry, upload_partial_retry, download_chunk_retry, dir_retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+# every retry waits here, so a cancelled job wakes it up right away. returns False if the job was cancelled and the retry shouldn't happen
 if os.environ.get("TESTING_ENV") == "test":
-    sleep = mock.Mock()
-    sleep.return_value = None
+    def _retry_wait(seconds) -> bool:
+        return not cancel_token.cancelled()
 else:
-    from time import sleep
+    def _retry_wait(seconds) -> bool:
+        return not cancel_token.wait(seconds)
+
+DOWNLOAD_BLOCK_BYTES = 1048576     # how much of a downloaded chunk is read between checks for a cancelled job
+DOWNLOAD_PROGRESS_SUFFIX = ".progress"     # sidecar next to a download in progress, records how much of it is safely on disk
 
 # Logging setup
 logger = logging.getLogger(__name__)
@@ -22,6 +34,9 @@ class OneDriveLargeUpload:
         self.file_name = upload_file_name
         self.onedrive_upload_url = None
         self.onedrive_upload_exp = None
+        self.next_byte = 0      # first byte onedrive doesn't have yet, more than 0 when a journaled session was resumed
+        self._journal_identity = None   # [size, mtime] of the file when its session is kept in the upload journal
+        self.uploaded_item = None       # the drive item onedrive returned when the upload finished
         self.thread_name = threading.current_thread().getName()
 
         try:
@@ -48,22 +63,14 @@ class OneDriveLargeUpload:
 
 
     @staticmethod
-    def _upload_initiate_retry(retry_count: int, file_name: str) -> bool:
+    def _upload_initiate_retry(retry_count: int, file_name: str, response=None) -> bool:
+        # response is the failed response, if there was one, so a Retry-After header can be followed
         thread_name = threading.current_thread().getName()
-        if retry_count == 1:
-            time.sleep(10)
-            logger.warning("thread: {0} - Retry 1 to initiate upload session for file: {1}".format(thread_name, file_name))
-            return True
-        elif retry_count == 2:
-            time.sleep(60)
-            logger.warning("thread: {0} - Retry 2 to initiate upload session for file: {1}".format(thread_name, file_name))
-            return True
-        elif retry_count == 3:
-            time.sleep(300)
-            logger.warning("thead: {0} - Retry 3 to initiate upload session for file: {1}".format(thread_name, file_name))
-            return True
-        if retry_count > 3:
+        seconds = upload_session_retry.delay(retry_count, response)
+        if seconds == None:
             return False
+        logger.warning("thread: {0} - Retry {1} to initiate upload session for file: {2} in {3:.0f} sec".format(thread_name, retry_count, file_name, seconds))
+        return _retry_wait(seconds)
 
     def initiate_upload_session(self, access_token):
          
@@ -83,7 +90,7 @@ class OneDriveLargeUpload:
             
             try:
                 # send our post request to the microsoft graph api to get an upload session url to use for uploading our large file a piece at a time
-                upload_session_response = requests.post(url=api_url, headers=headers, json=body, timeout=Config.api_timeout)
+                upload_session_response = graph.post(url=api_url, headers=headers, json=body)
                 upload_session_response.close()
 
             except requests.exceptions.Timeout:
@@ -123,12 +130,12 @@ class OneDriveLargeUpload:
                 logger.info("thread: {0} ---------------------------".format(self.thread_name))
                 return True
 
-            elif upload_session_response.status_code == 500 or upload_session_response.status_code == 502 or upload_session_response.status_code == 503 or upload_session_response.status_code == 504:
+            elif upload_session_response.status_code == 429 or upload_session_response.status_code == 500 or upload_session_response.status_code == 502 or upload_session_response.status_code == 503 or upload_session_response.status_code == 504:
                 logger.info("thread: {0} - Service problem".format(self.thread_name))
                 logger.info("thread: {0} - Status code: {1}".format(self.thread_name, upload_session_response.status_code))
                 logger.info("thread: {0} - Body: {1}".format(self.thread_name, upload_session_response.content))
                 retry_count = retry_count + 1
-                retry_flag = self._upload_initiate_retry(retry_count, self.file_name)
+                retry_flag = self._upload_initiate_retry(retry_count, self.file_name, upload_session_response)
                 if retry_flag == False:
                     return False
 
@@ -136,29 +143,109 @@ class OneDriveLargeUpload:
                 logger.error("thread: {0} - Problem creating upload session.\n status code: {1}\n response body: {2}".format(self.thread_name, upload_session_response.status_code, upload_session_response.json()))
                 return False
 
+    def _file_identity(self) -> list:
+        # [size, modification time] of the tar file being uploaded, None if it isn't on disk (ex: a streamed part)
+        try:
+            file_stat = os.stat(os.path.join(Config.crypt_tar_gz_dir, self.file_name))
+            return [file_stat.st_size, file_stat.st_mtime_ns]
+        except OSError:
+            return None
+
+    def _discard_journaled_session(self, entry: dict):
+        # cancel a recorded session we can't use, so onedrive doesn't hold on to its partial upload until it expires
+        try:
+            graph.delete(url=entry.get("upload-url")).close()
+        except Exception as e:
+            logger.warning("thread: {0} - problem cancelling recorded upload session for {1}".format(self.thread_name, self.file_name))
+            logger.warning(e)
+        upload_journal.remove(self.file_name)
+
+    def resume_upload_session(self) -> bool:
+        # pick up the upload session recorded in the upload journal for this file if onedrive still has it.
+        # sets next_byte to the first byte onedrive is missing and returns True, returns False when a new session is needed
+        identity = self._file_identity()
+        entry = upload_journal.get(self.file_name)
+        if identity == None or entry == None:
+            return False
+
+        if entry.get("onedrive-dir-id") != self.dir_id or [entry.get("file-size"), entry.get("file-mtime")] != identity:
+            logger.info("thread: {0} - {1} changed since its upload session was recorded, starting a new session".format(self.thread_name, self.file_name))
+            self._discard_journaled_session(entry)
+            return False
+
+        if session_expires_soon(entry.get("expires"), Config.upload_session_renew_minutes):
+            logger.info("thread: {0} - recorded upload session for {1} expires {2}, starting a new session".format(self.thread_name, self.file_name, entry.get("expires")))
+            self._discard_journaled_session(entry)
+            return False
+
+        try:
+            status_resp = graph.get(entry.get("upload-url"))
+            status_resp.close()
+            status_json = status_resp.json()
+        except Exception as e:
+            logger.warning("thread: {0} - problem checking recorded upload session for {1}, starting a new session".format(self.thread_name, self.file_name))
+            logger.warning(e)
+            return False
+
+        if status_resp.status_code != 200 or not status_json.get("nextExpectedRanges"):
+            logger.info("thread: {0} - recorded upload session for {1} is gone, status code: {2}, starting a new session".format(self.thread_name, self.file_name, status_resp.status_code))
+            upload_journal.remove(self.file_name)
+            return False
+
+        self.onedrive_upload_url = entry.get("upload-url")
+        self.onedrive_upload_exp = status_json.get("expirationDateTime", entry.get("expires"))
+        self.next_byte = int(status_json.get("nextExpectedRanges")[0].split("-")[0])
+        self._journal_identity = identity
+        upload_journal.confirm(self.file_name, self.next_byte, self.onedrive_upload_exp)
+        logger.info("thread: {0} - resuming upload of {1} at byte {2} of {3}".format(self.thread_name, self.file_name, self.next_byte, identity[0]))
+        return True
+
+    def open_upload_session(self, access_token) -> bool:
+        # resume this file's journaled session if there is one, otherwise start a new session and journal it
+        if self.resume_upload_session():
+            return True
+        if self.initiate_upload_session(access_token) == False:
+            return False
+        self.next_byte = 0
+        self._journal_identity = self._file_identity()
+        if self._journal_identity != None:
+            upload_journal.start(self.file_name, self.onedrive_upload_url, self.onedrive_upload_exp, self.dir_id, self._journal_identity[0], self._journal_identity[1])
+        return True
+
+    def _journal_progress(self, content_range_bytes: str, upload_response=None):
+        # onedrive has every byte up to the end of this range, and each accepted fragment pushes the session's expiration out
+        if self._journal_identity == None:
+            return
+        expires = None
+        try:
+            expires = upload_response.json().get("expirationDateTime")
+        except Exception:
+            pass
+        if expires != None:
+            self.onedrive_upload_exp = expires
+        upload_journal.confirm(self.file_name, int(content_range_bytes.split("-")[1]) + 1, expires)
+
+    def _journal_finish(self):
+        # the session is complete or cancelled, there's nothing left to resume
+        if self._journal_identity != None:
+            upload_journal.remove(self.file_name)
+            self._journal_identity = None
+
 
 
     @staticmethod
-    def _retry_logic(content_range_bytes: str, retry_count: int) -> bool:
+    def _retry_logic(content_range_bytes: str, retry_count: int, response=None) -> bool:
         
         thread_name = threading.current_thread().getName()
 
-        if retry_count == 1:
-            time.sleep(15)
-            logger.info("thread: {0} - Retry 1 for range {1}".format(thread_name, content_range_bytes))
-            return True
-        elif retry_count == 2:
-            time.sleep(600)
-            logger.info("thread: {0} - Retry 2 for range {1}".format(thread_name, content_range_bytes))
-            return True
-        elif retry_count == 3:
-            time.sleep(1800)
-            logger.info("thread: {0} - Retry 3 for range {1}".format(thread_name, content_range_bytes))
-            return True
-        if retry_count > 3:
+        seconds = upload_fragment_retry.delay(retry_count, response)
+        if seconds == None:
             return False
+        logger.info("thread: {0} - Retry {1} for range {2} in {3:.0f} sec".format(thread_name, retry_count, content_range_bytes, seconds))
+        return _retry_wait(seconds)
 
-    def upload_file_part(self, file_size_bytes: str, content_length_bytes: str, content_range_bytes: str, bytes_to_upload: bytes, flag_416=False):
+    def upload_file_part(self, file_size_bytes: str, content_length_bytes: str, content_range_bytes: str, bytes_to_upload, flag_416=False):
+        # bytes_to_upload can be bytes, a memoryview, or a FileRangeReader that streams the fragment from disk
         headers = {"Content-Length": content_length_bytes, "Content-Range": "bytes " + content_range_bytes + "/" + file_size_bytes}
         logger.debug("thread: {0} - Content-Length ".format(self.thread_name) + str(headers.get("Content-Length")))
         logger.info("thread: {0} - Content-Range ".format(self.thread_name) + headers.get("Content-Range"))
@@ -171,7 +258,9 @@ class OneDriveLargeUpload:
             ssl_err = False
             conn_err = False
             try:
-                upload_response = requests.put(url=self.onedrive_upload_url, headers=headers, data=bytes_to_upload, timeout=Config.api_timeout)
+                if isinstance(bytes_to_upload, FileRangeReader):
+                    bytes_to_upload.seek(0)     # a retry has to send the fragment from its first byte again
+                upload_response = graph.put(url=self.onedrive_upload_url, headers=headers, data=bytes_to_upload)
                 upload_response.close()
             except requests.exceptions.Timeout:
                 logger.warning("thread: {0} - Upload request timeout.".format(self.thread_name))
@@ -202,20 +291,28 @@ class OneDriveLargeUpload:
             
             elif upload_response.status_code == 202:
                 logger.info("thread: {0} - Upload accepted for range {1}".format(self.thread_name, content_range_bytes))
+                self._journal_progress(content_range_bytes, upload_response)
                 retry_flag = False
 
             elif upload_response.status_code == 200 or upload_response.status_code == 201:                
                 resp_json = upload_response.json()
                 logger.info("thread: {0} - Upload complete".format(self.thread_name))
                 logger.info("thread: {0} - File name: {1} size (bytes): {2}".format(self.thread_name, resp_json.get("name"), resp_json.get("size")))
+                self.uploaded_item = resp_json
+                self._journal_finish()
                 retry_flag = False
 
+            elif upload_response.status_code == 429:
+                logger.info("thread: {0} - Throttled by onedrive, Retry-After: {1}".format(self.thread_name, upload_response.headers.get("Retry-After")))
+                retry_count = retry_count + 1
+                retry_flag = self._retry_logic(content_range_bytes, retry_count, upload_response)
+
             elif upload_response.status_code == 500 or upload_response.status_code == 502 or upload_response.status_code == 503 or upload_response.status_code == 504:
                 logger.info("thread: {0} - Service problem".format(self.thread_name))
                 logger.info("thread: {0} - Status code: {1}".format(self.thread_name, upload_response.status_code))
                 logger.info("thread: {0} - Body: {1}".format(self.thread_name, upload_response.content))
                 retry_count = retry_count + 1
-                retry_flag = self._retry_logic(content_range_bytes, retry_count)
+                retry_flag = self._retry_logic(content_range_bytes, retry_count, upload_response)
 
             elif upload_response.status_code == 416 and flag_416 == False:
                 logger.info("thread: {0} - attempting partial fragment retry".format(self.thread_name))
@@ -224,9 +321,11 @@ class OneDriveLargeUpload:
                     logger.error("thread: {0} - partial fragment retry failed".format(self.thread_name))
                 elif partial_retry_result == "move-next":
                     logger.info("thread: {0} - partial retry - returning 'move-next'".format(self.thread_name))
+                    self._journal_progress(content_range_bytes)
                     return "move-next"
                 elif partial_retry_result == "upload-complete":
                     logger.info("thread: {0} - partial retry - returning 'upload-complete'".format(self.thread_name))
+                    self._journal_finish()
                     return "upload-complete"
                 else:
                     upload_response = partial_retry_result
@@ -261,7 +360,7 @@ class OneDriveLargeUpload:
         logger.info("thread: {0} - checking upload status".format(self.thread_name))
         # get the current status of the upload session
         try:
-            status_resp = requests.get(self.onedrive_upload_url, timeout=Config.api_timeout)
+            status_resp = graph.get(self.onedrive_upload_url)
             status_json = status_resp.json()
             logger.info("thread: {0} - current upload status {1}".format(self.thread_name, status_json))
         except Exception as e:
@@ -301,20 +400,27 @@ class OneDriveLargeUpload:
             logger.error("thread: {0} - next expected byte is outside of our fragment range".format(self.thread_name))
             return False
         
-        remaining_bytes = bytes_fragment[-(fragment_end-next_expected_byte+1):]
+        if isinstance(bytes_fragment, FileRangeReader):
+            remaining_bytes = bytes_fragment.tail(fragment_end-next_expected_byte+1)
+        else:
+            remaining_bytes = bytes_fragment[-(fragment_end-next_expected_byte+1):]
         remaining_range = str(next_expected_byte) + "-" + str(fragment_end)
         remaining_len = str(len(remaining_bytes))
 
-        logger.info("thread: {0} - partial retry - waiting for 5 min before attempting upload of partial fragment".format(self.thread_name))
-        sleep(300)
+        seconds = upload_partial_retry.delay(1)
+        logger.info("thread: {0} - partial retry - waiting for {1:.0f} sec before attempting upload of partial fragment".format(self.thread_name, seconds))
+        if not _retry_wait(seconds):
+            return False
 
         logger.info("thread: {0} - partial retry info - file_size_bytes: {1} remaining_len: {2} remaining_range: {3}".format(self.thread_name, file_size_bytes, remaining_len, remaining_range))
         
         partial_retry_resp = self._partial_retry_upload(file_size_bytes, remaining_len, remaining_range, remaining_bytes, flag_416=True)
 
         if partial_retry_resp == False:
-            logger.warning("thread: {0} - first partial retry failed, waiting for 20 min".format(self.thread_name))
-            sleep(1200)
+            seconds = upload_partial_retry.delay(2)
+            logger.warning("thread: {0} - first partial retry failed, waiting for {1:.0f} sec".format(self.thread_name, seconds))
+            if not _retry_wait(seconds):
+                return False
             logger.info("thread: {0} - partial retry info - file_size_bytes: {1} remaining_len: {2} remaining_range: {3}".format(self.thread_name, file_size_bytes, remaining_len, remaining_range))
             partial_retry_resp = self._partial_retry_upload(file_size_bytes, remaining_len, remaining_range, remaining_bytes, flag_416=True)
             if partial_retry_resp == False:
@@ -323,10 +429,29 @@ class OneDriveLargeUpload:
 
         return partial_retry_resp
 
-  
+    def verify_upload(self, quick_xor_hash: str) -> bool:
+        # compare the quickXorHash calculated while the fragments were sent with the one onedrive reports for the finished file.
+        # it can only fail on a mismatch, when there's nothing to compare the upload is accepted as it always was
+        if quick_xor_hash == None:
+            logger.warning("thread: {0} - no local quickxor hash for {1}, upload not verified".format(self.thread_name, self.file_name))
+            return True
+        if self.uploaded_item == None:
+            logger.info("thread: {0} - onedrive didn't return the finished item for {1}, upload not verified".format(self.thread_name, self.file_name))
+            return True
+        onedrive_hash = ((self.uploaded_item.get("file") or {}).get("hashes") or {}).get("quickXorHash")
+        if not onedrive_hash:
+            logger.info("thread: {0} - onedrive didn't report a quickxor hash for {1}, upload not verified".format(self.thread_name, self.file_name))
+            return True
+        if onedrive_hash != quick_xor_hash:
+            logger.error("thread: {0} - quickxor hash mismatch for {1}, local: {2} onedrive: {3}".format(self.thread_name, self.file_name, quick_xor_hash, onedrive_hash))
+            return False
+        logger.info("thread: {0} - quickxor hash of {1} matches onedrive, upload verified".format(self.thread_name, self.file_name))
+        return True
+
     def cancel_upload_session(self):
+        self._journal_finish()
         try:
-            cancel_resp = requests.delete(url=self.onedrive_upload_url, timeout=Config.api_timeout)
+            cancel_resp = graph.delete(url=self.onedrive_upload_url)
             cancel_resp.close()
         except Exception as e:
             logger.error("thread: {0} - problem with cancel upload session delete request in cancel_upload_session()".format(self.thread_name))
@@ -420,7 +545,7 @@ class MSGraphCredMgr:
 
         try:
             # body_data dict will be form url encoded automatically when we pass it in as the data= argument
-            refresh_token_resp = requests.post(url=token_url, data=body_data, headers=headers, timeout=Config.api_timeout)
+            refresh_token_resp = graph.post(url=token_url, data=body_data, headers=headers)
         
         except Exception as e:
             logger.error("thread: {0} - problem with post request to refresh access token in refresh_tokens()".format(self.thread_name))
@@ -490,6 +615,7 @@ class OneDriveDirMgr:
     
     def _check_dir_exists(self):
         thread_name = threading.current_thread().getName()
+        self.retry_response = None
 
         if self.msgcm.read_tokens() == False:
             logger.error("thread: {0} - unable to read tokens".format(thread_name))
@@ -498,7 +624,7 @@ class OneDriveDirMgr:
         self.headers = {"Authorization": "Bearer " + self.msgcm.access_token}
 
         try:
-            status_resp = requests.get(url=self.api_url + '/' + self.dir_name, timeout=Config.api_timeout, headers=self.headers)    # see if directory already exits
+            status_resp = graph.get(url=self.api_url + '/' + self.dir_name, headers=self.headers)    # see if directory already exits
         except Exception as e:
             logger.warning("thread: {0} - exception while checking status of directory: {1}".format(thread_name, self.dir_name))
             logger.warning(e)
@@ -516,6 +642,7 @@ class OneDriveDirMgr:
                 logger.error("thread: {0} - error writing directory: {1}".format(thread_name, self.dir_name))
                 return "error - write"
         else:
+            self.retry_response = status_resp    # a throttled check waits as long as graph asks before retrying
             logger.error("thread: {0} - unexpected error while checking the status of directory: {1}".format(thread_name, self.dir_name))
             logger.error("thread: {0} - status code: {1}".format(thread_name, status_resp.status_code))
             logger.error("thread: {0} - response body: \n {1}".format(thread_name, status_resp.content))
@@ -532,7 +659,7 @@ class OneDriveDirMgr:
         body = {"name": self.dir_name, "folder": {}}
 
         try:
-            create_resp = requests.post(url=self.api_url, timeout=Config.api_timeout, headers=self.headers, json=body)
+            create_resp = graph.post(url=self.api_url, headers=self.headers, json=body)
         except Exception as e:
             logger.error("thread: {0} - exception while creating directory: {1}".format(thread_name, self.dir_name))
             logger.error(e)
@@ -551,24 +678,15 @@ class OneDriveDirMgr:
             logger.error("thread: {0} - status code: {1}  content: {2}".format(thread_name, create_resp.status_code, create_resp.content))
             return False
     
-    def _retry_sleep(self, attempt_count):
+    def _retry_sleep(self, attempt_count, response=None):
         thread_name = threading.current_thread().getName()
 
-        if attempt_count == 1:
-            logger.warning("thread: {0} - retry directory check in 20 sec".format(thread_name))
-            sleep(20)
-            return True
-        elif attempt_count == 2:
-            logger.warning("thread: {0} - retry directory check in 10 min".format(thread_name))
-            sleep(600)
-            return True
-        elif attempt_count == 3:
-            logger.warning("thread: {0} - retry directory check in 30 min".format(thread_name))
-            sleep(1800)
-            return True
-        else:
+        seconds = dir_retry.delay(attempt_count, response)
+        if seconds == None:
             logger.error("thread: {0} - retries exceeded, stop retrying".format(thread_name))
             return False
+        logger.warning("thread: {0} - retry directory check in {1:.0f} sec".format(thread_name, seconds))
+        return _retry_wait(seconds)
     
     def create_dir(self):
         thread_name = threading.current_thread().getName()
@@ -580,7 +698,7 @@ class OneDriveDirMgr:
             dir_check_status = self._check_dir_exists()
             if dir_check_status != True and dir_check_status != False:
                 logger.warning("thread: {0} - problem checking directory status".format(thread_name))
-                retry_flag = self._retry_sleep(attempt_count)
+                retry_flag = self._retry_sleep(attempt_count, getattr(self, "retry_response", None))
                 if retry_flag == False:
                     logger.error("thread: {0} - could not check directory status".format(thread_name))
                     return None # all retries used up, need to report a failure
@@ -593,8 +711,10 @@ class OneDriveDirMgr:
             logger.info("thread: {0} - directory: {1} does not exist, let's make it".format(thread_name, self.dir_name))
             dir_create_status = self._create_onedrive_dir()
             if dir_create_status != True:
-                logger.warning("thread: {0} - problem creating directory: {1}, wait 20 seconds and try again.".format(thread_name, self.dir_name))
-                sleep(20)
+                seconds = dir_retry.delay(1)
+                logger.warning("thread: {0} - problem creating directory: {1}, wait {2:.0f} seconds and try again.".format(thread_name, self.dir_name, seconds))
+                if not _retry_wait(seconds):
+                    return None
                 dir_create_status = self._create_onedrive_dir()
                 if dir_create_status != True:
                     logger.error("thread: {0} - failed to create directory: {1}".format(thread_name, self.dir_name))
@@ -606,12 +726,20 @@ class OneDriveDirMgr:
             
 
 class OneDriveFileDownloadMgr:
-    def __init__(self, download_url: str, file_size_bytes: int, download_chunk_size_bytes: int, download_file_path: str, sha256_hash: str):
+    def __init__(self, download_url: str, file_size_bytes: int, download_chunk_size_bytes: int, download_file_path: str, sha256_hash: str, range_count: int=None, quick_xor_hash: str=None):
         self.download_url = download_url
         self.file_size_bytes = file_size_bytes
         self.download_chunk_size_bytes = download_chunk_size_bytes
         self.download_file_path = download_file_path
         self.sha256_hash = sha256_hash
+        self.quick_xor_hash = quick_xor_hash     # checked instead when graph doesn't have a sha256 hash for the item
+        # how many chunks of this file download at once
+        if range_count == None:
+            range_count = Config.download_ranges_per_file
+        self.range_count = range_count
+        self._hasher = None     # sha256 of the bytes written so far, fed as each chunk lands so verifying doesn't read the file again
+        self._quick_xor = None  # the same for items graph only has a quickxor hash for, the pieces can be hashed in any order
+        self._failed = threading.local()    # the last failed response on each range thread, so its retry can follow a Retry-After header
         self.thread_name = threading.current_thread().getName()
     
     def _download_chunk(self, start_byte: int, end_byte: int) -> bytes: 
@@ -619,38 +747,47 @@ class OneDriveFileDownloadMgr:
         byte_range = "bytes=" + str(start_byte) + "-" + str(end_byte)
         headers = {"Range": byte_range}
 
+        # the response hooks run before a streamed body is read, so the download is timed here once the whole chunk has arrived
+        start_time = time.monotonic()
         try:
-            resp = requests.get(url=self.download_url, headers=headers, timeout=Config.api_timeout)
+            resp = graph.get(url=self.download_url, headers=headers, stream=True)
         except Exception as e:
             logger.warning("thread: {0} - exception while downloading chunk".format(self.thread_name))
             logger.warning(e)
             return None
 
         if resp.status_code == 206:
+            # read the body a block at a time, so a cancelled job doesn't wait for the rest of the chunk to arrive
+            content = bytearray()
+            try:
+                for block in resp.iter_content(DOWNLOAD_BLOCK_BYTES):
+                    if cancel_token.cancelled():
+                        logger.warning("thread: {0} - download cancelled for byte range: {1}".format(self.thread_name, byte_range))
+                        return None
+                    content += block
+            except Exception as e:
+                logger.warning("thread: {0} - exception while reading downloaded chunk".format(self.thread_name))
+                logger.warning(e)
+                download_controller.record(None, 0, 0)
+                return None
+            finally:
+                resp.close()
+            download_controller.record(resp.status_code, time.monotonic() - start_time, len(content))
             logger.info("thread: {0} - chunk download successful for byte range: {1}".format(self.thread_name, byte_range))
             logger.debug("thread: {0} - download headers: {1}".format(self.thread_name, resp.headers))
-            return resp.content
+            return bytes(content)
         
+        download_controller.record(resp.status_code, time.monotonic() - start_time, 0)
         logger.warning("thread: {0} - unexpected response while downloading chunk  status: {1}  content: {2}".format(self.thread_name, resp.status_code, resp.content))
+        self._failed.response = resp
         return None
     
-    def _retry_delay(self, retry_count: int, start_byte: int, end_byte: int) -> bool:
-        if retry_count == 1:
-            sleep(15)
-            logger.warning("thread: {0} - Retry 1 for download start_byte: {1}  end_byte: {2}".format(self.thread_name, start_byte, end_byte))
-            return True
-        elif retry_count == 2:
-            sleep(600)
-            logger.warning("thread: {0} - Retry 2 for download start_byte: {1}  end_byte: {2}".format(self.thread_name, start_byte, end_byte))
-            return True
-        elif retry_count == 3:
-            sleep(1800)
-            logger.warning("thread: {0} - Retry 3 for download start_byte: {1}  end_byte: {2}".format(self.thread_name, start_byte, end_byte))
-            return True
-        else:
-            logger.warning("thread: {0} - Retry greater than 3, sleeping 20 seconds, download start_byte: {1}  end_byte: {1}".format(self.thread_name, start_byte, end_byte))
-            sleep(20)
+    def _retry_delay(self, retry_count: int, start_byte: int, end_byte: int, response=None) -> bool:
+        seconds = download_chunk_retry.delay(retry_count, response)
+        if seconds == None:
             return False
+        logger.warning("thread: {0} - Retry {1} for download start_byte: {2}  end_byte: {3} in {4:.0f} sec".format(self.thread_name, retry_count, start_byte, end_byte, seconds))
+        return _retry_wait(seconds)
         
     def _download_with_retry(self, start_byte: int, end_byte: int) -> bytes:
         exit_loop = False
@@ -658,10 +795,11 @@ class OneDriveFileDownloadMgr:
         loop_counter = 0
 
         while not exit_loop:            
+            self._failed.response = None
             bytes_to_write = self._download_chunk(start_byte, end_byte)
             if not bytes_to_write:
                 retry_count = retry_count + 1
-                if not self._retry_delay(retry_count, start_byte, end_byte):
+                if not self._retry_delay(retry_count, start_byte, end_byte, self._failed.response):
                     logger.error("thread: {0} - exceeded retries for download".format(self.thread_name))
                     return False
             else:
@@ -674,13 +812,16 @@ class OneDriveFileDownloadMgr:
         
         return None
 
-    def _verify_download(self) -> bool:
-        # verify the file is actually done downloading
+    def _verify_download(self, sha_hash: str=None, quick_xor_hash: str=None) -> bool:
+        # verify the file is actually done downloading, sha_hash and quick_xor_hash are the hashes already calculated while the file was written
         if os.path.getsize(self.download_file_path) == self.file_size_bytes:
             logger.info("thread: {0} - downloaded file {1} matches expected size of {2} bytes".format(self.thread_name, self.download_file_path, self.file_size_bytes))
+            if not self.sha256_hash:
+                return self._verify_quick_xor(quick_xor_hash)
             ## now check the hash before returning True
-            sha_calc = Sha256Calc(self.download_file_path)
-            sha_hash = sha_calc.calc()
+            if sha_hash == None:
+                sha_calc = Sha256Calc(self.download_file_path)
+                sha_hash = sha_calc.calc()
             if not sha_hash:
                 logger.error("thread: {0} - problem getting sha256 hash of download file".format(self.thread_name))
                 return False
@@ -692,18 +833,132 @@ class OneDriveFileDownloadMgr:
             logger.error("thread: {0} - download should be done, but the download file size is not correct for {1}, expected size: {2} bytes".format(self.thread_name, self.download_file_path, self.file_size_bytes))
             return False
 
-    def download_file(self):
+    def _verify_quick_xor(self, quick_xor_hash: str=None) -> bool:
+        # the file is only read again if the hash couldn't be calculated while it downloaded
+        if quick_xor_hash == None:
+            quick_xor_hash = quick_xor_file(self.download_file_path)
+        if not quick_xor_hash:
+            logger.error("thread: {0} - problem getting quickxor hash of download file".format(self.thread_name))
+            return False
+        if quick_xor_hash == self.quick_xor_hash:
+            logger.info("thread: {0} - quickxor hash of downloaded file matches MS graph hash, file download confirmed".format(self.thread_name))
+            return True
+        logger.error("thread: {0} - quickxor hash of downloaded file does not match MS graph hash".format(self.thread_name))
+        return False
 
-        bytes_remaining = self.file_size_bytes
-        start_byte = 0
-        if self.file_size_bytes >= self.download_chunk_size_bytes:
-            end_byte = self.download_chunk_size_bytes - 1
-        else:
-            end_byte = self.file_size_bytes - 1
-        
-        download_count = math.ceil(self.file_size_bytes/self.download_chunk_size_bytes)
+    def _progress_path(self) -> str:
+        return self.download_file_path + DOWNLOAD_PROGRESS_SUFFIX
 
-        for i in range(0, download_count):
+    def _read_progress(self) -> int:
+        # how many bytes at the start of the download file an earlier attempt wrote and synced to disk, 0 if there's nothing to pick up.
+        # the record has to be for the same version of the graph item, a backup uploaded again under the same name starts over
+        try:
+            with open(self._progress_path(), "r") as progress_file:
+                progress = json.load(progress_file)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.warning("thread: {0} - problem reading download progress for {1}, starting from the first byte".format(self.thread_name, self.download_file_path))
+            logger.warning(e)
+            return 0
+
+        verified_bytes = progress.get("verified-bytes", 0)
+        if progress.get("size-bytes") != self.file_size_bytes or progress.get("sha256hash") != self.sha256_hash or \
+                progress.get("quickxorhash") != self.quick_xor_hash:
+            logger.info("thread: {0} - download progress for {1} is for a different version of the file, starting from the first byte".format(self.thread_name, self.download_file_path))
+            return 0
+        if not os.path.isfile(self.download_file_path) or os.path.getsize(self.download_file_path) < verified_bytes:
+            return 0
+        return verified_bytes
+
+    def _write_progress(self, verified_bytes: int) -> bool:
+        # write to a temp file and swap it in, so a crash can't leave a half written record behind
+        tmp_path = self._progress_path() + ".tmp"
+        try:
+            with open(tmp_path, "w") as progress_file:
+                json.dump({"size-bytes": self.file_size_bytes, "sha256hash": self.sha256_hash, "quickxorhash": self.quick_xor_hash,
+                           "verified-bytes": verified_bytes}, progress_file)
+            os.replace(tmp_path, self._progress_path())
+            return True
+        except Exception as e:
+            logger.warning("thread: {0} - problem writing download progress for {1}".format(self.thread_name, self.download_file_path))
+            logger.warning(e)
+            return False
+
+    def _remove_progress(self):
+        try:
+            os.remove(self._progress_path())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("thread: {0} - problem removing download progress for {1}".format(self.thread_name, self.download_file_path))
+            logger.warning(e)
+
+    def _already_downloaded(self) -> bool:
+        # a file left by an earlier run that already matches the graph item's size and hash doesn't need to be downloaded again
+        if os.path.isfile(self._progress_path()) or not os.path.isfile(self.download_file_path):
+            return False
+        if os.path.getsize(self.download_file_path) != self.file_size_bytes:
+            return False
+        if not self.sha256_hash:
+            if self.quick_xor_hash and quick_xor_file(self.download_file_path) == self.quick_xor_hash:
+                logger.info("thread: {0} - {1} was already downloaded and matches the MS graph hash, skipping it".format(self.thread_name, self.download_file_path))
+                return True
+            return False
+        sha_hash = Sha256Calc(self.download_file_path).calc()
+        if sha_hash and self.sha256_hash and sha_hash.upper() == self.sha256_hash:
+            logger.info("thread: {0} - {1} was already downloaded and matches the MS graph hash, skipping it".format(self.thread_name, self.download_file_path))
+            return True
+        return False
+
+    def _start_hash(self, start_byte: int, hasher):
+        # hasher is an OffsetSha256 or a QuickXorHash, both take update(offset, bytes).
+        # a resumed download only has to read back the bytes an earlier attempt wrote. returns None if they can't be read,
+        # then the whole file is hashed once it's downloaded
+        if start_byte == 0:
+            return hasher
+        try:
+            with open(self.download_file_path, "rb") as download_file:
+                offset = 0
+                while offset < start_byte:
+                    file_bytes = download_file.read(min(Sha256Calc.read_size_bytes, start_byte - offset))
+                    if not file_bytes:
+                        return None
+                    hasher.update(offset, file_bytes)
+                    offset = offset + len(file_bytes)
+        except Exception as e:
+            logger.warning("thread: {0} - problem hashing the resumed part of {1}, it will be hashed after the download".format(self.thread_name, self.download_file_path))
+            logger.warning(e)
+            return None
+        return hasher
+
+    def _downloaded_hash(self) -> str:
+        # the hash calculated while downloading, None if there isn't one for the whole file
+        if self._hasher == None or self._hasher.offset != self.file_size_bytes:
+            return None
+        try:
+            return self._hasher.hexdigest()
+        except ValueError:
+            return None
+
+    def _downloaded_quick_xor(self) -> str:
+        # the quickxor hash calculated while downloading, None if there isn't one for the whole file
+        if self._quick_xor == None or self._quick_xor.length != self.file_size_bytes:
+            return None
+        return self._quick_xor.b64digest()
+
+    def _download_sequential(self, start_byte: int) -> bool:
+        # download one chunk at a time, appending each one to the file
+        try:
+            with open(self.download_file_path, "ab") as download_file:
+                download_file.truncate(start_byte)
+        except Exception as e:
+            logger.error("thread: {0} - problem preparing download file {1}".format(self.thread_name, self.download_file_path))
+            logger.error(e)
+            return False
+
+        while start_byte < self.file_size_bytes:
+            end_byte = min(start_byte + self.download_chunk_size_bytes, self.file_size_bytes) - 1
 
             bytes_to_write = self._download_with_retry(start_byte, end_byte)
             if not bytes_to_write:
@@ -712,25 +967,143 @@ class OneDriveFileDownloadMgr:
             try:
                 with open(self.download_file_path, "ab") as download_file:
                     download_file.write(bytes_to_write)
+                    # the bytes have to be on disk before the progress record says they are
+                    download_file.flush()
+                    os.fsync(download_file.fileno())
                 logger.debug("thread: {0} - successfully wrote bytes to download file start_byte: {1}  end_byte: {2}".format(self.thread_name, start_byte, end_byte))
             except Exception as e:
                 logger.error("thread: {0} - problem writing bytes to file, exiting download attempt".format(self.thread_name))
                 logger.error(e)
                 return False
-            
-            bytes_remaining = bytes_remaining - self.download_chunk_size_bytes
-            start_byte = self.file_size_bytes - bytes_remaining
 
-            if bytes_remaining > self.download_chunk_size_bytes:
-                end_byte = start_byte + self.download_chunk_size_bytes - 1
-            else:
-                end_byte = self.file_size_bytes - 1
-            
-                
-        if self._verify_download():
+            if self._hasher != None:
+                self._hasher.update(start_byte, bytes_to_write)
+            if self._quick_xor != None:
+                self._quick_xor.update(start_byte, bytes_to_write)
+            start_byte = end_byte + 1
+            self._write_progress(start_byte)
+
+        return True
+
+    def _open_preallocated(self, start_byte: int) -> int:
+        # open the download file for positioned writes, keeping its first start_byte bytes, and reserve the full size on disk up front
+        # so chunks landing out of order don't fragment the file or fail halfway through on a full disk
+        fd = os.open(self.download_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, start_byte)
+            try:
+                os.posix_fallocate(fd, 0, self.file_size_bytes)
+            except OSError:
+                # the filesystem can't reserve blocks, a sparse file of the right size still takes positioned writes
+                os.ftruncate(fd, self.file_size_bytes)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    @staticmethod
+    def _pwrite_all(fd: int, data: bytes, offset: int):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset = offset + written
+
+    def _download_ranges(self, start_byte: int) -> bool:
+        # download range_count chunks at once and write each one straight to its place in the file.
+        # each chunk retries on its own thread, so a slow or failing chunk doesn't hold up the others,
+        # and the progress record moves forward as the chunks before it finish
+        byte_ranges = [[range_start, min(range_start + self.download_chunk_size_bytes, self.file_size_bytes) - 1]
+                       for range_start in range(start_byte, self.file_size_bytes, self.download_chunk_size_bytes)]
+        try:
+            fd = self._open_preallocated(start_byte)
+        except Exception as e:
+            logger.error("thread: {0} - problem preparing download file {1}".format(self.thread_name, self.download_file_path))
+            logger.error(e)
+            return False
+        self._write_progress(start_byte)
+        if self._hasher != None:
+            # chunks that finish ahead of an earlier one wait in memory to be hashed, past a few chunks' worth they're read back from the file
+            self._hasher.max_buffer_bytes = self.range_count * 2 * self.download_chunk_size_bytes
+            self._hasher.read_back = lambda offset, length: os.pread(fd, length, offset)
+
+        lock = threading.Lock()
+        failed = threading.Event()
+        finished = {}       # start byte -> end byte + 1 of chunks written past the verified bytes
+        progress = {"verified-bytes": start_byte}
+
+        def fetch(byte_range) -> bool:
+            if failed.is_set():
+                return False
+            bytes_to_write = self._download_with_retry(byte_range[0], byte_range[1])
+            if not bytes_to_write or len(bytes_to_write) != byte_range[1] - byte_range[0] + 1:
+                logger.error("thread: {0} - problem downloading bytes {1}-{2}, stopping the other ranges".format(self.thread_name, byte_range[0], byte_range[1]))
+                failed.set()
+                return False
+            try:
+                self._pwrite_all(fd, bytes_to_write, byte_range[0])
+                with lock:
+                    if self._hasher != None:
+                        self._hasher.update(byte_range[0], bytes_to_write)
+                    if self._quick_xor != None:
+                        self._quick_xor.update(byte_range[0], bytes_to_write)
+                    finished[byte_range[0]] = byte_range[1] + 1
+                    verified_bytes = progress["verified-bytes"]
+                    while verified_bytes in finished:
+                        verified_bytes = finished.pop(verified_bytes)
+                    if verified_bytes != progress["verified-bytes"]:
+                        # the bytes have to be on disk before the progress record says they are
+                        os.fsync(fd)
+                        progress["verified-bytes"] = verified_bytes
+                        self._write_progress(verified_bytes)
+            except Exception as e:
+                logger.error("thread: {0} - problem writing bytes {1}-{2} to file, stopping the other ranges".format(self.thread_name, byte_range[0], byte_range[1]))
+                logger.error(e)
+                failed.set()
+                return False
+            return True
+
+        logger.info("thread: {0} - downloading {1} in {2} chunks, {3} at a time".format(self.thread_name, self.download_file_path, len(byte_ranges), self.range_count))
+        try:
+            with ThreadPoolExecutor(max_workers=self.range_count, thread_name_prefix=self.thread_name + "-range") as executor:
+                results = list(executor.map(fetch, byte_ranges))
+        finally:
+            os.close(fd)
+
+        return all(results)
+
+    def download_file(self):
+
+        if self._already_downloaded():
+            return True
+
+        # pick up where an earlier attempt left off, anything past the last synced byte is thrown away
+        start_byte = self._read_progress()
+        if start_byte > 0:
+            logger.info("thread: {0} - resuming download of {1} at byte {2} of {3}".format(self.thread_name, self.download_file_path, start_byte, self.file_size_bytes))
+        # the hash is calculated as the file is written, so it doesn't have to be read again to verify it
+        self._hasher = None
+        self._quick_xor = None
+        if self.sha256_hash:
+            self._hasher = self._start_hash(start_byte, OffsetSha256())
+        elif self.quick_xor_hash:
+            self._quick_xor = self._start_hash(start_byte, QuickXorHash())
+
+        # positioned writes aren't available on windows, it downloads one chunk at a time
+        if self.range_count > 1 and hasattr(os, "pwrite") and self.file_size_bytes - start_byte > self.download_chunk_size_bytes:
+            downloaded = self._download_ranges(start_byte)
+        else:
+            downloaded = self._download_sequential(start_byte)
+        if not downloaded:
+            return False
+
+        if self._verify_download(self._downloaded_hash(), self._downloaded_quick_xor()):
+            self._remove_progress()
             return True
         else:
+            # the bytes on disk can't be trusted, so the next attempt has to start over
             logger.error("thread: {0} - downloaded file could not be verified".format(self.thread_name))
+            self._remove_progress()
             return False
         
 
@@ -747,7 +1120,7 @@ class OneDriveItemGetter:
         dir_url = Config.api_url + "/v1.0/me/drive/special/approot/children/" + self.dir_name
 
         try:
-            resp = requests.get(url=dir_url, headers=self.headers, timeout=Config.api_timeout)        
+            resp = graph.get(url=dir_url, headers=self.headers)        
         except Exception as e:
             logger.warning("thread: {0} - exception encountered while fetching directory details for {1}".format(self.thread_name, self.dir_name))
             logger.warning(e)
@@ -801,7 +1174,7 @@ class OneDriveItemGetter:
         dir_url = Config.api_url + "/v1.0/me/drive/items/" + dir_item + "/children"
         
         try:
-            resp = requests.get(url=dir_url, headers=self.headers, timeout=Config.api_timeout)
+            resp = graph.get(url=dir_url, headers=self.headers)
         except Exception as e:
             logger.error("thread: {0} - exception encountered while trying to get list of item in dir: {1}".format(self.thread_name, self.dir_name))
             logger.error(e)
@@ -845,7 +1218,7 @@ class OneDriveGetItemDetails:
         headers = {"Authorization": "Bearer " + access_token}
 
         try:
-            resp = requests.get(url=item_url, headers=headers, timeout=Config.api_timeout)
+            resp = graph.get(url=item_url, headers=headers)
         except Exception as e:
             logger.error("thread: {0} - problem getting item detail".format(thread_name))
             logger.error(e)
@@ -879,12 +1252,14 @@ class OneDriveGetItemDetails:
                 logger.error("thread: {0} - missing hashes".format(thread_name))
                 return None 
 
+            # onedrive business and sharepoint only report a quickxor hash, either one is enough to verify the download
             sha256hash = hashes.get("sha256Hash")
-            if not sha256hash:
-                logger.error("thread: {0} - missing sha256 hash".format(thread_name))
+            quickxorhash = hashes.get("quickXorHash")
+            if not sha256hash and not quickxorhash:
+                logger.error("thread: {0} - missing sha256 and quickxor hashes".format(thread_name))
                 return None
             
-            file_download_info = {"download_url": download_url, "size_bytes": size, "sha256hash": sha256hash}
+            file_download_info = {"download_url": download_url, "size_bytes": size, "sha256hash": sha256hash, "quickxorhash": quickxorhash}
             return file_download_info                
         
         logger.error("thread: {0} - unexpected status code while fetching download item info".format(thread_name))
@@ -0,0 +1,85 @@
+import base64, logging, operator
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+WIDTH_BITS = 160
+SHIFT_BITS = 11
+_ROW_BITS = WIDTH_BITS * 8      # bytes WIDTH_BITS apart land on the same bit of the hash, so a row of WIDTH_BITS bytes can be folded together
+_WIDTH_MASK = (1 << WIDTH_BITS) - 1
+_READ_SIZE_BYTES = 1048576
+
+# byte i of a row starting at file offset n lands at bit (11 * (n + i)) % 160. For each starting offset % 160 and each bit within a byte (0-7),
+# these pick out the 20 bytes of a folded row landing at bits 8q + t, in order of q, so a row is placed with 8 int operations instead of 160.
+_SHIFT_INVERSE = pow(SHIFT_BITS, -1, WIDTH_BITS)     # 131, so (131 * bit) % 160 is the byte that lands on that bit
+_GATHER = [[operator.itemgetter(*[(_SHIFT_INVERSE * (8 * q + t) - phase) % WIDTH_BITS for q in range(WIDTH_BITS // 8)]) for t in range(8)]
+           for phase in range(WIDTH_BITS)]
+
+
+def _fold_rows(data) -> bytes:
+    # xor every WIDTH_BITS byte row of data together, the last row is padded with zeros.
+    # python ints do the work a whole buffer at a time, halving the rows on each pass, so there's no per byte loop
+    rows = -(-len(data) // WIDTH_BITS)
+    value = int.from_bytes(data, "little")
+    folded = 0
+    while rows > 1:
+        if rows % 2 == 1:
+            rows = rows - 1
+            folded = folded ^ (value >> (rows * _ROW_BITS))
+            value = value & ((1 << (rows * _ROW_BITS)) - 1)
+        rows = rows // 2
+        value = (value >> (rows * _ROW_BITS)) ^ (value & ((1 << (rows * _ROW_BITS)) - 1))
+    return (value ^ folded).to_bytes(WIDTH_BITS, "little")
+
+
+class QuickXorHash:
+    # the quickXorHash onedrive and sharepoint report for every file: byte n of the file is xored into a 160 bit value at bit 11 * n,
+    # wrapping around, and the file length is xored into the last 64 bits at the end.
+    # every byte lands in the same place however the file is split up, so pieces can be hashed in any order as long as each byte is hashed once
+
+    def __init__(self):
+        self._value = 0
+        self.length = 0     # bytes hashed so far
+
+    def update(self, offset: int, data):
+        # data is the bytes of the file starting at offset
+        if len(data) == 0:
+            return
+        folded = _fold_rows(data)
+        gathers = _GATHER[offset % WIDTH_BITS]
+        for t in range(8):
+            value = int.from_bytes(bytes(gathers[t](folded)), "little")
+            if value != 0:
+                self._value = self._value ^ (((value << t) | (value >> (WIDTH_BITS - t))) & _WIDTH_MASK)
+        self.length = self.length + len(data)
+
+    def digest(self) -> bytes:
+        digest = bytearray(self._value.to_bytes(WIDTH_BITS // 8, "little"))
+        for i, length_byte in enumerate(self.length.to_bytes(8, "little")):
+            digest[WIDTH_BITS // 8 - 8 + i] = digest[WIDTH_BITS // 8 - 8 + i] ^ length_byte
+        return bytes(digest)
+
+    def b64digest(self) -> str:
+        # the format graph returns in file.hashes.quickXorHash
+        return base64.b64encode(self.digest()).decode("ascii")
+
+
+def quick_xor_file(file_path: str) -> str:
+    # quickXorHash of a file on disk, None if it couldn't be read
+    quick_xor = QuickXorHash()
+    try:
+        with open(file_path, "rb") as hash_file:
+            file_bytes = hash_file.read(_READ_SIZE_BYTES)
+            while file_bytes:
+                quick_xor.update(quick_xor.length, file_bytes)
+                file_bytes = hash_file.read(_READ_SIZE_BYTES)
+    except Exception as e:
+        logger.error("problem reading file to calculate quickxor hash - file path: {0}".format(file_path))
+        logger.error(e)
+        return None
+    return quick_xor.b64digest()
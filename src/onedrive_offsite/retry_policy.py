@@ -0,0 +1,71 @@
+import random, logging
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+THROTTLED_STATUS_CODE = 429
+
+
+def retry_after_seconds(response) -> float:
+    # how long a response's Retry-After header asks us to wait, in seconds or as an http date. None if it doesn't have one
+    if response == None:
+        return None
+    try:
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+class RetryPolicy:
+    # how long one kind of graph call waits before each retry, and how many retries it gets.
+    # the wait grows by multiplier after each failure up to max_seconds, and jitter takes up to that fraction of each wait off at random,
+    # so threads that failed together don't all retry together. when graph sends a Retry-After header, that's the wait instead.
+    # a throttled (429) request isn't failing, it's being told to slow down, so it gets throttle_retries retries instead of max_retries
+
+    def __init__(self, name: str, max_retries: int, base_seconds: float, max_seconds: float=None, multiplier: float=None, jitter: float=None,
+                 throttle_retries: int=None, max_retry_after_seconds: float=None):
+        self.name = name
+        self.max_retries = max_retries
+        self.base_seconds = base_seconds
+        self.max_seconds = Config.retry_max_seconds if max_seconds == None else max_seconds
+        self.multiplier = Config.retry_backoff_multiplier if multiplier == None else multiplier
+        self.jitter = Config.retry_jitter if jitter == None else jitter
+        self.throttle_retries = max(max_retries, Config.retry_throttle_max if throttle_retries == None else throttle_retries)
+        self.max_retry_after_seconds = Config.retry_after_max_seconds if max_retry_after_seconds == None else max_retry_after_seconds
+
+    def backoff_seconds(self, retry_count: int) -> float:
+        seconds = min(self.max_seconds, self.base_seconds * self.multiplier ** (retry_count - 1))
+        return seconds - random.uniform(0, seconds * self.jitter)
+
+    def delay(self, retry_count: int, response=None) -> float:
+        # seconds to wait before retry number retry_count (starting at 1), None once this operation is out of retries.
+        # response is the failed response, if there was one
+        throttled = response != None and getattr(response, "status_code", None) == THROTTLED_STATUS_CODE
+        if retry_count > (self.throttle_retries if throttled else self.max_retries):
+            logger.warning("{0} is out of retries after {1} attempts".format(self.name, retry_count))
+            return None
+        retry_after = retry_after_seconds(response)
+        if retry_after != None:
+            return min(retry_after, self.max_retry_after_seconds)
+        return self.backoff_seconds(retry_count)
+
+
+# one policy for each kind of graph call, each with its own retry budget
+upload_session_retry = RetryPolicy("upload session", 3, 10)
+upload_fragment_retry = RetryPolicy("upload fragment", 3, 15)
+upload_partial_retry = RetryPolicy("partial fragment upload", 2, 60)
+download_chunk_retry = RetryPolicy("download chunk", 3, 15)
+dir_retry = RetryPolicy("directory check", 3, 20)
@@ -0,0 +1,103 @@
+import os, json, logging, threading
+from datetime import datetime, timezone, timedelta
+from onedrive_offsite.config import Config
+
+# Logging setup
+logger = logging.getLogger(__name__)
+logger.setLevel(Config.LOG_LEVEL)
+logger.addHandler(Config.FILE_HANDLER)
+logger.addHandler(Config.STOUT_HANDLER)
+
+
+def session_expires_soon(expires: str, minutes: float) -> bool:
+    # expires is the expirationDateTime onedrive returned for the session, ex: 2015-01-29T09:21:55.523Z
+    # anything that can't be read is treated as expiring, so it gets replaced with a new session
+    try:
+        expires = expires.replace("Z", "+00:00")
+        if "." in expires:
+            # python before 3.11 only reads exactly 3 or 6 digits of fractional seconds, graph can send up to 7
+            seconds, fraction = expires.split(".", 1)
+            digits = fraction.split("+")[0]
+            expires = seconds + "." + digits[:6].ljust(6, "0") + fraction[len(digits):]
+        expires_at = datetime.fromisoformat(expires)
+    except Exception:
+        return True
+    return expires_at - timedelta(minutes=minutes) < datetime.now(timezone.utc)
+
+
+class UploadJournal:
+    # local record of the upload sessions still in progress, so uploading the same tar file again after a restart carries on
+    # from the last byte onedrive confirmed instead of sending the whole part again:
+    # {file name: {"upload-url": ..., "expires": ..., "onedrive-dir-id": ..., "file-size": ..., "file-mtime": ..., "confirmed-bytes": ...}}
+    # the size and modification time tell us whether the file on disk is still the one the session was started for.
+    # it's written after every accepted fragment, which is one small write next to a 10 MB upload
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.sessions = None    # read from the journal file the first time it's needed
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.sessions != None:
+            return
+        if not os.path.isfile(self.journal_path):
+            self.sessions = {}
+            return
+        try:
+            with open(self.journal_path, "r") as journal_file:
+                self.sessions = json.load(journal_file).get("sessions", {})
+        except Exception as e:
+            logger.error("problem reading upload journal {0}, starting a new one".format(self.journal_path))
+            logger.error(e)
+            self.sessions = {}
+
+    def _save(self) -> bool:
+        # write to a temp file and swap it in, so a crash can't leave a half written journal behind
+        tmp_path = self.journal_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as journal_file:
+                json.dump({"version": 1, "sessions": self.sessions}, journal_file)
+            os.replace(tmp_path, self.journal_path)
+            return True
+        except Exception as e:
+            logger.error("problem writing upload journal {0}".format(self.journal_path))
+            logger.error(e)
+            return False
+
+    def get(self, file_name: str) -> dict:
+        with self._lock:
+            self._load()
+            entry = self.sessions.get(file_name)
+            if entry == None:
+                return None
+            return dict(entry)
+
+    def start(self, file_name: str, upload_url: str, expires: str, dir_id: str, file_size: int, file_mtime: int) -> bool:
+        with self._lock:
+            self._load()
+            self.sessions[file_name] = {"upload-url": upload_url, "expires": expires, "onedrive-dir-id": dir_id,
+                                        "file-size": file_size, "file-mtime": file_mtime, "confirmed-bytes": 0}
+            return self._save()
+
+    def confirm(self, file_name: str, confirmed_bytes: int, expires: str=None) -> bool:
+        # onedrive has every byte before confirmed_bytes, expires is the session's new expiration if onedrive sent one
+        with self._lock:
+            self._load()
+            entry = self.sessions.get(file_name)
+            if entry == None:
+                return False
+            entry["confirmed-bytes"] = confirmed_bytes
+            if expires != None:
+                entry["expires"] = expires
+            return self._save()
+
+    def remove(self, file_name: str) -> bool:
+        with self._lock:
+            self._load()
+            if self.sessions.pop(file_name, None) == None:
+                return True
+            return self._save()
+
+
+# the journal shared by every upload thread
+upload_journal = UploadJournal(Config.upload_journal_path)
@@ -1,5 +1,7 @@
-import math, tarfile, os, logging, json, shutil, mock, threading
+import math, tarfile, os, logging, json, shutil, mock, threading, queue
 from onedrive_offsite.config import Config
+from onedrive_offsite.cancellation import cancel_token
+from onedrive_offsite.quickxor import QuickXorHash
 
 
 if os.environ.get("TESTING_ENV") == "test" or os.environ.get("TESTING_ENV") == "test-dev":
@@ -42,6 +44,7 @@ def leading_zeros(number: int, max_number: int):
 
 def extract_tar_gz(targz_path: str, extract_dir: str, keep_targz=True) -> bool:
     try:
+        # tarfile detects the compression, so this works for both plain tar and tar.gz parts
         with tarfile.open(targz_path) as targz_file:
             targz_file.extractall(extract_dir)
     except Exception as e:
@@ -59,18 +62,26 @@ def extract_tar_gz(targz_path: str, extract_dir: str, keep_targz=True) -> bool:
 
 
 # function to create a tar.gz archive file from a collection of files located in a directory provided as a positional argument
-def make_tar_gz(dir_with_files: str, tar_gz_dir_path: str, max_chunks_to_add: int, base_file_name, removeorig=False):
+# with compress=False a plain tar file is created instead, which is what we want for encrypted chunks that won't compress
+def make_tar_gz(dir_with_files: str, tar_gz_dir_path: str, max_chunks_to_add: int, base_file_name, removeorig=False, compress=True):
 
     file_counter = 1  
     chunk_groups = get_file_groups(dir_with_files, max_chunks_to_add)    
 
+    if compress == True:
+        tar_mode = "x:gz"
+        archive_type = "tar.gz"
+    else:
+        tar_mode = "x"
+        archive_type = "tar"
+
     try:
         for files in chunk_groups:  
             # set leading zeros assuming we will never have more than 1000 tar.gz files to upload
             lead_zeros = leading_zeros(file_counter, 1000)          
-            # create a tar file and compress with gunzip
-            logger.info("creating tar.gz file {0}{1}".format(lead_zeros, file_counter))
-            with tarfile.open(os.path.join(tar_gz_dir_path, lead_zeros + str(file_counter) + "_" + base_file_name), "x:gz") as tar:                               
+            # create a tar file and, if requested, compress with gunzip
+            logger.info("creating {0} file {1}{2}".format(archive_type, lead_zeros, file_counter))
+            with tarfile.open(os.path.join(tar_gz_dir_path, lead_zeros + str(file_counter) + "_" + base_file_name), tar_mode) as tar:                               
                for file in files:
                     # add the specified file to the tar.gz file
                     # using path.join to build the full file path
@@ -80,7 +91,7 @@ def make_tar_gz(dir_with_files: str, tar_gz_dir_path: str, max_chunks_to_add: in
                     if removeorig==True:
                         os.remove(os.path.join(dir_with_files,file))
 
-            logger.info("done creating tar.gz file {0}{1}".format(lead_zeros, file_counter))
+            logger.info("done creating {0} file {1}{2}".format(archive_type, lead_zeros, file_counter))
             file_counter = file_counter + 1
 
     except Exception as e:
@@ -90,6 +101,56 @@ def make_tar_gz(dir_with_files: str, tar_gz_dir_path: str, max_chunks_to_add: in
     
     return True
 
+# calculate the size in bytes of an uncompressed tar archive containing files of the provided sizes
+# each member gets a 512 byte header and its data is padded to a multiple of 512 bytes, the archive ends with two
+# empty 512 byte blocks and is then padded to a multiple of the tar record size (10240 bytes)
+def tar_part_size(member_sizes: list) -> int:
+    archive_size = 0
+    for member_size in member_sizes:
+        archive_size = archive_size + tarfile.BLOCKSIZE + math.ceil(member_size/tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    archive_size = archive_size + 2 * tarfile.BLOCKSIZE
+
+    return math.ceil(archive_size/tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+class FragmentQueueWriter:
+    # file-like object that tarfile can write a stream to, the written bytes are cut into upload fragments of
+    # fragment_size_bytes and put on a bounded queue for an upload thread to consume
+    def __init__(self, fragment_q, fragment_size_bytes: int, stop_event):
+        self.fragment_q = fragment_q
+        self.fragment_size_bytes = fragment_size_bytes
+        self.stop_event = stop_event
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    def _put(self, fragment):
+        # block while the queue is full, but give up if the upload side has stopped
+        while True:
+            if self.stop_event.is_set():
+                raise IOError("fragment stream stopped")
+            try:
+                self.fragment_q.put(fragment, timeout=1)
+                return True
+            except queue.Full:
+                pass
+
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+        self.bytes_written = self.bytes_written + len(data)
+        while len(self.buffer) >= self.fragment_size_bytes:
+            self._put(bytes(self.buffer[:self.fragment_size_bytes]))
+            del self.buffer[:self.fragment_size_bytes]
+        return len(data)
+
+    def close(self):
+        # send whatever is left over as the last fragment, then None to signal the end of the stream
+        if len(self.buffer) > 0:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._put(None)
+
+
 def get_file_groups(dir: str, max_group_size: int) -> list:
     sub_group = []
     file_groups = []
@@ -110,18 +171,161 @@ def get_file_groups(dir: str, max_group_size: int) -> list:
 
 
 
+class FileRangeReader:
+    # file like object for length bytes of an open file starting at start_byte, so requests can stream an upload fragment from disk.
+    # it keeps its own position and seeks before every read, so more than one reader can share the same open file.
+    # with a QuickXorHash, the bytes are hashed the first time they're read, a retry sending the fragment again doesn't hash them twice.
+    # reads go into one buffer the reader keeps, so sending a fragment a block at a time doesn't allocate a new bytes object for every block
+    
+    def __init__(self, file_obj, start_byte: int, length: int, quick_xor: QuickXorHash=None):
+        self.file_obj = file_obj
+        self.start_byte = start_byte
+        self.length = length
+        self.position = 0
+        self.quick_xor = quick_xor
+        self.hashed_bytes = 0   # bytes at the start of the range already added to quick_xor
+        self._buffer = None     # reused by every read(), grown to the largest block asked for
+
+    def __len__(self):
+        # requests uses the length minus tell() as the size left to send
+        return self.length
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, position: int, whence: int=0) -> int:
+        if whence == 1:
+            position = self.position + position
+        elif whence == 2:
+            position = self.length + position
+        self.position = max(0, min(position, self.length))
+        return self.position
+
+    def read(self, size: int=-1) -> memoryview:
+        # requests reads the body a block at a time while sending, so this stops a fragment part way through when the job is cancelled.
+        # the returned view is over the reader's buffer and is only good until the next read(), http.client sends each block before reading another
+        if cancel_token.cancelled():
+            raise IOError("transfer cancelled")
+        if size == None or size < 0 or size > self.length - self.position:
+            size = self.length - self.position
+        if size == 0:
+            return b""
+        if self._buffer == None or len(self._buffer) < size:
+            self._buffer = bytearray(size)
+        self.file_obj.seek(self.start_byte + self.position, 0)
+        data = memoryview(self._buffer)[:size]
+        data = data[:self.file_obj.readinto(data)]
+        # only hash on from where the hashing left off, a read that skipped ahead is picked up by finish_hash()
+        if self.quick_xor != None and self.position <= self.hashed_bytes < self.position + len(data):
+            skip = self.hashed_bytes - self.position
+            self.quick_xor.update(self.start_byte + self.hashed_bytes, data[skip:])
+            self.hashed_bytes = self.position + len(data)
+        self.position = self.position + len(data)
+        return data
+
+    def finish_hash(self) -> bool:
+        # hash whatever part of the range wasn't read while it was sent, once onedrive has accepted the whole fragment
+        if self.quick_xor == None or self.hashed_bytes >= self.length:
+            return True
+        try:
+            self.file_obj.seek(self.start_byte + self.hashed_bytes, 0)
+            data = self.file_obj.read(self.length - self.hashed_bytes)
+        except Exception as e:
+            logger.error("problem reading fragment to finish its quickxor hash")
+            logger.error(e)
+            return False
+        if len(data) != self.length - self.hashed_bytes:
+            logger.error("fragment ended early while finishing its quickxor hash")
+            return False
+        self.quick_xor.update(self.start_byte + self.hashed_bytes, data)
+        self.hashed_bytes = self.length
+        return True
+
+    def tail(self, tail_bytes: int):
+        # reader for the last tail_bytes of this range, used to resend the part of a fragment onedrive didn't get.
+        # it doesn't hash, finish_hash() on this reader covers any of those bytes it didn't get to
+        tail_bytes = min(tail_bytes, self.length)
+        return FileRangeReader(self.file_obj, self.start_byte + self.length - tail_bytes, tail_bytes)
+
+
+
+GRAPH_FRAGMENT_LIMIT_BYTES = 62914560     # 60 MiB, onedrive only accepts upload requests smaller than this
+
+
+class FragmentSizer:
+    # picks the size of the next upload fragment from how fast the last ones went, so each fragment takes about target_seconds.
+    # big fragments on a fast link mean fewer round trips, small ones on a slow or flaky link keep a retry cheap and well inside the api timeout.
+    # sizes are always a multiple of range_factor_bytes between min_bytes and max_bytes, and at most double from one fragment to the next
+
+    def __init__(self, start_bytes: int, min_bytes: int, max_bytes: int, target_seconds: float, range_factor_bytes: int=327680):
+        self.range_factor_bytes = range_factor_bytes
+        self.min_bytes = max(range_factor_bytes, self._round(min_bytes))
+        self.max_bytes = max(self.min_bytes, self._round(min(max_bytes, GRAPH_FRAGMENT_LIMIT_BYTES - 1)))
+        self.target_seconds = target_seconds
+        self.bytes_per_second = None
+        self.size_bytes = self._clamp(start_bytes)
+
+    def _round(self, size_bytes: float) -> int:
+        return int(math.floor(size_bytes/self.range_factor_bytes) * self.range_factor_bytes)
+
+    def _clamp(self, size_bytes: float) -> int:
+        return max(self.min_bytes, min(self._round(size_bytes), self.max_bytes))
+
+    def next_size(self, sent_bytes: int, seconds: float) -> int:
+        # record a fragment of sent_bytes that took seconds and return the size for the next one
+        if sent_bytes <= 0 or seconds <= 0:
+            return self.size_bytes
+        measured = sent_bytes / seconds
+        if self.bytes_per_second == None:
+            self.bytes_per_second = measured
+        else:
+            # average with the earlier fragments so one slow or fast fragment doesn't swing the size too far
+            self.bytes_per_second = (self.bytes_per_second + measured) / 2
+        self.size_bytes = self._clamp(min(self.bytes_per_second * self.target_seconds, self.size_bytes * 2))
+        return self.size_bytes
+
+
+def upload_fragment_sizer():
+    # a new sizer for each upload session, or None to use fixed size fragments
+    if Config.adaptive_fragment_size != True:
+        return None
+    return FragmentSizer(int(Config.onedrive_upload_chunk_size_kb * 1000), int(Config.upload_fragment_min_kb * 1000),
+                         int(Config.upload_fragment_max_kb * 1000), Config.upload_fragment_target_seconds)
+
+
+def upload_quick_xor():
+    # a new hash for each upload session, or None when uploads aren't verified
+    if Config.upload_verify_hash != True:
+        return None
+    return QuickXorHash()
+
+
 class FilePartialRead:
     
-    def __init__(self, file_path, max_size_kb, range_factor_bytes=327680):
+    def __init__(self, file_path, max_size_kb, range_factor_bytes=327680, file_size=None, sizer=None, quick_xor=None):
         self.file_path = file_path
         self.max_size_bytes = int(max_size_kb * 1000)
-        self.file_size = os.path.getsize(file_path)
+        # a file size can be provided when the file doesn't exist on disk (ex: a streamed tar part)
+        if file_size == None:
+            self.file_size = os.path.getsize(file_path)
+        else:
+            self.file_size = file_size
 
         # --- Tryig to accomdoate this note from the Microsoft documentation with a default value of 327,680 bytes ---
         # Note: If your app splits a file into multiple byte ranges, the size of each byte range MUST be a multiple of 320 KiB (327,680 bytes).
         # Using a fragment size that does not divide evenly by 320 KiB will result in errors committing some files.
         self.range_factor_bytes = range_factor_bytes
 
+        # open file shared by the range readers, kept open until close() is called
+        self._file = None
+        self._prefetched_index = -1     # last upload_array index already handed to prefetch_fragments()
+
+        # with a FragmentSizer, the fragments still to upload are replanned after each one with record_fragment()
+        self.sizer = sizer
+
+        # with a QuickXorHash, every fragment is hashed as it's read for the upload, so the finished file can be checked against onedrive's hash
+        self.quick_xor = quick_xor
+
         self._calc_sizes_and_ranges()
     
     def _calc_sizes_and_ranges(self):
@@ -174,19 +378,120 @@ class FilePartialRead:
             ])  
 
 
-    # function to return a subset of data from a file in the form of bytes  
-    def read_file_bytes(self, start_byte: int, read_bytes: int) -> bytes:
+    def _plan_ranges(self, start_byte: int, range_size_bytes: int) -> list:
+        # upload_array entries from start_byte to the end of the file, every fragment but the last one is range_size_bytes
+        ranges = []
+        while start_byte < self.file_size:
+            content_len = min(range_size_bytes, self.file_size - start_byte)
+            ranges.append([content_len, start_byte, str(start_byte) + "-" + str(start_byte + content_len - 1)])
+            start_byte = start_byte + content_len
+        return ranges
+
+    # drop the fragments before start_byte when a journaled upload session is resumed, onedrive already has them
+    def resume_from(self, start_byte: int):
+        if start_byte <= 0:
+            return
+        self.upload_array = self._plan_ranges(start_byte, self.file_range_size_bytes)
+        self._prefetched_index = -1
+        if self.quick_xor != None:
+            self._hash_prefix(start_byte)
+
+    # the fragments onedrive already has still have to be in the hash of the whole file, so read them once here.
+    # if they can't be read the upload carries on without being verified
+    def _hash_prefix(self, end_byte: int):
         try:
-            with open(self.file_path, 'rb') as file:
-                # the 0 indicates to start from the beginning of the file before offsetting
-                file.seek(start_byte, 0)
-                file_data = file.read(read_bytes)
+            if self._file == None:
+                self._file = open(self.file_path, 'rb')
+            self._file.seek(0, 0)
+            while self.quick_xor.length < end_byte:
+                data = self._file.read(min(1048576, end_byte - self.quick_xor.length))
+                if not data:
+                    raise IOError("file ended at byte {0}".format(self.quick_xor.length))
+                self.quick_xor.update(self.quick_xor.length, data)
         except Exception as e:
-            logger.error("problem reading file in read_file_bytes")
+            logger.warning("problem hashing the part of {0} already uploaded, the upload won't be verified".format(os.path.basename(self.file_path)))
+            logger.warning(e)
+            self.quick_xor = None
+
+    # the quickXorHash of the whole file once every fragment has been hashed, None if the upload isn't being verified
+    def upload_hash(self) -> str:
+        if self.quick_xor == None or self.quick_xor.length != self.file_size:
+            return None
+        return self.quick_xor.b64digest()
+
+    # record how long upload_array[index] took to upload, and if the sizer picks a new fragment size, replan the rest of the file with it.
+    # onedrive only needs each fragment to be a multiple of 320 KiB, they don't all have to be the same size
+    def record_fragment(self, index: int, seconds: float):
+        if self.sizer == None:
+            return
+        chunks = self.upload_array[index]
+        next_start = chunks[1] + chunks[0]
+        new_size = self.sizer.next_size(chunks[0], seconds)
+        if new_size == self.file_range_size_bytes or next_start >= self.file_size:
+            return
+        logger.info("fragment size for {0} changed from {1} to {2} bytes at byte {3} ({4:.1f} MB/s)".format(
+            os.path.basename(self.file_path), self.file_range_size_bytes, new_size, next_start, self.sizer.bytes_per_second / 1000000))
+        self.file_range_size_bytes = new_size
+        self.upload_array[index + 1:] = self._plan_ranges(next_start, new_size)
+        # the replanned fragments haven't been prefetched yet
+        self._prefetched_index = index
+
+    # a reader over a fragment of the file, for uploading straight from disk without holding the fragment in memory
+    def range_reader(self, start_byte: int, read_bytes: int):
+        try:
+            if self._file == None:
+                self._file = open(self.file_path, 'rb')
+            return FileRangeReader(self._file, start_byte, min(read_bytes, self.file_size - start_byte), quick_xor=self.quick_xor)
+        except Exception as e:
+            logger.error("problem opening file in range_reader")
             logger.error(e)
+            self.close()
             return None
 
-        return file_data
+    # start reading the fragments after upload_array[index] into the os page cache, at most depth fragments and max_bytes ahead.
+    # posix_fadvise asks the kernel to read them in the background, where it isn't available (windows) a thread reads them instead
+    def prefetch_fragments(self, index: int, depth: int, max_bytes: int) -> bool:
+        if depth <= 0 or max_bytes <= 0:
+            return True
+        depth = min(depth, max(1, math.floor(max_bytes/self.file_range_size_bytes)))
+        try:
+            if self._file == None:
+                self._file = open(self.file_path, 'rb')
+            for chunks in self.upload_array[max(index + 1, self._prefetched_index + 1):index + 1 + depth]:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(self._file.fileno(), chunks[1], chunks[0], os.POSIX_FADV_WILLNEED)
+                else:
+                    threading.Thread(target=self._warm_range, args=(chunks[1], chunks[0]), daemon=True).start()
+            self._prefetched_index = max(self._prefetched_index, index + depth)
+            return True
+        except Exception as e:
+            logger.error("problem prefetching file fragments in prefetch_fragments")
+            logger.error(e)
+            return False
+
+    def _warm_range(self, start_byte: int, read_bytes: int):
+        # read a range with a separate file handle and throw the data away, leaving it in the page cache for the upload
+        buffer_view = memoryview(bytearray(1048576))
+        try:
+            with open(self.file_path, 'rb') as file:
+                file.seek(start_byte, 0)
+                while read_bytes > 0:
+                    bytes_read = file.readinto(buffer_view[:min(read_bytes, len(buffer_view))])
+                    if not bytes_read:
+                        break
+                    read_bytes = read_bytes - bytes_read
+        except Exception as e:
+            logger.warning("problem warming file range in _warm_range")
+            logger.warning(e)
+
+    def close(self):
+        if self._file != None:
+            try:
+                self._file.close()
+            except Exception as e:
+                logger.error("problem closing file in FilePartialRead")
+                logger.error(e)
+            self._file = None
 
 
 def ses_send_email(to_email_address: str, from_email_address: str, email_from_name: str, email_message_txt: str, email_subject: str, ses_aws_region: str ) -> bool:
@@ -1,10 +1,13 @@
-from onedrive_offsite.onedrive import OneDriveLargeUpload, MSGraphCredMgr, OneDriveDirMgr, OneDriveGetItemDetails, OneDriveFileDownloadMgr, OneDriveItemGetter
-from onedrive_offsite.utils import FilePartialRead, extract_tar_gz
+from onedrive_offsite.onedrive import OneDriveLargeUpload, MSGraphCredMgr, OneDriveDirMgr, OneDriveGetItemDetails, OneDriveFileDownloadMgr, OneDriveItemGetter, DOWNLOAD_PROGRESS_SUFFIX
+from onedrive_offsite.utils import FilePartialRead, FragmentQueueWriter, extract_tar_gz, upload_fragment_sizer, upload_quick_xor
 from onedrive_offsite.config import Config
-from onedrive_offsite.crypt import Crypt, Sha256Calc
-from time import sleep
+from onedrive_offsite.crypt import Crypt, Sha256Calc, ChunkSha256
+from onedrive_offsite.concurrency import upload_controller, download_controller
+from onedrive_offsite.cancellation import cancel_token
+from onedrive_offsite.dedup import read_manifest, manifest_packs, restore_from_manifest, MANIFEST_SUFFIX
+from time import time
 from datetime import datetime, timedelta
-import os, logging, queue, threading, json
+import os, logging, queue, threading, json, tarfile, io
 
 # Logging setup
 logger = logging.getLogger(__name__)
@@ -37,9 +40,25 @@ def _check_token_read(msgcm, targz_file, upload_attempted_q, kill_q):
     return True        
 
 
-def flood_kill_queue(kill_q):
+def flood_kill_queue(kill_q, cancel_reason: str=None):
     for i in range(0,20):
         kill_q.put("kill")
+    # wake up threads waiting in wait_for_kill()
+    cancel_token.stop()
+    # when the job failed, also wake up retry waits and stop fragments in flight, instead of leaving threads asleep until they next
+    # check the kill queue. a job that finished, or a thread passing on a kill it was given, has nothing left to cancel
+    if cancel_reason != None:
+        cancel_token.cancel(cancel_reason)
+
+
+QUEUE_WAIT_SECONDS = 5  # how long a worker or manager blocks on its queue before checking the kill queue again
+
+def wait_for_kill(kill_q, seconds) -> bool:
+    # sleep for up to seconds, but wake up as soon as flood_kill_queue() is called, returns True if the kill queue isn't empty
+    if not kill_q.empty():
+        return True
+    cancel_token.wait_stopped(seconds)
+    return not kill_q.empty()
 
 
 def upload_status_gen(targz_filename, status, msg=""):
@@ -56,7 +75,7 @@ def publish_to_attempted_q(q_msg, upload_attempted_q, kill_q):
     except Exception as e:
         logger.error("thread: {0} - problem putting msg on upload attempted queue, flooding kill queue".format(thread_name))
         logger.error(e)
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "could not publish to the attempted queue")
         return False
 
 
@@ -117,21 +136,34 @@ def _write_to_lock_file(lock_status: str):
     return True
 
 
-def token_refresh_worker(kill_q, error_q):
+def token_refresh_worker(kill_q, error_q, tokens_ready=None):
+    # tokens_ready is set as soon as the other threads can use the tokens, so they don't have to sleep and hope.
+    # it is also set when this worker exits for any reason, so nothing waits on it forever
+    if tokens_ready == None:
+        tokens_ready = threading.Event()
+    try:
+        return _token_refresh_loop(kill_q, error_q, tokens_ready)
+    finally:
+        tokens_ready.set()
+
+
+def _token_refresh_loop(kill_q, error_q, tokens_ready):
 
     thread_name = threading.current_thread().getName()
     logger.info("thread: {0} - token refresh worker thread starting".format(thread_name)) 
 
     while _lock_file_check() == True:
         logger.info("thread: {0} - in lock file loop".format(thread_name)) 
+        # another process is refreshing the tokens, so they can be used while we wait for our turn
+        tokens_ready.set()
         if not kill_q.empty():
             return None
-        sleep(300)
+        wait_for_kill(kill_q, 300)
     
     # update lock file to locked since we are going to refresh credentials
     if not _write_to_lock_file("locked"):
         logger.error("thread: {0} - could not write to lock file, flooding kill queue".format(thread_name))
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "could not lock the token file")
         write_to_error_q(error_q)
         _write_to_lock_file("not locked")
         return None
@@ -140,10 +172,11 @@ def token_refresh_worker(kill_q, error_q):
     msgcm_obj = token_refresh_cycle()                         # initial token refresh
     if msgcm_obj == False:
         logger.error("thread: {0} - token refresh worker failed to refresh tokens".format(thread_name))
-        flood_kill_queue(kill_q)                                                    # make sure the rest of the threads know to stop
+        flood_kill_queue(kill_q, "token refresh failed")                            # make sure the rest of the threads know to stop
         write_to_error_q(error_q)
         _write_to_lock_file("not locked")
         return False
+    tokens_ready.set()
 
     retry = 0    
     while kill_q.empty():                                                           # keep looping to make sure the token is refreshed during the upload process
@@ -159,7 +192,7 @@ def token_refresh_worker(kill_q, error_q):
 
             if check_refresh == False and retry > 1:
                 logger.error("thread: {0} - token refresh worker failed to refresh tokens".format(thread_name))
-                flood_kill_queue(kill_q)                                            # make sure the rest of the threads know to stop
+                flood_kill_queue(kill_q, "token refresh failed")                    # make sure the rest of the threads know to stop
                 write_to_error_q(error_q)
                 _write_to_lock_file("not locked")
                 return False
@@ -169,7 +202,7 @@ def token_refresh_worker(kill_q, error_q):
                 retry = retry + 1
             else:
                 retry = 0
-        sleep(60)                                                                   # wait for one minute to check the token expiration again
+        wait_for_kill(kill_q, 60)                                                   # wait for one minute to check the token expiration again, or until the kill queue fills
     
     if not _write_to_lock_file("not locked"):
         logger.error("thread: {0} - could not write to lock file to unlock".format(thread_name))
@@ -189,8 +222,8 @@ def _worker_upload(bytes_to_send, targz_file, chunks, fpr, upload_attempted_q, k
     thread_name = threading.current_thread().getName()
 
     if bytes_to_send == None:
-        logger.error("thread: {0} - no bytes read in with read_file_bytes()".format(thread_name))
-        q_msg = upload_status_gen(targz_file, "error", "no bytes read in with read_file_bytes()" )
+        logger.error("thread: {0} - unable to read fragment from {1}".format(thread_name, targz_file))
+        q_msg = upload_status_gen(targz_file, "error", "unable to read fragment" )
         publish_to_attempted_q(q_msg, upload_attempted_q, kill_q)
         return "error-empty-bytes"
 
@@ -219,17 +252,38 @@ def _worker_upload(bytes_to_send, targz_file, chunks, fpr, upload_attempted_q, k
 def _worker_chunk_loop(fpr, targz_file, upload_attempted_q, kill_q, odlu):
 
     # loop through the calculated chunks and upload them
-    for chunks in fpr.upload_array:
+    # with adaptive fragment sizes the chunks after the current one can be replanned, so check the length of upload_array every time through
+    i = 0
+    while i < len(fpr.upload_array):
+        chunks = fpr.upload_array[i]
         if kill_q.empty():  # make sure the kill queue is still empty between each upload attempt
-            bytes_to_send = fpr.read_file_bytes(chunks[1], fpr.file_range_size_bytes)
+            # get the next fragments coming off the disk while this one is being sent
+            fpr.prefetch_fragments(i, Config.upload_prefetch_depth, int(Config.upload_prefetch_max_mb * 1000000))
+            # stream the fragment from disk, so memory use doesn't grow with the fragment size or through retries
+            bytes_to_send = fpr.range_reader(chunks[1], chunks[0])
 
+            start_time = time()
             upload_result = _worker_upload(bytes_to_send, targz_file, chunks, fpr, upload_attempted_q, kill_q, odlu)
             
             if upload_result == "error-empty-bytes" or upload_result == "upload-failed":
                 return "upload-failed"
 
+            # a fragment that couldn't be fully hashed leaves the file's hash incomplete, so the upload can't be verified
+            if not bytes_to_send.finish_hash():
+                q_msg = upload_status_gen(targz_file, "error", "unable to finish the quickxor hash of a fragment")
+                publish_to_attempted_q(q_msg, upload_attempted_q, kill_q)
+                return "upload-failed"
+            fpr.record_fragment(i, time() - start_time)
+
         else:
             return "kill-q"
+        i = i + 1
+
+    # check the whole file against the hash onedrive has for it, a mismatch fails the upload so the file is sent again
+    if fpr.quick_xor != None and not odlu.verify_upload(fpr.upload_hash()):
+        q_msg = upload_status_gen(targz_file, "error", "uploaded file does not match onedrive hash")
+        publish_to_attempted_q(q_msg, upload_attempted_q, kill_q)
+        return "upload-failed"
     
     return "upload-success"
 
@@ -238,8 +292,8 @@ def _worker_start_upload_session(odlu,msgcm, targz_file, upload_attempted_q, kil
 
     thread_name = threading.current_thread().getName()    
 
-    # initialize the upload session to retrieve the upload URL
-    if odlu.initiate_upload_session(msgcm.access_token) == False:
+    # resume the journaled upload session for this file, or initialize a new one to retrieve the upload URL
+    if odlu.open_upload_session(msgcm.access_token) == False:
         q_msg = upload_status_gen(targz_file, "error", "unable to initiate upload session")
         logger.info("thread: {0} - queue msg: {1}".format(thread_name, str(q_msg)))
         publish_to_attempted_q(q_msg, upload_attempted_q, kill_q)
@@ -257,17 +311,28 @@ def file_upload_worker(to_upload_q, upload_attempted_q, kill_q):
     file_upload_status = None
 
     while kill_q.empty():
+        # wait for the concurrency controller to let one more file upload, it can allow fewer uploads than there are worker threads
+        if not upload_controller.acquire(timeout=5):
+            continue
         try:
             start_time = datetime.now() # reset the start_time variable, since we had a message on the queue   
-            targz_file = to_upload_q.get_nowait()         
+            targz_file = to_upload_q.get(timeout=QUEUE_WAIT_SECONDS)
+            if targz_file == None:
+                # None means the manager is done, leave it on the queue for the next worker
+                to_upload_q.put(None)
+                break
             odlu = OneDriveLargeUpload(targz_file) # instantiate the OneDriveLargUpload object, using the same file name as the encrypted tar.gz files
             msgcm = MSGraphCredMgr()
 
             if _check_token_read(msgcm, targz_file, upload_attempted_q, kill_q): # if we can read the tokens, move forward
 
                 if _worker_start_upload_session(odlu, msgcm, targz_file, upload_attempted_q, kill_q): # if we can successfully initiate an upload session, move forward                    
-                    fpr = FilePartialRead(os.path.join(Config.crypt_tar_gz_dir, targz_file), Config.onedrive_upload_chunk_size_kb) # instantiate the FilePartialRead object which will calculate how to break up the backup file during the upload
-                    upload_chunks_result = _worker_chunk_loop(fpr, targz_file, upload_attempted_q, kill_q, odlu)
+                    fpr = FilePartialRead(os.path.join(Config.crypt_tar_gz_dir, targz_file), Config.onedrive_upload_chunk_size_kb, sizer=upload_fragment_sizer(), quick_xor=upload_quick_xor()) # instantiate the FilePartialRead object which will calculate how to break up the backup file during the upload
+                    fpr.resume_from(odlu.next_byte) # skip what onedrive already has from a resumed session
+                    try:
+                        upload_chunks_result = _worker_chunk_loop(fpr, targz_file, upload_attempted_q, kill_q, odlu)
+                    finally:
+                        fpr.close()
 
                     if upload_chunks_result == "upload-success":
                         upload_failed = False
@@ -293,7 +358,8 @@ def file_upload_worker(to_upload_q, upload_attempted_q, kill_q):
                 logger.info("thread: {0} - the to upload queue has been empty for more than 2 hrs, exiting this thread".format(thread_name))
                 file_upload_status = "to-upload-empty-too-long"
                 break
-            sleep(5) # if the to upload queue is empty, wait a bit for it to get some more data
+        finally:
+            upload_controller.release()
         
     try:
         kill_data = kill_q.get_nowait()
@@ -324,7 +390,7 @@ def _prime_to_upload_q(upload_file_list: list, to_upload_q, kill_q, error_q):
             logger.error("thread: {0} - error putting targz files on the to upload queue".format(thread_name))
             logger.error(e)
             logger.error("thread: {0} - flooding kill queue".format(thread_name))
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "could not queue the files to upload")
             write_to_error_q(error_q)
             return False
     return upload_mgmt
@@ -338,7 +404,7 @@ def _put_file_back_on_q(file_name: str, to_upload_q, kill_q, error_q):
     except:
         logger.error("thread {0} - problem putting file: {1} back on the to upload queue, flooding the kill queue".format(thread_name, file_name))
         write_to_error_q(error_q)
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "could not requeue a failed upload")
         return False
     
     return True
@@ -361,7 +427,7 @@ def _evaluate_upload_mgmt(upload_mgmt: dict, kill_q, error_q):
     
     if exceed_retry == True:
         logger.error("thread {0} - too many upload attempts, putting kill on kill queue".format(thread_name))
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "too many upload attempts")
         write_to_error_q(error_q)
         return False    
     return None
@@ -370,10 +436,9 @@ def _empty_check(start_time, kill_q, error_q):
     thread_name = threading.current_thread().getName()
     if (datetime.now() - start_time).total_seconds()/60/60 > 4: # if no messages have been posted to the upload attempted queue for four hrs, flood the kill queue
         logger.error("thread: {0} - the attempted queue has been empty for more than 4 hours, something is wrong, flooding the kill queue".format(thread_name))
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "upload queue stalled")
         write_to_error_q(error_q)
         return False
-    sleep(5) # wait for a bit before checking the queue again
     return None
 
 def upload_manager(upload_file_list, to_upload_q, upload_attempted_q, kill_q, error_q):
@@ -387,7 +452,7 @@ def upload_manager(upload_file_list, to_upload_q, upload_attempted_q, kill_q, er
     start_time = datetime.now()    # initialize the start time variable so that we can prevent this thread from running forever
     while kill_q.empty():
         try:
-            upload_info = upload_attempted_q.get_nowait()
+            upload_info = upload_attempted_q.get(timeout=QUEUE_WAIT_SECONDS)
             start_time = datetime.now() # reset the start_time variable
             logger.info("thread: {0} - upload status msg: {1}".format(thread_name, upload_info))
             logger.info("thread: {0} - current upload_mgmt: {1}".format(thread_name, upload_mgmt))
@@ -414,6 +479,150 @@ def upload_manager(upload_file_list, to_upload_q, upload_attempted_q, kill_q, er
     write_to_error_q(error_q)
     return False
 
+###############################################################################################################
+##### ------------------------------- STREAMING UPLOAD WORKER AND HELPER FUNCTIONS ------------------------------------
+
+def _stream_part_producer(crypt, backup_file_path: str, part: dict, fragment_q, fragment_size_bytes: int, stop_event, chunk_hash):
+    thread_name = threading.current_thread().getName()
+    writer = FragmentQueueWriter(fragment_q, fragment_size_bytes, stop_event)
+
+    try:
+        # write an uncompressed tar stream, the encrypted chunks won't compress and we need to know the part size before we start uploading
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            for chunk_num, chunk_name, plain_bytes, encrypted in crypt.chunk_encrypt_stream(backup_file_path, Config.crypt_chunk_size_mb, part["first-chunk"], part["chunk-count"],
+                                                                                                      workers=Config.crypt_workers, max_in_flight=Config.crypt_max_in_flight):
+                chunk_hash.update(chunk_num, plain_bytes)
+                tarinfo = tarfile.TarInfo(chunk_name)
+                tarinfo.size = len(encrypted)
+                tarinfo.mtime = int(time())
+                tar.addfile(tarinfo, io.BytesIO(encrypted))
+                crypt.log_chunk(chunk_num, chunk_name)
+        writer.close()
+        logger.info("thread: {0} - finished streaming {1} ({2} bytes)".format(thread_name, part["name"], writer.bytes_written))
+        return True
+
+    except Exception as e:
+        if stop_event.is_set():
+            logger.info("thread: {0} - stopped streaming {1}".format(thread_name, part["name"]))
+            return None
+        logger.error("thread: {0} - problem building stream for {1}".format(thread_name, part["name"]))
+        logger.error(e)
+        try:
+            writer._put(False) # let the upload side know the stream is broken
+        except Exception:
+            pass
+        return False
+
+
+def _stream_get_fragment(fragment_q, kill_q, producer):
+    thread_name = threading.current_thread().getName()
+
+    while kill_q.empty():
+        try:
+            return fragment_q.get(timeout=5)
+        except queue.Empty:
+            if not producer.is_alive() and fragment_q.empty():
+                logger.error("thread: {0} - stream producer exited before sending all fragments".format(thread_name))
+                return False
+    return False
+
+
+def _stream_part_upload(odlu, fpr, part_name: str, fragment_q, kill_q, producer):
+    thread_name = threading.current_thread().getName()
+    attempted_q = queue.Queue()     # _worker_upload() reports errors here, stream_upload_worker() handles retries itself
+
+    for chunks in fpr.upload_array:
+        if not kill_q.empty():
+            return "kill-q"
+
+        fragment = _stream_get_fragment(fragment_q, kill_q, producer)
+        if not fragment:
+            fragment = None
+        elif len(fragment) != chunks[0]:
+            logger.error("thread: {0} - streamed fragment size {1} does not match expected size {2} for {3}".format(thread_name, len(fragment), chunks[0], part_name))
+            odlu.cancel_upload_session()
+            return "upload-failed"
+
+        upload_result = _worker_upload(fragment, part_name, chunks, fpr, attempted_q, kill_q, odlu)
+        if upload_result == "error-empty-bytes":
+            odlu.cancel_upload_session()
+            return "upload-failed"
+        if upload_result == "upload-failed":
+            return "upload-failed"
+
+    return "upload-success"
+
+
+def _stream_part(crypt, backup_file_path: str, part: dict, chunk_hash, kill_q):
+    thread_name = threading.current_thread().getName()
+
+    odlu = OneDriveLargeUpload(part["name"])
+    msgcm = MSGraphCredMgr()
+    if msgcm.read_tokens() == False:
+        logger.warning("thread: {0} - problem reading credentials file".format(thread_name))
+        return "upload-failed"
+
+    if odlu.initiate_upload_session(msgcm.access_token) == False:
+        logger.warning("thread: {0} - unable to initiate upload session for {1}".format(thread_name, part["name"]))
+        return "upload-failed"
+
+    fpr = FilePartialRead(part["name"], Config.onedrive_upload_chunk_size_kb, file_size=part["size-bytes"])
+    fragment_q = queue.Queue(maxsize=Config.stream_queue_depth)
+    stop_event = threading.Event()
+    producer = threading.Thread(target=_stream_part_producer, name=thread_name + "-producer",
+                                args=[crypt, backup_file_path, part, fragment_q, fpr.file_range_size_bytes, stop_event, chunk_hash])
+    producer.start()
+
+    upload_result = _stream_part_upload(odlu, fpr, part["name"], fragment_q, kill_q, producer)
+
+    if upload_result != "upload-success":
+        stop_event.set()
+    producer.join()
+
+    return upload_result
+
+
+def stream_upload_worker(backup_file_path: str, stream_parts: list, chunk_hash, kill_q, error_q):
+    thread_name = threading.current_thread().getName()
+    logger.info("starting thread {0}".format(thread_name))
+
+    # part sizes are worked out before anything is encrypted, so zero runs can't be shrunk here
+    crypt = Crypt(Config.key_path, elide_zeros=False)
+    if crypt.fetch_key() == False:
+        logger.error("thread: {0} - unable to fetch encryption key, flooding kill queue".format(thread_name))
+        flood_kill_queue(kill_q, "no encryption key")
+        write_to_error_q(error_q)
+        return False
+
+    # parts are streamed one at a time and in order, so the backup file is read once from start to finish and chunk_hash is fed in order.
+    # this is slower than the 5 staged upload workers, see the streaming upload comment in config.py
+    for part in stream_parts:
+        attempts = 0
+        part_done = False
+        while part_done == False:
+            if not kill_q.empty():
+                logger.error("thread: {0} - kill queue not empty, stream worker exiting".format(thread_name))
+                write_to_error_q(error_q)
+                return False
+
+            part_result = _stream_part(crypt, backup_file_path, part, chunk_hash, kill_q)
+            if part_result == "upload-success":
+                logger.info("thread: {0} - finished uploading {1} successfully".format(thread_name, part["name"]))
+                part_done = True
+            else:
+                attempts = attempts + 1
+                if attempts > Config.stream_part_retries:
+                    logger.error("thread: {0} - too many upload attempts for {1}, flooding kill queue".format(thread_name, part["name"]))
+                    flood_kill_queue(kill_q, "too many streaming upload attempts")
+                    write_to_error_q(error_q)
+                    return False
+                logger.warning("thread: {0} - problem streaming {1}, retry attempt {2}".format(thread_name, part["name"], attempts))
+
+    logger.info("thread: {0} - streaming uploads are complete, putting kill on kill queue".format(thread_name))
+    flood_kill_queue(kill_q)
+    return True
+
+
 #######################################################################################################################
 ##### ----------------------------------------------- DIR MANAGER -----------------------------------------------------
 
@@ -436,14 +645,14 @@ def dir_manager(kill_q, error_q, dir_complete_q):
 
     if oddm.dir_name == None:
         logger.error("thread: {0} - problem retrieving dir_name, flooding kill queue".format(thread_name))
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "no onedrive directory name")
         write_to_error_q(error_q)
         _write_to_dir_complete_q(dir_complete_q)
         return None
     
     if not oddm.create_dir():
         logger.error("thread: {0} - unable to verify or create onedrive directory, flooding kill queue".format(thread_name))
-        flood_kill_queue(kill_q)
+        flood_kill_queue(kill_q, "could not create the onedrive directory")
         write_to_error_q(error_q)
         _write_to_dir_complete_q(dir_complete_q)
         return None
@@ -456,6 +665,48 @@ def dir_manager(kill_q, error_q, dir_complete_q):
 #######################################################################################################################
 ##### ------------------------------------------------ DOWNLOADS ------------------------------------------------------
 
+# the file system side of DownloadManager._create_download_dir() and DownloadWorker._remove_failed_download(), without the queues,
+# so the async transfer engine can use them too. they return None when the download can't go on
+def _make_download_dir() -> bool:
+    thread_name = threading.current_thread().getName()
+
+    if not os.path.isdir(Config.download_dir):
+        try:
+            os.mkdir(Config.download_dir)
+            logger.info("thread: {0} - created download directory {1}".format(thread_name, Config.download_dir))
+            return True
+
+        except Exception as e:
+            logger.error("thread: {0} - problem creating download directory".format(thread_name))
+            logger.error(e)
+            return None
+    
+    return False
+
+def _remove_download_file(file_name: str) -> bool:
+    thread_name = threading.current_thread().getName()
+
+    file_path = os.path.join(Config.download_dir, file_name)
+
+    # a download with a progress record can pick up from its last synced byte, so leave it for the next attempt
+    if os.path.isfile(file_path + DOWNLOAD_PROGRESS_SUFFIX):
+        logger.info("thread: {0} - keeping failed download file {1} so the next attempt can resume it".format(thread_name, file_path))
+        return True
+
+    if os.path.isfile(file_path):
+        try:
+            os.remove(file_path)
+            logger.info("thread: {0} - failed download file {1} removed".format(thread_name, file_path))
+            return True
+        except Exception as e:
+            logger.error("thread: {0} - failed to remove failed download file".format(thread_name))
+            logger.error(e)
+            return None
+    else:
+        logger.warning("thread: {0} - no failed file found to delete, checked {1}".format(thread_name, file_path))
+        return True
+
+
 class DownloadManager:
 
     @staticmethod
@@ -528,9 +779,62 @@ class DownloadManager:
         if not file_list:
             logger.error("thread: {0} - problem getting file list".format(thread_name))
             return None
+
+        for item in file_list:
+            if item.get("name").endswith(MANIFEST_SUFFIX):
+                return DownloadManager._get_dedup_download_list(item, dir_name, file_list, msgcm.access_token)
         
         return file_list
 
+    @staticmethod
+    def _get_dedup_download_list(manifest_item: dict, dir_name: str, file_list: list, access_token: str) -> list:
+        # a dedup backup needs tar parts from earlier backup directories too, download its manifest first to find out which ones
+        thread_name = threading.current_thread().getName()
+
+        manifest_path = os.path.join(Config.download_dir, manifest_item.get("name"))
+        try:
+            if os.path.isfile(manifest_path):
+                os.remove(manifest_path)
+        except Exception as e:
+            logger.error("thread: {0} - problem removing old manifest {1}".format(thread_name, manifest_path))
+            logger.error(e)
+            return None
+
+        manifest_info = OneDriveGetItemDetails.get_details(manifest_item.get("id"), access_token)
+        if not manifest_info:
+            logger.error("thread: {0} - problem getting manifest details".format(thread_name))
+            return None
+
+        odfdm = OneDriveFileDownloadMgr(manifest_info.get("download_url"), manifest_info.get("size_bytes"), Config.download_chunk_size_b, manifest_path, manifest_info.get("sha256hash"), quick_xor_hash=manifest_info.get("quickxorhash"))
+        if odfdm.download_file() != True:
+            logger.error("thread: {0} - problem downloading manifest {1}".format(thread_name, manifest_item.get("name")))
+            return None
+
+        manifest = read_manifest(Crypt(Config.key_path), manifest_path)
+        if not manifest:
+            return None
+
+        dir_items = {dir_name: file_list}
+        download_list = []
+        for onedrive_dir, pack in manifest_packs(manifest):
+            if onedrive_dir not in dir_items:
+                dir_items[onedrive_dir] = OneDriveItemGetter(access_token, onedrive_dir).get_dir_items()
+                if not dir_items[onedrive_dir]:
+                    logger.error("thread: {0} - problem getting file list for {1}".format(thread_name, onedrive_dir))
+                    return None
+
+            pack_item = None
+            for item in dir_items[onedrive_dir]:
+                if item.get("name") == pack:
+                    pack_item = item
+            if not pack_item:
+                logger.error("thread: {0} - {1} is missing from {2}, the backup can't be restored".format(thread_name, pack, onedrive_dir))
+                return None
+            download_list.append(pack_item)
+
+        logger.info("thread: {0} - dedup backup needs {1} tar parts from {2} directories".format(thread_name, len(download_list), len(dir_items)))
+        return download_list
+
     @staticmethod
     def _put_file_back_on_q(id: str, name: str, to_download_q, kill_q, error_q) -> bool:
         thread_name = threading.current_thread().getName()
@@ -541,7 +845,7 @@ class DownloadManager:
         except:
             logger.error("thread {0} - problem putting file: {1} back on the to download queue, flooding the kill queue".format(thread_name, name))
             write_to_error_q(error_q)
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "could not requeue a failed download")
             return None
         
         return True
@@ -565,29 +869,18 @@ class DownloadManager:
         
         if exceed_retry == True:
             logger.error("thread {0} - too many download attempts, putting kill on kill queue".format(thread_name))
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "too many download attempts")
             write_to_error_q(error_q)
             return False    
         return None
     
     @staticmethod
     def _create_download_dir(kill_q, error_q) -> bool:
-        thread_name = threading.current_thread().getName()
-
-        if not os.path.isdir(Config.download_dir):
-            try:
-                os.mkdir(Config.download_dir)
-                logger.info("thread: {0} - created download directory {1}".format(thread_name, Config.download_dir))
-                return True
-
-            except Exception as e:
-                logger.error("thread: {0} - problem creating download directory".format(thread_name))
-                logger.error(e)
-                flood_kill_queue(kill_q)
-                write_to_error_q(error_q)
-                return None
-        
-        return False
+        check_dir = _make_download_dir()
+        if check_dir == None:
+            flood_kill_queue(kill_q, "could not create the download directory")
+            write_to_error_q(error_q)
+        return check_dir
     
     @staticmethod
     def manage_downloads(to_download_q, download_attempted_q, kill_q, error_q):
@@ -597,7 +890,7 @@ class DownloadManager:
 
         file_list = DownloadManager._get_download_list()
         if not file_list:
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "no files to download")
             write_to_error_q(error_q)
             return None
 
@@ -605,7 +898,7 @@ class DownloadManager:
 
         download_mgr = DownloadManager._prime_to_download_q(to_download_q, file_list)
         if not download_mgr:
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "could not queue the files to download")
             write_to_error_q(error_q)
             return None
         
@@ -615,7 +908,7 @@ class DownloadManager:
         start_time = datetime.now()    # initialize the start time variable so that we can prevent this thread from running forever
         while kill_q.empty():
             try:
-                download_info = download_attempted_q.get_nowait()
+                download_info = download_attempted_q.get(timeout=QUEUE_WAIT_SECONDS)
                 start_time = datetime.now() # reset the start_time variable
                 logger.info("thread: {0} - downlaod status msg: {1}".format(thread_name, download_info))
                 logger.info("thread: {0} - current download_mgr: {1}".format(thread_name, download_mgr))
@@ -654,7 +947,7 @@ class DownloadWorker:
         except Exception as e:
             logger.error("thread: {0} - problem putting msg on download attempted queue, flooding kill queue".format(thread_name))
             logger.error(e)
-            flood_kill_queue(kill_q)
+            flood_kill_queue(kill_q, "could not publish to the download attempted queue")
             return False
 
 
@@ -670,25 +963,11 @@ class DownloadWorker:
 
     @staticmethod
     def _remove_failed_download(file_name: str, kill_q, error_q) -> bool:
-        thread_name = threading.current_thread().getName()
-
-        file_path = os.path.join(Config.download_dir, file_name)
-
-        if os.path.isfile(file_path):
-            try:
-                os.remove(file_path)
-                logger.info("thread: {0} - failed download file {1} removed".format(thread_name, file_path))
-                return True
-            except Exception as e:
-                logger.error("thread: {0} - failed to remove failed download file, flood kill queue".format(thread_name))
-                logger.error(e)
-                flood_kill_queue(kill_q)
-                write_to_error_q(error_q)
-                return None
-        else:
-            logger.warning("thread: {0} - no failed file found to delete, checked {1}".format(thread_name, file_path))
-            return True
-                
+        check_remove = _remove_download_file(file_name)
+        if check_remove == None:
+            flood_kill_queue(kill_q, "could not remove a failed download")
+            write_to_error_q(error_q)
+        return check_remove
 
     @staticmethod
     def download_worker(to_download_q, download_attempted_q, kill_q, error_q):
@@ -701,16 +980,23 @@ class DownloadWorker:
         #file_download_status = None
 
         while kill_q.empty():
+            # wait for the concurrency controller to let one more file download
+            if not download_controller.acquire(timeout=5):
+                continue
             try:
                 start_time = datetime.now() # reset the start_time variable, since we had a message on the queue   
-                download_file = to_download_q.get_nowait()         
+                download_file = to_download_q.get(timeout=QUEUE_WAIT_SECONDS)
+                if download_file == None:
+                    # None means the manager is done, leave it on the queue for the next worker
+                    to_download_q.put(None)
+                    break
                 msgcm = MSGraphCredMgr()
 
                 if DownloadWorker._check_token_read(msgcm, download_attempted_q, kill_q, download_file.get("name"), download_file.get("id")): # if we can read the tokens, move forward
                     
                     file_download_info = OneDriveGetItemDetails.get_details(download_file.get("id"), msgcm.access_token)
                     if file_download_info:
-                        odfdm = OneDriveFileDownloadMgr(file_download_info.get("download_url"), file_download_info.get("size_bytes"), Config.download_chunk_size_b, os.path.join(Config.download_dir,download_file.get("name")) , file_download_info.get("sha256hash"))
+                        odfdm = OneDriveFileDownloadMgr(file_download_info.get("download_url"), file_download_info.get("size_bytes"), Config.download_chunk_size_b, os.path.join(Config.download_dir,download_file.get("name")) , file_download_info.get("sha256hash"), quick_xor_hash=file_download_info.get("quickxorhash"))
                         download_result = odfdm.download_file()
 
                         if download_result == True:
@@ -728,7 +1014,8 @@ class DownloadWorker:
                 if (datetime.now() - start_time).total_seconds()/60/60 > 2:    # if the to download queue has been empty for too long, exit this thread
                     logger.info("thread: {0} - the to download queue has been empty for more than 2 hrs, exiting this thread".format(thread_name))
                     break
-                sleep(5) # if the to upload queue is empty, wait a bit for it to get some more data
+            finally:
+                download_controller.release()
             
         try:
             kill_data = kill_q.get_nowait()
@@ -749,7 +1036,8 @@ class DownloadDecrypter:
     @staticmethod
     def _get_downloaded_gz_files() -> list:
         try:
-            file_list = sorted(os.listdir(Config.download_dir))
+            # skip the progress records of downloads that never finished
+            file_list = sorted([file_name for file_name in os.listdir(Config.download_dir) if DOWNLOAD_PROGRESS_SUFFIX not in file_name])
         except Exception as e:
             logger.error("Problem getting list of downloaded tar.gz files from {0}".format(Config.download_dir))
             return None
@@ -772,7 +1060,7 @@ class DownloadDecrypter:
    
     
     @staticmethod
-    def _decrypt() -> bool:
+    def _get_restore_file_path() -> str:
 
         download_json = DownloadManager._get_download_info() # reusing this method to get the json out of the download info json file
         if not download_json:
@@ -783,18 +1071,71 @@ class DownloadDecrypter:
         if not restore_file_name:
             logger.error("no onedrive-dir in download info json")
             return None
+
+        return os.path.join(Config.var_basedir, restore_file_name + ".vma.zst")
+
+    @staticmethod
+    def _decrypt() -> bool:
+
+        restore_file_path = DownloadDecrypter._get_restore_file_path()
+        if not restore_file_path:
+            return None
         
         crypt = Crypt(Config.key_path)
 
-        restore_file_path = os.path.join(Config.var_basedir, restore_file_name + ".vma.zst")
-
-        if crypt.chunk_decrypt(Config.extract_dir, restore_file_path, removeorig=True) == True:
+        if crypt.chunk_decrypt(Config.extract_dir, restore_file_path, removeorig=True, workers=Config.crypt_workers, max_in_flight=Config.crypt_max_in_flight) == True:
             logger.info("finished decrypting and reassembling {0}".format(restore_file_path))
             return True
 
         logger.error("problem decrypting and reassembling file")
         return None
 
+    @staticmethod
+    def _stream_decrypt(file_list: list) -> str:
+        # read each downloaded part as a tar stream and decrypt its chunks straight into the restored file, hashing as we go
+        # returns the sha256 hash of the restored file
+        restore_file_path = DownloadDecrypter._get_restore_file_path()
+        if not restore_file_path:
+            return None
+
+        crypt = Crypt(Config.key_path)
+        chunk_hash = ChunkSha256()
+        tar_paths = [os.path.join(Config.download_dir, tar_file) for tar_file in file_list]
+
+        if crypt.chunk_decrypt_tars(tar_paths, restore_file_path, chunk_hash=chunk_hash, removetars=True,
+                                     workers=Config.crypt_workers, max_in_flight=Config.crypt_max_in_flight) == True:
+            logger.info("finished stream decrypting and reassembling {0}".format(restore_file_path))
+            return chunk_hash.hexdigest()
+
+        logger.error("problem stream decrypting and reassembling file")
+        return None
+
+    @staticmethod
+    def _dedup_decrypt(manifest_name: str, file_list: list) -> str:
+        # rebuild a dedup backup from its manifest and the downloaded tar parts, returns the sha256 hash of the restored file
+        restore_file_path = DownloadDecrypter._get_restore_file_path()
+        if not restore_file_path:
+            return None
+
+        crypt = Crypt(Config.key_path)
+        manifest = read_manifest(crypt, os.path.join(Config.download_dir, manifest_name))
+        if not manifest:
+            return None
+
+        chunk_hash = ChunkSha256()
+        if restore_from_manifest(crypt, manifest, Config.download_dir, restore_file_path, chunk_hash=chunk_hash) != True:
+            logger.error("problem restoring dedup backup")
+            return None
+        logger.info("finished decrypting and reassembling {0}".format(restore_file_path))
+
+        for file_name in file_list:
+            try:
+                os.remove(os.path.join(Config.download_dir, file_name))
+            except Exception as e:
+                logger.warning("problem removing {0}".format(file_name))
+
+        return chunk_hash.hexdigest()
+
     @staticmethod
     def _fetch_hash(onedrive_dir: str) -> str:
         try:
@@ -808,7 +1149,8 @@ class DownloadDecrypter:
 
     
     @staticmethod
-    def _verify_hash() -> bool:
+    def _verify_hash(download_hash: str=None) -> bool:
+        # download_hash can be passed in when it was already calculated while the file was restored
         try:
             with open(Config.download_info_path, "r") as download_info_file:
                 download_info = json.load(download_info_file)
@@ -820,8 +1162,9 @@ class DownloadDecrypter:
         original_hash_256 = DownloadDecrypter._fetch_hash(download_info.get("onedrive-dir"))
 
         if original_hash_256:
-            download_hash_obj = Sha256Calc(os.path.join(Config.var_basedir, download_info.get("onedrive-dir") + ".vma.zst"))
-            download_hash = download_hash_obj.calc()
+            if download_hash == None:
+                download_hash_obj = Sha256Calc(os.path.join(Config.var_basedir, download_info.get("onedrive-dir") + ".vma.zst"))
+                download_hash = download_hash_obj.calc()
             if download_hash:
                 if original_hash_256 == download_hash:
                     logger.info("original sha 256 hash and downloaded and combined sha 256 hash match!")
@@ -841,6 +1184,24 @@ class DownloadDecrypter:
         file_list = DownloadDecrypter._get_downloaded_gz_files()
         if not file_list:
             return None
+
+        manifest_names = [file_name for file_name in file_list if file_name.endswith(MANIFEST_SUFFIX)]
+
+        if manifest_names or Config.stream_restore == True:
+            if manifest_names:
+                download_hash = DownloadDecrypter._dedup_decrypt(manifest_names[0], file_list)
+            else:
+                download_hash = DownloadDecrypter._stream_decrypt(file_list)
+            if download_hash:
+                logger.info("decrypt and combine complete")
+                if DownloadDecrypter._verify_hash(download_hash) == True:
+                    logger.info("sha256 hash verified, backup file is intact")
+                    return True
+                else:
+                    logger.error("sha256 hash for decrypted and combined file does not match the hash before upload")
+
+            logger.error("problem with decrypt and combine")
+            return None
         
         extract_result = DownloadDecrypter._extract_tar_gzs(file_list)
         if not extract_result:
@@ -1,6 +1,6 @@
-import unittest, os, shutil
+import unittest, os, shutil, tarfile
 
-from onedrive_offsite.crypt import Crypt
+from onedrive_offsite.crypt import Crypt, ChunkSha256, Sha256Calc, AeadChunkCipher
 
 
 ### ------------------------------ chunk encryption and chunk decrypt with key gen -----------------------------------
@@ -91,4 +91,157 @@ class TestCryptEncryptDecrypt(unittest.TestCase):
             orig_data = orig_file.read()
         
         check_value = len(os.listdir(TestCryptEncryptDecrypt.test_chunk_dir))
-        self.assertEqual(check_value, 0)
\ No newline at end of file
+        self.assertEqual(check_value, 0)
+    def test_int_chunk_encrypt_parallel_verify_names_and_restored_backup(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        check_value = crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010, workers=2, max_in_flight=3)
+        self.assertEqual(check_value, True)
+        self.assertEqual(sorted(os.listdir(TestCryptEncryptDecrypt.test_chunk_dir)), ["1_backup.crypt", "2_backup.crypt", "3_backup.crypt", "4_backup.crypt"])
+
+        crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, removeorig=False)
+        with open(TestCryptEncryptDecrypt.test_restored_backup_path, "r") as restored_file:
+            restored_data = restored_file.read()
+
+        self.assertEqual(restored_data, TestCryptEncryptDecrypt.test_backup_data)
+
+    def test_int_chunk_encrypt_hash_matches_sha256calc(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        chunk_hash = ChunkSha256()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010, chunk_hash=chunk_hash)
+        self.assertEqual(chunk_hash.hexdigest(), Sha256Calc(TestCryptEncryptDecrypt.test_backup_path).calc())
+
+    def test_int_chunk_encrypt_default_format_is_binary(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path, chunk_format="aes-gcm")
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        with open(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "1_backup.crypt"), "rb") as chunk_file:
+            self.assertEqual(len(chunk_file.read()), Crypt.encrypted_chunk_size(10, "aes-gcm"))
+
+    def test_int_chunk_decrypt_legacy_fernet_and_mixed_chunks(self):
+        # chunks written by older versions are fernet tokens, make sure they still restore alongside aes-gcm chunks
+        fernet_crypt = Crypt(TestCryptEncryptDecrypt.test_key_path, chunk_format="fernet")
+        fernet_crypt.gen_key_file()
+        fernet_crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        os.remove(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "2_backup.crypt"))
+
+        aead_crypt = Crypt(TestCryptEncryptDecrypt.test_key_path, chunk_format="aes-gcm")
+        aead_crypt.fetch_key()
+        with open(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "2_backup.crypt"), "wb") as chunk_file:
+            chunk_file.write(AeadChunkCipher(aead_crypt.key).encrypt(TestCryptEncryptDecrypt.test_backup_data[10:20].encode()))
+
+        check_value = aead_crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, removeorig=False)
+        self.assertEqual(check_value, True)
+        with open(TestCryptEncryptDecrypt.test_restored_backup_path, "r") as restored_file:
+            self.assertEqual(restored_file.read(), TestCryptEncryptDecrypt.test_backup_data)
+
+    def _make_tar_parts(self, mode):
+        # put the 4 encrypted chunks into two tar parts, the same way make_tar_gz() groups them
+        part_paths = []
+        chunk_names = sorted(os.listdir(TestCryptEncryptDecrypt.test_chunk_dir))
+        for part_num, chunk_group in enumerate([chunk_names[:2], chunk_names[2:]]):
+            part_path = os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "part{0}.tar".format(part_num))
+            with tarfile.open(part_path, mode) as tar_file:
+                for chunk_name in chunk_group:
+                    tar_file.add(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, chunk_name), arcname=chunk_name)
+            part_paths.append(part_path)
+        return part_paths
+
+    def test_int_chunk_decrypt_tars_restore_and_hash(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        for mode in ["w", "w:gz"]:
+            part_paths = self._make_tar_parts(mode)
+            chunk_hash = ChunkSha256()
+            check_value = crypt.chunk_decrypt_tars(part_paths, TestCryptEncryptDecrypt.test_restored_backup_path, chunk_hash=chunk_hash, removetars=True)
+            self.assertEqual(check_value, True)
+            with open(TestCryptEncryptDecrypt.test_restored_backup_path, "r") as restored_file:
+                self.assertEqual(restored_file.read(), TestCryptEncryptDecrypt.test_backup_data)
+            self.assertEqual(chunk_hash.hexdigest(), Sha256Calc(TestCryptEncryptDecrypt.test_backup_path).calc())
+            self.assertEqual([os.path.isfile(part_path) for part_path in part_paths], [False, False])
+
+    def test_int_chunk_decrypt_tars_parts_out_of_order(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        part_paths = self._make_tar_parts("w")
+        check_value = crypt.chunk_decrypt_tars(list(reversed(part_paths)), TestCryptEncryptDecrypt.test_restored_backup_path)
+        self.assertEqual(check_value, False)
+
+    def test_int_chunk_decrypt_parallel_verify_restored_backup(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        check_value = crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, removeorig=True, workers=2, max_in_flight=2)
+        self.assertEqual(check_value, True)
+        self.assertEqual(os.listdir(TestCryptEncryptDecrypt.test_chunk_dir), [])
+        with open(TestCryptEncryptDecrypt.test_restored_backup_path, "r") as restored_file:
+            self.assertEqual(restored_file.read(), TestCryptEncryptDecrypt.test_backup_data)
+
+    def test_int_chunk_decrypt_parallel_corrupted_chunk(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        with open(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "3_backup.crypt"), "r+b") as chunk_file:
+            chunk_file.seek(-1, 2)
+            last_byte = chunk_file.read(1)
+            chunk_file.seek(-1, 2)
+            chunk_file.write(bytes([last_byte[0] ^ 1]))
+        check_value = crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, workers=2)
+        self.assertEqual(check_value, False)
+
+    def test_int_chunk_decrypt_tars_parallel_restore_and_hash(self):
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path)
+        crypt.gen_key_file()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010)
+        part_paths = self._make_tar_parts("w")
+        chunk_hash = ChunkSha256()
+        check_value = crypt.chunk_decrypt_tars(part_paths, TestCryptEncryptDecrypt.test_restored_backup_path, chunk_hash=chunk_hash, removetars=True, workers=2, max_in_flight=3)
+        self.assertEqual(check_value, True)
+        self.assertEqual(chunk_hash.hexdigest(), Sha256Calc(TestCryptEncryptDecrypt.test_backup_path).calc())
+        self.assertEqual([os.path.isfile(part_path) for part_path in part_paths], [False, False])
+
+    def test_int_chunk_encrypt_zero_chunks_restore(self):
+        # chunks 2 and 4 are all zeros, the last one leaves a hole at the end of the restored file
+        backup_data = b"1234567890" + bytes(10) + b"abcdefghij" + bytes(10)
+        with open(TestCryptEncryptDecrypt.test_backup_path, "wb") as test_backup_file:
+            test_backup_file.write(backup_data)
+
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path, elide_zeros=True)
+        crypt.gen_key_file()
+        chunk_hash = ChunkSha256()
+        crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000010, workers=2)
+        with open(os.path.join(TestCryptEncryptDecrypt.test_chunk_dir, "2_backup.crypt"), "rb") as chunk_file:
+            self.assertEqual(chunk_file.read(4), b"ODZ0")
+
+        for workers in [1, 2]:
+            if os.path.isfile(TestCryptEncryptDecrypt.test_restored_backup_path):
+                os.remove(TestCryptEncryptDecrypt.test_restored_backup_path)
+            check_value = crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, workers=workers)
+            self.assertEqual(check_value, True)
+            with open(TestCryptEncryptDecrypt.test_restored_backup_path, "rb") as restored_file:
+                self.assertEqual(restored_file.read(), backup_data)
+
+        part_paths = self._make_tar_parts("w")
+        check_value = crypt.chunk_decrypt_tars(part_paths, TestCryptEncryptDecrypt.test_restored_backup_path, chunk_hash=chunk_hash)
+        self.assertEqual(check_value, True)
+        self.assertEqual(chunk_hash.hexdigest(), Sha256Calc(TestCryptEncryptDecrypt.test_backup_path).calc())
+        self.assertEqual(os.path.getsize(TestCryptEncryptDecrypt.test_restored_backup_path), len(backup_data))
+
+    def test_int_chunk_encrypt_compressed_chunks_restore(self):
+        backup_data = b"a" * 25 + b"1234567890" + b"b" * 25
+        with open(TestCryptEncryptDecrypt.test_backup_path, "wb") as test_backup_file:
+            test_backup_file.write(backup_data)
+
+        crypt = Crypt(TestCryptEncryptDecrypt.test_key_path, compression="zlib")
+        crypt.gen_key_file()
+        for workers in [1, 2]:
+            crypt.chunk_encrypt(TestCryptEncryptDecrypt.test_backup_path, TestCryptEncryptDecrypt.test_chunk_dir, .000020, workers=workers)
+            if os.path.isfile(TestCryptEncryptDecrypt.test_restored_backup_path):
+                os.remove(TestCryptEncryptDecrypt.test_restored_backup_path)
+            check_value = crypt.chunk_decrypt(TestCryptEncryptDecrypt.test_chunk_dir, TestCryptEncryptDecrypt.test_restored_backup_path, removeorig=True, workers=workers)
+            self.assertEqual(check_value, True)
+            with open(TestCryptEncryptDecrypt.test_restored_backup_path, "rb") as restored_file:
+                self.assertEqual(restored_file.read(), backup_data)
@@ -0,0 +1,89 @@
+import unittest, mock, os, shutil
+
+from onedrive_offsite.crypt import Crypt, ChunkSha256, Sha256Calc
+from onedrive_offsite.utils import make_tar_gz
+from onedrive_offsite.dedup import DedupIndex, dedup_chunk_encrypt, pack_locations, build_manifest, write_manifest, read_manifest, commit_manifest, restore_from_manifest
+
+
+### ------------------------------ two dedup backups, then restore the second one -----------------------------------
+
+@mock.patch("onedrive_offsite.dedup.Config")
+class TestDedupBackupRestore(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_work_dir = os.path.join(test_dir, "test_dedup/")
+    test_chunk_dir = os.path.join(test_work_dir, "chunks/")
+    test_pack_dir = os.path.join(test_work_dir, "packs/")
+    test_backup_path = os.path.join(test_work_dir, "test_backup")
+    test_restored_backup_path = os.path.join(test_work_dir, "test_restored")
+    test_key_path = os.path.join(test_work_dir, "test_key.key")
+    test_index_path = os.path.join(test_work_dir, "dedup_index.json")
+
+    def setUp(self):
+        os.mkdir(TestDedupBackupRestore.test_work_dir)
+        os.mkdir(TestDedupBackupRestore.test_chunk_dir)
+        os.mkdir(TestDedupBackupRestore.test_pack_dir)
+
+    def tearDown(self):
+        shutil.rmtree(TestDedupBackupRestore.test_work_dir)
+
+    def _backup(self, crypt, data, onedrive_dir):
+        # stands in for crypt_file_build() and the upload, the tar parts of every backup end up in the same pack dir
+        with open(TestDedupBackupRestore.test_backup_path, "wb") as backup_file:
+            backup_file.write(data)
+
+        index = DedupIndex(TestDedupBackupRestore.test_index_path, 30)
+        index.load()
+        manifest_chunks = dedup_chunk_encrypt(crypt, TestDedupBackupRestore.test_backup_path, TestDedupBackupRestore.test_chunk_dir, index)
+        new_chunks = len(os.listdir(TestDedupBackupRestore.test_chunk_dir))
+
+        upload_dir = os.path.join(TestDedupBackupRestore.test_work_dir, onedrive_dir)
+        os.mkdir(upload_dir)
+        if new_chunks > 0:
+            make_tar_gz(TestDedupBackupRestore.test_chunk_dir, upload_dir, 3, onedrive_dir + "_backup.tar", removeorig=True, compress=False)
+        manifest = build_manifest(onedrive_dir, manifest_chunks, index, pack_locations(upload_dir))
+        manifest_path = os.path.join(TestDedupBackupRestore.test_work_dir, onedrive_dir + "_manifest.crypt")
+        write_manifest(crypt, manifest, manifest_path)
+        commit_manifest(crypt, manifest_path, index)
+
+        for pack in os.listdir(upload_dir):
+            shutil.move(os.path.join(upload_dir, pack), TestDedupBackupRestore.test_pack_dir)
+        return manifest_path, new_chunks
+
+    def test_int_dedup_second_backup_reuses_chunks_and_restores(self, mock_config):
+        mock_config.dedup_min_chunk_mb = .0001     # 100 bytes
+        mock_config.crypt_chunk_size_mb = .001     # 1000 bytes
+        segments = [os.urandom(500) + b"\x9e\x37\x79" for i in range(12)]
+
+        crypt = Crypt(TestDedupBackupRestore.test_key_path)
+        crypt.gen_key_file()
+        manifest_path, first_new_chunks = self._backup(crypt, b"".join(segments), "backup-1")
+        self.assertEqual(first_new_chunks, 12)
+
+        # change the middle of the file and insert some data, only the chunks around those changes should be new
+        second_data = b"".join(segments[:5]) + b"changed" + b"".join(segments[5:9]) + os.urandom(300) + b"".join(segments[9:])
+        manifest_path, second_new_chunks = self._backup(crypt, second_data, "backup-2")
+        self.assertEqual(second_new_chunks, 2)
+
+        manifest = read_manifest(crypt, manifest_path)
+        self.assertEqual(sorted(set([chunk[2] for chunk in manifest["chunks"]])), ["backup-1", "backup-2"])
+
+        chunk_hash = ChunkSha256()
+        check_value = restore_from_manifest(crypt, manifest, TestDedupBackupRestore.test_pack_dir, TestDedupBackupRestore.test_restored_backup_path, chunk_hash=chunk_hash)
+        self.assertEqual(check_value, True)
+        with open(TestDedupBackupRestore.test_restored_backup_path, "rb") as restored_file:
+            self.assertEqual(restored_file.read(), second_data)
+        self.assertEqual(chunk_hash.hexdigest(), Sha256Calc(TestDedupBackupRestore.test_backup_path).calc())
+
+    def test_int_dedup_restore_missing_pack(self, mock_config):
+        mock_config.dedup_min_chunk_mb = .0001
+        mock_config.crypt_chunk_size_mb = .001
+
+        crypt = Crypt(TestDedupBackupRestore.test_key_path)
+        crypt.gen_key_file()
+        manifest_path, new_chunks = self._backup(crypt, os.urandom(3000), "backup-1")
+        manifest = read_manifest(crypt, manifest_path)
+        for pack in os.listdir(TestDedupBackupRestore.test_pack_dir):
+            os.remove(os.path.join(TestDedupBackupRestore.test_pack_dir, pack))
+
+        check_value = restore_from_manifest(crypt, manifest, TestDedupBackupRestore.test_pack_dir, TestDedupBackupRestore.test_restored_backup_path)
+        self.assertEqual(check_value, False)
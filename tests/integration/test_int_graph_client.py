@@ -0,0 +1,50 @@
+import unittest, threading, http.server
+
+from onedrive_offsite.graph_client import GraphClient
+
+
+class _CountingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    connections = set()
+
+    def do_PUT(self):
+        _CountingHandler.connections.add(self.client_address)
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+### ------------------------------ connections are reused across requests -----------------------------------
+class TestGraphClientKeepAlive(unittest.TestCase):
+
+    def setUp(self):
+        _CountingHandler.connections = set()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _CountingHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.url = "http://127.0.0.1:{0}/upload".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_int_one_connection_for_many_fragments(self):
+        client = GraphClient(timeout=(5, 5), pool_connections=1, pool_maxsize=2)
+        for i in range(5):
+            resp = client.put(self.url, data=b"fake fragment")
+            self.assertEqual(resp.status_code, 202)
+        client.close()
+        self.assertEqual(len(_CountingHandler.connections), 1)
+
+    def test_int_threads_reuse_pooled_connection(self):
+        client = GraphClient(timeout=(5, 5), pool_connections=1, pool_maxsize=2)
+        for i in range(3):
+            thread = threading.Thread(target=client.put, args=(self.url,), kwargs={"data": b"fake fragment"})
+            thread.start()
+            thread.join()
+        client.close()
+        self.assertEqual(len(_CountingHandler.connections), 1)
@@ -0,0 +1,73 @@
+import unittest, mock, os, shutil, io, tarfile, queue, hashlib
+
+from onedrive_offsite.crypt import Crypt, ChunkSha256
+from onedrive_offsite.config import Config
+from onedrive_offsite.file_ops import _stream_part_plan
+from onedrive_offsite.workers import stream_upload_worker
+
+
+### ------------------------------ stream encrypted tar parts and restore them -----------------------------------
+
+class FakeOneDriveLargeUpload:
+    # collects the uploaded fragments in memory instead of sending them to onedrive
+    uploaded = {}
+
+    def __init__(self, upload_file_name):
+        self.file_name = upload_file_name
+        FakeOneDriveLargeUpload.uploaded[upload_file_name] = bytearray()
+
+    def initiate_upload_session(self, access_token):
+        return True
+
+    def upload_file_part(self, file_size_bytes, content_length_bytes, content_range_bytes, bytes_to_upload):
+        FakeOneDriveLargeUpload.uploaded[self.file_name].extend(bytes_to_upload)
+        upload_response = mock.Mock()
+        upload_response.status_code = 202
+        return upload_response
+
+    def cancel_upload_session(self):
+        return True
+
+
+class TestStreamUpload(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_work_dir = os.path.join(test_dir, "test_stream/")
+    test_extract_dir = os.path.join(test_work_dir, "extracted/")
+    test_backup_path = os.path.join(test_work_dir, "test_backup")
+    test_restored_backup_path = os.path.join(test_work_dir, "test_restored")
+    test_key_path = os.path.join(test_work_dir, "test_key.key")
+    test_backup_data = os.urandom(1000)
+
+    def setUp(self):
+        os.mkdir(TestStreamUpload.test_work_dir)
+        os.mkdir(TestStreamUpload.test_extract_dir)
+        with open(TestStreamUpload.test_backup_path, "wb") as test_backup_file:
+            test_backup_file.write(TestStreamUpload.test_backup_data)
+        Crypt(TestStreamUpload.test_key_path).gen_key_file()
+        FakeOneDriveLargeUpload.uploaded = {}
+
+    def tearDown(self):
+        shutil.rmtree(TestStreamUpload.test_work_dir)
+
+    @mock.patch("onedrive_offsite.workers.MSGraphCredMgr")
+    @mock.patch("onedrive_offsite.workers.OneDriveLargeUpload", FakeOneDriveLargeUpload)
+    def test_int_stream_upload_restore(self, mock_msgcm):
+        # 1000 bytes in 100 byte chunks, 3 chunks per part, uploaded in 1 KB fragments
+        stream_parts = _stream_part_plan(len(TestStreamUpload.test_backup_data), .0001, 3, "test_backup.tar.gz")
+        chunk_hash = ChunkSha256()
+
+        with mock.patch.object(Config, "key_path", TestStreamUpload.test_key_path), mock.patch.object(Config, "crypt_chunk_size_mb", .0001), mock.patch.object(Config, "onedrive_upload_chunk_size_kb", 1):
+            check_value = stream_upload_worker(TestStreamUpload.test_backup_path, stream_parts, chunk_hash, queue.Queue(), queue.Queue())
+        self.assertEqual(check_value, True)
+
+        for part in stream_parts:
+            part_bytes = bytes(FakeOneDriveLargeUpload.uploaded[part["name"]])
+            self.assertEqual(len(part_bytes), part["size-bytes"])
+            with tarfile.open(fileobj=io.BytesIO(part_bytes)) as tar:
+                tar.extractall(TestStreamUpload.test_extract_dir)
+
+        Crypt(TestStreamUpload.test_key_path).chunk_decrypt(TestStreamUpload.test_extract_dir, TestStreamUpload.test_restored_backup_path)
+        with open(TestStreamUpload.test_restored_backup_path, "rb") as restored_file:
+            self.assertEqual(restored_file.read(), TestStreamUpload.test_backup_data)
+
+        self.assertEqual(chunk_hash.hexdigest(), hashlib.sha256(TestStreamUpload.test_backup_data).hexdigest())
@@ -0,0 +1,238 @@
+import unittest, mock, asyncio, threading
+
+from onedrive_offsite.async_engine import AsyncTransferEngine, UPLOAD_FILE_ATTEMPTS
+
+
+def _patch_tokens(test_func):
+    # the lock file and token refresh work without touching the credentials files
+    test_func = mock.patch("onedrive_offsite.async_engine._lock_file_check", return_value=False)(test_func)
+    test_func = mock.patch("onedrive_offsite.async_engine._write_to_lock_file", return_value=True)(test_func)
+    test_func = mock.patch("onedrive_offsite.async_engine.token_refresh_cycle")(test_func)
+    return test_func
+
+
+def _mock_fpr(fragment_count: int):
+    fpr = mock.Mock()
+    fpr.file_size = fragment_count * 10
+    fpr.file_range_size_bytes = 10
+    fpr.upload_array = [[10, i * 10, str(i * 10) + "-" + str(i * 10 + 9)] for i in range(fragment_count)]
+    return fpr
+
+
+### ------------------------------ AsyncTransferEngine.upload() -----------------------------------
+@mock.patch("onedrive_offsite.async_engine.MSGraphCredMgr")
+@mock.patch("onedrive_offsite.async_engine.OneDriveDirMgr")
+class TestAsyncUpload(unittest.TestCase):
+
+    @_patch_tokens
+    def test_unit_upload_success(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            mock_odlu.return_value.upload_file_part.return_value.status_code = 202
+            with mock.patch("onedrive_offsite.async_engine.FilePartialRead", side_effect=lambda *args, **kwargs: _mock_fpr(3)) as mock_fpr:
+                check_value = AsyncTransferEngine(2).upload(["file1", "file2"])
+                self.assertEqual(check_value, True)
+                self.assertEqual(mock_odlu.return_value.upload_file_part.call_count, 6)
+                mock_write_lock.assert_called_with("not locked")
+
+    @_patch_tokens
+    def test_unit_upload_retries_then_fails(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            mock_odlu.return_value.upload_file_part.return_value = False
+            with mock.patch("onedrive_offsite.async_engine.FilePartialRead", side_effect=lambda *args, **kwargs: _mock_fpr(3)) as mock_fpr:
+                check_value = AsyncTransferEngine(1).upload(["file1"])
+                self.assertEqual(check_value, False)
+                self.assertEqual(mock_odlu.return_value.open_upload_session.call_count, UPLOAD_FILE_ATTEMPTS)
+                self.assertEqual(mock_odlu.return_value.cancel_upload_session.call_count, UPLOAD_FILE_ATTEMPTS)
+
+    @_patch_tokens
+    def test_unit_upload_hash_mismatch_retries(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            mock_odlu.return_value.upload_file_part.return_value.status_code = 202
+            mock_odlu.return_value.verify_upload.return_value = False
+            with mock.patch("onedrive_offsite.async_engine.FilePartialRead", side_effect=lambda *args, **kwargs: _mock_fpr(2)) as mock_fpr:
+                check_value = AsyncTransferEngine(1).upload(["file1"])
+                self.assertEqual(check_value, False)
+                self.assertEqual(mock_odlu.return_value.verify_upload.call_count, UPLOAD_FILE_ATTEMPTS)
+
+    @_patch_tokens
+    def test_unit_upload_finish_hash_fail(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            mock_odlu.return_value.upload_file_part.return_value.status_code = 202
+            fpr = _mock_fpr(2)
+            fpr.range_reader.return_value.finish_hash.return_value = False
+            with mock.patch("onedrive_offsite.async_engine.FilePartialRead", return_value=fpr) as mock_fpr:
+                check_value = AsyncTransferEngine(1).upload(["file1"])
+                self.assertEqual(check_value, False)
+                mock_odlu.return_value.verify_upload.assert_not_called()
+
+    @_patch_tokens
+    def test_unit_upload_token_refresh_fail(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        mock_refresh.return_value = False
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            check_value = AsyncTransferEngine(1).upload(["file1"])
+            self.assertEqual(check_value, False)
+            mock_odlu.assert_not_called()
+
+    @_patch_tokens
+    def test_unit_upload_credentials_locked(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        # another process is refreshing the tokens, the upload goes ahead with them and leaves its lock alone
+        mock_lock_check.return_value = True
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            mock_odlu.return_value.upload_file_part.return_value.status_code = 202
+            with mock.patch("onedrive_offsite.async_engine.FilePartialRead", side_effect=lambda *args, **kwargs: _mock_fpr(2)) as mock_fpr:
+                check_value = AsyncTransferEngine(1).upload(["file1"])
+                self.assertEqual(check_value, True)
+                mock_refresh.assert_not_called()
+                mock_write_lock.assert_not_called()
+
+    @_patch_tokens
+    def test_unit_upload_create_dir_fail(self, mock_lock_check, mock_write_lock, mock_refresh, mock_oddm, mock_msgcm):
+        mock_oddm.return_value.create_dir.return_value = False
+        with mock.patch("onedrive_offsite.async_engine.OneDriveLargeUpload") as mock_odlu:
+            check_value = AsyncTransferEngine(1).upload(["file1"])
+            self.assertEqual(check_value, False)
+            mock_odlu.assert_not_called()
+            mock_write_lock.assert_called_with("not locked")
+
+
+### ------------------------------ AsyncTransferEngine.download() -----------------------------------
+@mock.patch("onedrive_offsite.async_engine.MSGraphCredMgr")
+@mock.patch("onedrive_offsite.async_engine.OneDriveGetItemDetails")
+@mock.patch("onedrive_offsite.async_engine.DownloadManager")
+class TestAsyncDownload(unittest.TestCase):
+
+    @_patch_tokens
+    def test_unit_download_success(self, mock_lock_check, mock_write_lock, mock_refresh, mock_dl_mgr, mock_details, mock_msgcm):
+        mock_dl_mgr._get_download_list.return_value = [{"id": "1", "name": "file1"}, {"id": "2", "name": "file2"}]
+        with mock.patch("onedrive_offsite.async_engine.OneDriveFileDownloadMgr") as mock_odfdm:
+            mock_odfdm.return_value.download_file.return_value = True
+            check_value = AsyncTransferEngine(2).download()
+            self.assertEqual(check_value, True)
+            self.assertEqual(mock_odfdm.return_value.download_file.call_count, 2)
+
+    @_patch_tokens
+    def test_unit_download_fail_removes_file(self, mock_lock_check, mock_write_lock, mock_refresh, mock_dl_mgr, mock_details, mock_msgcm):
+        mock_dl_mgr._get_download_list.return_value = [{"id": "1", "name": "file1"}]
+        with mock.patch("onedrive_offsite.async_engine.OneDriveFileDownloadMgr") as mock_odfdm:
+            with mock.patch("onedrive_offsite.async_engine._remove_download_file", return_value=True) as mock_rm_file:
+                mock_odfdm.return_value.download_file.return_value = False
+                check_value = AsyncTransferEngine(2).download()
+                self.assertEqual(check_value, False)
+                self.assertEqual(mock_rm_file.call_count, 3)
+                mock_rm_file.assert_called_with("file1")
+
+    @_patch_tokens
+    def test_unit_download_remove_fail_stops(self, mock_lock_check, mock_write_lock, mock_refresh, mock_dl_mgr, mock_details, mock_msgcm):
+        mock_dl_mgr._get_download_list.return_value = [{"id": "1", "name": "file1"}]
+        with mock.patch("onedrive_offsite.async_engine.OneDriveFileDownloadMgr") as mock_odfdm:
+            with mock.patch("onedrive_offsite.async_engine._remove_download_file", return_value=None) as mock_rm_file:
+                mock_odfdm.return_value.download_file.return_value = False
+                check_value = AsyncTransferEngine(2).download()
+                self.assertEqual(check_value, False)
+                mock_rm_file.assert_called_once()
+
+    @_patch_tokens
+    def test_unit_download_no_file_list(self, mock_lock_check, mock_write_lock, mock_refresh, mock_dl_mgr, mock_details, mock_msgcm):
+        mock_dl_mgr._get_download_list.return_value = None
+        with mock.patch("onedrive_offsite.async_engine.OneDriveFileDownloadMgr") as mock_odfdm:
+            check_value = AsyncTransferEngine(2).download()
+            self.assertEqual(check_value, False)
+            mock_odfdm.assert_not_called()
+
+
+### ------------------------------ token refresh -----------------------------------
+class TestAsyncTokenRefresh(unittest.TestCase):
+
+    @_patch_tokens
+    def test_unit_takes_over_released_lock(self, mock_lock_check, mock_write_lock, mock_refresh):
+        # the other process lets go of the credentials lock, so the engine locks it and does the refreshing from then on
+        mock_lock_check.side_effect = [True, False]
+        mock_refresh.return_value = False
+        with mock.patch("onedrive_offsite.async_engine.asyncio.sleep", new=mock.AsyncMock()) as mock_sleep:
+            check_value = asyncio.run(AsyncTransferEngine(1)._token_refresh_loop(None))
+        self.assertEqual(check_value, False)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(mock_write_lock.call_args_list, [mock.call("locked"), mock.call("not locked")])
+
+
+### ------------------------------ concurrency and cancellation -----------------------------------
+class TestAsyncScheduling(unittest.TestCase):
+
+    def test_unit_failure_cancels_other_transfers(self):
+        cancelled = []
+
+        async def fails():
+            await asyncio.sleep(0.01)
+            return False
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+                return True
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def run():
+            token_task = asyncio.ensure_future(asyncio.sleep(10))
+            result = await AsyncTransferEngine(3)._all_or_cancel([fails(), slow(), slow()], token_task)
+            token_task.cancel()
+            return result
+
+        with mock.patch("onedrive_offsite.async_engine.cancel_token") as mock_cancel_token:
+            self.assertEqual(asyncio.run(run()), False)
+            mock_cancel_token.cancel.assert_called_once()     # wakes retries and stops fragments running on the executor
+        self.assertEqual(cancelled, [True, True])
+
+    def test_unit_token_failure_cancels_transfers(self):
+        async def slow():
+            await asyncio.sleep(10)
+            return True
+
+        async def token_fails():
+            await asyncio.sleep(0.01)
+            return False
+
+        async def run():
+            return await AsyncTransferEngine(3)._all_or_cancel([slow()], asyncio.ensure_future(token_fails()))
+
+        self.assertEqual(asyncio.run(run()), False)
+
+    def test_unit_acquire_woken_by_release(self):
+        # a transfer waiting for a slot wakes up when another thread releases one, it doesn't poll
+        engine = AsyncTransferEngine(1)
+        controller = engine.upload_controller
+
+        async def run():
+            self.assertEqual(controller.try_acquire(), True)
+            waiter = asyncio.ensure_future(engine._acquire(controller))
+            await asyncio.sleep(0.01)
+            self.assertEqual(waiter.done(), False)
+            threading.Thread(target=controller.release).start()
+            await asyncio.wait_for(waiter, 1)
+            return controller.active
+
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(controller._listeners, [])
+
+    def test_unit_concurrency_limit(self):
+        engine = AsyncTransferEngine(2)
+        running = []
+        most_running = []
+
+        async def fake_attempt(targz_file):
+            running.append(targz_file)
+            most_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(targz_file)
+            return True
+
+        async def run():
+            token_task = asyncio.ensure_future(asyncio.sleep(10))
+            with mock.patch.object(engine, "_upload_attempt", side_effect=fake_attempt):
+                result = await engine._all_or_cancel([engine._upload_file("file" + str(i)) for i in range(6)], token_task)
+            token_task.cancel()
+            return result
+
+        self.assertEqual(asyncio.run(run()), True)
+        self.assertEqual(max(most_running), 2)
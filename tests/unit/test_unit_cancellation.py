@@ -0,0 +1,130 @@
+import unittest, mock, threading, time, queue
+
+from onedrive_offsite.cancellation import CancelToken, cancel_token
+from onedrive_offsite.onedrive import OneDriveLargeUpload, OneDriveFileDownloadMgr
+from onedrive_offsite.utils import FileRangeReader
+from onedrive_offsite.workers import flood_kill_queue
+
+
+### ------------------------------ CancelToken -----------------------------------
+class TestCancelToken(unittest.TestCase):
+
+    def test_unit_cancel_outside_job_ignored(self):
+        token = CancelToken()
+        self.assertEqual(token.cancel("test"), False)
+        self.assertEqual(token.cancelled(), False)
+
+    def test_unit_cancel(self):
+        token = CancelToken()
+        token.start()
+        self.assertEqual(token.cancel("first"), True)
+        self.assertEqual(token.cancel("second"), False)
+        self.assertEqual(token.cancelled(), True)
+        self.assertEqual(token.reason, "first")
+
+    def test_unit_finish_clears(self):
+        token = CancelToken()
+        token.start()
+        token.cancel("test")
+        token.finish()
+        self.assertEqual(token.cancelled(), False)
+        self.assertEqual(token.cancel("test"), False)
+
+    def test_unit_start_clears(self):
+        token = CancelToken()
+        token.start()
+        token.cancel("test")
+        token.start()
+        self.assertEqual(token.cancelled(), False)
+        self.assertEqual(token.reason, None)
+
+    def test_unit_stop(self):
+        token = CancelToken()
+        token.stop()
+        self.assertEqual(token.wait_stopped(0), False)     # outside a job
+        token.start()
+        self.assertEqual(token.wait_stopped(0.01), False)
+        token.stop()
+        self.assertEqual(token.wait_stopped(0), True)
+        self.assertEqual(token.cancelled(), False)
+        token.start()
+        token.cancel("test")
+        self.assertEqual(token.wait_stopped(0), True)     # a cancelled job is stopped too
+
+    def test_unit_wait_times_out(self):
+        token = CancelToken()
+        token.start()
+        self.assertEqual(token.wait(0.01), False)
+
+    def test_unit_wait_wakes_on_cancel(self):
+        token = CancelToken()
+        token.start()
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(token.wait(1800))) for i in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        start_time = time.monotonic()
+        token.cancel("test")
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(results, [True, True, True])
+        self.assertLess(time.monotonic() - start_time, 5)
+
+
+### ------------------------------ cancelling the shared token -----------------------------------
+@mock.patch("onedrive_offsite.onedrive.threading.current_thread")
+class TestCancelTransfers(unittest.TestCase):
+
+    def setUp(self):
+        cancel_token.start()
+
+    def tearDown(self):
+        cancel_token.finish()
+
+    def test_unit_flood_kill_queue_cancels(self, mock_curr_thread):
+        flood_kill_queue(queue.Queue(), "test")
+        self.assertEqual(cancel_token.cancelled(), True)
+        self.assertEqual(cancel_token.reason, "test")
+
+    def test_unit_flood_kill_queue_finished_not_cancelled(self, mock_curr_thread):
+        # a job that finished floods the kill queue too, that must not cancel anything or log that transfers are being cancelled
+        flood_kill_queue(queue.Queue())
+        self.assertEqual(cancel_token.cancelled(), False)
+        self.assertEqual(cancel_token.wait_stopped(0), True)
+
+    def test_unit_retry_logic_stops_when_cancelled(self, mock_curr_thread):
+        cancel_token.cancel("test")
+        start_time = time.monotonic()
+        self.assertEqual(OneDriveLargeUpload._retry_logic("0-100001", 3), False)
+        self.assertLess(time.monotonic() - start_time, 5)
+
+    def test_unit_retry_delay_stops_when_cancelled(self, mock_curr_thread):
+        cancel_token.cancel("test")
+        oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+        self.assertEqual(oddlm._retry_delay(2, 10, 19), False)
+
+    def test_unit_retry_wakes_when_cancelled(self, mock_curr_thread):
+        results = []
+        retry_thread = threading.Thread(target=lambda: results.append(OneDriveLargeUpload._retry_logic("0-100001", 3)))
+        retry_thread.start()
+        cancel_token.cancel("test")
+        retry_thread.join(5)
+        self.assertEqual(results, [False])
+
+    def test_unit_upload_body_stops_when_cancelled(self, mock_curr_thread):
+        reader = FileRangeReader(mock.Mock(), 0, 100)
+        cancel_token.cancel("test")
+        with self.assertRaises(IOError):
+            reader.read(10)
+
+    def test_unit_download_chunk_stops_when_cancelled(self, mock_curr_thread):
+        def blocks(block_size):
+            yield b"fake"
+            cancel_token.cancel("test")
+            yield b"bytes"
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            mock_get.return_value.status_code = 206
+            mock_get.return_value.iter_content.side_effect = blocks
+            oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+            self.assertIs(oddlm._download_chunk(10, 19), None)
+            mock_get.return_value.close.assert_called_once()
@@ -0,0 +1,176 @@
+import unittest, mock, threading
+from datetime import timedelta
+
+from onedrive_offsite.concurrency import AimdController, reset_controller, _record_response, _record_error, upload_controller, download_controller
+
+
+def _controller(start=4, min_limit=1, max_limit=8):
+    return AimdController("test", start, min_limit, max_limit, 4, 0.25)
+
+
+def _window(controller, status_code=202, seconds=1.0, transfer_bytes=10000000):
+    for i in range(controller.window_size):
+        controller.record(status_code, seconds, transfer_bytes)
+
+
+### ------------------------------ AimdController decisions -----------------------------------
+class TestAimdDecisions(unittest.TestCase):
+
+    def test_unit_increase_when_healthy(self):
+        controller = _controller()
+        _window(controller)
+        self.assertEqual(controller.limit, 5)
+        self.assertEqual(controller.decisions[0]["from"], 4)
+        self.assertEqual(controller.decisions[0]["to"], 5)
+
+    def test_unit_halve_when_throttled(self):
+        controller = _controller()
+        for i in range(3):
+            controller.record(202, 1.0, 10000000)
+        controller.record(429, 1.0, 0)
+        self.assertEqual(controller.limit, 2)
+        self.assertIn("1 throttled", controller.decisions[0]["reason"])
+
+    def test_unit_halve_on_errors(self):
+        controller = _controller()
+        controller.record(202, 1.0, 10000000)
+        controller.record(202, 1.0, 10000000)
+        controller.record(None, 0, 0)
+        controller.record(502, 1.0, 0)
+        self.assertEqual(controller.limit, 2)
+
+    def test_unit_never_below_min(self):
+        controller = _controller(start=1)
+        _window(controller, status_code=429)
+        self.assertEqual(controller.limit, 1)
+
+    def test_unit_never_above_max(self):
+        controller = _controller(start=8)
+        _window(controller)
+        self.assertEqual(controller.limit, 8)
+
+    def test_unit_hold_when_latency_rises(self):
+        controller = _controller()
+        _window(controller, seconds=1.0)
+        _window(controller, seconds=3.0)
+        self.assertEqual(controller.limit, 5)
+        self.assertIn("latency rising", controller.decisions[1]["reason"])
+
+    def test_unit_hold_when_increase_did_not_help(self):
+        controller = _controller()
+        controller.active = 8
+        _window(controller, seconds=1.0)
+        # one more transfer but each one got slower, so the total didn't go up
+        _window(controller, seconds=1.25)
+        self.assertEqual(controller.limit, 5)
+        self.assertIn("did not raise throughput", controller.decisions[1]["reason"])
+
+    def test_unit_reset(self):
+        controller = _controller()
+        _window(controller, status_code=429)
+        controller.reset(3, 2, 6)
+        self.assertEqual((controller.limit, controller.min_limit, controller.max_limit), (3, 2, 6))
+        self.assertEqual(controller.decisions, [])
+
+
+### ------------------------------ AimdController slots -----------------------------------
+class TestAimdSlots(unittest.TestCase):
+
+    def test_unit_try_acquire_up_to_limit(self):
+        controller = _controller(start=2)
+        self.assertEqual(controller.try_acquire(), True)
+        self.assertEqual(controller.try_acquire(), True)
+        self.assertEqual(controller.try_acquire(), False)
+        controller.release()
+        self.assertEqual(controller.try_acquire(), True)
+
+    def test_unit_acquire_timeout(self):
+        controller = _controller(start=1)
+        controller.acquire()
+        self.assertEqual(controller.acquire(timeout=0.01), False)
+
+    def test_unit_acquire_wakes_on_increase(self):
+        controller = _controller(start=1)
+        controller.acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(controller.acquire(timeout=5)))
+        waiter.start()
+        _window(controller)
+        waiter.join()
+        self.assertEqual(acquired, [True])
+
+    def test_unit_listeners_called_on_changes(self):
+        controller = _controller(start=1)
+        listener = mock.Mock()
+        controller.add_listener(listener)
+        controller.acquire()
+        listener.assert_not_called()
+        controller.release()
+        self.assertEqual(listener.call_count, 1)
+        _window(controller)
+        self.assertEqual(listener.call_count, 2)
+        controller.remove_listener(listener)
+        controller.release()
+        self.assertEqual(listener.call_count, 2)
+
+
+### ------------------------------ reset_controller() -----------------------------------
+@mock.patch("onedrive_offsite.concurrency.Config")
+class TestResetController(unittest.TestCase):
+
+    def test_unit_fixed_when_not_adaptive(self, mock_config):
+        mock_config.adaptive_concurrency = False
+        mock_config.transfer_concurrency = 5
+        controller = _controller()
+        reset_controller(controller)
+        self.assertEqual((controller.limit, controller.min_limit, controller.max_limit), (5, 5, 5))
+
+    def test_unit_adaptive_capped_by_workers(self, mock_config):
+        mock_config.adaptive_concurrency = True
+        mock_config.transfer_concurrency = 5
+        mock_config.transfer_concurrency_min = 1
+        mock_config.transfer_concurrency_max = 16
+        controller = _controller()
+        reset_controller(controller, max_workers=5)
+        self.assertEqual((controller.limit, controller.min_limit, controller.max_limit), (5, 1, 5))
+
+
+### ------------------------------ graph client hooks -----------------------------------
+class TestRecordHooks(unittest.TestCase):
+
+    def test_unit_put_recorded_as_upload(self):
+        resp = mock.Mock()
+        resp.request.method = "PUT"
+        resp.request.headers = {"Content-Length": "10485760"}
+        resp.status_code = 202
+        resp.elapsed = timedelta(seconds=2)
+        with mock.patch.object(upload_controller, "record") as mock_record:
+            _record_response(resp)
+            mock_record.assert_called_once_with(202, 2.0, 10485760)
+
+    def test_unit_ranged_get_not_recorded_by_hook(self):
+        # the body hasn't been read when the hook runs, the download manager records ranged downloads once it has
+        resp = mock.Mock()
+        resp.request.method = "GET"
+        resp.request.headers = {"Range": "bytes=0-99"}
+        resp.headers = {"Content-Length": "100"}
+        resp.status_code = 206
+        resp.elapsed = timedelta(seconds=1)
+        with mock.patch.object(download_controller, "record") as mock_record:
+            _record_response(resp)
+            mock_record.assert_not_called()
+
+    def test_unit_other_requests_ignored(self):
+        resp = mock.Mock()
+        resp.request.method = "GET"
+        resp.request.headers = {}
+        with mock.patch.object(download_controller, "record") as mock_record:
+            with mock.patch.object(upload_controller, "record") as mock_up_record:
+                _record_response(resp)
+                mock_record.assert_not_called()
+                mock_up_record.assert_not_called()
+
+    def test_unit_error_recorded(self):
+        with mock.patch.object(upload_controller, "record") as mock_record:
+            _record_error("PUT", {}, Exception("fake timeout"))
+            mock_record.assert_called_once_with(None, 0, 0)
@@ -1,6 +1,8 @@
-import unittest, mock, os, shutil
+import unittest, mock, os, shutil, hashlib
 
-from onedrive_offsite.crypt import Crypt, Sha256Calc
+from onedrive_offsite.crypt import Crypt, Sha256Calc, ChunkSha256, OffsetSha256, AeadChunkCipher, FernetChunkCipher, ZeroRun, SparseChunk, is_zero_block, zero_blocks, encrypt_chunk, decrypt_chunk, write_decrypted, choose_compression, COMPRESSION_MAGIC, ZERO_RUN_MAGIC, ZERO_MAP_MAGIC, decrypted_size
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
 
 
 ### ------------------------------ Crypt.gen_key() -----------------------------------
@@ -109,6 +111,216 @@ class TestCryptchunkencrypt(unittest.TestCase):
                     check_value = crypt.chunk_encrypt("fake/file/to/encrypt", "fake/chunk/dir", 1)
                     self.assertEqual(check_value, False)
     
+### ------------------------------ Crypt.encrypted_chunk_size() -----------------------------------
+class TestCryptencryptedchunksize(unittest.TestCase):
+
+    def test_unit_encrypted_chunk_size_matches_fernet(self):
+        fernet = Fernet(Fernet.generate_key())
+        for plain_size in [0, 1, 15, 16, 17, 1000, 30000]:
+            self.assertEqual(Crypt.encrypted_chunk_size(plain_size, "fernet"), len(fernet.encrypt(b'a' * plain_size)))
+
+    def test_unit_encrypted_chunk_size_matches_aes_gcm(self):
+        aead = AeadChunkCipher(Fernet.generate_key())
+        for plain_size in [0, 1, 15, 16, 17, 1000, 30000]:
+            self.assertEqual(Crypt.encrypted_chunk_size(plain_size, "aes-gcm"), len(aead.encrypt(b'a' * plain_size)))
+
+    def test_unit_chunk_name(self):
+        self.assertEqual(Crypt.chunk_name(7, Crypt.max_chunk_count(3000, 10)), "007_backup.crypt")
+
+
+### ------------------------------ AeadChunkCipher -----------------------------------
+class TestAeadChunkCipher(unittest.TestCase):
+
+    def test_unit_aead_round_trip(self):
+        aead = AeadChunkCipher(Fernet.generate_key())
+        encrypted = aead.encrypt(b'some backup data')
+        self.assertEqual(AeadChunkCipher.is_aead_chunk(encrypted), True)
+        self.assertEqual(aead.decrypt(encrypted), b'some backup data')
+
+    def test_unit_aead_unique_nonce_per_chunk(self):
+        aead = AeadChunkCipher(Fernet.generate_key())
+        self.assertNotEqual(aead.encrypt(b'same data'), aead.encrypt(b'same data'))
+
+    def test_unit_aead_fernet_token_not_detected(self):
+        fernet_token = Fernet(Fernet.generate_key()).encrypt(b'some backup data')
+        self.assertEqual(AeadChunkCipher.is_aead_chunk(fernet_token), False)
+
+    def test_unit_aead_wrong_key(self):
+        encrypted = AeadChunkCipher(Fernet.generate_key()).encrypt(b'some backup data')
+        with self.assertRaises(InvalidTag):
+            AeadChunkCipher(Fernet.generate_key()).decrypt(encrypted)
+
+    def test_unit_aead_tampered_header(self):
+        aead = AeadChunkCipher(Fernet.generate_key())
+        encrypted = bytearray(aead.encrypt(b'some backup data'))
+        encrypted[10] = encrypted[10] ^ 1   # flip a bit in the nonce
+        with self.assertRaises(InvalidTag):
+            aead.decrypt(bytes(encrypted))
+
+    def test_unit_aead_unsupported_version(self):
+        aead = AeadChunkCipher(Fernet.generate_key())
+        encrypted = bytearray(aead.encrypt(b'some backup data'))
+        encrypted[4] = 99
+        with self.assertRaises(InvalidTag):
+            aead.decrypt(bytes(encrypted))
+
+
+### ------------------------------ zero runs -----------------------------------
+class TestZeroRuns(unittest.TestCase):
+
+    def test_unit_is_zero_block(self):
+        self.assertEqual(is_zero_block(bytes(1000)), True)
+        self.assertEqual(is_zero_block(bytes(999) + b'a'), False)
+        self.assertEqual(is_zero_block(b'a' + bytes(999)), False)
+        self.assertEqual(is_zero_block(b''), False)
+
+    def test_unit_zero_chunk_round_trip(self):
+        key = Fernet.generate_key()
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            encrypted = encrypt_chunk(cipher, bytes(30000), True)
+            self.assertLess(len(encrypted), 200)
+            decrypted = decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key))
+            self.assertIsInstance(decrypted, ZeroRun)
+            self.assertEqual(decrypted, 30000)
+
+    def test_unit_zero_chunk_not_elided(self):
+        key = Fernet.generate_key()
+        encrypted = encrypt_chunk(AeadChunkCipher(key), bytes(1000), False)
+        self.assertEqual(decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key)), bytes(1000))
+
+    def test_unit_real_chunk_swapped_for_zero_run(self):
+        # a real chunk with the zero run marker put in front of it must not restore as zeros
+        key = Fernet.generate_key()
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            encrypted = ZERO_RUN_MAGIC + encrypt_chunk(cipher, (7).to_bytes(8, "big"), True)
+            with self.assertRaises((InvalidTag, InvalidToken)):
+                decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key))
+
+    def test_unit_zero_run_marker_stripped(self):
+        key = Fernet.generate_key()
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            encrypted = encrypt_chunk(cipher, bytes(30000), True)
+            with self.assertRaises((InvalidTag, InvalidToken)):
+                decrypt_chunk(encrypted[len(ZERO_RUN_MAGIC):], FernetChunkCipher(key), AeadChunkCipher(key))
+
+    def test_unit_write_decrypted_zero_run_seeks(self):
+        combined_file = mock.Mock()
+        chunk_hash = mock.Mock()
+        write_decrypted(combined_file, ZeroRun(10), chunk_hash, 3)
+        combined_file.seek.assert_called_with(10, os.SEEK_CUR)
+        combined_file.write.assert_not_called()
+        chunk_hash.update.assert_called_with(3, ZeroRun(10))
+
+    def test_unit_zero_blocks(self):
+        with mock.patch("onedrive_offsite.crypt.ZERO_BLOCK_BYTES", 100):
+            self.assertEqual(zero_blocks(bytes(100) + b'a' + bytes(99) + bytes(100) + bytes(49) + b'a'), [True, False, True, False])
+            self.assertEqual(zero_blocks(bytes(250)), [True, True, True])
+            self.assertEqual(zero_blocks(b''), [])
+
+    @mock.patch("onedrive_offsite.crypt.ZERO_BLOCK_BYTES", 100)
+    def test_unit_zero_map_chunk_round_trip(self):
+        key = Fernet.generate_key()
+        plain_bytes = os.urandom(150) + bytes(250) + os.urandom(100) + bytes(130)
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            for compression in [None, "zlib"]:
+                encrypted = encrypt_chunk(cipher, plain_bytes, True, compression)
+                self.assertEqual(encrypted[:4], ZERO_MAP_MAGIC)
+                decrypted = decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key))
+                self.assertIsInstance(decrypted, SparseChunk)
+                # blocks 0 and 1, 2 and 3 are zeros, 4, then 5 and 6
+                self.assertEqual(decrypted, [plain_bytes[:200], ZeroRun(200), plain_bytes[400:500], ZeroRun(130)])
+                self.assertEqual(decrypted_size(decrypted), len(plain_bytes))
+
+    @mock.patch("onedrive_offsite.crypt.ZERO_BLOCK_BYTES", 100)
+    def test_unit_zero_map_marker_stripped(self):
+        key = Fernet.generate_key()
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            encrypted = encrypt_chunk(cipher, os.urandom(100) + bytes(100), True)
+            with self.assertRaises((InvalidTag, InvalidToken)):
+                decrypt_chunk(encrypted[len(ZERO_MAP_MAGIC):], FernetChunkCipher(key), AeadChunkCipher(key))
+            with self.assertRaises((InvalidTag, InvalidToken)):
+                decrypt_chunk(ZERO_RUN_MAGIC + encrypted[len(ZERO_MAP_MAGIC):], FernetChunkCipher(key), AeadChunkCipher(key))
+
+    def test_unit_write_decrypted_sparse_chunk(self):
+        combined_file = mock.Mock()
+        write_decrypted(combined_file, SparseChunk([b'abc', ZeroRun(10), b'de']))
+        self.assertEqual(combined_file.method_calls, [mock.call.write(b'abc'), mock.call.seek(10, os.SEEK_CUR), mock.call.write(b'de')])
+
+    def test_unit_chunk_sha256_zero_runs(self):
+        # zero runs hash the same as the zeros they stand for, fed from the shared zero block rather than one buffer as large as the run
+        chunk_hash = ChunkSha256()
+        chunk_hash.update(1, ZeroRun(2500000))
+        chunk_hash.update(2, SparseChunk([b'abc', ZeroRun(1048577), b'de']))
+        self.assertEqual(chunk_hash.hexdigest(), hashlib.sha256(bytes(2500000) + b'abc' + bytes(1048577) + b'de').hexdigest())
+
+
+### ------------------------------ compression -----------------------------------
+class TestCompression(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_sample_path = os.path.join(test_dir, "test_sample_file")
+
+    def tearDown(self):
+        if os.path.isfile(TestCompression.test_sample_path):
+            os.remove(TestCompression.test_sample_path)
+
+    def _write_sample_file(self, data):
+        with open(TestCompression.test_sample_path, "wb") as sample_file:
+            sample_file.write(data)
+
+    def test_unit_choose_compression_off(self):
+        self.assertIs(choose_compression("fake/file/path", "off"), None)
+
+    @mock.patch("onedrive_offsite.crypt.zstandard", None)
+    def test_unit_choose_compression_on(self):
+        self.assertEqual(choose_compression("fake/file/path", "on"), "zlib")
+
+    @mock.patch("onedrive_offsite.crypt.zstandard", None)
+    def test_unit_choose_compression_auto_compressible(self):
+        self._write_sample_file(b"some very compressible text " * 100000)
+        self.assertEqual(choose_compression(TestCompression.test_sample_path, "auto"), "zlib")
+
+    def test_unit_choose_compression_auto_already_compressed(self):
+        self._write_sample_file(os.urandom(2000000))
+        self.assertIs(choose_compression(TestCompression.test_sample_path, "auto"), None)
+
+    def test_unit_choose_compression_auto_sample_exception(self):
+        self.assertIs(choose_compression("fake/file/path", "auto"), None)
+
+    def test_unit_compressed_chunk_round_trip(self):
+        key = Fernet.generate_key()
+        plain_bytes = b"some very compressible text " * 1000
+        encrypted = encrypt_chunk(AeadChunkCipher(key), plain_bytes, True, "zlib")
+        self.assertEqual(encrypted[:4], COMPRESSION_MAGIC["zlib"])
+        self.assertLess(len(encrypted), len(plain_bytes) / 10)
+        self.assertEqual(decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key)), plain_bytes)
+
+    def test_unit_incompressible_chunk_stored_plain(self):
+        key = Fernet.generate_key()
+        plain_bytes = os.urandom(10000)
+        encrypted = encrypt_chunk(AeadChunkCipher(key), plain_bytes, True, "zlib")
+        self.assertEqual(AeadChunkCipher.is_aead_chunk(encrypted), True)
+        self.assertEqual(decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key)), plain_bytes)
+
+    def test_unit_compression_marker_tampered(self):
+        # swapping, stripping or adding a compression marker has to fail decryption, not restore the wrong bytes
+        key = Fernet.generate_key()
+        plain_bytes = b"some very compressible text " * 1000
+        for cipher in [FernetChunkCipher(key), AeadChunkCipher(key)]:
+            encrypted = encrypt_chunk(cipher, plain_bytes, True, "zlib")
+            record = encrypted[len(COMPRESSION_MAGIC["zlib"]):]
+            plain_record = encrypt_chunk(cipher, plain_bytes, True)
+            for tampered in [COMPRESSION_MAGIC["zstd"] + record, record, COMPRESSION_MAGIC["zlib"] + plain_record]:
+                with self.assertRaises((InvalidTag, InvalidToken)):
+                    decrypt_chunk(tampered, FernetChunkCipher(key), AeadChunkCipher(key))
+
+    @mock.patch("onedrive_offsite.crypt.zstandard", None)
+    def test_unit_zstd_chunk_without_zstandard(self):
+        key = Fernet.generate_key()
+        encrypted = COMPRESSION_MAGIC["zstd"] + AeadChunkCipher(key).encrypt(b"fake zstd frame", COMPRESSION_MAGIC["zstd"])
+        with self.assertRaises(ImportError):
+            decrypt_chunk(encrypted, FernetChunkCipher(key), AeadChunkCipher(key))
+
+
 ### ------------------------------ Crypt.chunk_decrypt() -----------------------------------
 class TestCryptchunkdecrypt(unittest.TestCase):
 
@@ -186,3 +398,67 @@ class TestSha256Calc(unittest.TestCase):
         self.assertEqual(check_val, "0123456789abcdef")
 
 
+### ------------------------------ ChunkSha256 -----------------------------------
+class TestChunkSha256(unittest.TestCase):
+
+    def test_unit_chunk_sha256_matches_whole_file_hash(self):
+        chunk_hash = ChunkSha256()
+        chunk_hash.update(1, b'abc')
+        chunk_hash.update(2, b'def')
+        self.assertEqual(chunk_hash.hexdigest(), hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_unit_chunk_sha256_skip_repeated_chunk(self):
+        chunk_hash = ChunkSha256()
+        chunk_hash.update(1, b'abc')
+        check_val = chunk_hash.update(1, b'abc')
+        self.assertIs(check_val, False)
+        self.assertEqual(chunk_hash.hexdigest(), hashlib.sha256(b'abc').hexdigest())
+
+    def test_unit_chunk_sha256_out_of_order(self):
+        chunk_hash = ChunkSha256()
+        with self.assertRaises(ValueError):
+            chunk_hash.update(2, b'def')
+
+
+### ------------------------------ OffsetSha256 -----------------------------------
+class TestOffsetSha256(unittest.TestCase):
+
+    def test_unit_offset_sha256_in_order(self):
+        offset_hash = OffsetSha256()
+        offset_hash.update(0, b'abc')
+        offset_hash.update(3, b'def')
+        self.assertEqual(offset_hash.offset, 6)
+        self.assertEqual(offset_hash.hexdigest(), hashlib.sha256(b'abcdef').hexdigest())
+
+    def test_unit_offset_sha256_out_of_order(self):
+        offset_hash = OffsetSha256(max_buffer_bytes=100)
+        offset_hash.update(6, b'ghi')
+        offset_hash.update(3, b'def')
+        self.assertEqual(offset_hash.offset, 0)
+        self.assertEqual(offset_hash.buffered_bytes, 6)
+        offset_hash.update(0, b'abc')
+        self.assertEqual(offset_hash.offset, 9)
+        self.assertEqual(offset_hash.buffered_bytes, 0)
+        self.assertEqual(offset_hash.hexdigest(), hashlib.sha256(b'abcdefghi').hexdigest())
+
+    def test_unit_offset_sha256_read_back_past_buffer(self):
+        file_bytes = b'abcdefghi'
+        read_back = mock.Mock(side_effect=lambda offset, length: file_bytes[offset:offset + length])
+        offset_hash = OffsetSha256(max_buffer_bytes=3, read_back=read_back)
+        offset_hash.update(3, b'def')
+        offset_hash.update(6, b'ghi')     # the buffer is full, this one is read back later
+        self.assertEqual(offset_hash.buffered_bytes, 3)
+        offset_hash.update(0, b'abc')
+        read_back.assert_called_once_with(6, 3)
+        self.assertEqual(offset_hash.hexdigest(), hashlib.sha256(file_bytes).hexdigest())
+
+    def test_unit_offset_sha256_start_offset(self):
+        offset_hash = OffsetSha256(3)
+        with self.assertRaises(ValueError):
+            offset_hash.update(0, b'abc')
+
+    def test_unit_offset_sha256_missing_piece(self):
+        offset_hash = OffsetSha256(max_buffer_bytes=100)
+        offset_hash.update(3, b'def')
+        with self.assertRaises(ValueError):
+            offset_hash.hexdigest()
@@ -0,0 +1,130 @@
+import unittest, mock, os, io, json, shutil
+from datetime import datetime, timedelta
+
+from onedrive_offsite.dedup import cdc_chunks, chunk_id_key, chunk_id, DedupIndex, build_manifest, manifest_packs, commit_manifest, read_manifest
+from cryptography.fernet import Fernet
+
+
+def _anchored_data(segment_count: int, segment_size: int) -> bytes:
+    # random segments that each end in an anchor, so the content defined boundaries land at known places
+    return b"".join([os.urandom(segment_size) + b"\x9e\x37\x79" for i in range(segment_count)])
+
+
+### ------------------------------ cdc_chunks() -----------------------------------
+class TestCdcChunks(unittest.TestCase):
+
+    def test_unit_cdc_chunks_rebuild_file(self):
+        data = os.urandom(10000)
+        chunks = list(cdc_chunks(io.BytesIO(data), 100, 1000))
+        self.assertEqual(b"".join(chunks), data)
+
+    def test_unit_cdc_chunks_size_limits(self):
+        data = _anchored_data(20, 50) + os.urandom(5000)
+        chunks = list(cdc_chunks(io.BytesIO(data), 100, 1000))
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 100)
+            self.assertLessEqual(len(chunk), 1000)
+
+    def test_unit_cdc_chunks_cut_after_anchor(self):
+        data = _anchored_data(5, 500)
+        chunks = list(cdc_chunks(io.BytesIO(data), 100, 1000))
+        self.assertEqual([len(chunk) for chunk in chunks], [503] * 5)
+
+    def test_unit_cdc_chunks_insert_only_changes_nearby_chunks(self):
+        data = _anchored_data(10, 500)
+        shifted_data = data[:200] + b"inserted bytes" + data[200:]
+        chunks = list(cdc_chunks(io.BytesIO(data), 100, 1000))
+        shifted_chunks = list(cdc_chunks(io.BytesIO(shifted_data), 100, 1000))
+        self.assertNotEqual(chunks[0], shifted_chunks[0])
+        self.assertEqual(chunks[1:], shifted_chunks[1:])
+
+    def test_unit_cdc_chunks_empty_file(self):
+        self.assertEqual(list(cdc_chunks(io.BytesIO(b""), 100, 1000)), [])
+
+
+### ------------------------------ chunk_id() -----------------------------------
+class TestChunkId(unittest.TestCase):
+
+    def test_unit_chunk_id_same_key_same_id(self):
+        key = Fernet.generate_key()
+        self.assertEqual(chunk_id(chunk_id_key(key), b"some data"), chunk_id(chunk_id_key(key), b"some data"))
+
+    def test_unit_chunk_id_depends_on_key(self):
+        self.assertNotEqual(chunk_id(chunk_id_key(Fernet.generate_key()), b"some data"), chunk_id(chunk_id_key(Fernet.generate_key()), b"some data"))
+
+
+### ------------------------------ DedupIndex -----------------------------------
+class TestDedupIndex(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_index_path = os.path.join(test_dir, "test_dedup_index.json")
+
+    def tearDown(self):
+        if os.path.isfile(TestDedupIndex.test_index_path):
+            os.remove(TestDedupIndex.test_index_path)
+
+    def test_unit_index_load_missing_file(self):
+        index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        self.assertEqual(index.load(), True)
+        self.assertEqual(index.chunks, {})
+
+    def test_unit_index_save_and_load(self):
+        index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        index.add("fake-id", "fake-dir", "fake-pack")
+        self.assertEqual(index.save(), True)
+
+        loaded_index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        loaded_index.load()
+        self.assertEqual(loaded_index.lookup("fake-id").get("pack"), "fake-pack")
+        self.assertEqual(os.path.isfile(TestDedupIndex.test_index_path + ".tmp"), False)
+
+    def test_unit_index_load_exception(self):
+        with open(TestDedupIndex.test_index_path, "w") as index_file:
+            index_file.write("not json")
+        index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        self.assertEqual(index.load(), False)
+
+    def test_unit_index_lookup_too_old(self):
+        index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        index.chunks["fake-id"] = {"onedrive-dir": "fake-dir", "pack": "fake-pack", "added": (datetime.now() - timedelta(days=31)).isoformat()}
+        self.assertIs(index.lookup("fake-id"), None)
+
+    def test_unit_index_lookup_missing(self):
+        index = DedupIndex(TestDedupIndex.test_index_path, 30)
+        self.assertIs(index.lookup("fake-id"), None)
+
+
+### ------------------------------ manifests -----------------------------------
+class TestManifest(unittest.TestCase):
+
+    def test_unit_build_manifest_new_and_reused_chunks(self):
+        index = DedupIndex("fake/index/path", 30)
+        index.add("old-id", "old-dir", "old-pack")
+        manifest = build_manifest("new-dir", [["new-id", 10], ["old-id", 20]], index, {"new-id": "new-pack"})
+        self.assertEqual(manifest["chunks"], [["new-id", 10, "new-dir", "new-pack"], ["old-id", 20, "old-dir", "old-pack"]])
+
+    def test_unit_build_manifest_missing_chunk(self):
+        index = DedupIndex("fake/index/path", 30)
+        self.assertIs(build_manifest("new-dir", [["lost-id", 10]], index, {}), None)
+
+    def test_unit_manifest_packs_in_first_use_order(self):
+        manifest = {"chunks": [["a", 1, "dir2", "pack2"], ["b", 1, "dir1", "pack1"], ["c", 1, "dir2", "pack2"]]}
+        self.assertEqual(manifest_packs(manifest), [["dir2", "pack2"], ["dir1", "pack1"]])
+
+    def test_unit_read_manifest_unable_to_fetch_key(self):
+        crypt = mock.Mock()
+        crypt.fetch_key.return_value = False
+        self.assertIs(read_manifest(crypt, "fake/manifest/path"), None)
+
+    def test_unit_commit_manifest_only_adds_new_chunks(self):
+        manifest = {"onedrive-dir": "new-dir", "chunks": [["new-id", 10, "new-dir", "new-pack"], ["old-id", 20, "old-dir", "old-pack"]]}
+        index = mock.Mock()
+        with mock.patch("onedrive_offsite.dedup.read_manifest", return_value=manifest) as mock_read_manifest:
+            commit_manifest(mock.Mock(), "fake/manifest/path", index)
+            index.add.assert_called_once_with("new-id", "new-dir", "new-pack")
+            index.save.assert_called_once()
+
+    def test_unit_commit_manifest_read_fail(self):
+        index = mock.Mock()
+        with mock.patch("onedrive_offsite.dedup.read_manifest", return_value=None) as mock_read_manifest:
+            self.assertEqual(commit_manifest(mock.Mock(), "fake/manifest/path", index), False)
+            index.save.assert_not_called()
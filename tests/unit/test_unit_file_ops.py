@@ -1,6 +1,7 @@
-import unittest, mock, os
+import unittest, mock, os, queue, threading
 
-from onedrive_offsite.file_ops import crypt_file_build, crypt_file_upload, crypt_file_build_and_upload, download, restore
+from onedrive_offsite.file_ops import crypt_file_build, crypt_file_upload, crypt_file_build_and_upload, download, restore, crypt_file_stream_upload, _stream_part_plan, _dedup_build, _dedup_commit, _wait_for_dir_manager, _start_token_refresh
+from onedrive_offsite.crypt import Crypt
 
 
 @mock.patch("onedrive_offsite.file_ops.Config")
@@ -24,8 +25,8 @@ class Testcryptfilebuild(unittest.TestCase):
                     backup_info_json = {"backup-file-path":"/fake/backup/path", "start-date-time":"2022-01-10-23:18:18", "size-bytes": 125000000, "onedrive-filename":"fake-onedrive-filename.tar.gz", "done-date-time":"2022-01-10-24:18:18"}
                     mock_json.return_value.load.return_value = backup_info_json
                     with mock.patch("onedrive_offsite.file_ops.os.path.isdir", side_effect=[True, True]) as mock_isdir: # [crypt_chunk_dir, crypt_tar_gz_dir]
-                        with mock.patch("onedrive_offsite.file_ops.Sha256Calc") as mock_shacalc:
-                            mock_shacalc.return_value.calc.return_value = "fakehash"
+                        with mock.patch("onedrive_offsite.file_ops.ChunkSha256") as mock_shacalc:
+                            mock_shacalc.return_value.hexdigest.return_value = "fakehash"
                             with mock.patch("onedrive_offsite.file_ops.make_tar_gz", return_value=True) as mock_make_tar_gz:
                                 check_value = crypt_file_build()
                                 self.assertEqual(check_value, True)
@@ -48,8 +49,8 @@ class Testcryptfilebuild(unittest.TestCase):
                     backup_info_json = {"backup-file-path":"/fake/backup/path", "start-date-time":"2022-01-10-23:18:18", "size-bytes": 125000000, "onedrive-filename":"fake-onedrive-filename.tar.gz", "done-date-time":"2022-01-10-24:18:18"}
                     mock_json.return_value.load.return_value = backup_info_json
                     with mock.patch("onedrive_offsite.file_ops.os.path.isdir", side_effect=[True, True]) as mock_isdir: # [crypt_chunk_dir, crypt_tar_gz_dir]
-                        with mock.patch("onedrive_offsite.file_ops.Sha256Calc") as mock_shacalc:
-                            mock_shacalc.return_value.calc.return_value = None
+                        with mock.patch("onedrive_offsite.file_ops.ChunkSha256") as mock_shacalc:
+                            mock_shacalc.return_value.hexdigest.return_value = None
                             with mock.patch("onedrive_offsite.file_ops.make_tar_gz", return_value=True) as mock_make_tar_gz:
                                 check_value = crypt_file_build()
                                 self.assertEqual(check_value, True)
@@ -96,8 +97,8 @@ class Testcryptfilebuild(unittest.TestCase):
                     mock_json.return_value.load.return_value = backup_info_json
                     with mock.patch("onedrive_offsite.file_ops.os.path.isdir", side_effect=[False, False]) as mock_isdir: # [crypt_chunk_dir, crypt_tar_gz_dir]
                         with mock.patch("onedrive_offsite.file_ops.os.mkdir") as mock_mkdir:
-                            with mock.patch("onedrive_offsite.file_ops.Sha256Calc") as mock_shacalc:
-                                mock_shacalc.return_value.calc.return_value = "fakehash"
+                            with mock.patch("onedrive_offsite.file_ops.ChunkSha256") as mock_shacalc:
+                                mock_shacalc.return_value.hexdigest.return_value = "fakehash"
                                 with mock.patch("onedrive_offsite.file_ops.make_tar_gz", return_value=False) as mock_make_tar_gz:
                                     with mock.patch("onedrive_offsite.file_ops.file_cleanup") as mock_file_cleanup:
                                         check_value = crypt_file_build()
@@ -133,8 +134,8 @@ class Testcryptfilebuild(unittest.TestCase):
             with mock.patch("onedrive_offsite.file_ops.open") as mock_open:
                 with mock.patch("onedrive_offsite.file_ops.json.load") as mock_json:
                     with mock.patch("onedrive_offsite.file_ops.os.path.isdir", return_value=True) as mock_isdir:
-                        with mock.patch("onedrive_offsite.file_ops.Sha256Calc") as mock_shacalc:
-                            mock_shacalc.return_value.calc.return_value = "fakehash"
+                        with mock.patch("onedrive_offsite.file_ops.ChunkSha256") as mock_shacalc:
+                            mock_shacalc.return_value.hexdigest.return_value = "fakehash"
                             with mock.patch("onedrive_offsite.file_ops.file_cleanup") as mock_file_cleanup:  
                                 check_value = crypt_file_build()
                                 self.assertEqual(check_value, False)
@@ -146,9 +147,9 @@ class Testcryptfileupload(unittest.TestCase):
     @mock.patch("onedrive_offsite.file_ops.file_cleanup")
     @mock.patch("onedrive_offsite.file_ops.Config")
     @mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["file1", "file2", "file3"])
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_crypt_file_upload_error_not_empty(self, mock_Thread, mock_sleep, mock_listdir, mock_config, mock_file_clean):
+    def test_crypt_file_upload_error_not_empty(self, mock_Thread, mock_event, mock_listdir, mock_config, mock_file_clean):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -166,9 +167,9 @@ class Testcryptfileupload(unittest.TestCase):
     @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=False)
     @mock.patch("onedrive_offsite.file_ops.Config")
     @mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["file1", "file2", "file3"])
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_crypt_file_upload_error_empty_cleanup_problem(self, mock_Thread, mock_sleep, mock_listdir, mock_config, mock_file_clean):
+    def test_crypt_file_upload_error_empty_cleanup_problem(self, mock_Thread, mock_event, mock_listdir, mock_config, mock_file_clean):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -186,9 +187,9 @@ class Testcryptfileupload(unittest.TestCase):
     @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=True)
     @mock.patch("onedrive_offsite.file_ops.Config")
     @mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["file1", "file2", "file3"])
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_crypt_file_upload_error_empty_cleanup_works(self, mock_Thread, mock_sleep, mock_listdir, mock_config, mock_file_clean):
+    def test_crypt_file_upload_error_empty_cleanup_works(self, mock_Thread, mock_event, mock_listdir, mock_config, mock_file_clean):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -203,6 +204,66 @@ class Testcryptfileupload(unittest.TestCase):
             self.assertEqual(check_value, True)
 
 
+    @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=True)
+    @mock.patch("onedrive_offsite.file_ops.Config")
+    @mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["file2", "file1"])
+    def test_crypt_file_upload_asyncio_engine(self, mock_listdir, mock_config, mock_file_clean):
+        mock_config.transfer_engine = "asyncio"
+        mock_config.dedup = False
+        with mock.patch("onedrive_offsite.file_ops.async_upload", return_value=True) as mock_async_upload:
+            with mock.patch("onedrive_offsite.file_ops.threading.Thread") as mock_Thread:
+                check_value = crypt_file_upload()
+                self.assertEqual(check_value, True)
+                mock_async_upload.assert_called_once_with(["file1", "file2"])
+                mock_Thread.assert_not_called()
+
+    @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=True)
+    @mock.patch("onedrive_offsite.file_ops.Config")
+    @mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["file1"])
+    def test_crypt_file_upload_asyncio_engine_fail(self, mock_listdir, mock_config, mock_file_clean):
+        mock_config.transfer_engine = "asyncio"
+        with mock.patch("onedrive_offsite.file_ops.async_upload", return_value=False) as mock_async_upload:
+            check_value = crypt_file_upload()
+            self.assertEqual(check_value, False)
+            mock_file_clean.assert_called_once_with(error=True)
+
+
+class Testthreadstartup(unittest.TestCase):
+
+    def test_unit_wait_for_dir_manager_done(self):
+        dir_complete_q = queue.Queue()
+        dir_complete_q.put("done")
+        kill_q = queue.Queue()
+        error_q = queue.Queue()
+        _wait_for_dir_manager(dir_complete_q, kill_q, error_q)
+        self.assertEqual(kill_q.empty(), True)
+        self.assertEqual(error_q.empty(), True)
+
+    def test_unit_wait_for_dir_manager_too_long(self):
+        dir_complete_q = mock.Mock()
+        dir_complete_q.get.side_effect = queue.Empty
+        kill_q = queue.Queue()
+        error_q = queue.Queue()
+        _wait_for_dir_manager(dir_complete_q, kill_q, error_q)
+        self.assertEqual(dir_complete_q.get.call_args[1]["timeout"], 7200)
+        self.assertEqual(kill_q.qsize(), 20)
+        self.assertEqual(error_q.qsize(), 1)
+
+    def test_unit_start_token_refresh_waits_for_tokens(self):
+        events = []
+        def fake_worker(kill_q, error_q, tokens_ready):
+            events.append("refreshed")
+            tokens_ready.set()
+            kill_q.get()            # keep running until the test is done
+        with mock.patch("onedrive_offsite.file_ops.token_refresh_worker", side_effect=fake_worker):
+            kill_q = queue.Queue()
+            credential_thread = _start_token_refresh("cred-thread", kill_q, queue.Queue())
+            events.append("started")
+            kill_q.put("kill")
+            credential_thread.join()
+        self.assertEqual(events, ["refreshed", "started"])
+
+
 class Testcryptfilebuildandupload(unittest.TestCase):
 
     def test_unit_successful(self):
@@ -223,12 +284,179 @@ class Testcryptfilebuildandupload(unittest.TestCase):
             self.assertEqual(check_value, False)
 
 
+    @mock.patch("onedrive_offsite.file_ops.Config")
+    def test_unit_stream_upload(self, mock_config):
+        mock_config.stream_upload = True
+        with mock.patch("onedrive_offsite.file_ops.crypt_file_stream_upload", return_value=True) as mock_stream:
+            with mock.patch("onedrive_offsite.file_ops.crypt_file_build") as mock_build:
+                check_value = crypt_file_build_and_upload()
+                self.assertEqual(check_value, True)
+                self.assertEqual(mock_build.call_count, 0)
+
+    @mock.patch("onedrive_offsite.file_ops.Config")
+    def test_unit_dedup_uses_build_path(self, mock_config):
+        mock_config.stream_upload = True
+        mock_config.dedup = True
+        with mock.patch("onedrive_offsite.file_ops.crypt_file_stream_upload") as mock_stream:
+            with mock.patch("onedrive_offsite.file_ops.crypt_file_build", return_value=True) as mock_build:
+                with mock.patch("onedrive_offsite.file_ops.crypt_file_upload", return_value=True) as mock_upload:
+                    check_value = crypt_file_build_and_upload()
+                    self.assertEqual(check_value, True)
+                    self.assertEqual(mock_stream.call_count, 0)
+
+
+### ------------------------------ _dedup_build() and _dedup_commit() -----------------------------------
+@mock.patch("onedrive_offsite.file_ops.Config")
+class Testdedupbuild(unittest.TestCase):
+
+    def test_unit_dedup_build_index_load_fail(self, mock_config):
+        with mock.patch("onedrive_offsite.file_ops.DedupIndex") as mock_index:
+            mock_index.return_value.load.return_value = False
+            with mock.patch("onedrive_offsite.file_ops.dedup_chunk_encrypt") as mock_encrypt:
+                check_value = _dedup_build(mock.Mock(), {"onedrive-dir": "fake-dir"}, 10)
+                self.assertEqual(check_value, False)
+                self.assertEqual(mock_encrypt.call_count, 0)
+
+    def test_unit_dedup_build_encrypt_fail(self, mock_config):
+        with mock.patch("onedrive_offsite.file_ops.DedupIndex") as mock_index:
+            with mock.patch("onedrive_offsite.file_ops.dedup_chunk_encrypt", return_value=None) as mock_encrypt:
+                with mock.patch("onedrive_offsite.file_ops._write_hash_file") as mock_write_hash:
+                    check_value = _dedup_build(mock.Mock(), {"onedrive-dir": "fake-dir"}, 10)
+                    self.assertEqual(check_value, False)
+                    self.assertEqual(mock_write_hash.call_count, 0)
+
+    def test_unit_dedup_build_no_new_chunks(self, mock_config):
+        mock_config.crypt_tar_gz_dir = "fake/tar/dir"
+        with mock.patch("onedrive_offsite.file_ops.DedupIndex") as mock_index:
+            with mock.patch("onedrive_offsite.file_ops.dedup_chunk_encrypt", return_value=[["fake-id", 10]]) as mock_encrypt:
+                with mock.patch("onedrive_offsite.file_ops._write_hash_file") as mock_write_hash:
+                    with mock.patch("onedrive_offsite.file_ops.os.path.isdir", return_value=True) as mock_isdir:
+                        with mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=[]) as mock_listdir:
+                            with mock.patch("onedrive_offsite.file_ops.make_tar_gz") as mock_make_tar_gz:
+                                with mock.patch("onedrive_offsite.file_ops.pack_locations", return_value={}) as mock_locations:
+                                    with mock.patch("onedrive_offsite.file_ops.build_manifest", return_value={"chunks": []}) as mock_build_manifest:
+                                        with mock.patch("onedrive_offsite.file_ops.write_manifest", return_value=True) as mock_write_manifest:
+                                            check_value = _dedup_build(mock.Mock(), {"onedrive-dir": "fake-dir"}, 10)
+                                            self.assertEqual(check_value, True)
+                                            self.assertEqual(mock_make_tar_gz.call_count, 0)
+                                            self.assertEqual(mock_write_manifest.call_args[0][2], os.path.join("fake/tar/dir", "fake-dir_manifest.crypt"))
+
+    def test_unit_dedup_build_manifest_fail(self, mock_config):
+        with mock.patch("onedrive_offsite.file_ops.DedupIndex") as mock_index:
+            with mock.patch("onedrive_offsite.file_ops.dedup_chunk_encrypt", return_value=[["fake-id", 10]]) as mock_encrypt:
+                with mock.patch("onedrive_offsite.file_ops._write_hash_file") as mock_write_hash:
+                    with mock.patch("onedrive_offsite.file_ops.os.path.isdir", return_value=True) as mock_isdir:
+                        with mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["fake-id.crypt"]) as mock_listdir:
+                            with mock.patch("onedrive_offsite.file_ops.make_tar_gz", return_value=True) as mock_make_tar_gz:
+                                with mock.patch("onedrive_offsite.file_ops.pack_locations", return_value={}) as mock_locations:
+                                    with mock.patch("onedrive_offsite.file_ops.build_manifest", return_value=None) as mock_build_manifest:
+                                        check_value = _dedup_build(mock.Mock(), {"onedrive-dir": "fake-dir"}, 10)
+                                        self.assertEqual(check_value, False)
+                                        self.assertEqual(mock_make_tar_gz.call_args[1]["compress"], False)
+
+    def test_unit_dedup_commit_no_manifest(self, mock_config):
+        with mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["001_fake.tar"]) as mock_listdir:
+            with mock.patch("onedrive_offsite.file_ops.commit_manifest") as mock_commit:
+                self.assertEqual(_dedup_commit(), False)
+                self.assertEqual(mock_commit.call_count, 0)
+
+    def test_unit_dedup_commit_success(self, mock_config):
+        mock_config.crypt_tar_gz_dir = "fake/tar/dir"
+        with mock.patch("onedrive_offsite.file_ops.os.listdir", return_value=["001_fake.tar", "fake-dir_manifest.crypt"]) as mock_listdir:
+            with mock.patch("onedrive_offsite.file_ops.DedupIndex") as mock_index:
+                with mock.patch("onedrive_offsite.file_ops.Crypt") as mock_crypt:
+                    with mock.patch("onedrive_offsite.file_ops.commit_manifest", return_value=True) as mock_commit:
+                        self.assertEqual(_dedup_commit(), True)
+                        self.assertEqual(mock_commit.call_args[0][1], os.path.join("fake/tar/dir", "fake-dir_manifest.crypt"))
+
+
+class Teststreampartplan(unittest.TestCase):
+
+    def test_unit_part_grouping(self):
+        # 25 bytes in 10 byte chunks = 3 chunks, 2 chunks per part
+        stream_parts = _stream_part_plan(25, .000010, 2, "fake.tar.gz")
+        self.assertEqual(len(stream_parts), 2)
+        self.assertEqual(stream_parts[0]["name"], "0001_fake.tar.gz")
+        self.assertEqual(stream_parts[1]["first-chunk"], 3)
+        self.assertEqual(stream_parts[1]["chunk-count"], 1)
+
+    def test_unit_part_size(self):
+        with mock.patch("onedrive_offsite.file_ops.tar_part_size", return_value=10240) as mock_tar_size:
+            stream_parts = _stream_part_plan(25, .000010, 2, "fake.tar.gz")
+            self.assertEqual(stream_parts[0]["size-bytes"], 10240)
+            # last chunk only has 5 bytes of plain text
+            mock_tar_size.assert_called_with([Crypt.encrypted_chunk_size(5)])
+
+
+@mock.patch("onedrive_offsite.file_ops.Config")
+class Testcryptfilestreamupload(unittest.TestCase):
+
+    def test_unit_max_chunks_0(self, mock_config):
+        mock_config.crypt_tar_gz_max_size_mb = 1
+        mock_config.crypt_chunk_size_mb = 10
+        with mock.patch("onedrive_offsite.file_ops.file_cleanup") as mock_file_cleanup:
+            check_value = crypt_file_stream_upload()
+            self.assertEqual(check_value, False)
+
+    def test_unit_backup_file_info_read_exception(self, mock_config):
+        mock_config.crypt_tar_gz_max_size_mb = 10
+        mock_config.crypt_chunk_size_mb = 1
+        with mock.patch("onedrive_offsite.file_ops.open", side_effect=Exception("fake exception")) as mock_open:
+            with mock.patch("onedrive_offsite.file_ops.file_cleanup") as mock_file_cleanup:
+                check_value = crypt_file_stream_upload()
+                self.assertEqual(check_value, False)
+
+    @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=True)
+    @mock.patch("onedrive_offsite.file_ops._write_hash_file")
+    @mock.patch("onedrive_offsite.file_ops.os.path.getsize", return_value=25)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
+    @mock.patch("onedrive_offsite.file_ops.threading.Thread")
+    def test_unit_stream_no_errors(self, mock_Thread, mock_event, mock_getsize, mock_write_hash, mock_file_clean, mock_config):
+        mock_config.crypt_tar_gz_max_size_mb = 10
+        mock_config.crypt_chunk_size_mb = 1
+        with mock.patch("onedrive_offsite.file_ops.open") as mock_open:
+            with mock.patch("onedrive_offsite.file_ops.json.load", return_value={"backup-file-path": "/fake/backup/path", "onedrive-dir": "fake-dir"}) as mock_json:
+                with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
+                    mock_kill_q = mock.Mock()
+                    mock_err_q = mock.Mock()
+                    mock_err_q.empty = mock.PropertyMock(return_value=True)
+                    mock_dir_q = mock.Mock()
+                    mock_dir_q.empty = mock.PropertyMock(return_value=False)
+                    mock_Q.side_effect = [mock_kill_q, mock_err_q, mock_dir_q]
+
+                    check_value = crypt_file_stream_upload()
+                    self.assertEqual(check_value, True)
+                    self.assertEqual(mock_write_hash.call_count, 1)
+
+    @mock.patch("onedrive_offsite.file_ops.file_cleanup", return_value=False)
+    @mock.patch("onedrive_offsite.file_ops._write_hash_file")
+    @mock.patch("onedrive_offsite.file_ops.os.path.getsize", return_value=25)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
+    @mock.patch("onedrive_offsite.file_ops.threading.Thread")
+    def test_unit_stream_error(self, mock_Thread, mock_event, mock_getsize, mock_write_hash, mock_file_clean, mock_config):
+        mock_config.crypt_tar_gz_max_size_mb = 10
+        mock_config.crypt_chunk_size_mb = 1
+        with mock.patch("onedrive_offsite.file_ops.open") as mock_open:
+            with mock.patch("onedrive_offsite.file_ops.json.load", return_value={"backup-file-path": "/fake/backup/path", "onedrive-dir": "fake-dir"}) as mock_json:
+                with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
+                    mock_kill_q = mock.Mock()
+                    mock_err_q = mock.Mock()
+                    mock_err_q.empty = mock.PropertyMock(return_value=False)
+                    mock_dir_q = mock.Mock()
+                    mock_dir_q.empty = mock.PropertyMock(return_value=False)
+                    mock_Q.side_effect = [mock_kill_q, mock_err_q, mock_dir_q]
+
+                    check_value = crypt_file_stream_upload()
+                    self.assertEqual(check_value, False)
+                    self.assertEqual(mock_write_hash.call_count, 0)
+
+
 class Testdownload(unittest.TestCase):
 
     @mock.patch("onedrive_offsite.file_ops.download_file_email", return_value=True)
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_unit_download_no_err_email_works(self, mock_Thread, mock_sleep, mock_dl_file_email):
+    def test_unit_download_no_err_email_works(self, mock_Thread, mock_event, mock_dl_file_email):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -241,9 +469,9 @@ class Testdownload(unittest.TestCase):
             self.assertEqual(check_value, True)
 
     @mock.patch("onedrive_offsite.file_ops.download_file_email", return_value=True)
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_unit_download_with_err(self, mock_Thread, mock_sleep, mock_dl_file_email):
+    def test_unit_download_with_err(self, mock_Thread, mock_event, mock_dl_file_email):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -256,9 +484,9 @@ class Testdownload(unittest.TestCase):
             self.assertEqual(check_value, None)
 
     @mock.patch("onedrive_offsite.file_ops.download_file_email", return_value=False)
-    @mock.patch("onedrive_offsite.file_ops.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.file_ops.threading.Event")
     @mock.patch("onedrive_offsite.file_ops.threading.Thread")
-    def test_unit_download_with_no_err_fail_email(self, mock_Thread, mock_sleep, mock_dl_file_email):
+    def test_unit_download_with_no_err_fail_email(self, mock_Thread, mock_event, mock_dl_file_email):
         with mock.patch("onedrive_offsite.file_ops.Queue") as mock_Q:
             mock_to_up_q = mock.Mock()
             mock_attempt_q = mock.Mock()
@@ -272,6 +500,18 @@ class Testdownload(unittest.TestCase):
 
 
 
+    @mock.patch("onedrive_offsite.file_ops.download_file_email", return_value=True)
+    @mock.patch("onedrive_offsite.file_ops.Config")
+    def test_unit_download_asyncio_engine(self, mock_config, mock_dl_file_email):
+        mock_config.transfer_engine = "asyncio"
+        with mock.patch("onedrive_offsite.file_ops.async_download", return_value=False) as mock_async_download:
+            with mock.patch("onedrive_offsite.file_ops.threading.Thread") as mock_Thread:
+                check_value = download()
+                self.assertEqual(check_value, None)
+                mock_Thread.assert_not_called()
+                mock_dl_file_email.assert_called_once_with(error=True)
+
+
 class Testrestore(unittest.TestCase):
 
 
@@ -0,0 +1,41 @@
+import unittest, mock, threading
+
+from onedrive_offsite.graph_client import GraphClient
+
+
+### ------------------------------ GraphClient -----------------------------------
+class TestGraphClient(unittest.TestCase):
+
+    def test_unit_default_timeout(self):
+        client = GraphClient(timeout=(1, 2), pool_connections=1, pool_maxsize=1)
+        with mock.patch("onedrive_offsite.graph_client.requests.Session.request") as mock_request:
+            client.get("http://fake-url", headers={"fake": "header"})
+            mock_request.assert_called_once_with("GET", "http://fake-url", headers={"fake": "header"}, timeout=(1, 2))
+
+    def test_unit_explicit_timeout(self):
+        client = GraphClient(timeout=(1, 2), pool_connections=1, pool_maxsize=1)
+        with mock.patch("onedrive_offsite.graph_client.requests.Session.request") as mock_request:
+            client.put(url="http://fake-url", data=b"fake bytes", timeout=5)
+            mock_request.assert_called_once_with("PUT", "http://fake-url", data=b"fake bytes", timeout=5)
+
+    def test_unit_same_session_in_thread(self):
+        client = GraphClient(pool_connections=1, pool_maxsize=1)
+        self.assertIs(client._session(), client._session())
+
+    def test_unit_threads_share_adapter(self):
+        client = GraphClient(pool_connections=1, pool_maxsize=1)
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(client._session())) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertIs(sessions[0].get_adapter("https://graph.microsoft.com"), sessions[1].get_adapter("https://login.microsoftonline.com"))
+
+    def test_unit_response_hooks(self):
+        client = GraphClient(pool_connections=1, pool_maxsize=1)
+        session = client._session()
+        hook = mock.Mock()
+        client.add_response_hook(hook)
+        self.assertEqual(session.hooks["response"], [hook])
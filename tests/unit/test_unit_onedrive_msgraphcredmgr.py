@@ -32,7 +32,7 @@ class TestMSGraphCredMgr(unittest.TestCase):
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.json") as mock_json:
                 mock_json.load.return_value = test_json
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                     mock_post.return_value.status_code = 200
                     mock_post.return_value.json.return_value = {"access_token":"fake-access-token2", "refresh_token":"fake-refresh-token2", "expires_in":3600}
                     msgcm = MSGraphCredMgr()
@@ -58,7 +58,7 @@ class TestMSGraphCredMgr(unittest.TestCase):
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.json") as mock_json:
                 mock_json.load.return_value = test_json
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                     mock_post.side_effect = requests.exceptions.Timeout
                     msgcm = MSGraphCredMgr()
                     msgcm.refresh_token = "fake-refresh-token1"
@@ -73,7 +73,7 @@ class TestMSGraphCredMgr(unittest.TestCase):
             with mock.patch("onedrive_offsite.onedrive.json") as mock_json:
                 mock_json.load.return_value = test_json
                 mock_json.dump.side_effect = Exception("fake exception")
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                     mock_post.return_value.status_code = 200
                     mock_post.return_value.json.return_value = {"access_token":"fake-access-token2", "refresh_token":"fake-refresh-token2"}
                     msgcm = MSGraphCredMgr()
@@ -88,7 +88,7 @@ class TestMSGraphCredMgr(unittest.TestCase):
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.json") as mock_json:
                 mock_json.load.return_value = test_json
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                     mock_post.return_value.status_code = 500
                     msgcm = MSGraphCredMgr()
                     msgcm.refresh_token = "fake-refresh-token1"
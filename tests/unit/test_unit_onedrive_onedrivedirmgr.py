@@ -100,7 +100,7 @@ class TestOneDriveDirMgr_check_dir_exits(unittest.TestCase):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init:           
-                with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_get:
                     mock_msgcm = mock.Mock()
                     mock_msgcm.access_token = "fakeaccesstoken"
                     oddm = OneDriveDirMgr(mock_msgcm)
@@ -114,7 +114,7 @@ class TestOneDriveDirMgr_check_dir_exits(unittest.TestCase):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get: # will create an unaccounted for error
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get: # will create an unaccounted for error
                     mock_msgcm = mock.Mock()
                     mock_msgcm.access_token = "fakeaccesstoken"
                     oddm = OneDriveDirMgr(mock_msgcm)
@@ -131,7 +131,7 @@ class TestOneDriveDirMgr_check_dir_exits(unittest.TestCase):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get: 
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get: 
                     mock_get.return_value.status_code = 404
                     mock_msgcm = mock.Mock()
                     mock_msgcm.access_token = "fakeaccesstoken"
@@ -149,7 +149,7 @@ class TestOneDriveDirMgr_check_dir_exits(unittest.TestCase):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
                     mock_get.return_value.status_code = 200
                     mock_get.return_value.json.return_value = {
                             "@odata.context": "https://graph.microsoft.com/v1.0/$metadata#users('test%40hotmail.com')/drive/items/$entity",
@@ -177,7 +177,7 @@ class TestOneDriveDirMgr_check_dir_exits(unittest.TestCase):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get: # will create an unaccounted for error
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get: # will create an unaccounted for error
                     mock_get.return_value.status_code = 200
                     mock_get.return_value.json.return_value = {
                             "@odata.context": "https://graph.microsoft.com/v1.0/$metadata#users('test%40hotmail.com')/drive/items/$entity",
@@ -207,7 +207,7 @@ class TestOneDriveDirMgr__create_onedrive_dir(unittest.TestCase):
         with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.post", side_effect=Exception("fake exception")) as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=Exception("fake exception")) as mock_post:
                         mock_msgcm = mock.Mock()
                         mock_msgcm.access_token = "fakeaccesstoken"
                         oddm = OneDriveDirMgr(mock_msgcm)
@@ -224,7 +224,7 @@ class TestOneDriveDirMgr__create_onedrive_dir(unittest.TestCase):
         with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                         mock_post.return_value.status_code = 500
                         mock_post.return_value.content = {"err":"fake error msg"}
                         mock_msgcm = mock.Mock()
@@ -244,7 +244,7 @@ class TestOneDriveDirMgr__create_onedrive_dir(unittest.TestCase):
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
                 with mock.patch(__name__ + ".OneDriveDirMgr._write_dir_id", return_value = False) as mock_write:
-                    with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                    with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                             mock_post.return_value.status_code = 201
                             mock_post.return_value.json.return_value = {
                                 "@odata.context": "https://graph.microsoft.com/v1.0/$metadata#users('test%40hotmail.com')/drive/items/$entity",
@@ -270,7 +270,7 @@ class TestOneDriveDirMgr__create_onedrive_dir(unittest.TestCase):
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
                 with mock.patch(__name__ + ".OneDriveDirMgr._write_dir_id", return_value = True) as mock_write:
-                    with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_post:
+                    with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_post:
                             mock_post.return_value.status_code = 201
                             mock_post.return_value.json.return_value = {
                                 "@odata.context": "https://graph.microsoft.com/v1.0/$metadata#users('test%40hotmail.com')/drive/items/$entity",
@@ -295,10 +295,28 @@ class TestOneDriveDirMgr__create_onedrive_dir(unittest.TestCase):
 ### -------------------------- OneDriveDirMgr.create_dir() ------------------------
 class TestOneDriveDirMgr_create_dir(unittest.TestCase):
 
+    def test_create_dir_throttled_check_follows_retry_after(self):
+        with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
+            mock_thread_getname.return_value.getName.return_value = "fake-thread"
+            with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
+                with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init:
+                    oddm = OneDriveDirMgr("fakeaccesstoken")
+                    throttled = mock.Mock()
+                    throttled.status_code = 429
+                    throttled.headers = {"Retry-After": "8"}
+                    def check_dir_exists():
+                        if mock_sleep.call_count == 0:
+                            oddm.retry_response = throttled
+                            return "error - unknown"
+                        return True
+                    with mock.patch(__name__ + ".OneDriveDirMgr._check_dir_exists", side_effect=check_dir_exists) as mock_check:
+                        self.assertEqual(oddm.create_dir(), True)
+                        mock_sleep.assert_called_once_with(8)
+
     def test_create_dir_cannot_check_dir_status(self):
         with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
-            with mock.patch("onedrive_offsite.onedrive.sleep", return_value = None) as mock_sleep:
+            with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                 with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
                     with mock.patch(__name__ + ".OneDriveDirMgr._check_dir_exists", return_value = None) as mock_write:
                         oddm = OneDriveDirMgr("fakeaccesstoken")
@@ -309,7 +327,7 @@ class TestOneDriveDirMgr_create_dir(unittest.TestCase):
     def test_create_dir_need_to_create_dir_fail_to_create(self):
         with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
-            with mock.patch("onedrive_offsite.onedrive.sleep", return_value = None) as mock_sleep:
+            with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                 with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
                     with mock.patch(__name__ + ".OneDriveDirMgr._check_dir_exists", return_value = False) as mock_write:
                         with mock.patch(__name__ + ".OneDriveDirMgr._create_onedrive_dir", return_value = None) as mock_create:
@@ -323,7 +341,7 @@ class TestOneDriveDirMgr_create_dir(unittest.TestCase):
     def test_create_dir_need_to_create_dir_create_succeeds(self):
         with mock.patch("onedrive_offsite.onedrive.threading.current_thread") as mock_thread_getname:
             mock_thread_getname.return_value.getName.return_value = "fake-thread"
-            with mock.patch("onedrive_offsite.onedrive.sleep", return_value = None) as mock_sleep:
+            with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                 with mock.patch("onedrive_offsite.onedrive.OneDriveDirMgr.__init__", return_value=None) as mock_init: 
                     with mock.patch(__name__ + ".OneDriveDirMgr._check_dir_exists", return_value = False) as mock_write:
                         with mock.patch(__name__ + ".OneDriveDirMgr._create_onedrive_dir", return_value = True) as mock_create:
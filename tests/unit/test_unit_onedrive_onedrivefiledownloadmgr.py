@@ -1,6 +1,7 @@
-import unittest, mock
+import unittest, mock, os, json, hashlib
 
-from onedrive_offsite.onedrive import OneDriveFileDownloadMgr
+from onedrive_offsite.onedrive import OneDriveFileDownloadMgr, DOWNLOAD_PROGRESS_SUFFIX
+from onedrive_offsite.quickxor import QuickXorHash
 
 example_resp_header = {'Cache-Control': 'public', 'Content-Length': '10485760', 'Content-Type': 'application/x-gzip', 'Content-Location': 'https://public.dm.files.1drv.com/y4m2q3NLOINxecteYxSP4Kwrs5rNzyLFRTGGHjVWpJwimfGU02ETiSx86H0N2CFcwDy5Y9TJxjoK8oXuLTANVIPPby5b-eBHisKj2WBcIoCWKGt_31ggMhjrnzqTrvuGnl7PjEeWBHbwUm3XBTB8RuNBYmWUOShTIU1bMsLiBRjkUW6GYpKNnlUI1BvcuVoTMjUDhbeyJajA9ZhfGezkCV_7zuXl5Ytf4KyONYpvybW1Fc', 'Content-Range': 'bytes 146800640-157286399/170403564', 'Expires': 'Sat, 23 Jul 2022 14:35:37 GMT', 'Last-Modified': 'Sat, 23 Apr 2022 17:38:26 GMT', 'Accept-Ranges': 'bytes', 'ETag': 'aRDIzRDA5OTkwQTFENUZDOSExNjkuMQ', 'P3P': 'CP="BUS CUR CONo FIN IVDo ONL OUR PHY SAMo TELo"', 'X-MSNSERVER': 'DM5SCH102221802', 'Strict-Transport-Security': 'max-age=31536000; includeSubDomains', 'MS-CV': 'tlIKn5qcHU6yQCgnkrzzjA.0', 'X-SqlDataOrigin': 'S', 'CTag': 'aYzpEMjNEMDk5OTBBMUQ1RkM5ITE2OS4yNTc', 'X-PreAuthInfo': 'rv;poba;', 'Content-Disposition': "attachment; filename*=UTF-8''offsite_backup.tar%20copy.gz", 'X-Content-Type-Options': 'nosniff', 'X-StreamOrigin': 'X', 'X-AsmVersion': 'UNKNOWN; 19.891.405.2005', 'X-Cache': 'CONFIG_NOCACHE', 'X-MSEdge-Ref': 'Ref A: BC860FE2E730462D80932AB1B419D859 Ref B: PDX31EDGE0121 Ref C: 2022-04-24T14:35:37Z', 'Date': 'Sun, 24 Apr 2022 14:35:38 GMT'}
 
@@ -11,7 +12,7 @@ class TestOneDriveFileDownloadMgr_download_chunk(unittest.TestCase):
     def test_unit_download_chunk_request_exception(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_get:
 
             download_url = "https://fakedownloadurl"
             file_size = 12345
@@ -27,11 +28,11 @@ class TestOneDriveFileDownloadMgr_download_chunk(unittest.TestCase):
     def test_unit_download_chunk_request_success(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
 
             mock_get.return_value.status_code = 206
             mock_get.return_value.headers = example_resp_header
-            mock_get.return_value.content = b'fakebytes'
+            mock_get.return_value.iter_content.return_value = [b'fake', b'bytes']
 
             download_url = "https://fakedownloadurl"
             file_size = 12345
@@ -44,10 +45,38 @@ class TestOneDriveFileDownloadMgr_download_chunk(unittest.TestCase):
 
             self.assertEqual(check_val, b'fakebytes')
 
+    def test_unit_download_chunk_records_body_time(self, mock_curr_thread):
+        # the sample covers reading the whole body, not just the time until the response headers arrived
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.download_controller") as mock_controller:
+                with mock.patch("onedrive_offsite.onedrive.time.monotonic", side_effect=[100.0, 103.5]) as mock_time:
+                    mock_get.return_value.status_code = 206
+                    mock_get.return_value.iter_content.return_value = [b'fake', b'bytes']
+
+                    oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+                    oddlm._download_chunk(10, 19)
+
+                    mock_controller.record.assert_called_once_with(206, 3.5, 9)
+
+    def test_unit_download_chunk_records_throttled(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.download_controller") as mock_controller:
+                mock_get.return_value.status_code = 429
+                mock_get.return_value.content = b'error info'
+
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+                self.assertIs(oddlm._download_chunk(10, 19), None)
+
+                self.assertEqual(mock_controller.record.call_args[0][0], 429)
+
     def test_unit_download_chunk_request_bad_status(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
 
             mock_get.return_value.status_code = 404
             mock_get.return_value.content = b'error info'
@@ -65,7 +94,7 @@ class TestOneDriveFileDownloadMgr_download_chunk(unittest.TestCase):
 
 
 #### ------------ OneDriveFileDownloadMgr._retry_delay() -------------------------
-@mock.patch("onedrive_offsite.onedrive.sleep", return_value=None)
+@mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True)
 @mock.patch("onedrive_offsite.onedrive.threading.current_thread")
 class TestOneDriveFileDownloadMgr_retry_delay(unittest.TestCase):
 
@@ -121,6 +150,28 @@ class TestOneDriveFileDownloadMgr_retry_delay(unittest.TestCase):
 
         self.assertIs(check_val, False)
 
+    def test_unit_retry_delay_follows_retry_after(self, mock_curr_thread, mock_sleep):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        response = mock.Mock()
+        response.status_code = 429
+        response.headers = {"Retry-After": "12"}
+        oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+        self.assertIs(oddlm._retry_delay(5, 10, 19, response), True)
+        mock_sleep.assert_called_once_with(12)
+
+    def test_unit_download_with_retry_throttled(self, mock_curr_thread, mock_sleep):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        throttled = mock.Mock()
+        throttled.status_code = 429
+        throttled.headers = {"Retry-After": "3"}
+        ok = mock.Mock()
+        ok.status_code = 206
+        ok.iter_content.return_value = [b"fakebytes"]
+        with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=[throttled, ok]) as mock_get:
+            oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+            self.assertEqual(oddlm._download_with_retry(10, 19), b"fakebytes")
+            mock_sleep.assert_called_once_with(3)
+
 
 #### ------------ OneDriveFileDownloadMgr._download_with_retry() -------------------------
 @mock.patch("onedrive_offsite.onedrive.threading.current_thread")
@@ -224,71 +275,325 @@ class TestOneDriveFileDownloadMgr_verify_download(unittest.TestCase):
 
                 self.assertIs(check_val, True)
 
+    def test_unit_verify_download_hash_from_download(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.os.path.getsize", return_value=12345) as mock_getsize:
+            with mock.patch("onedrive_offsite.onedrive.Sha256Calc") as mock_shacalc:
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", "0123456789ABCDEF")
+                self.assertIs(oddlm._verify_download("0123456789abcdef"), True)
+                mock_shacalc.assert_not_called()
+
+    def test_unit_verify_download_quick_xor_match(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.os.path.getsize", return_value=12345) as mock_getsize:
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file", return_value="aCgDG9jwBhDc4Q1yawMZAAAAAAA=") as mock_quick_xor:
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", None, quick_xor_hash="aCgDG9jwBhDc4Q1yawMZAAAAAAA=")
+                self.assertIs(oddlm._verify_download(), True)
+                mock_quick_xor.assert_called_once_with("fakefilepath")
+
+    def test_unit_verify_download_quick_xor_mismatch(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.os.path.getsize", return_value=12345) as mock_getsize:
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file", return_value="AAAAAAAAAAAAAAAAAAAAAAAAAAA=") as mock_quick_xor:
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", None, quick_xor_hash="aCgDG9jwBhDc4Q1yawMZAAAAAAA=")
+                self.assertIs(oddlm._verify_download(), False)
+
+    def test_unit_verify_download_quick_xor_from_download(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.os.path.getsize", return_value=12345) as mock_getsize:
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file") as mock_quick_xor:
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", None, quick_xor_hash="aCgDG9jwBhDc4Q1yawMZAAAAAAA=")
+                self.assertIs(oddlm._verify_download(None, "aCgDG9jwBhDc4Q1yawMZAAAAAAA="), True)
+                mock_quick_xor.assert_not_called()
+
+    def test_unit_verify_download_quick_xor_fail(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.os.path.getsize", return_value=12345) as mock_getsize:
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file", return_value=None) as mock_quick_xor:
+                oddlm = OneDriveFileDownloadMgr("https://fakedownloadurl", 12345, 15, "fakefilepath", None, quick_xor_hash="aCgDG9jwBhDc4Q1yawMZAAAAAAA=")
+                self.assertIs(oddlm._verify_download(), False)
+
 
 
 #### ------------ OneDriveFileDownloadMgr.download_file() -------------------------
+def _fake_range(start_byte: int, end_byte: int) -> bytes:
+    # the bytes a download of this range would return, each byte is its offset mod 256
+    return bytes([i % 256 for i in range(start_byte, end_byte + 1)])
+
+
 @mock.patch("onedrive_offsite.onedrive.threading.current_thread")
 class TestOneDriveFileDownloadMgr_download_file(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    download_path = os.path.join(test_dir, "test_download_file.tar")
+    progress_path = download_path + DOWNLOAD_PROGRESS_SUFFIX
+    download_url = "https://fakedownloadurl"
+    hash = "0123456789ABCDEF"
+
+    def tearDown(self):
+        for path in [TestOneDriveFileDownloadMgr_download_file.download_path, TestOneDriveFileDownloadMgr_download_file.progress_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _odfdm(self, file_size: int, chunk_size: int) -> OneDriveFileDownloadMgr:
+        return OneDriveFileDownloadMgr(self.download_url, file_size, chunk_size, self.download_path, self.hash)
+
+    def _write_progress(self, verified_bytes: int, file_size: int=500, hash: str=None):
+        with open(self.progress_path, "w") as progress_file:
+            json.dump({"size-bytes": file_size, "sha256hash": hash or self.hash, "verified-bytes": verified_bytes}, progress_file)
 
     def test_unit_download_file_file_smaller_than_chunk_download_fail(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", return_value = False) as mock_dl_w_retry:
-            download_url = "https://fakedownloadurl"
-            file_size = 250
-            chunk_size = 300
-            download_path = "fakefilepath"
-            hash = "0123456789ABCDEF"
-
-            oddlm = OneDriveFileDownloadMgr(download_url, file_size, chunk_size, download_path, hash)
-            check_val = oddlm.download_file()
-
-            self.assertIs(check_val, False)     
+            check_val = self._odfdm(250, 300).download_file()
+            self.assertIs(check_val, False)
+            mock_dl_w_retry.assert_called_once_with(0, 249)
 
     def test_unit_download_file_file_bigger_than_chunk_open_except(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", return_value = b'fakebytes') as mock_dl_w_retry:
             with mock.patch("onedrive_offsite.onedrive.open", side_effect=Exception("fake exception")) as mock_open:
-                download_url = "https://fakedownloadurl"
-                file_size = 500
-                chunk_size = 200
-                download_path = "fakefilepath"
-                hash = "0123456789ABCDEF"
+                check_val = self._odfdm(500, 200).download_file()
+                self.assertIs(check_val, False)
 
-                oddlm = OneDriveFileDownloadMgr(download_url, file_size, chunk_size, download_path, hash)
-                check_val = oddlm.download_file()
+    def test_unit_download_file_file_bigger_than_chunk_fail_verify(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=False) as mock_verify_dl:
+                check_val = self._odfdm(500, 200).download_file()
+                self.assertIs(check_val, False)
+                # a file that failed verification can't be resumed
+                self.assertEqual(os.path.isfile(self.progress_path), False)
 
-                self.assertIs(check_val, False)   
+    def test_unit_download_file_file_bigger_than_chunk_everything_works(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                check_val = self._odfdm(500, 200).download_file()
+                self.assertIs(check_val, True)
+                self.assertEqual([call[0] for call in mock_dl_w_retry.call_args_list], [(0, 199), (200, 399), (400, 499)])
+                with open(self.download_path, "rb") as download_file:
+                    self.assertEqual(download_file.read(), _fake_range(0, 499))
+                self.assertEqual(os.path.isfile(self.progress_path), False)
 
+    def test_unit_download_file_hashes_while_downloading(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(500, 200).download_file(), True)
+                mock_verify_dl.assert_called_once_with(hashlib.sha256(_fake_range(0, 499)).hexdigest(), None)
 
-    def test_unit_download_file_file_bigger_than_chunk_fail_verify(self, mock_curr_thread):
+    def test_unit_download_file_resume_hashes_resumed_bytes(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", return_value = b'fakebytes') as mock_dl_w_retry:
-            with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
-                with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=False) as mock_verify_dl:
-                    download_url = "https://fakedownloadurl"
-                    file_size = 500
-                    chunk_size = 200
-                    download_path = "fakefilepath"
-                    hash = "0123456789ABCDEF"
-
-                    oddlm = OneDriveFileDownloadMgr(download_url, file_size, chunk_size, download_path, hash)
-                    check_val = oddlm.download_file()
-
-                    self.assertIs(check_val, False)   
-                    
-    
-    def test_unit_download_file_file_bigger_than_chunk_everything_works(self, mock_curr_thread):
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 199))
+        self._write_progress(200)
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(500, 200).download_file(), True)
+                mock_verify_dl.assert_called_once_with(hashlib.sha256(_fake_range(0, 499)).hexdigest(), None)
+
+    def test_unit_download_file_records_progress(self, mock_curr_thread):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", return_value = b'fakebytes') as mock_dl_w_retry:
-            with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=[_fake_range(0, 199), False]) as mock_dl_w_retry:
+            check_val = self._odfdm(500, 200).download_file()
+            self.assertIs(check_val, False)
+            with open(self.progress_path, "r") as progress_file:
+                self.assertEqual(json.load(progress_file).get("verified-bytes"), 200)
+
+    def test_unit_download_file_resumes_from_progress(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        # 250 bytes on disk, but only the first 200 were synced before the last attempt stopped
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 249))
+        self._write_progress(200)
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                check_val = self._odfdm(500, 200).download_file()
+                self.assertIs(check_val, True)
+                self.assertEqual([call[0] for call in mock_dl_w_retry.call_args_list], [(200, 399), (400, 499)])
+                with open(self.download_path, "rb") as download_file:
+                    self.assertEqual(download_file.read(), _fake_range(0, 499))
+
+    def test_unit_download_file_progress_for_other_version(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(b"x" * 200)
+        self._write_progress(200, hash="FEDCBA9876543210")
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(500, 200).download_file(), True)
+                self.assertEqual(mock_dl_w_retry.call_args_list[0][0], (0, 199))
+                with open(self.download_path, "rb") as download_file:
+                    self.assertEqual(download_file.read(), _fake_range(0, 499))
+
+    def test_unit_download_file_stale_partial_without_progress(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(b"x" * 300)
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(500, 200).download_file(), True)
+                with open(self.download_path, "rb") as download_file:
+                    self.assertEqual(download_file.read(), _fake_range(0, 499))
+
+    def test_unit_download_file_skips_matching_file(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 499))
+        with mock.patch("onedrive_offsite.onedrive.Sha256Calc") as mock_sha:
+            mock_sha.return_value.calc.return_value = self.hash.lower()
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry") as mock_dl_w_retry:
+                self.assertIs(self._odfdm(500, 200).download_file(), True)
+                mock_dl_w_retry.assert_not_called()
+
+    def test_unit_download_file_quick_xor_only(self, mock_curr_thread):
+        # onedrive business items only have a quickxor hash, the downloaded file is checked against it
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        quick_xor = QuickXorHash()
+        quick_xor.update(0, _fake_range(0, 499))
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            odfdm = OneDriveFileDownloadMgr(self.download_url, 500, 200, self.download_path, None, quick_xor_hash=quick_xor.b64digest())
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file") as mock_quick_xor_file:
+                self.assertIs(odfdm.download_file(), True)
+                # hashed as it downloaded, the file isn't read again to verify it
+                mock_quick_xor_file.assert_not_called()
+            self.assertIs(odfdm._hasher, None)
+            # the file on disk now matches, so a second run skips it
+            mock_dl_w_retry.reset_mock()
+            self.assertIs(odfdm.download_file(), True)
+            mock_dl_w_retry.assert_not_called()
+
+    def test_unit_download_file_quick_xor_resume(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        quick_xor = QuickXorHash()
+        quick_xor.update(0, _fake_range(0, 499))
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 199))
+        with open(self.progress_path, "w") as progress_file:
+            json.dump({"size-bytes": 500, "sha256hash": None, "quickxorhash": quick_xor.b64digest(), "verified-bytes": 200}, progress_file)
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                odfdm = OneDriveFileDownloadMgr(self.download_url, 500, 200, self.download_path, None, quick_xor_hash=quick_xor.b64digest())
+                self.assertIs(odfdm.download_file(), True)
+                mock_verify_dl.assert_called_once_with(None, quick_xor.b64digest())
+
+    def test_unit_download_file_redownloads_hash_mismatch(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(b"x" * 500)
+        with mock.patch("onedrive_offsite.onedrive.Sha256Calc") as mock_sha:
+            mock_sha.return_value.calc.return_value = "abcdef"
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
                 with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
-                    download_url = "https://fakedownloadurl"
-                    file_size = 500
-                    chunk_size = 200
-                    download_path = "fakefilepath"
-                    hash = "0123456789ABCDEF"
+                    self.assertIs(self._odfdm(500, 200).download_file(), True)
+                    self.assertEqual(mock_dl_w_retry.call_count, 3)
+
+
+#### ------------ OneDriveFileDownloadMgr._download_ranges() -------------------------
+@mock.patch("onedrive_offsite.onedrive.threading.current_thread")
+class TestOneDriveFileDownloadMgr_download_ranges(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    download_path = os.path.join(test_dir, "test_download_ranges.tar")
+    progress_path = download_path + DOWNLOAD_PROGRESS_SUFFIX
+    hash = "0123456789ABCDEF"
+
+    def tearDown(self):
+        for path in [TestOneDriveFileDownloadMgr_download_ranges.download_path, TestOneDriveFileDownloadMgr_download_ranges.progress_path]:
+            if os.path.isfile(path):
+                os.remove(path)
 
-                    oddlm = OneDriveFileDownloadMgr(download_url, file_size, chunk_size, download_path, hash)
-                    check_val = oddlm.download_file()
+    def _odfdm(self, file_size: int, chunk_size: int, range_count: int) -> OneDriveFileDownloadMgr:
+        return OneDriveFileDownloadMgr("https://fakedownloadurl", file_size, chunk_size, self.download_path, self.hash, range_count=range_count)
 
-                    self.assertIs(check_val, True) 
\ No newline at end of file
+    def _read_progress(self) -> int:
+        with open(self.progress_path, "r") as progress_file:
+            return json.load(progress_file).get("verified-bytes")
+
+    def test_unit_download_ranges_everything_works(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(1050, 100, 3).download_file(), True)
+                self.assertEqual(sorted([call[0] for call in mock_dl_w_retry.call_args_list]), [(i, min(i + 99, 1049)) for i in range(0, 1050, 100)])
+                with open(self.download_path, "rb") as download_file:
+                    self.assertEqual(download_file.read(), _fake_range(0, 1049))
+                self.assertEqual(os.path.isfile(self.progress_path), False)
+
+    def test_unit_download_ranges_hash_while_downloading(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._verify_download", return_value=True) as mock_verify_dl:
+                self.assertIs(self._odfdm(1050, 100, 4).download_file(), True)
+                mock_verify_dl.assert_called_once_with(hashlib.sha256(_fake_range(0, 1049)).hexdigest(), None)
+
+    def test_unit_download_ranges_quick_xor_while_downloading(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        quick_xor = QuickXorHash()
+        quick_xor.update(0, _fake_range(0, 1049))
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            with mock.patch("onedrive_offsite.onedrive.quick_xor_file") as mock_quick_xor_file:
+                odfdm = OneDriveFileDownloadMgr("https://fakedownloadurl", 1050, 100, self.download_path, None, range_count=4, quick_xor_hash=quick_xor.b64digest())
+                self.assertIs(odfdm.download_file(), True)
+                mock_quick_xor_file.assert_not_called()
+
+    def test_unit_download_ranges_resume(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 299))
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=_fake_range) as mock_dl_w_retry:
+            odfdm = self._odfdm(1000, 100, 4)
+            self.assertIs(odfdm._download_ranges(300), True)
+            self.assertEqual(sorted([call[0][0] for call in mock_dl_w_retry.call_args_list]), [300, 400, 500, 600, 700, 800, 900])
+            self.assertEqual(self._read_progress(), 1000)
+            with open(self.download_path, "rb") as download_file:
+                self.assertEqual(download_file.read(), _fake_range(0, 999))
+
+    def test_unit_download_ranges_failed_range(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        def fake_download(start_byte, end_byte):
+            if start_byte == 300:
+                return False
+            return _fake_range(start_byte, end_byte)
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", side_effect=fake_download) as mock_dl_w_retry:
+            self.assertIs(self._odfdm(1000, 100, 1)._download_ranges(0), False)
+            # the chunks after the failed one are never started, and progress stops at the failed chunk
+            self.assertEqual([call[0][0] for call in mock_dl_w_retry.call_args_list], [0, 100, 200, 300])
+            self.assertEqual(self._read_progress(), 300)
+
+    def test_unit_download_ranges_short_response(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_with_retry", return_value=b"too short") as mock_dl_w_retry:
+            self.assertIs(self._odfdm(1000, 100, 2)._download_ranges(0), False)
+            self.assertEqual(self._read_progress(), 0)
+
+    def test_unit_download_ranges_preallocates(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        odfdm = self._odfdm(1000, 100, 2)
+        fd = odfdm._open_preallocated(0)
+        os.close(fd)
+        self.assertEqual(os.path.getsize(self.download_path), 1000)
+
+    def test_unit_download_ranges_fallocate_not_supported(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with open(self.download_path, "wb") as download_file:
+            download_file.write(_fake_range(0, 499))
+        with mock.patch("onedrive_offsite.onedrive.os.posix_fallocate", side_effect=OSError("not supported"), create=True):
+            fd = self._odfdm(1000, 100, 2)._open_preallocated(200)
+            os.close(fd)
+        self.assertEqual(os.path.getsize(self.download_path), 1000)
+        with open(self.download_path, "rb") as download_file:
+            self.assertEqual(download_file.read(300), _fake_range(0, 199) + bytes(100))
+
+    def test_unit_download_file_one_range_is_sequential(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_sequential", return_value=False) as mock_sequential:
+            with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_ranges") as mock_ranges:
+                self.assertIs(self._odfdm(1000, 100, 1).download_file(), False)
+                mock_sequential.assert_called_once_with(0)
+                mock_ranges.assert_not_called()
+
+    def test_unit_download_file_uses_ranges(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.OneDriveFileDownloadMgr._download_ranges", return_value=False) as mock_ranges:
+            self.assertIs(self._odfdm(1000, 100, 4).download_file(), False)
+            mock_ranges.assert_called_once_with(0)
@@ -10,7 +10,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_get_except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_get:
             access_token = "fakeaccesstoken"
             item_id = "fake-item-id"            
             check_val = OneDriveGetItemDetails.get_details(item_id,access_token)
@@ -19,7 +19,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_get_401(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 401
             access_token = "fakeaccesstoken"
             item_id = "fake-item-id"            
@@ -29,7 +29,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_get_resp_json_except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.side_effect = Exception("fake exception")
             access_token = "fakeaccesstoken"
@@ -40,7 +40,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_download_url(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"error":"err msg"}
             access_token = "fakeaccesstoken"
@@ -51,7 +51,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_size(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url"}
             access_token = "fakeaccesstoken"
@@ -62,7 +62,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_file(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url", "size":10}
             access_token = "fakeaccesstoken"
@@ -73,7 +73,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_hashes(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url", "size":10, "file": {"fake":"fake"}}
             access_token = "fakeaccesstoken"
@@ -84,7 +84,7 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_sha256(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url", "size":10, "file": {"hashes":{"fake": "fake"}}}
             access_token = "fakeaccesstoken"
@@ -95,10 +95,21 @@ class TestOneDriveGetItemDetails(unittest.TestCase):
     @mock.patch("onedrive_offsite.onedrive.Config")
     def test_unit_get_details_no_has_everything(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_get.return_value.status_code = 200
             mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url", "size":10, "file": {"hashes":{"sha256Hash": "0123456789abcdef"}}}
             access_token = "fakeaccesstoken"
             item_id = "fake-item-id"            
             check_val = OneDriveGetItemDetails.get_details(item_id,access_token)
-            self.assertEqual(check_val, {"download_url": "fake-url", "size_bytes": 10, "sha256hash": "0123456789abcdef"} )
\ No newline at end of file
+            self.assertEqual(check_val, {"download_url": "fake-url", "size_bytes": 10, "sha256hash": "0123456789abcdef", "quickxorhash": None} )
+
+    @mock.patch("onedrive_offsite.onedrive.Config")
+    def test_unit_get_details_quickxor_only(self, mock_curr_thread, mock_config):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.json.return_value = {"@microsoft.graph.downloadUrl":"fake-url", "size":10, "file": {"hashes":{"quickXorHash": "aCgDG9jwBhDc4Q1yawMZAAAAAAA="}}}
+            access_token = "fakeaccesstoken"
+            item_id = "fake-item-id"            
+            check_val = OneDriveGetItemDetails.get_details(item_id,access_token)
+            self.assertEqual(check_val, {"download_url": "fake-url", "size_bytes": 10, "sha256hash": None, "quickxorhash": "aCgDG9jwBhDc4Q1yawMZAAAAAAA="} )
\ No newline at end of file
@@ -11,7 +11,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_details_get_except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_get:
             access_token = "fakeaccesstoken"
             dir_name = "fake_dir_name"
             
@@ -23,7 +23,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_details_get_404(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_resp = mock.Mock()
             mock_resp.status_code = 404
             mock_resp.content = b'some fake content'
@@ -39,7 +39,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_details_json_except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_resp = mock.Mock()
             mock_resp.status_code = 200
             mock_resp.content = b'some fake content'
@@ -56,7 +56,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_details_everything_works(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
 
-        with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
             mock_resp = mock.Mock()
             mock_resp.status_code = 200
             mock_resp.content = b'some fake content'
@@ -134,7 +134,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_items_get_except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveItemGetter._get_dir_details", return_value = "D23D09990A1D5FC9!169") as mock_get_dir_details:
-            with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_get:
 
                 access_token = "fakeaccesstoken"
                 dir_name = "fake_dir_name"        
@@ -147,7 +147,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_items_get_resp_json_Except(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveItemGetter._get_dir_details", return_value = "D23D09990A1D5FC9!169") as mock_get_dir_details:
-            with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
                 mock_get.return_value.status_code = 200
                 mock_get.return_value.json.side_effect = Exception("fake exception")
 
@@ -162,7 +162,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_items_get_proc_json_none(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveItemGetter._get_dir_details", return_value = "D23D09990A1D5FC9!169") as mock_get_dir_details:
-            with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
                 mock_get.return_value.status_code = 200
                 mock_get.return_value.json.return_value = {"value":[{"id": "id-1", "name": "name-1"}, {"id": "id-2", "name": "name-2"}]}
                 with mock.patch("onedrive_offsite.onedrive.OneDriveItemGetter._process_json", return_value=None) as mock_proc_json:
@@ -178,7 +178,7 @@ class TestOneDriveItemGetter(unittest.TestCase):
     def test_unit_get_dir_items_get_status_401(self, mock_curr_thread, mock_config):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.OneDriveItemGetter._get_dir_details", return_value = "D23D09990A1D5FC9!169") as mock_get_dir_details:
-            with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_get:
+            with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
                 mock_get.return_value.status_code = 401
 
                 access_token = "fakeaccesstoken"
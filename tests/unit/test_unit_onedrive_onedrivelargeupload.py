@@ -1,6 +1,7 @@
-import unittest, mock, requests, datetime
+import unittest, mock, requests, datetime, io
 
 from onedrive_offsite.onedrive import OneDriveLargeUpload
+from onedrive_offsite.utils import FileRangeReader
 
 @mock.patch("onedrive_offsite.onedrive.threading.current_thread")
 class TestOneDriveLargeUpload(unittest.TestCase):
@@ -47,25 +48,25 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 #### ------------ OneDriveLargeUpload._upload_initiate_retry() -------------------------
     def test_unit_upload_initiate_retry_retry_1(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._upload_initiate_retry(1, "fakefilename")
             self.assertEqual(check_value, True)
     
     def test_unit_upload_initiate_retry_retry_2(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._upload_initiate_retry(2, "fakefilename")
             self.assertEqual(check_value, True)
     
     def test_unit_upload_initiate_retry_retry_3(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._upload_initiate_retry(3, "fakefilename")
             self.assertEqual(check_value, True)
 
     def test_unit_upload_initiate_retry_retry_4(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._upload_initiate_retry(4, "fakefilename")
             self.assertEqual(check_value, False)
 
@@ -81,7 +82,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:      
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_requests_post:
                     mock_requests_post.return_value.status_code =200
                     mock_requests_post.return_value.json.return_value = {"uploadUrl":"fake-url", "expirationDateTime":"2015-01-29T09:21:55.523Z"}
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
@@ -99,7 +100,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post", side_effect=requests.exceptions.Timeout) as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=requests.exceptions.Timeout) as mock_requests_post:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._upload_initiate_retry", return_value=False) as mock_retry:
                         odlu = OneDriveLargeUpload("fakeuploadfilename")
                         check_value = odlu.initiate_upload_session("fakeaccesstoken")
@@ -116,7 +117,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post", side_effect=requests.exceptions.SSLError) as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=requests.exceptions.SSLError) as mock_requests_post:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._upload_initiate_retry", return_value=False) as mock_retry:
                         odlu = OneDriveLargeUpload("fakeuploadfilename")
                         check_value = odlu.initiate_upload_session("fakeaccesstoken")
@@ -133,7 +134,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post", side_effect=requests.exceptions.ConnectionError) as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=requests.exceptions.ConnectionError) as mock_requests_post:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._upload_initiate_retry", return_value=False) as mock_retry:
                         odlu = OneDriveLargeUpload("fakeuploadfilename")
                         check_value = odlu.initiate_upload_session("fakeaccesstoken")
@@ -150,7 +151,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post", side_effect=Exception("fake exception")) as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=Exception("fake exception")) as mock_requests_post:
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
                     check_value = odlu.initiate_upload_session("fakeaccesstoken")
                     self.assertEqual(check_value, False)
@@ -166,7 +167,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_requests_post:
                     mock_requests_post.return_value.status_code = 503
                     mock_requests_post.return_value.json.return_value = {"Error":"fake error"}
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._upload_initiate_retry", return_value=False) as mock_retry:
@@ -185,7 +186,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.post") as mock_requests_post:
+                with mock.patch("onedrive_offsite.onedrive.graph.post") as mock_requests_post:
                     mock_requests_post.return_value.status_code = 416
                     mock_requests_post.return_value.json.return_value = {"Error":"fake error"}
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
@@ -197,28 +198,69 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
     def test_unit_retry_logic_1(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._retry_logic("0-100001", 1)
             self.assertEqual(check_value, True)
     
     def test_unit_retry_logic_2(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._retry_logic("0-100001", 2)
             self.assertEqual(check_value, True)
 
     def test_unit_retry_logic_3(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:    
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:    
             check_value = OneDriveLargeUpload._retry_logic("0-100001", 3)
             self.assertEqual(check_value, True)
 
     def test_unit_retry_logic_4(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.onedrive.time.sleep", return_value=None) as mock_sleep:
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
             check_value = OneDriveLargeUpload._retry_logic("0-100001", 4)
             self.assertEqual(check_value, False)
 
+    def test_unit_retry_logic_throttled(self, mock_thread_getname):
+        # a 429 follows Retry-After and keeps retrying after the error retries run out
+        mock_thread_getname.return_value.getName.return_value = "fake-thread"
+        response = mock.Mock()
+        response.status_code = 429
+        response.headers = {"Retry-After": "30"}
+        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
+            check_value = OneDriveLargeUpload._retry_logic("0-100001", 4, response)
+            self.assertEqual(check_value, True)
+            mock_sleep.assert_called_once_with(30)
+
+    def test_unit_upload_file_part_throttled(self, mock_thread_getname):
+        mock_thread_getname.return_value.getName.return_value = "fake-thread"
+        throttled = mock.Mock()
+        throttled.status_code = 429
+        throttled.headers = {"Retry-After": "5"}
+        accepted = mock.Mock()
+        accepted.status_code = 202
+        with mock.patch("onedrive_offsite.onedrive.upload_journal") as mock_journal:
+            with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=[throttled, accepted]) as mock_put:
+                with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=True) as mock_retry_logic:
+                    odlu = _journal_odlu()
+                    check_value = odlu.upload_file_part("1000", "500", "0-499", b"fake bytes")
+                    self.assertEqual(check_value.status_code, 202)
+                    mock_retry_logic.assert_called_once_with("0-499", 1, throttled)
+
+    def test_unit_initiate_upload_session_throttled(self, mock_thread_getname):
+        mock_thread_getname.return_value.getName.return_value = "fake-thread"
+        throttled = mock.Mock()
+        throttled.status_code = 429
+        throttled.headers = {"Retry-After": "5"}
+        created = mock.Mock()
+        created.status_code = 200
+        created.json.return_value = {"uploadUrl": "https://fakeurl", "expirationDateTime": "2999-01-22T22:49:43.2Z"}
+        with mock.patch("onedrive_offsite.onedrive.graph.post", side_effect=[throttled, created]) as mock_post:
+            with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
+                odlu = _journal_odlu()
+                self.assertEqual(odlu.initiate_upload_session("fakeaccesstoken"), True)
+                self.assertEqual(odlu.onedrive_upload_url, "https://fakeurl")
+                mock_sleep.assert_called_once_with(5)
+
 
 
 ### ----------------------- OneDriveLargeUpload.upload_file_part() ----------------------------------------
@@ -235,7 +277,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['500-999']}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 202
                     mock_requests_put.return_value.json.return_value = test_json
                     odlu = OneDriveLargeUpload("fakefilename")
@@ -255,7 +297,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"id": "912310013A123","name": "fakefilename","size": 500, "file": { }}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 201
                     mock_requests_put.return_value.json.return_value = test_json
                     odlu = OneDriveLargeUpload("fakefilename")
@@ -274,7 +316,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.put", side_effect=requests.exceptions.Timeout) as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=requests.exceptions.Timeout) as mock_requests_put:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
                         odlu = OneDriveLargeUpload("fakefilename")
                         check_value = odlu.upload_file_part("1000", "500", "500-999", b'my fake bytes, definitely not 500 bytes')
@@ -292,7 +334,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.put", side_effect=requests.exceptions.SSLError) as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=requests.exceptions.SSLError) as mock_requests_put:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
                         odlu = OneDriveLargeUpload("fakefilename")
                         check_value = odlu.upload_file_part("1000", "500", "500-999", b'my fake bytes, definitely not 500 bytes')
@@ -309,7 +351,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "done-date-time": "2022-04-14-21:37:15", 
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.put", side_effect=requests.exceptions.ConnectionError) as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=requests.exceptions.ConnectionError) as mock_requests_put:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
                         odlu = OneDriveLargeUpload("fakefilename")
                         check_value = odlu.upload_file_part("1000", "500", "500-999", b'my fake bytes, definitely not 500 bytes')
@@ -327,7 +369,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                              "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.put", side_effect=Exception("unexpected exception")) as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=Exception("unexpected exception")) as mock_requests_put:
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
                         odlu = OneDriveLargeUpload("fakefilename")
                         check_value = odlu.upload_file_part("1000", "500", "500-999", b'my fake bytes, definitely not 500 bytes')
@@ -346,7 +388,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error": {"code": "generalException", "message": "General Exception While Processing"}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 500
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
@@ -368,7 +410,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error":{"code":"invalidRange", "message":"The uploaded fragment overlaps with data that has already been received.","innererror":{"code":"fragmentOverlap"}}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 416
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_partial_fragment", return_value=False) as mock_retry_logic: # simulate final retry
@@ -390,7 +432,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error":{"code":"invalidRange", "message":"The uploaded fragment overlaps with data that has already been received.","innererror":{"code":"fragmentOverlap"}}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 416
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_partial_fragment", return_value="move-next") as mock_retry_logic: # simulate final retry
@@ -412,7 +454,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
 
                 test_json = {"error":{"code":"invalidRange", "message":"The uploaded fragment overlaps with data that has already been received.","innererror":{"code":"fragmentOverlap"}}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 416
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_partial_fragment", return_value="upload-complete") as mock_retry_logic: 
@@ -434,7 +476,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error":{"code":"invalidRange", "message":"The uploaded fragment overlaps with data that has already been received.","innererror":{"code":"fragmentOverlap"}}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 416
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_partial_fragment") as mock_retry_logic: # simulate successful partial upload
@@ -459,7 +501,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error":{"code":"invalidRange", "message":"The uploaded fragment overlaps with data that has already been received.","innererror":{"code":"fragmentOverlap"}}}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 416
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_partial_fragment", return_value=False) as mock_retry_logic: # simulate final retry
@@ -468,6 +510,32 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                         self.assertEqual(check_value.status_code, 416)
                         self.assertEqual(check_value.json(), test_json)
 
+    def test_unit_upload_file_part_range_reader_resent_from_start(self, mock_thread_getname):
+        mock_thread_getname.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
+            test_info_json = {"backup-file-path": "/home/user/backup_file.tar",
+                            "start-date-time": "2022-04-14-21:37:09",
+                            "size-bytes": 170403564,
+                            "onedrive-dir": "backup_test_2",
+                            "onedrive-filename": "backup_test_local.tar.gz",
+                            "done-date-time": "2022-04-14-21:37:15", 
+                            "onedrive-dir-id": "D23D09990A1D5FC9!161"}
+
+            with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
+                sent_bytes = []
+                def fake_put(url, headers, data):
+                    sent_bytes.append(data.read())
+                    mock_resp = mock.Mock()
+                    mock_resp.status_code = 503 if len(sent_bytes) == 1 else 202
+                    return mock_resp
+                with mock.patch("onedrive_offsite.onedrive.graph.put", side_effect=fake_put) as mock_requests_put:
+                    with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=True) as mock_retry_logic:
+                        odlu = OneDriveLargeUpload("fakefilename")
+                        reader = FileRangeReader(io.BytesIO(b"0123456789"), 2, 5)
+                        check_value = odlu.upload_file_part("10", "5", "2-6", reader)
+                        self.assertEqual(check_value.status_code, 202)
+                        self.assertEqual(sent_bytes, [b"23456", b"23456"])
+
     def test_unit_upload_file_part_upload_404(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
@@ -481,7 +549,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
                 test_json = {"error": "not found"}
-                with mock.patch("onedrive_offsite.onedrive.requests.put") as mock_requests_put:
+                with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_requests_put:
                     mock_requests_put.return_value.status_code = 404
                     mock_requests_put.return_value.json.return_value = test_json
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._retry_logic", return_value=False) as mock_retry_logic: # simulate final retry
@@ -548,11 +616,11 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 200
                     mock_requests_get.return_value.json.return_value = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['3-9']}
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._partial_retry_upload") as mock_part_retry_up:
-                        with mock.patch("onedrive_offsite.onedrive.sleep", return_value=None) as mock_sleep:
+                        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                             mock_part_retry_resp = mock.Mock()
                             mock_part_retry_resp.status_code = 200
                             mock_part_retry_up.return_value = mock_part_retry_resp
@@ -560,6 +628,29 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             check_value = odlu._retry_partial_fragment("10", "0-4",b'abcd')
                             self.assertEqual(check_value.status_code, 200)
 
+    def test_unit_retry_partial_fragment_range_reader(self, mock_thread_getname):
+        mock_thread_getname.return_value.getName.return_value = "fake-thread"
+        with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
+            test_info_json = {"backup-file-path": "/home/user/backup_file.tar",
+                            "start-date-time": "2022-04-14-21:37:09",
+                            "size-bytes": 170403564,
+                            "onedrive-dir": "backup_test_2",
+                            "onedrive-filename": "backup_test_local.tar.gz",
+                            "done-date-time": "2022-04-14-21:37:15", 
+                            "onedrive-dir-id": "D23D09990A1D5FC9!161"}
+
+            with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
+                    mock_requests_get.return_value.status_code = 200
+                    mock_requests_get.return_value.json.return_value = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['3-9']}
+                    with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._partial_retry_upload") as mock_part_retry_up:
+                        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
+                            odlu = OneDriveLargeUpload("fakeuploadfilename")
+                            odlu._retry_partial_fragment("10", "0-4", FileRangeReader(io.BytesIO(b"abcdefghij"), 0, 5))
+                            remaining_bytes = mock_part_retry_up.call_args[0][3]
+                            self.assertEqual(mock_part_retry_up.call_args[0][1], "2")
+                            self.assertEqual(remaining_bytes.read(), b"de")
+
     def test_unit_retry_partial_fragment_upload_complete(self, mock_thread_getname):
         mock_thread_getname.return_value.getName.return_value = "fake-thread"
         with mock.patch("onedrive_offsite.onedrive.open") as mock_open:
@@ -572,7 +663,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 400
                     mock_requests_get.return_value.json.return_value = {'error': {'code': 'itemNotFound', 'message': 'Upload session not found', 'innererror': {'code': 'uploadSessionNotFound'}}}
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._check_file_update_recent") as mock_file_up_rec:
@@ -593,7 +684,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 400
                     mock_requests_get.return_value.json.return_value = {'error': {'code': 'itemNotFound', 'message': 'Upload session not found', 'innererror': {'code': 'uploadSessionNotFound'}}}
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._check_file_update_recent") as mock_file_up_rec:
@@ -614,7 +705,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get", side_effect=Exception("fake exception")) as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=Exception("fake exception")) as mock_requests_get:
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
                     check_value = odlu._retry_partial_fragment("10", "0-4",b'abcd')
                     self.assertEqual(check_value, False)
@@ -631,7 +722,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 200
                     mock_requests_get.return_value.json.return_value = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['0-9']}
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
@@ -650,7 +741,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 200
                     mock_requests_get.return_value.json.return_value = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['5-9']}
                     odlu = OneDriveLargeUpload("fakeuploadfilename")
@@ -669,11 +760,11 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.get") as mock_requests_get:
+                with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_requests_get:
                     mock_requests_get.return_value.status_code = 200
                     mock_requests_get.return_value.json.return_value = {'expirationDateTime': '2022-01-22T22:49:43.2Z', 'nextExpectedRanges': ['3-9']}
                     with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._partial_retry_upload") as mock_part_retry_up:
-                        with mock.patch("onedrive_offsite.onedrive.sleep", return_value=None) as mock_sleep:
+                        with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                             mock_part_retry_up.return_value = False
                             odlu = OneDriveLargeUpload("fakeuploadfilename")
                             check_value = odlu._retry_partial_fragment("10", "0-4",b'abcd')
@@ -695,7 +786,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.delete") as mock_requests_delete:
+                with mock.patch("onedrive_offsite.onedrive.graph.delete") as mock_requests_delete:
                     mock_requests_delete.return_value.status_code = 204
                     odlu = OneDriveLargeUpload("fakename")
                     check_value = odlu.cancel_upload_session()
@@ -713,7 +804,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.delete", side_effect=Exception("fake exception")) as mock_requests_delete:
+                with mock.patch("onedrive_offsite.onedrive.graph.delete", side_effect=Exception("fake exception")) as mock_requests_delete:
                     odlu = OneDriveLargeUpload("fakename")
                     check_value = odlu.cancel_upload_session()
                     self.assertEqual(check_value, False)
@@ -730,7 +821,7 @@ class TestOneDriveLargeUpload(unittest.TestCase):
                             "onedrive-dir-id": "D23D09990A1D5FC9!161"}
 
             with mock.patch("onedrive_offsite.onedrive.json.load", return_value=test_info_json) as mock_json_load:
-                with mock.patch("onedrive_offsite.onedrive.requests.delete") as mock_requests_delete:
+                with mock.patch("onedrive_offsite.onedrive.graph.delete") as mock_requests_delete:
                     mock_requests_delete.return_value.status_code = 500
                     odlu = OneDriveLargeUpload("fakename")
                     check_value = odlu.cancel_upload_session()
@@ -798,3 +889,175 @@ class TestOneDriveLargeUpload_check_file_update_recent(unittest.TestCase):
                                 check_value = odlu._check_file_update_recent()
                                 self.assertIs(check_value, False)
 
+
+
+### ----------------------- OneDriveLargeUpload upload journal ----------------------------------------
+def _journal_odlu() -> OneDriveLargeUpload:
+    with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.__init__", return_value=None):
+        odlu = OneDriveLargeUpload("fakename")
+    odlu.file_name = "fake-file"
+    odlu.dir_id = "fake-dir-id"
+    odlu.thread_name = "fake-thread"
+    odlu.onedrive_upload_url = None
+    odlu.onedrive_upload_exp = None
+    odlu.next_byte = 0
+    odlu._journal_identity = None
+    odlu.uploaded_item = None
+    return odlu
+
+_journal_entry = {"upload-url": "https://fakeurl", "expires": "2999-01-22T22:49:43.2Z", "onedrive-dir-id": "fake-dir-id",
+                  "file-size": 1000, "file-mtime": 12345, "confirmed-bytes": 500}
+
+
+@mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload._file_identity", return_value=[1000, 12345])
+@mock.patch("onedrive_offsite.onedrive.upload_journal")
+class TestOneDriveLargeUpload_journal(unittest.TestCase):
+
+    def test_unit_resume_upload_session_success(self, mock_journal, mock_identity):
+        mock_journal.get.return_value = dict(_journal_entry)
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.json.return_value = {"expirationDateTime": "2999-01-23T22:49:43.2Z", "nextExpectedRanges": ["655360-"]}
+            odlu = _journal_odlu()
+            self.assertEqual(odlu.resume_upload_session(), True)
+            self.assertEqual(odlu.next_byte, 655360)
+            self.assertEqual(odlu.onedrive_upload_url, "https://fakeurl")
+            self.assertEqual(odlu.onedrive_upload_exp, "2999-01-23T22:49:43.2Z")
+            mock_journal.confirm.assert_called_once_with("fake-file", 655360, "2999-01-23T22:49:43.2Z")
+
+    def test_unit_resume_upload_session_no_entry(self, mock_journal, mock_identity):
+        mock_journal.get.return_value = None
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            self.assertEqual(_journal_odlu().resume_upload_session(), False)
+            mock_get.assert_not_called()
+
+    def test_unit_resume_upload_session_file_changed(self, mock_journal, mock_identity):
+        mock_identity.return_value = [1000, 99999]
+        mock_journal.get.return_value = dict(_journal_entry)
+        with mock.patch("onedrive_offsite.onedrive.graph.delete") as mock_delete:
+            self.assertEqual(_journal_odlu().resume_upload_session(), False)
+            mock_delete.assert_called_once_with(url="https://fakeurl")
+            mock_journal.remove.assert_called_once_with("fake-file")
+
+    def test_unit_resume_upload_session_expiring(self, mock_journal, mock_identity):
+        entry = dict(_journal_entry)
+        entry["expires"] = "2022-01-22T22:49:43.2Z"
+        mock_journal.get.return_value = entry
+        with mock.patch("onedrive_offsite.onedrive.graph.delete") as mock_delete:
+            with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+                self.assertEqual(_journal_odlu().resume_upload_session(), False)
+                mock_get.assert_not_called()
+                mock_journal.remove.assert_called_once_with("fake-file")
+
+    def test_unit_resume_upload_session_gone(self, mock_journal, mock_identity):
+        mock_journal.get.return_value = dict(_journal_entry)
+        with mock.patch("onedrive_offsite.onedrive.graph.get") as mock_get:
+            mock_get.return_value.status_code = 404
+            mock_get.return_value.json.return_value = {"error": {"code": "itemNotFound"}}
+            self.assertEqual(_journal_odlu().resume_upload_session(), False)
+            mock_journal.remove.assert_called_once_with("fake-file")
+
+    def test_unit_resume_upload_session_status_exception(self, mock_journal, mock_identity):
+        mock_journal.get.return_value = dict(_journal_entry)
+        with mock.patch("onedrive_offsite.onedrive.graph.get", side_effect=requests.exceptions.ConnectionError):
+            self.assertEqual(_journal_odlu().resume_upload_session(), False)
+            mock_journal.remove.assert_not_called()
+
+    def test_unit_open_upload_session_resumes(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.resume_upload_session", return_value=True):
+            with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.initiate_upload_session") as mock_initiate:
+                self.assertEqual(_journal_odlu().open_upload_session("fake-token"), True)
+                mock_initiate.assert_not_called()
+                mock_journal.start.assert_not_called()
+
+    def test_unit_open_upload_session_new(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.resume_upload_session", return_value=False):
+            with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.initiate_upload_session", return_value=True):
+                odlu = _journal_odlu()
+                odlu.onedrive_upload_url = "https://fakeurl"
+                odlu.onedrive_upload_exp = "2999-01-22T22:49:43.2Z"
+                self.assertEqual(odlu.open_upload_session("fake-token"), True)
+                self.assertEqual(odlu.next_byte, 0)
+                mock_journal.start.assert_called_once_with("fake-file", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345)
+
+    def test_unit_open_upload_session_not_on_disk(self, mock_journal, mock_identity):
+        mock_identity.return_value = None
+        with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.resume_upload_session", return_value=False):
+            with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.initiate_upload_session", return_value=True):
+                self.assertEqual(_journal_odlu().open_upload_session("fake-token"), True)
+                mock_journal.start.assert_not_called()
+
+    def test_unit_open_upload_session_fail(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.resume_upload_session", return_value=False):
+            with mock.patch("onedrive_offsite.onedrive.OneDriveLargeUpload.initiate_upload_session", return_value=False):
+                self.assertEqual(_journal_odlu().open_upload_session("fake-token"), False)
+                mock_journal.start.assert_not_called()
+
+    def test_unit_upload_file_part_journals_progress(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_put:
+            mock_put.return_value.status_code = 202
+            mock_put.return_value.json.return_value = {"expirationDateTime": "2999-01-23T22:49:43.2Z", "nextExpectedRanges": ["500-999"]}
+            odlu = _journal_odlu()
+            odlu._journal_identity = [1000, 12345]
+            odlu.upload_file_part("1000", "500", "0-499", b"fake bytes")
+            mock_journal.confirm.assert_called_once_with("fake-file", 500, "2999-01-23T22:49:43.2Z")
+            self.assertEqual(odlu.onedrive_upload_exp, "2999-01-23T22:49:43.2Z")
+
+    def test_unit_upload_file_part_complete_clears_journal(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_put:
+            mock_put.return_value.status_code = 201
+            odlu = _journal_odlu()
+            odlu._journal_identity = [1000, 12345]
+            odlu.upload_file_part("1000", "500", "500-999", b"fake bytes")
+            mock_journal.remove.assert_called_once_with("fake-file")
+
+    def test_unit_upload_file_part_not_journaled(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_put:
+            mock_put.return_value.status_code = 202
+            _journal_odlu().upload_file_part("1000", "500", "0-499", b"fake bytes")
+            mock_journal.confirm.assert_not_called()
+
+    def test_unit_cancel_upload_session_clears_journal(self, mock_journal, mock_identity):
+        with mock.patch("onedrive_offsite.onedrive.graph.delete") as mock_delete:
+            mock_delete.return_value.status_code = 204
+            odlu = _journal_odlu()
+            odlu._journal_identity = [1000, 12345]
+            self.assertEqual(odlu.cancel_upload_session(), True)
+            mock_journal.remove.assert_called_once_with("fake-file")
+
+
+#### ------------ OneDriveLargeUpload.verify_upload() -------------------------
+class TestOneDriveLargeUpload_verify_upload(unittest.TestCase):
+
+    def test_unit_verify_upload_match(self):
+        odlu = _journal_odlu()
+        odlu.uploaded_item = {"name": "fake-file", "file": {"hashes": {"quickXorHash": "aCgDG9jwBhDc4Q1yawMZAAAAAAA="}}}
+        self.assertEqual(odlu.verify_upload("aCgDG9jwBhDc4Q1yawMZAAAAAAA="), True)
+
+    def test_unit_verify_upload_mismatch(self):
+        odlu = _journal_odlu()
+        odlu.uploaded_item = {"name": "fake-file", "file": {"hashes": {"quickXorHash": "aCgDG9jwBhDc4Q1yawMZAAAAAAA="}}}
+        self.assertEqual(odlu.verify_upload("AAAAAAAAAAAAAAAAAAAAAAAAAAA="), False)
+
+    def test_unit_verify_upload_no_onedrive_hash(self):
+        odlu = _journal_odlu()
+        odlu.uploaded_item = {"name": "fake-file", "file": {"hashes": None}}
+        self.assertEqual(odlu.verify_upload("AAAAAAAAAAAAAAAAAAAAAAAAAAA="), True)
+
+    def test_unit_verify_upload_no_item(self):
+        # the upload finished without onedrive returning the item, ex: the session was gone when the last fragment was retried
+        self.assertEqual(_journal_odlu().verify_upload("AAAAAAAAAAAAAAAAAAAAAAAAAAA="), True)
+
+    def test_unit_verify_upload_no_local_hash(self):
+        odlu = _journal_odlu()
+        odlu.uploaded_item = {"name": "fake-file", "file": {"hashes": {"quickXorHash": "aCgDG9jwBhDc4Q1yawMZAAAAAAA="}}}
+        self.assertEqual(odlu.verify_upload(None), True)
+
+    def test_unit_upload_file_part_keeps_item(self):
+        with mock.patch("onedrive_offsite.onedrive.upload_journal") as mock_journal:
+            with mock.patch("onedrive_offsite.onedrive.graph.put") as mock_put:
+                mock_put.return_value.status_code = 201
+                mock_put.return_value.json.return_value = {"name": "fake-file", "size": 1000}
+                odlu = _journal_odlu()
+                odlu.upload_file_part("1000", "500", "500-999", b"fake bytes")
+                self.assertEqual(odlu.uploaded_item, {"name": "fake-file", "size": 1000})
@@ -0,0 +1,72 @@
+import unittest, os, base64, random
+
+from onedrive_offsite.quickxor import QuickXorHash, quick_xor_file
+
+
+def reference_quick_xor(data: bytes) -> str:
+    # the hash worked out one byte at a time, the way it's defined
+    value = 0
+    for n, byte in enumerate(data):
+        shift = (11 * n) % 160
+        value = value ^ (((byte << shift) | (byte >> (160 - shift))) & ((1 << 160) - 1))
+    digest = bytearray(value.to_bytes(20, "little"))
+    for i, length_byte in enumerate(len(data).to_bytes(8, "little")):
+        digest[12 + i] = digest[12 + i] ^ length_byte
+    return base64.b64encode(bytes(digest)).decode("ascii")
+
+
+def random_bytes(seed: int, size: int) -> bytes:
+    rng = random.Random(seed)
+    return bytes([rng.randrange(256) for i in range(size)])
+
+
+### ------------------------------ QuickXorHash -----------------------------------
+class TestQuickXorHash(unittest.TestCase):
+
+    def test_unit_empty(self):
+        self.assertEqual(QuickXorHash().b64digest(), "AAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+
+    def test_unit_known_value(self):
+        quick_xor = QuickXorHash()
+        quick_xor.update(0, b"hello world")
+        self.assertEqual(quick_xor.b64digest(), "aCgDG9jwBhDc4Q1yawMZAAAAAAA=")
+        self.assertEqual(quick_xor.length, 11)
+
+    def test_unit_matches_reference(self):
+        data = random_bytes(11, 5000)
+        for size in [1, 159, 160, 161, 319, 320, 1000, 5000]:
+            quick_xor = QuickXorHash()
+            quick_xor.update(0, data[:size])
+            self.assertEqual(quick_xor.b64digest(), reference_quick_xor(data[:size]))
+
+    def test_unit_pieces_in_any_order(self):
+        data = random_bytes(7, 4000)
+        pieces = [(0, 1), (1, 333), (334, 160), (494, 1506), (2000, 2000)]
+        random.Random(3).shuffle(pieces)
+        quick_xor = QuickXorHash()
+        for offset, size in pieces:
+            quick_xor.update(offset, memoryview(data)[offset:offset + size])
+        self.assertEqual(quick_xor.b64digest(), reference_quick_xor(data))
+
+    def test_unit_empty_update(self):
+        quick_xor = QuickXorHash()
+        quick_xor.update(10, b"")
+        self.assertEqual(quick_xor.length, 0)
+
+
+### ------------------------------ quick_xor_file() -----------------------------------
+class TestQuickXorFile(unittest.TestCase):
+    test_file_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "testfilequickxor")
+
+    def tearDown(self):
+        if os.path.isfile(TestQuickXorFile.test_file_path):
+            os.remove(TestQuickXorFile.test_file_path)
+
+    def test_unit_quick_xor_file(self):
+        data = random_bytes(5, 3000)
+        with open(TestQuickXorFile.test_file_path, "wb") as test_file:
+            test_file.write(data)
+        self.assertEqual(quick_xor_file(TestQuickXorFile.test_file_path), reference_quick_xor(data))
+
+    def test_unit_quick_xor_file_missing(self):
+        self.assertIs(quick_xor_file("fake/file/path"), None)
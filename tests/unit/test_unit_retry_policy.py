@@ -0,0 +1,76 @@
+import unittest, mock
+from email.utils import format_datetime
+from datetime import datetime, timezone, timedelta
+
+from onedrive_offsite.retry_policy import RetryPolicy, retry_after_seconds
+
+
+def _response(status_code: int, retry_after: str=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = {} if retry_after == None else {"Retry-After": retry_after}
+    return response
+
+
+### ------------------------------ retry_after_seconds() -----------------------------------
+class TestRetryAfterSeconds(unittest.TestCase):
+
+    def test_unit_retry_after_seconds(self):
+        self.assertEqual(retry_after_seconds(_response(429, "10")), 10)
+
+    def test_unit_retry_after_http_date(self):
+        retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=120), usegmt=True)
+        self.assertAlmostEqual(retry_after_seconds(_response(503, retry_at)), 120, delta=5)
+
+    def test_unit_retry_after_in_the_past(self):
+        self.assertEqual(retry_after_seconds(_response(429, "-5")), 0)
+
+    def test_unit_retry_after_missing(self):
+        self.assertIs(retry_after_seconds(_response(429)), None)
+        self.assertIs(retry_after_seconds(None), None)
+
+    def test_unit_retry_after_unreadable(self):
+        self.assertIs(retry_after_seconds(_response(429, "soon")), None)
+
+
+### ------------------------------ RetryPolicy -----------------------------------
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_unit_backoff_grows(self):
+        policy = RetryPolicy("test", 3, 10, max_seconds=1800, multiplier=4, jitter=0)
+        self.assertEqual([policy.delay(retry_count) for retry_count in [1, 2, 3]], [10, 40, 160])
+
+    def test_unit_backoff_capped(self):
+        policy = RetryPolicy("test", 5, 10, max_seconds=100, multiplier=4, jitter=0)
+        self.assertEqual(policy.delay(5), 100)
+
+    def test_unit_backoff_jitter(self):
+        policy = RetryPolicy("test", 3, 10, max_seconds=1800, multiplier=4, jitter=0.5)
+        for i in range(50):
+            seconds = policy.delay(2)
+            self.assertGreaterEqual(seconds, 20)
+            self.assertLessEqual(seconds, 40)
+
+    def test_unit_out_of_retries(self):
+        policy = RetryPolicy("test", 3, 10, jitter=0)
+        self.assertIs(policy.delay(4), None)
+        self.assertIs(policy.delay(4, _response(503)), None)
+
+    def test_unit_follows_retry_after(self):
+        policy = RetryPolicy("test", 3, 10, jitter=0)
+        self.assertEqual(policy.delay(3, _response(503, "7")), 7)
+
+    def test_unit_retry_after_capped(self):
+        policy = RetryPolicy("test", 3, 10, jitter=0, max_retry_after_seconds=60)
+        self.assertEqual(policy.delay(1, _response(429, "7200")), 60)
+
+    def test_unit_throttled_budget(self):
+        # a throttled request keeps retrying past the error budget, up to its own limit
+        policy = RetryPolicy("test", 3, 10, jitter=0, throttle_retries=8)
+        self.assertEqual(policy.delay(6, _response(429, "10")), 10)
+        self.assertIs(policy.delay(9, _response(429, "10")), None)
+        self.assertIs(policy.delay(6, _response(500)), None)
+
+    def test_unit_throttled_without_retry_after(self):
+        policy = RetryPolicy("test", 3, 10, max_seconds=1800, multiplier=2, jitter=0, throttle_retries=8)
+        self.assertEqual(policy.delay(5, _response(429)), 160)
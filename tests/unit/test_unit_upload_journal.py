@@ -0,0 +1,93 @@
+import unittest, os, json
+from datetime import datetime, timezone, timedelta
+
+from onedrive_offsite.upload_journal import UploadJournal, session_expires_soon
+
+
+### ------------------------------ session_expires_soon() -----------------------------------
+class TestSessionExpiresSoon(unittest.TestCase):
+
+    def test_unit_expires_soon_far_off(self):
+        expires = (datetime.now(timezone.utc) + timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        self.assertEqual(session_expires_soon(expires, 60), False)
+
+    def test_unit_expires_soon_inside_margin(self):
+        expires = (datetime.now(timezone.utc) + timedelta(minutes=30)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        self.assertEqual(session_expires_soon(expires, 60), True)
+
+    def test_unit_expires_soon_graph_fraction_digits(self):
+        # graph can send anywhere from 1 to 7 digits of fractional seconds
+        self.assertEqual(session_expires_soon("2999-01-22T22:49:43.2Z", 60), False)
+        self.assertEqual(session_expires_soon("2999-01-22T22:49:43.1234567Z", 60), False)
+        self.assertEqual(session_expires_soon("2999-01-22T22:49:43Z", 60), False)
+
+    def test_unit_expires_soon_already_expired(self):
+        self.assertEqual(session_expires_soon("2022-01-22T22:49:43.2Z", 60), True)
+
+    def test_unit_expires_soon_unreadable(self):
+        self.assertEqual(session_expires_soon(None, 60), True)
+        self.assertEqual(session_expires_soon("not a date", 60), True)
+
+
+### ------------------------------ UploadJournal -----------------------------------
+class TestUploadJournal(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_journal_path = os.path.join(test_dir, "test_upload_journal.json")
+
+    def tearDown(self):
+        if os.path.isfile(TestUploadJournal.test_journal_path):
+            os.remove(TestUploadJournal.test_journal_path)
+
+    def test_unit_journal_get_missing_file(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        self.assertIs(journal.get("fakefile"), None)
+        self.assertEqual(os.path.isfile(TestUploadJournal.test_journal_path), False)
+
+    def test_unit_journal_start_and_reload(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        self.assertEqual(journal.start("fakefile", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345), True)
+
+        loaded_journal = UploadJournal(TestUploadJournal.test_journal_path)
+        entry = loaded_journal.get("fakefile")
+        self.assertEqual(entry.get("upload-url"), "https://fakeurl")
+        self.assertEqual(entry.get("confirmed-bytes"), 0)
+        self.assertEqual([entry.get("file-size"), entry.get("file-mtime")], [1000, 12345])
+        self.assertEqual(os.path.isfile(TestUploadJournal.test_journal_path + ".tmp"), False)
+
+    def test_unit_journal_confirm(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        journal.start("fakefile", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345)
+        self.assertEqual(journal.confirm("fakefile", 500, "2999-01-23T22:49:43.2Z"), True)
+        self.assertEqual(journal.confirm("fakefile", 750), True)
+
+        entry = UploadJournal(TestUploadJournal.test_journal_path).get("fakefile")
+        self.assertEqual(entry.get("confirmed-bytes"), 750)
+        self.assertEqual(entry.get("expires"), "2999-01-23T22:49:43.2Z")
+
+    def test_unit_journal_confirm_unknown_file(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        self.assertEqual(journal.confirm("fakefile", 500), False)
+
+    def test_unit_journal_remove(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        journal.start("fakefile", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345)
+        self.assertEqual(journal.remove("fakefile"), True)
+        self.assertEqual(journal.remove("fakefile"), True)
+        self.assertIs(UploadJournal(TestUploadJournal.test_journal_path).get("fakefile"), None)
+
+    def test_unit_journal_get_returns_copy(self):
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        journal.start("fakefile", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345)
+        journal.get("fakefile")["confirmed-bytes"] = 999
+        self.assertEqual(journal.get("fakefile").get("confirmed-bytes"), 0)
+
+    def test_unit_journal_load_exception(self):
+        with open(TestUploadJournal.test_journal_path, "w") as journal_file:
+            journal_file.write("not json")
+        journal = UploadJournal(TestUploadJournal.test_journal_path)
+        self.assertIs(journal.get("fakefile"), None)
+        self.assertEqual(journal.sessions, {})
+
+    def test_unit_journal_save_exception(self):
+        journal = UploadJournal(os.path.join(TestUploadJournal.test_dir, "no-such-dir", "journal.json"))
+        self.assertEqual(journal.start("fakefile", "https://fakeurl", "2999-01-22T22:49:43.2Z", "fake-dir-id", 1000, 12345), False)
@@ -1,7 +1,8 @@
-import unittest, mock, os, shutil
+import unittest, mock, os, shutil, tarfile, io, queue, threading
 from onedrive_offsite.config import Config
 
-from onedrive_offsite.utils import leading_zeros, make_tar_gz, FilePartialRead, get_file_groups, ses_send_email, file_cleanup, get_recent_log_lines, download_file_email, extract_tar_gz, decrypt_email, read_backup_file_info
+from onedrive_offsite.utils import leading_zeros, make_tar_gz, FilePartialRead, get_file_groups, ses_send_email, file_cleanup, get_recent_log_lines, download_file_email, extract_tar_gz, decrypt_email, read_backup_file_info, tar_part_size, FragmentQueueWriter, FileRangeReader, FragmentSizer, upload_fragment_sizer, upload_quick_xor
+from onedrive_offsite.quickxor import QuickXorHash
 
 
 class TestUtilsleadingzeros(unittest.TestCase):
@@ -82,6 +83,21 @@ class TestUtilsmaketargz(unittest.TestCase):
         self.assertTrue(os.path.isfile(os.path.join(TestUtilsmaketargz.test_targz_dir, "0003_" + Config.onedrive_upload_default_filename)), "0003 tar.gz file should exist")
         self.assertFalse(os.path.isfile(TestUtilsmaketargz.test_chunk_dir + "/test_file_1"), "Original files should NOT be there")
 
+    def test_unit_create_tar_no_compression(self):
+        make_tar_gz(TestUtilsmaketargz.test_chunk_dir, TestUtilsmaketargz.test_targz_dir, 24, Config.onedrive_upload_default_filename, compress=False)
+        tar_path = os.path.join(TestUtilsmaketargz.test_targz_dir, "0001_" + Config.onedrive_upload_default_filename)
+        # opening with "r:" only works for uncompressed archives
+        with tarfile.open(tar_path, "r:") as tar:
+            self.assertEqual(len(tar.getnames()), 24)
+
+    def test_unit_extract_tar_and_tar_gz(self):
+        make_tar_gz(TestUtilsmaketargz.test_chunk_dir, TestUtilsmaketargz.test_targz_dir, 12, "plain.tar", compress=False)
+        make_tar_gz(TestUtilsmaketargz.test_chunk_dir, TestUtilsmaketargz.test_targz_dir, 12, "legacy.tar.gz", compress=True)
+        extract_dir = os.path.join(TestUtilsmaketargz.test_targz_dir, "extracted")
+        for archive in sorted(os.listdir(TestUtilsmaketargz.test_targz_dir)):
+            self.assertIs(extract_tar_gz(os.path.join(TestUtilsmaketargz.test_targz_dir, archive), extract_dir), True)
+        self.assertEqual(len(os.listdir(extract_dir)), 24)
+
     def test_unit_exception(self):
         with mock.patch('onedrive_offsite.utils.tarfile.open', side_effect=Exception("fake tarfile.open exception")):
             check_value = make_tar_gz(TestUtilsmaketargz.test_chunk_dir, TestUtilsmaketargz.test_targz_dir, 2, Config.onedrive_upload_default_filename, removeorig=True)
@@ -177,16 +193,361 @@ class TestUtilFPR(unittest.TestCase):
         test_value = fpr.upload_array[len(fpr.upload_array)-1][2]
         self.assertEqual(test_value, "0-9999", "Expecting '0-9999' range")
     
-    def test_unit_read_data(self):
+    def test_unit_range_reader_keeps_file_open(self):
         fpr = FilePartialRead(TestUtilFPR.test_file_path_10_5kb, 1, 1000)
-        test_value = fpr.read_file_bytes(5, 10)
-        self.assertEqual(test_value, b'6789012345', "Expecting b'6789012345")
-
-    def test_unit_read_data_except(self):
-        with mock.patch('onedrive_offsite.utils.open', side_effect=Exception):
-            fpr = FilePartialRead(TestUtilFPR.test_file_path_10_5kb, 1, 1000)
-            test_value = fpr.read_file_bytes(5, 10)
-            self.assertEqual(test_value, None, "Expecting None")
+        with mock.patch('onedrive_offsite.utils.open', side_effect=open) as mock_open:
+            self.assertEqual(fpr.range_reader(5, 10).read(), b'6789012345')
+            fpr.range_reader(10495, 10)
+            mock_open.assert_called_once()
+        fpr.close()
+        self.assertIs(fpr._file, None)
+
+    def test_unit_file_size_provided(self):
+        fpr = FilePartialRead("fake/streamed/part", 1, 1000, file_size=10500)
+        test_value = fpr.upload_array[len(fpr.upload_array)-1][2]
+        self.assertEqual(test_value, "10000-10499", "Expecting '10000-10499' range")
+
+
+class TestUtilFileRangeReader(unittest.TestCase):
+
+    def test_unit_read_only_range(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 2, 5)
+        self.assertEqual(len(reader), 5)
+        self.assertEqual(reader.read(3), b"234")
+        self.assertEqual(reader.read(), b"56")
+        self.assertEqual(reader.read(), b"")
+
+    def test_unit_seek_and_tell(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 2, 5)
+        reader.read(4)
+        self.assertEqual(reader.tell(), 4)
+        reader.seek(0)
+        self.assertEqual(reader.read(), b"23456")
+
+    def test_unit_shared_file(self):
+        file_obj = io.BytesIO(b"0123456789")
+        first_reader = FileRangeReader(file_obj, 0, 5)
+        second_reader = FileRangeReader(file_obj, 5, 5)
+        self.assertEqual(first_reader.read(2), b"01")
+        self.assertEqual(second_reader.read(2), b"56")
+        self.assertEqual(first_reader.read(), b"234")
+
+    def test_unit_read_reuses_buffer(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 2, 6)
+        first_value = reader.read(3)
+        self.assertIsInstance(first_value, memoryview)
+        self.assertEqual(bytes(first_value), b"234")
+        second_value = reader.read(3)
+        self.assertIs(first_value.obj, second_value.obj)
+        self.assertEqual(bytes(second_value), b"567")
+
+    def test_unit_tail(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 2, 5)
+        self.assertEqual(reader.tail(2).read(), b"56")
+
+    def test_unit_range_reader_from_fpr(self):
+        test_file_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "testfilerangereader")
+        with open(test_file_path, "wb") as test_file:
+            test_file.write(b"1234567890" * 100)
+        try:
+            fpr = FilePartialRead(test_file_path, .4, 400)
+            readers = [fpr.range_reader(chunks[1], fpr.file_range_size_bytes) for chunks in fpr.upload_array]
+            self.assertEqual([len(reader) for reader in readers], [chunks[0] for chunks in fpr.upload_array])
+            self.assertEqual(b"".join([reader.read() for reader in readers]), b"1234567890" * 100)
+            fpr.close()
+        finally:
+            os.remove(test_file_path)
+
+    def test_unit_range_reader_missing_file(self):
+        fpr = FilePartialRead("fake/file/path", 1, 1000, file_size=10500)
+        self.assertIs(fpr.range_reader(0, 1000), None)
+
+    def test_unit_hash_while_reading(self):
+        data = b"0123456789" * 50
+        expected = QuickXorHash()
+        expected.update(100, data[100:400])
+        quick_xor = QuickXorHash()
+        reader = FileRangeReader(io.BytesIO(data), 100, 300, quick_xor=quick_xor)
+        reader.read(120)
+        # a retry sends the fragment again from the start, those bytes aren't hashed twice
+        reader.seek(0)
+        reader.read(50)
+        reader.read()
+        self.assertEqual(reader.hashed_bytes, 300)
+        self.assertEqual(reader.finish_hash(), True)
+        self.assertEqual(quick_xor.digest(), expected.digest())
+        self.assertEqual(quick_xor.length, 300)
+
+    def test_unit_finish_hash_reads_rest(self):
+        data = b"0123456789" * 50
+        expected = QuickXorHash()
+        expected.update(0, data[:300])
+        quick_xor = QuickXorHash()
+        reader = FileRangeReader(io.BytesIO(data), 0, 300, quick_xor=quick_xor)
+        reader.read(100)
+        # the rest of the fragment was sent by a tail reader, which doesn't hash
+        self.assertEqual(reader.tail(200).quick_xor, None)
+        self.assertEqual(reader.finish_hash(), True)
+        self.assertEqual(quick_xor.digest(), expected.digest())
+
+    def test_unit_finish_hash_short_file(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 5, 10, quick_xor=QuickXorHash())
+        self.assertEqual(reader.finish_hash(), False)
+
+    def test_unit_finish_hash_no_hash(self):
+        reader = FileRangeReader(io.BytesIO(b"0123456789"), 0, 10)
+        self.assertEqual(reader.finish_hash(), True)
+
+
+class TestUtilFPRPrefetch(unittest.TestCase):
+    test_dir = os.path.abspath(os.path.dirname(__file__))
+    test_file_path = os.path.join(test_dir, "testfileprefetch")
+
+    def setUp(self):
+        with open(TestUtilFPRPrefetch.test_file_path, "wb") as test_file:
+            test_file.write(b"1234567890" * 100)   # 1,000 bytes, 10 fragments of 100 bytes
+
+    def tearDown(self):
+        if os.path.isfile(TestUtilFPRPrefetch.test_file_path):
+            os.remove(TestUtilFPRPrefetch.test_file_path)
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise not available")
+    def test_unit_prefetch_advises_next_fragments(self):
+        fpr = FilePartialRead(TestUtilFPRPrefetch.test_file_path, .1, 100)
+        with mock.patch("onedrive_offsite.utils.os.posix_fadvise") as mock_fadvise:
+            self.assertEqual(fpr.prefetch_fragments(0, 2, 1000), True)
+            self.assertEqual([call[0][1:3] for call in mock_fadvise.call_args_list], [(100, 100), (200, 100)])
+        fpr.close()
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise not available")
+    def test_unit_prefetch_skips_fragments_already_prefetched(self):
+        fpr = FilePartialRead(TestUtilFPRPrefetch.test_file_path, .1, 100)
+        with mock.patch("onedrive_offsite.utils.os.posix_fadvise") as mock_fadvise:
+            fpr.prefetch_fragments(0, 2, 1000)
+            fpr.prefetch_fragments(1, 2, 1000)
+            self.assertEqual([call[0][1] for call in mock_fadvise.call_args_list], [100, 200, 300])
+        fpr.close()
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise not available")
+    def test_unit_prefetch_memory_cap(self):
+        fpr = FilePartialRead(TestUtilFPRPrefetch.test_file_path, .1, 100)
+        with mock.patch("onedrive_offsite.utils.os.posix_fadvise") as mock_fadvise:
+            fpr.prefetch_fragments(0, 4, 250)
+            self.assertEqual(mock_fadvise.call_count, 2)
+        fpr.close()
+
+    def test_unit_prefetch_off(self):
+        fpr = FilePartialRead(TestUtilFPRPrefetch.test_file_path, .1, 100)
+        with mock.patch("onedrive_offsite.utils.open") as mock_open:
+            self.assertEqual(fpr.prefetch_fragments(0, 0, 1000), True)
+            mock_open.assert_not_called()
+
+    def test_unit_prefetch_thread_without_fadvise(self):
+        fpr = FilePartialRead(TestUtilFPRPrefetch.test_file_path, .1, 100)
+        with mock.patch("onedrive_offsite.utils.hasattr", return_value=False, create=True) as mock_hasattr:
+            with mock.patch("onedrive_offsite.utils.threading.Thread") as mock_thread:
+                fpr.prefetch_fragments(8, 2, 1000)
+                self.assertEqual(mock_thread.call_args[1]["args"], (900, 100))
+                mock_thread.return_value.start.assert_called_once()
+        fpr.close()
+
+    def test_unit_prefetch_exception(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000)
+        self.assertEqual(fpr.prefetch_fragments(0, 2, 1000), False)
+
+
+class TestUtilFragmentSizer(unittest.TestCase):
+
+    def test_unit_start_size_rounded_to_range_factor(self):
+        sizer = FragmentSizer(1050, 100, 10000, 10, 100)
+        self.assertEqual(sizer.size_bytes, 1000)
+
+    def test_unit_size_follows_bandwidth(self):
+        # 1,000 bytes in 1 second with a 2 second target
+        sizer = FragmentSizer(1000, 100, 10000, 2, 100)
+        self.assertEqual(sizer.next_size(1000, 1), 2000)
+
+    def test_unit_size_grows_at_most_double(self):
+        sizer = FragmentSizer(1000, 100, 100000, 10, 100)
+        self.assertEqual(sizer.next_size(1000, .1), 2000)
+
+    def test_unit_size_shrinks_on_slow_link(self):
+        sizer = FragmentSizer(1000, 100, 10000, 1, 100)
+        self.assertEqual(sizer.next_size(1000, 4), 200)
+
+    def test_unit_size_clamped(self):
+        sizer = FragmentSizer(1000, 300, 1500, 1, 100)
+        self.assertEqual(sizer.next_size(1000, 100), 300)
+        sizer = FragmentSizer(1000, 300, 1500, 1000, 100)
+        self.assertEqual(sizer.next_size(1000, 1), 1500)
+
+    def test_unit_bandwidth_averaged(self):
+        sizer = FragmentSizer(1000, 100, 10000, 1, 100)
+        sizer.next_size(1000, 1)
+        self.assertEqual(sizer.next_size(3000, 1), 2000)
+
+    def test_unit_no_time_keeps_size(self):
+        sizer = FragmentSizer(1000, 100, 10000, 1, 100)
+        self.assertEqual(sizer.next_size(1000, 0), 1000)
+
+    def test_unit_graph_limits(self):
+        sizer = FragmentSizer(int(Config.onedrive_upload_chunk_size_kb * 1000), int(Config.upload_fragment_min_kb * 1000),
+                              int(Config.upload_fragment_max_kb * 1000), Config.upload_fragment_target_seconds)
+        self.assertEqual(sizer.min_bytes, 327680)
+        self.assertEqual(sizer.max_bytes, 62586880)
+        for seconds in [.01, .01, .01, .01, .01, 100, 1000]:
+            size = sizer.next_size(sizer.size_bytes, seconds)
+            self.assertEqual(size % 327680, 0)
+            self.assertTrue(327680 <= size < 62914560)
+
+    def test_unit_never_60_mib(self):
+        # graph rejects a request of 60 MiB or more, even when the configured maximum allows it
+        sizer = FragmentSizer(10485760, 327680, 62914560, 10)
+        self.assertEqual(sizer.max_bytes, 62586880)
+        for i in range(20):
+            self.assertLess(sizer.next_size(sizer.size_bytes, .001), 62914560)
+        self.assertEqual(sizer.size_bytes, 62586880)
+
+    def test_unit_upload_fragment_sizer_off(self):
+        with mock.patch("onedrive_offsite.utils.Config") as mock_config:
+            mock_config.adaptive_fragment_size = False
+            self.assertEqual(upload_fragment_sizer(), None)
+
+    def test_unit_upload_fragment_sizer_on(self):
+        with mock.patch("onedrive_offsite.utils.Config") as mock_config:
+            mock_config.adaptive_fragment_size = True
+            mock_config.onedrive_upload_chunk_size_kb = 10485.76
+            mock_config.upload_fragment_min_kb = 327.68
+            mock_config.upload_fragment_max_kb = 62586.88
+            mock_config.upload_fragment_target_seconds = 10
+            self.assertEqual(upload_fragment_sizer().size_bytes, 10485760)
+
+
+class TestUtilFPRRecordFragment(unittest.TestCase):
+
+    def test_unit_record_fragment_no_sizer(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000)
+        fpr.record_fragment(0, 100)
+        self.assertEqual(len(fpr.upload_array), 10)
+
+    def test_unit_record_fragment_replans_rest_of_file(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1050, sizer=FragmentSizer(100, 100, 1000, 2, 100))
+        fpr.record_fragment(0, 1)
+        self.assertEqual(fpr.file_range_size_bytes, 200)
+        self.assertEqual(fpr.upload_array, [[100, 0, "0-99"], [200, 100, "100-299"], [200, 300, "300-499"], [200, 500, "500-699"],
+                                            [200, 700, "700-899"], [150, 900, "900-1049"]])
+
+    def test_unit_record_fragment_same_size(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000, sizer=FragmentSizer(100, 100, 1000, 1, 100))
+        original_array = list(fpr.upload_array)
+        fpr.record_fragment(0, 1)
+        self.assertEqual(fpr.upload_array, original_array)
+
+    def test_unit_record_fragment_last_fragment(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000, sizer=FragmentSizer(100, 100, 1000, 2, 100))
+        fpr.record_fragment(9, 1)
+        self.assertEqual(len(fpr.upload_array), 10)
+        self.assertEqual(fpr.file_range_size_bytes, 100)
+
+    def test_unit_record_fragment_resets_prefetch(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000, sizer=FragmentSizer(100, 100, 1000, 2, 100))
+        fpr._prefetched_index = 3
+        fpr.record_fragment(1, 1)
+        self.assertEqual(fpr._prefetched_index, 1)
+
+
+class TestUtilFPRResumeFrom(unittest.TestCase):
+
+    def test_unit_resume_from_skips_sent_bytes(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1050)
+        fpr._prefetched_index = 2
+        fpr.resume_from(700)
+        self.assertEqual(fpr.upload_array, [[100, 700, "700-799"], [100, 800, "800-899"], [100, 900, "900-999"], [50, 1000, "1000-1049"]])
+        self.assertEqual(fpr._prefetched_index, -1)
+
+    def test_unit_resume_from_start(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000)
+        original_array = list(fpr.upload_array)
+        fpr.resume_from(0)
+        self.assertEqual(fpr.upload_array, original_array)
+
+    def test_unit_resume_from_hashes_sent_bytes(self):
+        test_file_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "testfileresumehash")
+        with open(test_file_path, "wb") as test_file:
+            test_file.write(b"1234567890" * 100)
+        try:
+            expected = QuickXorHash()
+            expected.update(0, b"1234567890" * 100)
+            fpr = FilePartialRead(test_file_path, .1, 100, quick_xor=QuickXorHash())
+            fpr.resume_from(700)
+            self.assertEqual(fpr.quick_xor.length, 700)
+            self.assertIs(fpr.upload_hash(), None)
+            for chunks in fpr.upload_array:
+                reader = fpr.range_reader(chunks[1], chunks[0])
+                reader.read()
+                reader.finish_hash()
+            self.assertEqual(fpr.upload_hash(), expected.b64digest())
+            fpr.close()
+        finally:
+            os.remove(test_file_path)
+
+    def test_unit_resume_from_hash_missing_file(self):
+        fpr = FilePartialRead("fake/file/path", .1, 100, file_size=1000, quick_xor=QuickXorHash())
+        fpr.resume_from(700)
+        self.assertIs(fpr.quick_xor, None)
+        self.assertIs(fpr.upload_hash(), None)
+
+
+class TestUtilsuploadquickxor(unittest.TestCase):
+
+    def test_unit_upload_quick_xor_off(self):
+        with mock.patch("onedrive_offsite.utils.Config") as mock_config:
+            mock_config.upload_verify_hash = False
+            self.assertIs(upload_quick_xor(), None)
+
+    def test_unit_upload_quick_xor_on(self):
+        with mock.patch("onedrive_offsite.utils.Config") as mock_config:
+            mock_config.upload_verify_hash = True
+            self.assertIsInstance(upload_quick_xor(), QuickXorHash)
+
+
+class TestUtilstarpartsize(unittest.TestCase):
+
+    def test_unit_matches_tarfile_stream(self):
+        member_sizes = [1, 511, 512, 513, 20000]
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode="w|") as tar:
+            for i, member_size in enumerate(member_sizes):
+                tarinfo = tarfile.TarInfo(str(i) + "_backup.crypt")
+                tarinfo.size = member_size
+                tarinfo.mtime = 1650000000
+                tar.addfile(tarinfo, io.BytesIO(b'a' * member_size))
+        self.assertEqual(tar_part_size(member_sizes), len(tar_bytes.getvalue()))
+
+    def test_unit_empty_archive(self):
+        self.assertEqual(tar_part_size([]), tarfile.RECORDSIZE)
+
+
+class TestUtilsfragmentqueuewriter(unittest.TestCase):
+
+    def test_unit_fragments_and_end_of_stream(self):
+        fragment_q = queue.Queue()
+        writer = FragmentQueueWriter(fragment_q, 4, threading.Event())
+        writer.write(b'abcdef')
+        writer.write(b'ghij')
+        writer.close()
+        fragments = []
+        while not fragment_q.empty():
+            fragments.append(fragment_q.get())
+        self.assertEqual(fragments, [b'abcd', b'efgh', b'ij', None])
+        self.assertEqual(writer.bytes_written, 10)
+
+    def test_unit_stop_event_set(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        writer = FragmentQueueWriter(queue.Queue(maxsize=1), 4, stop_event)
+        with self.assertRaises(IOError):
+            writer.write(b'abcdef')
 
 
 class TestUtilsessendemail(unittest.TestCase):
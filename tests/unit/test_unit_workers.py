@@ -1,8 +1,10 @@
-import unittest, mock, queue, datetime
+import unittest, mock, queue, datetime, os, threading, time
 
-from onedrive_offsite.workers import flood_kill_queue, upload_status_gen, write_to_error_q, publish_to_attempted_q, token_refresh_cycle, token_refresh_worker, _token_refresh_get_offset
+from onedrive_offsite.workers import flood_kill_queue, wait_for_kill, upload_status_gen, write_to_error_q, publish_to_attempted_q, token_refresh_cycle, token_refresh_worker, _token_refresh_get_offset
 from onedrive_offsite.workers import _check_token_read, _worker_upload, _worker_chunk_loop, _worker_start_upload_session, file_upload_worker, _prime_to_upload_q, _put_file_back_on_q
 from onedrive_offsite.workers import _evaluate_upload_mgmt, _empty_check, upload_manager, dir_manager, _lock_file_check, _write_to_lock_file, DownloadManager, DownloadWorker, DownloadDecrypter
+from onedrive_offsite.workers import stream_upload_worker, _stream_part, _stream_part_upload
+from onedrive_offsite.cancellation import cancel_token
 
 class TestHelpers(unittest.TestCase):
 #### ----------------------------------- write_to_error_q() -----------------------------------------------
@@ -54,6 +56,35 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual(kill_q.qsize(), 20)        # expecting 20 items in our kill queue
         self.assertEqual(kill_q.get(), "kill")      # expecting 'kill" in our kill queue
     
+#### ----------------------------------- wait_for_kill() -----------------------------------------------
+    def test_unit_wait_for_kill_times_out(self):
+        kill_q = queue.Queue()
+        self.assertEqual(wait_for_kill(kill_q, 0.01), False)
+
+    def test_unit_wait_for_kill_already_killed(self):
+        kill_q = queue.Queue()
+        kill_q.put("kill")
+        self.assertEqual(wait_for_kill(kill_q, 10), True)
+        self.assertEqual(kill_q.qsize(), 1)         # waiting doesn't take anything off the kill queue
+
+    def test_unit_wait_for_kill_wakes_on_flood(self):
+        kill_q = queue.Queue()
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(wait_for_kill(kill_q, 30))) for i in range(3)]
+        cancel_token.start()
+        try:
+            for waiter in waiters:
+                waiter.start()
+            start_time = time.monotonic()
+            flood_kill_queue(kill_q)
+            for waiter in waiters:
+                waiter.join()
+            self.assertEqual(results, [True, True, True])
+            self.assertLess(time.monotonic() - start_time, 5)
+            self.assertEqual(cancel_token.cancelled(), False)      # a flood without a reason only stops the job
+        finally:
+            cancel_token.finish()
+
 #### ----------------------------------- upload_status_gen() -----------------------------------------------
     def test_unit_upload_status_gen(self):
         check_value = upload_status_gen("testfilename", "teststatus", "testmsg")
@@ -186,7 +217,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
 #### ----------------------------------- token_refresh_worker() -----------------------------------------------
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=True)
     @mock.patch("onedrive_offsite.workers._lock_file_check", side_effect=[True, False])
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_write_lock_fail_token_refresh(self, mock_sleep, mock_lock, mock_write_lock):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -202,7 +233,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
     
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=True)
     @mock.patch("onedrive_offsite.workers._lock_file_check", side_effect=[True, False])
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_write_lock_fail_token_refresh_exceed_retry(self, mock_sleep, mock_lock, mock_write_lock):
          with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -227,7 +258,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
 
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", side_effect=[True, False])
     @mock.patch("onedrive_offsite.workers._lock_file_check", side_effect=[True, False])
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_write_lock_once_kill_q_not_empty_fail_write_lock(self, mock_sleep, mock_lock, mock_write_lock):
          with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -243,7 +274,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
 
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=True)
     @mock.patch("onedrive_offsite.workers._lock_file_check", side_effect=[True, False])
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_write_lock_no_token_refresh_needed_in_loop(self, mock_sleep, mock_lock, mock_write_lock):
          with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -266,7 +297,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
 
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=False)
     @mock.patch("onedrive_offsite.workers._lock_file_check", side_effect=[True, False])
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_fail_write_lock(self, mock_sleep, mock_lock, mock_write_lock):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -280,7 +311,7 @@ class TestTokenRefreshWorker(unittest.TestCase):
 
     @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=False)
     @mock.patch("onedrive_offsite.workers._lock_file_check", return_value=True)
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     def test_token_refresh_worker_lock_once_kill_q_not_empty(self, mock_sleep, mock_lock, mock_write_lock):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -292,6 +323,50 @@ class TestTokenRefreshWorker(unittest.TestCase):
             self.assertIs(check_value, None)
 
 
+    @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=True)
+    @mock.patch("onedrive_offsite.workers._lock_file_check", return_value=False)
+    def test_token_refresh_worker_sets_tokens_ready_after_refresh(self, mock_lock, mock_write_lock):
+        tokens_ready = threading.Event()
+        kill_q = queue.Queue()
+        mock_msgcm_ret = mock.Mock()
+        mock_msgcm_ret.expires = datetime.datetime(2022, 3, 30, 2, 0)
+        def refresh():
+            self.assertEqual(tokens_ready.is_set(), False)     # not ready until the first refresh is done
+            return mock_msgcm_ret
+        def ready_then_kill(kill_q, seconds):
+            self.assertEqual(tokens_ready.is_set(), True)
+            kill_q.put("kill")
+        with mock.patch("onedrive_offsite.workers.token_refresh_cycle", side_effect=refresh):
+            with mock.patch("onedrive_offsite.workers.wait_for_kill", side_effect=ready_then_kill) as mock_wait:
+                with mock.patch("onedrive_offsite.workers.datetime") as mock_datetime:
+                    mock_datetime.now.return_value = datetime.datetime(2022, 3, 30, 0, 0)
+                    check_value = token_refresh_worker(kill_q, queue.Queue(), tokens_ready)
+                    self.assertEqual(check_value, True)
+                    mock_wait.assert_called_once_with(kill_q, 60)
+
+    @mock.patch("onedrive_offsite.workers._write_to_lock_file", return_value=True)
+    @mock.patch("onedrive_offsite.workers._lock_file_check", return_value=False)
+    def test_token_refresh_worker_sets_tokens_ready_on_failure(self, mock_lock, mock_write_lock):
+        tokens_ready = threading.Event()
+        with mock.patch("onedrive_offsite.workers.token_refresh_cycle", return_value=False):
+            check_value = token_refresh_worker(queue.Queue(), queue.Queue(), tokens_ready)
+            self.assertEqual(check_value, False)
+            self.assertEqual(tokens_ready.is_set(), True)
+
+    @mock.patch("onedrive_offsite.workers._lock_file_check", return_value=True)
+    def test_token_refresh_worker_tokens_ready_while_locked(self, mock_lock):
+        # another process holds the lock and keeps the tokens fresh, so the other threads don't wait for it
+        tokens_ready = threading.Event()
+        kill_q = queue.Queue()
+        def check_ready(kill_q, seconds):
+            self.assertEqual(tokens_ready.is_set(), True)
+            kill_q.put("kill")
+        with mock.patch("onedrive_offsite.workers.wait_for_kill", side_effect=check_ready) as mock_wait:
+            check_value = token_refresh_worker(kill_q, queue.Queue(), tokens_ready)
+            self.assertIs(check_value, None)
+            mock_wait.assert_called_once_with(kill_q, 300)
+
+
 class TestFileUploadWorker(unittest.TestCase):
 
 #### ----------------------------------- _worker_upload() -----------------------------------------------
@@ -375,12 +450,22 @@ class TestFileUploadWorker(unittest.TestCase):
             check_value = _worker_upload(bytes_to_send, targz_file, chunks, fpr, upload_attempted_q, kill_q, odlu)
             self.assertEqual(check_value, "upload-failed")
 
+    def test_file_upload_worker_stops_on_none(self):
+        # None on the to upload queue means the manager is done, it is left there for the other workers
+        to_upload_q = queue.Queue()
+        to_upload_q.put(None)
+        kill_q = queue.Queue()
+        with mock.patch("onedrive_offsite.workers.OneDriveLargeUpload") as mock_odlu:
+            file_upload_worker(to_upload_q, queue.Queue(), kill_q)
+            mock_odlu.assert_not_called()
+            self.assertEqual(to_upload_q.get_nowait(), None)
+
 #### ----------------------------------- _worker_chunk_loop() -----------------------------------------------
     def test_worker_chunk_loop_upload_failed(self):
         with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-failed") as mock_work_up:
             fpr = mock.Mock()
             fpr.upload_array = [[1, 2]]
-            fpr.read_file_bytes = mock.PropertyMock(return_value=b'bytestosend')
+            fpr.range_reader = mock.PropertyMock(return_value=b'bytestosend')
             odlu = mock.Mock()
             targz_file = "faketargzfile"
             upload_attempted_q = queue.Queue()
@@ -392,7 +477,7 @@ class TestFileUploadWorker(unittest.TestCase):
     def test_worker_chunk_loop_kill_q(self):
         fpr = mock.Mock()
         fpr.upload_array = [[1, 2]]
-        fpr.read_file_bytes = mock.PropertyMock(return_value=b'bytestosend')
+        fpr.range_reader = mock.PropertyMock(return_value=b'bytestosend')
         odlu = mock.Mock()
         targz_file = "faketargzfile"
         upload_attempted_q = queue.Queue()
@@ -406,7 +491,8 @@ class TestFileUploadWorker(unittest.TestCase):
         with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
             fpr = mock.Mock()
             fpr.upload_array = [[1, 2]]
-            fpr.read_file_bytes = mock.PropertyMock(return_value=b'bytestosend')
+            reader = mock.Mock()
+            fpr.range_reader = mock.PropertyMock(return_value=reader)
             odlu = mock.Mock()
             targz_file = "faketargzfile"
             upload_attempted_q = queue.Queue()
@@ -414,6 +500,76 @@ class TestFileUploadWorker(unittest.TestCase):
 
             check_value = _worker_chunk_loop(fpr, targz_file, upload_attempted_q, kill_q, odlu)
             self.assertEqual(check_value, "upload-success")
+            reader.finish_hash.assert_called_once()
+            odlu.verify_upload.assert_called_once_with(fpr.upload_hash.return_value)
+
+    def test_worker_chunk_loop_hash_mismatch(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            with mock.patch("onedrive_offsite.workers.publish_to_attempted_q") as mock_pub_att_q:
+                fpr = mock.Mock()
+                fpr.upload_array = [[1, 2]]
+                odlu = mock.Mock()
+                odlu.verify_upload.return_value = False
+
+                check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), odlu)
+                self.assertEqual(check_value, "upload-failed")
+                self.assertEqual(mock_pub_att_q.call_args[0][0].get("status"), "error")
+
+    def test_worker_chunk_loop_finish_hash_failed(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            with mock.patch("onedrive_offsite.workers.publish_to_attempted_q") as mock_pub_att_q:
+                fpr = mock.Mock()
+                fpr.upload_array = [[1, 2]]
+                fpr.range_reader.return_value.finish_hash.return_value = False
+                odlu = mock.Mock()
+
+                check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), odlu)
+                self.assertEqual(check_value, "upload-failed")
+                self.assertEqual(mock_pub_att_q.call_args[0][0].get("status"), "error")
+                odlu.verify_upload.assert_not_called()
+
+    def test_worker_chunk_loop_not_verified(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            fpr = mock.Mock()
+            fpr.upload_array = [[1, 2]]
+            fpr.quick_xor = None
+            odlu = mock.Mock()
+
+            check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), odlu)
+            self.assertEqual(check_value, "upload-success")
+            odlu.verify_upload.assert_not_called()
+
+    def test_worker_chunk_loop_prefetches_next_fragments(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            with mock.patch("onedrive_offsite.workers.Config") as mock_config:
+                mock_config.upload_prefetch_depth = 2
+                mock_config.upload_prefetch_max_mb = 64
+                fpr = mock.Mock()
+                fpr.upload_array = [[1, 2], [3, 4]]
+                check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), mock.Mock())
+                self.assertEqual(check_value, "upload-success")
+                self.assertEqual(fpr.prefetch_fragments.call_args_list, [mock.call(0, 2, 64000000), mock.call(1, 2, 64000000)])
+
+    def test_worker_chunk_loop_records_fragments(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            fpr = mock.Mock()
+            fpr.upload_array = [[1, 2], [3, 4]]
+            check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), mock.Mock())
+            self.assertEqual(check_value, "upload-success")
+            self.assertEqual([call[0][0] for call in fpr.record_fragment.call_args_list], [0, 1])
+
+    def test_worker_chunk_loop_uploads_replanned_fragments(self):
+        # record_fragment() replacing the rest of upload_array is picked up by the loop
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            fpr = mock.Mock()
+            fpr.upload_array = [[1, 0], [1, 1]]
+            def replan(index, seconds):
+                if index == 0:
+                    fpr.upload_array[1:] = [[2, 1], [2, 3], [1, 5]]
+            fpr.record_fragment.side_effect = replan
+            check_value = _worker_chunk_loop(fpr, "faketargzfile", queue.Queue(), queue.Queue(), mock.Mock())
+            self.assertEqual(check_value, "upload-success")
+            self.assertEqual([call[0][2] for call in mock_work_up.call_args_list], [[1, 0], [2, 1], [2, 3], [1, 5]])
 
 #### ----------------------------------- _worker_start_upload_session() -----------------------------------------------
     def test_worker_start_upload_session_fail(self):
@@ -423,7 +579,7 @@ class TestFileUploadWorker(unittest.TestCase):
                 mock_up_stat_gen.return_value = "fake queue message"
                 with mock.patch("onedrive_offsite.workers.publish_to_attempted_q") as mock_pub_att_q:
                     odlu = mock.Mock()
-                    odlu.initiate_upload_session = mock.PropertyMock(return_value=False)        
+                    odlu.open_upload_session = mock.PropertyMock(return_value=False)        
                     msgcm = mock.Mock()
                     msgcm.access_token = "fakeaccesstoken"
                     targz_file = "faketargzfile"
@@ -437,7 +593,7 @@ class TestFileUploadWorker(unittest.TestCase):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
             odlu = mock.Mock()
-            odlu.initiate_upload_session = mock.PropertyMock(return_value=True)        
+            odlu.open_upload_session = mock.PropertyMock(return_value=True)        
             msgcm = mock.Mock()
             msgcm.access_token = "fakeaccesstoken"
             targz_file = "faketargzfile"
@@ -464,13 +620,40 @@ class TestFileUploadWorker(unittest.TestCase):
                                 kill_q.get_nowait = mock.PropertyMock(return_value="kill")
 
                                 to_upload_q = mock.Mock()
-                                to_upload_q.get_nowait = mock.PropertyMock(return_value="faketargzfile")
+                                to_upload_q.get = mock.PropertyMock(return_value="faketargzfile")
 
                                 upload_attempted_q = queue.Queue()
 
                                 check_value = file_upload_worker(to_upload_q, upload_attempted_q, kill_q)
                                 self.assertEqual(check_value, "token-read-fail")
 
+    def test_file_upload_worker_waits_for_slot(self):
+        with mock.patch("onedrive_offsite.workers.upload_controller") as mock_controller:
+            mock_controller.acquire.return_value = False      # the controller has no free slot
+            kill_q = mock.Mock()
+            kill_q.empty = mock.PropertyMock(side_effect=[True, False])
+            kill_q.get_nowait = mock.PropertyMock(return_value="kill")
+            to_upload_q = mock.Mock()
+
+            file_upload_worker(to_upload_q, queue.Queue(), kill_q)
+            to_upload_q.get.assert_not_called()
+            mock_controller.release.assert_not_called()
+
+    def test_file_upload_worker_releases_slot(self):
+        with mock.patch("onedrive_offsite.workers.upload_controller") as mock_controller:
+            with mock.patch("onedrive_offsite.workers.OneDriveLargeUpload") as mock_odlu:
+                with mock.patch("onedrive_offsite.workers.MSGraphCredMgr") as mock_msgcm:
+                    with mock.patch("onedrive_offsite.workers._check_token_read", return_value=False) as mock_ch_tok_rd:
+                        mock_controller.acquire.return_value = True
+                        kill_q = mock.Mock()
+                        kill_q.empty = mock.PropertyMock(side_effect=[True, False])
+                        kill_q.get_nowait = mock.PropertyMock(return_value="kill")
+                        to_upload_q = mock.Mock()
+                        to_upload_q.get = mock.PropertyMock(return_value="faketargzfile")
+
+                        file_upload_worker(to_upload_q, queue.Queue(), kill_q)
+                        mock_controller.release.assert_called_once()
+
     def test_file_upload_worker_cant_start_upload(self):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
@@ -487,7 +670,7 @@ class TestFileUploadWorker(unittest.TestCase):
                                     kill_q.get_nowait = mock.PropertyMock(return_value="kill")
 
                                     to_upload_q = mock.Mock()
-                                    to_upload_q.get_nowait = mock.PropertyMock(return_value="faketargzfile")
+                                    to_upload_q.get = mock.PropertyMock(return_value="faketargzfile")
 
                                     upload_attempted_q = queue.Queue()
 
@@ -514,7 +697,7 @@ class TestFileUploadWorker(unittest.TestCase):
                                                     kill_q.get_nowait = mock.PropertyMock(return_value="kill")
 
                                                     to_upload_q = mock.Mock()
-                                                    to_upload_q.get_nowait = mock.PropertyMock(return_value="faketargzfile")
+                                                    to_upload_q.get = mock.PropertyMock(return_value="faketargzfile")
 
                                                     upload_attempted_q = queue.Queue()
 
@@ -539,7 +722,7 @@ class TestFileUploadWorker(unittest.TestCase):
                                             kill_q.get_nowait = mock.PropertyMock(return_value="kill")
 
                                             to_upload_q = mock.Mock()
-                                            to_upload_q.get_nowait = mock.PropertyMock(return_value="faketargzfile")
+                                            to_upload_q.get = mock.PropertyMock(return_value="faketargzfile")
 
                                             upload_attempted_q = queue.Queue()
 
@@ -551,7 +734,7 @@ class TestFileUploadWorker(unittest.TestCase):
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.workers.datetime") as mock_datetime:
                 mock_datetime.now.side_effect = [datetime.datetime(2022, 3, 30, 0, 0), datetime.datetime(2022, 3, 30, 0, 0), datetime.datetime(2022, 3, 30, 1, 59), datetime.datetime(2022, 3, 30, 2, 0), datetime.datetime(2022, 3, 30, 4, 1)] # 2nd time through loop q will be empty for should be 2 hrs 1 min 
-                with mock.patch("onedrive_offsite.workers.sleep", return_value=None) as mock_sleep:
+                with mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False) as mock_sleep:
                     with mock.patch("onedrive_offsite.workers.flood_kill_queue") as mock_flood_kill:
                         
                         kill_q = mock.Mock()
@@ -559,7 +742,7 @@ class TestFileUploadWorker(unittest.TestCase):
                         kill_q.get_nowait = mock.PropertyMock(side_effect=queue.Empty)
 
                         to_upload_q = mock.Mock()
-                        to_upload_q.get_nowait = mock.PropertyMock(side_effect=[queue.Empty, queue.Empty]) # to upload q empty
+                        to_upload_q.get = mock.PropertyMock(side_effect=[queue.Empty, queue.Empty]) # to upload q empty
 
                         upload_attempted_q = queue.Queue()
 
@@ -694,7 +877,7 @@ class TestFileUploadManager(unittest.TestCase):
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.workers.datetime") as mock_datetime: 
                 mock_datetime.now.return_value = datetime.datetime(2022, 3, 1, 3, 0) # mock 3AM
-                with mock.patch("onedrive_offsite.workers.sleep", return_value=None) as mock_sleep:
+                with mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False) as mock_sleep:
                     start_time = datetime.datetime(2022, 3, 1, 0, 0) # set start time to midnight
                     kill_q = queue.Queue()
                     error_q = queue.Queue()
@@ -746,7 +929,7 @@ class TestFileUploadManager(unittest.TestCase):
                         kill_q.empty = mock.PropertyMock(side_effect=[True])
 
                         upload_attempted_q = mock.Mock()
-                        upload_attempted_q.get_nowait = mock.PropertyMock(side_effect=[queue.Empty])
+                        upload_attempted_q.get = mock.PropertyMock(side_effect=[queue.Empty])
 
                         file_list = ["file1", "file2", "file3"]
                         to_upload_q = queue.Queue()                
@@ -771,7 +954,7 @@ class TestFileUploadManager(unittest.TestCase):
                         kill_q.empty = mock.PropertyMock(side_effect=[True])
 
                         upload_attempted_q = mock.Mock()
-                        upload_attempted_q.get_nowait = mock.PropertyMock(return_value={"filename": "file1", "status": "error", "msg": "fake err msg"})
+                        upload_attempted_q.get = mock.PropertyMock(return_value={"filename": "file1", "status": "error", "msg": "fake err msg"})
 
                         file_list = ["file1", "file2", "file3"]
                         to_upload_q = queue.Queue()                
@@ -796,7 +979,7 @@ class TestFileUploadManager(unittest.TestCase):
                         kill_q.empty = mock.PropertyMock(side_effect=[True])
 
                         upload_attempted_q = mock.Mock()
-                        upload_attempted_q.get_nowait = mock.PropertyMock(return_value={"filename": "file1", "status": "complete", "msg": "fake comlete msg"})
+                        upload_attempted_q.get = mock.PropertyMock(return_value={"filename": "file1", "status": "complete", "msg": "fake comlete msg"})
 
                         file_list = ["file1", "file2", "file3"]
                         to_upload_q = queue.Queue()                
@@ -822,7 +1005,7 @@ class TestFileUploadManager(unittest.TestCase):
                             kill_q.empty = mock.PropertyMock(side_effect=[True])
 
                             upload_attempted_q = mock.Mock()
-                            upload_attempted_q.get_nowait = mock.PropertyMock(return_value={"filename": "file1", "status": "error", "msg": "fake err msg"})
+                            upload_attempted_q.get = mock.PropertyMock(return_value={"filename": "file1", "status": "error", "msg": "fake err msg"})
 
                             file_list = ["file1", "file2", "file3"]
                             to_upload_q = queue.Queue()                
@@ -856,6 +1039,100 @@ class TestFileUploadManager(unittest.TestCase):
                     self.assertEqual(check_value, False)
 
 
+class TestStreamUploadWorker(unittest.TestCase):
+
+#### ----------------------------------- _stream_part_upload() -----------------------------------------------
+    def test_stream_part_upload_success(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            fpr = mock.Mock()
+            fpr.upload_array = [[4, 0, "0-3"], [2, 4, "4-5"]]
+            fragment_q = queue.Queue()
+            fragment_q.put(b'abcd')
+            fragment_q.put(b'ef')
+            check_value = _stream_part_upload(mock.Mock(), fpr, "fakepart", fragment_q, queue.Queue(), mock.Mock())
+            self.assertEqual(check_value, "upload-success")
+            self.assertEqual(mock_work_up.call_count, 2)
+
+    def test_stream_part_upload_wrong_fragment_size(self):
+        with mock.patch("onedrive_offsite.workers._worker_upload", return_value="upload-succeeded") as mock_work_up:
+            fpr = mock.Mock()
+            fpr.upload_array = [[4, 0, "0-3"]]
+            fragment_q = queue.Queue()
+            fragment_q.put(b'abc')
+            odlu = mock.Mock()
+            check_value = _stream_part_upload(odlu, fpr, "fakepart", fragment_q, queue.Queue(), mock.Mock())
+            self.assertEqual(check_value, "upload-failed")
+            self.assertEqual(odlu.cancel_upload_session.call_count, 1)
+
+    def test_stream_part_upload_producer_error(self):
+        fpr = mock.Mock()
+        fpr.upload_array = [[4, 0, "0-3"]]
+        fragment_q = queue.Queue()
+        fragment_q.put(False)
+        odlu = mock.Mock()
+        check_value = _stream_part_upload(odlu, fpr, "fakepart", fragment_q, queue.Queue(), mock.Mock())
+        self.assertEqual(check_value, "upload-failed")
+
+    def test_stream_part_upload_kill_q(self):
+        fpr = mock.Mock()
+        fpr.upload_array = [[4, 0, "0-3"]]
+        kill_q = queue.Queue()
+        kill_q.put("kill")
+        check_value = _stream_part_upload(mock.Mock(), fpr, "fakepart", queue.Queue(), kill_q, mock.Mock())
+        self.assertEqual(check_value, "kill-q")
+
+#### ----------------------------------- _stream_part() -----------------------------------------------
+    def test_stream_part_cant_read_tokens(self):
+        with mock.patch("onedrive_offsite.workers.OneDriveLargeUpload") as mock_odlu:
+            with mock.patch("onedrive_offsite.workers.MSGraphCredMgr") as mock_msgcm:
+                mock_msgcm.return_value.read_tokens.return_value = False
+                check_value = _stream_part(mock.Mock(), "fake/backup/path", {"name": "fakepart"}, mock.Mock(), queue.Queue())
+                self.assertEqual(check_value, "upload-failed")
+
+    def test_stream_part_cant_start_session(self):
+        with mock.patch("onedrive_offsite.workers.OneDriveLargeUpload") as mock_odlu:
+            with mock.patch("onedrive_offsite.workers.MSGraphCredMgr") as mock_msgcm:
+                mock_odlu.return_value.initiate_upload_session.return_value = False
+                check_value = _stream_part(mock.Mock(), "fake/backup/path", {"name": "fakepart"}, mock.Mock(), queue.Queue())
+                self.assertEqual(check_value, "upload-failed")
+
+#### ----------------------------------- stream_upload_worker() -----------------------------------------------
+    @mock.patch("onedrive_offsite.workers.Crypt")
+    def test_stream_upload_worker_fetch_key_fail(self, mock_crypt):
+        mock_crypt.return_value.fetch_key.return_value = False
+        kill_q = queue.Queue()
+        error_q = queue.Queue()
+        check_value = stream_upload_worker("fake/backup/path", [{"name": "fakepart"}], mock.Mock(), kill_q, error_q)
+        self.assertEqual(check_value, False)
+        self.assertFalse(kill_q.empty())
+        self.assertFalse(error_q.empty())
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    @mock.patch("onedrive_offsite.workers.Crypt")
+    def test_stream_upload_worker_too_many_retries(self, mock_crypt, mock_config):
+        mock_config.stream_part_retries = 2
+        with mock.patch("onedrive_offsite.workers._stream_part", return_value="upload-failed") as mock_stream_part:
+            kill_q = queue.Queue()
+            error_q = queue.Queue()
+            check_value = stream_upload_worker("fake/backup/path", [{"name": "fakepart"}], mock.Mock(), kill_q, error_q)
+            self.assertEqual(check_value, False)
+            self.assertEqual(mock_stream_part.call_count, 3)
+            self.assertFalse(error_q.empty())
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    @mock.patch("onedrive_offsite.workers.Crypt")
+    def test_stream_upload_worker_retry_then_success(self, mock_crypt, mock_config):
+        mock_config.stream_part_retries = 2
+        with mock.patch("onedrive_offsite.workers._stream_part", side_effect=["upload-failed", "upload-success", "upload-success"]) as mock_stream_part:
+            kill_q = queue.Queue()
+            error_q = queue.Queue()
+            check_value = stream_upload_worker("fake/backup/path", [{"name": "fakepart1"}, {"name": "fakepart2"}], mock.Mock(), kill_q, error_q)
+            self.assertEqual(check_value, True)
+            self.assertEqual(mock_stream_part.call_count, 3)
+            self.assertTrue(error_q.empty())
+            self.assertFalse(kill_q.empty())
+
+
 class TestDirManager(unittest.TestCase):
 
 ### -------------------------------------- dir_manager() ---------------------------------------
@@ -865,7 +1142,7 @@ class TestDirManager(unittest.TestCase):
         with mock.patch("onedrive_offsite.workers.threading.current_thread") as mock_curr_thread:
             mock_curr_thread.return_value.getName.return_value = "fake-thread"
             with mock.patch("onedrive_offsite.workers.MSGraphCredMgr") as mock_msgrcrmgr:
-                with mock.patch("onedrive_offsite.onedrive.sleep", return_value = None) as mock_sleep:
+                with mock.patch("onedrive_offsite.onedrive._retry_wait", return_value=True) as mock_sleep:
                     mock_msgrcrmgr.return_value.read_tokens.return_value = False
 
                     kill_q = queue.Queue()
@@ -1050,6 +1327,64 @@ class TestDownloadManager(unittest.TestCase):
                     check_val = DownloadManager._get_download_list()
                     self.assertEqual(check_val, [{"id": "id1", "name": "name1"}, {"id": "id2", "name": "name2"}])
 
+    @mock.patch("onedrive_offsite.workers.threading.current_thread")
+    def test_unit_get_download_list_dedup_manifest(self, mock_curr_thread):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        file_list = [{"id": "id1", "name": "fake-dir_001_backup.tar"}, {"id": "id2", "name": "fake-dir_manifest.crypt"}]
+        with mock.patch("onedrive_offsite.workers.DownloadManager._get_download_info", return_value={"onedrive-dir": "fake-dir"}) as mock_get_dl_list:
+            with mock.patch("onedrive_offsite.workers.MSGraphCredMgr") as mock_msgcm:
+                mock_msgcm.return_value.read_tokens.return_value = True
+                with mock.patch("onedrive_offsite.workers.OneDriveItemGetter") as mock_odig:
+                    mock_odig.return_value.get_dir_items.return_value = file_list
+                    with mock.patch("onedrive_offsite.workers.DownloadManager._get_dedup_download_list", return_value=["fake-list"]) as mock_dedup_list:
+                        check_val = DownloadManager._get_download_list()
+                        self.assertEqual(check_val, ["fake-list"])
+                        mock_dedup_list.assert_called_with(file_list[1], "fake-dir", file_list, mock_msgcm.return_value.access_token)
+
+
+### -------------------------------------- _get_dedup_download_list() ---------------------------------------
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_get_dedup_download_list_parts_from_two_dirs(self, mock_config):
+        mock_config.download_dir = "fake/download/dir"
+        file_list = [{"id": "id1", "name": "new-dir_001_backup.tar"}, {"id": "id2", "name": "new-dir_manifest.crypt"}]
+        manifest = {"chunks": [["a", 1, "old-dir", "old-dir_001_backup.tar"], ["b", 1, "new-dir", "new-dir_001_backup.tar"]]}
+        with mock.patch("onedrive_offsite.workers.OneDriveGetItemDetails.get_details", return_value={"download_url": "fake-url"}) as mock_details:
+            with mock.patch("onedrive_offsite.workers.OneDriveFileDownloadMgr") as mock_odfdm:
+                mock_odfdm.return_value.download_file.return_value = True
+                with mock.patch("onedrive_offsite.workers.read_manifest", return_value=manifest) as mock_read_manifest:
+                    with mock.patch("onedrive_offsite.workers.Crypt") as mock_crypt:
+                        with mock.patch("onedrive_offsite.workers.OneDriveItemGetter") as mock_odig:
+                            mock_odig.return_value.get_dir_items.return_value = [{"id": "id3", "name": "old-dir_001_backup.tar"}]
+                            check_val = DownloadManager._get_dedup_download_list(file_list[1], "new-dir", file_list, "fake-token")
+                            self.assertEqual(check_val, [{"id": "id3", "name": "old-dir_001_backup.tar"}, {"id": "id1", "name": "new-dir_001_backup.tar"}])
+                            mock_odig.assert_called_once_with("fake-token", "old-dir")
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_get_dedup_download_list_missing_part(self, mock_config):
+        mock_config.download_dir = "fake/download/dir"
+        file_list = [{"id": "id2", "name": "new-dir_manifest.crypt"}]
+        manifest = {"chunks": [["b", 1, "new-dir", "new-dir_001_backup.tar"]]}
+        with mock.patch("onedrive_offsite.workers.OneDriveGetItemDetails.get_details", return_value={"download_url": "fake-url"}) as mock_details:
+            with mock.patch("onedrive_offsite.workers.OneDriveFileDownloadMgr") as mock_odfdm:
+                mock_odfdm.return_value.download_file.return_value = True
+                with mock.patch("onedrive_offsite.workers.read_manifest", return_value=manifest) as mock_read_manifest:
+                    with mock.patch("onedrive_offsite.workers.Crypt") as mock_crypt:
+                        check_val = DownloadManager._get_dedup_download_list(file_list[0], "new-dir", file_list, "fake-token")
+                        self.assertIs(check_val, None)
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_get_dedup_download_list_manifest_download_fail(self, mock_config):
+        mock_config.download_dir = "fake/download/dir"
+        file_list = [{"id": "id2", "name": "new-dir_manifest.crypt"}]
+        with mock.patch("onedrive_offsite.workers.OneDriveGetItemDetails.get_details", return_value={"download_url": "fake-url"}) as mock_details:
+            with mock.patch("onedrive_offsite.workers.OneDriveFileDownloadMgr") as mock_odfdm:
+                mock_odfdm.return_value.download_file.return_value = None
+                with mock.patch("onedrive_offsite.workers.read_manifest") as mock_read_manifest:
+                    check_val = DownloadManager._get_dedup_download_list(file_list[0], "new-dir", file_list, "fake-token")
+                    self.assertIs(check_val, None)
+                    self.assertEqual(mock_read_manifest.call_count, 0)
+
 
 ### -------------------------------------- _put_file_back_on_q() ---------------------------------------
 
@@ -1231,7 +1566,7 @@ class TestDownloadManager(unittest.TestCase):
 
                         to_download_q = mock.Mock()
                         download_attempted_q = mock.Mock()
-                        download_attempted_q.get_nowait.side_effect = queue.Empty
+                        download_attempted_q.get.side_effect = queue.Empty
                         kill_q = mock.Mock()
                         kill_q.empty.return_value = True
                         error_q = mock.Mock()
@@ -1251,7 +1586,7 @@ class TestDownloadManager(unittest.TestCase):
 
                         to_download_q = mock.Mock()
                         download_attempted_q = mock.Mock()
-                        download_attempted_q.get_nowait = mock.PropertyMock(return_value = {"id":"id1","name":"name1","status":"error"})
+                        download_attempted_q.get = mock.PropertyMock(return_value = {"id":"id1","name":"name1","status":"error"})
                         kill_q = mock.Mock()
                         kill_q.empty.return_value = True
                         error_q = queue.Queue()
@@ -1272,7 +1607,7 @@ class TestDownloadManager(unittest.TestCase):
 
                         to_download_q = mock.Mock()
                         download_attempted_q = mock.Mock()
-                        download_attempted_q.get_nowait = mock.PropertyMock(return_value = {"id":"id1","name":"name1","status":"complete"})
+                        download_attempted_q.get = mock.PropertyMock(return_value = {"id":"id1","name":"name1","status":"complete"})
                         kill_q = mock.Mock()
                         kill_q.empty.return_value = True
                         error_q = queue.Queue()
@@ -1363,7 +1698,7 @@ class TestDownloadWorker(unittest.TestCase):
     @mock.patch("onedrive_offsite.workers.threading.current_thread")
     def test_unit_remove_failed_download_file_removed(self, mock_curr_thread, mock_config, mock_join):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.workers.os.path.isfile", return_value=True) as mock_isfile:
+        with mock.patch("onedrive_offsite.workers.os.path.isfile", side_effect=[False, True]) as mock_isfile:     # no progress record, file exists
             with mock.patch("onedrive_offsite.workers.os.remove", return_value=True) as mock_rm:
         
                 kill_q = mock.Mock()
@@ -1380,7 +1715,7 @@ class TestDownloadWorker(unittest.TestCase):
     @mock.patch("onedrive_offsite.workers.threading.current_thread")
     def test_unit_remove_failed_download_file_remove_except(self, mock_curr_thread, mock_config, mock_join, mock_flood, mock_wr_err):
         mock_curr_thread.return_value.getName.return_value = "fake-thread"
-        with mock.patch("onedrive_offsite.workers.os.path.isfile", return_value=True) as mock_isfile:
+        with mock.patch("onedrive_offsite.workers.os.path.isfile", side_effect=[False, True]) as mock_isfile:
             with mock.patch("onedrive_offsite.workers.os.remove", side_effect=Exception("fake exception")) as mock_rm:
         
                 kill_q = mock.Mock()
@@ -1390,6 +1725,18 @@ class TestDownloadWorker(unittest.TestCase):
                 check_val = DownloadWorker._remove_failed_download(file_name, kill_q, error_q)
                 self.assertIs(check_val, None)
 
+    @mock.patch("onedrive_offsite.workers.Config")
+    @mock.patch("onedrive_offsite.workers.threading.current_thread")
+    def test_unit_remove_failed_download_keeps_resumable(self, mock_curr_thread, mock_config):
+        mock_curr_thread.return_value.getName.return_value = "fake-thread"
+        mock_config.download_dir = "fake/download/dir"
+        with mock.patch("onedrive_offsite.workers.os.path.isfile", return_value=True) as mock_isfile:
+            with mock.patch("onedrive_offsite.workers.os.remove") as mock_rm:
+                check_val = DownloadWorker._remove_failed_download("fake-file-name", mock.Mock(), mock.Mock())
+                self.assertIs(check_val, True)
+                self.assertEqual(mock_isfile.call_args_list[0], mock.call("fake/download/dir/fake-file-name.progress"))
+                mock_rm.assert_not_called()
+
 
 ### -------------------------------------- download_worker() ---------------------------------------
 
@@ -1405,13 +1752,22 @@ class TestDownloadWorker(unittest.TestCase):
             kill_q.get_nowait.return_value = "kill"
 
             to_download_q = mock.Mock()
-            to_download_q.get_nowait.return_value = {"id":"id1","name":"name1"}
+            to_download_q.get.return_value = {"id":"id1","name":"name1"}
             download_attempted_q = mock.Mock()
             error_q = mock.Mock()
 
             check_val = DownloadWorker.download_worker(to_download_q, download_attempted_q, kill_q, error_q)
             self.assertIs(check_val, None)
 
+    def test_unit_download_worker_stops_on_none(self):
+        to_download_q = queue.Queue()
+        to_download_q.put(None)
+        with mock.patch("onedrive_offsite.workers.OneDriveGetItemDetails") as mock_odgid:
+            check_val = DownloadWorker.download_worker(to_download_q, queue.Queue(), queue.Queue(), queue.Queue())
+            self.assertIs(check_val, None)
+            mock_odgid.get_details.assert_not_called()
+            self.assertEqual(to_download_q.get_nowait(), None)
+
     @mock.patch("onedrive_offsite.workers.flood_kill_queue")
     @mock.patch("onedrive_offsite.workers.threading.current_thread")
     def test_unit_download_worker_download_success(self, mock_curr_thread, mock_flood):
@@ -1431,7 +1787,7 @@ class TestDownloadWorker(unittest.TestCase):
                                 kill_q.get_nowait.return_value = "kill"
 
                                 to_download_q = mock.Mock()
-                                to_download_q.get_nowait.return_value = {"id":"id1","name":"name1"}
+                                to_download_q.get.return_value = {"id":"id1","name":"name1"}
                                 download_attempted_q = mock.Mock()
                                 error_q = mock.Mock()
 
@@ -1459,14 +1815,14 @@ class TestDownloadWorker(unittest.TestCase):
                                     kill_q.get_nowait.return_value = "kill"
 
                                     to_download_q = mock.Mock()
-                                    to_download_q.get_nowait.return_value = {"id":"id1","name":"name1"}
+                                    to_download_q.get.return_value = {"id":"id1","name":"name1"}
                                     download_attempted_q = mock.Mock()
                                     error_q = mock.Mock()
 
                                     check_val = DownloadWorker.download_worker(to_download_q, download_attempted_q, kill_q, error_q)
                                     self.assertIs(check_val, None)
 
-    @mock.patch("onedrive_offsite.workers.sleep", return_value=None)
+    @mock.patch("onedrive_offsite.workers.wait_for_kill", return_value=False)
     @mock.patch("onedrive_offsite.workers.flood_kill_queue")
     @mock.patch("onedrive_offsite.workers.threading.current_thread")
     def test_unit_download_worker_to_download_emtpy_too_long(self, mock_curr_thread, mock_flood, mock_sleep):
@@ -1479,7 +1835,7 @@ class TestDownloadWorker(unittest.TestCase):
             kill_q.get_nowait.side_effect = queue.Empty
 
             to_download_q = mock.Mock()
-            to_download_q.get_nowait.side_effect = queue.Empty
+            to_download_q.get.side_effect = queue.Empty
             download_attempted_q = mock.Mock()
             error_q = mock.Mock()
 
@@ -1506,6 +1862,11 @@ class TestDownloadDecrypter(unittest.TestCase):
             check_val = DownloadDecrypter._get_downloaded_gz_files()
             self.assertEqual(check_val, ["file1","file2"])
 
+    def test_unit_get_download_gz_files_skips_progress(self):
+        with mock.patch("onedrive_offsite.workers.os.listdir", return_value=["file2", "file1", "file2.progress", "file2.progress.tmp"]) as mock_listdir:
+            check_val = DownloadDecrypter._get_downloaded_gz_files()
+            self.assertEqual(check_val, ["file1","file2"])
+
     ### -------------------------------------- _extract_tar_gzs() ---------------------------------------
     def test_unit_extract_tar_gzs_extract_fail(self):
         with mock.patch("onedrive_offsite.workers.os.path.join") as mock_join:
@@ -1610,6 +1971,43 @@ class TestDownloadDecrypter(unittest.TestCase):
                         check_val = DownloadDecrypter._verify_hash()
                         self.assertIs(check_val, True)
 
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_verify_hash_download_hash_provided(self, mock_config):
+        with mock.patch("onedrive_offsite.workers.open") as mock_open:
+            with mock.patch("onedrive_offsite.workers.json.load", return_value={"onedrive-dir":"fake-dir"}) as mock_json_load:
+                with mock.patch("onedrive_offsite.workers.DownloadDecrypter._fetch_hash", return_value="fake-hash") as mock_fetch_hash:
+                    with mock.patch("onedrive_offsite.workers.Sha256Calc") as mock_sha256calc:
+                        check_val = DownloadDecrypter._verify_hash("fake-hash")
+                        self.assertIs(check_val, True)
+                        mock_sha256calc.assert_not_called()
+
+### -------------------------------------- _stream_decrypt() ---------------------------------------
+    def test_unit_stream_decrypt_no_restore_path(self):
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_restore_file_path", return_value=None) as mock_restore_path:
+            check_val = DownloadDecrypter._stream_decrypt(["file1"])
+            self.assertIs(check_val, None)
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_stream_decrypt_success(self, mock_config):
+        mock_config.download_dir = "fake/download/dir"
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_restore_file_path", return_value="fake/restore.vma.zst") as mock_restore_path:
+            with mock.patch("onedrive_offsite.workers.Crypt") as mock_crypt:
+                with mock.patch("onedrive_offsite.workers.ChunkSha256") as mock_chunk_hash:
+                    mock_crypt.return_value.chunk_decrypt_tars.return_value = True
+                    mock_chunk_hash.return_value.hexdigest.return_value = "fake-hash"
+                    check_val = DownloadDecrypter._stream_decrypt(["file1", "file2"])
+                    self.assertEqual(check_val, "fake-hash")
+                    mock_crypt.return_value.chunk_decrypt_tars.assert_called_with([os.path.join("fake/download/dir", "file1"), os.path.join("fake/download/dir", "file2")],
+                                                                                    "fake/restore.vma.zst", chunk_hash=mock_chunk_hash.return_value, removetars=True,
+                                                                                    workers=mock_config.crypt_workers, max_in_flight=mock_config.crypt_max_in_flight)
+
+    def test_unit_stream_decrypt_fail(self):
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_restore_file_path", return_value="fake/restore.vma.zst") as mock_restore_path:
+            with mock.patch("onedrive_offsite.workers.Crypt") as mock_crypt:
+                mock_crypt.return_value.chunk_decrypt_tars.return_value = False
+                check_val = DownloadDecrypter._stream_decrypt(["file1"])
+                self.assertIs(check_val, None)
+
 
 ### -------------------------------------- decrypt_and_combine() ---------------------------------------
 
@@ -1645,4 +2043,56 @@ class TestDownloadDecrypter(unittest.TestCase):
             with mock.patch("onedrive_offsite.workers.DownloadDecrypter._extract_tar_gzs", return_value=True) as mock_extract:
                 with mock.patch("onedrive_offsite.workers.DownloadDecrypter._decrypt", return_value=False) as mock_decrypt:
                     check_val = DownloadDecrypter.decrypt_and_combine()
-                    self.assertIs(check_val, None)
\ No newline at end of file
+                    self.assertIs(check_val, None)
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_decrypt_and_combine_stream_hash_verified(self, mock_config):
+        mock_config.stream_restore = True
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_downloaded_gz_files", return_value=["file1", "file2"]) as mock_get_dl_files:
+            with mock.patch("onedrive_offsite.workers.DownloadDecrypter._stream_decrypt", return_value="fake-hash") as mock_stream_decrypt:
+                with mock.patch("onedrive_offsite.workers.DownloadDecrypter._extract_tar_gzs") as mock_extract:
+                    with mock.patch("onedrive_offsite.workers.DownloadDecrypter._verify_hash", return_value=True) as mock_verify_hash:
+                        check_val = DownloadDecrypter.decrypt_and_combine()
+                        self.assertIs(check_val, True)
+                        mock_verify_hash.assert_called_with("fake-hash")
+                        mock_extract.assert_not_called()
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_decrypt_and_combine_stream_decrypt_fail(self, mock_config):
+        mock_config.stream_restore = True
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_downloaded_gz_files", return_value=["file1", "file2"]) as mock_get_dl_files:
+            with mock.patch("onedrive_offsite.workers.DownloadDecrypter._stream_decrypt", return_value=None) as mock_stream_decrypt:
+                with mock.patch("onedrive_offsite.workers.DownloadDecrypter._verify_hash") as mock_verify_hash:
+                    check_val = DownloadDecrypter.decrypt_and_combine()
+                    self.assertIs(check_val, None)
+                    mock_verify_hash.assert_not_called()
+
+    @mock.patch("onedrive_offsite.workers.Config")
+    def test_unit_decrypt_and_combine_stream_hash_fail(self, mock_config):
+        mock_config.stream_restore = True
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_downloaded_gz_files", return_value=["file1", "file2"]) as mock_get_dl_files:
+            with mock.patch("onedrive_offsite.workers.DownloadDecrypter._stream_decrypt", return_value="fake-hash") as mock_stream_decrypt:
+                with mock.patch("onedrive_offsite.workers.DownloadDecrypter._verify_hash", return_value=None) as mock_verify_hash:
+                    check_val = DownloadDecrypter.decrypt_and_combine()
+                    self.assertIs(check_val, None)
+
+    def test_unit_decrypt_and_combine_dedup_manifest(self):
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_downloaded_gz_files", return_value=["fake-dir_001_backup.tar", "fake-dir_manifest.crypt"]) as mock_get_dl_files:
+            with mock.patch("onedrive_offsite.workers.DownloadDecrypter._dedup_decrypt", return_value="fake-hash") as mock_dedup_decrypt:
+                with mock.patch("onedrive_offsite.workers.DownloadDecrypter._stream_decrypt") as mock_stream_decrypt:
+                    with mock.patch("onedrive_offsite.workers.DownloadDecrypter._verify_hash", return_value=True) as mock_verify_hash:
+                        check_val = DownloadDecrypter.decrypt_and_combine()
+                        self.assertIs(check_val, True)
+                        mock_dedup_decrypt.assert_called_with("fake-dir_manifest.crypt", ["fake-dir_001_backup.tar", "fake-dir_manifest.crypt"])
+                        mock_verify_hash.assert_called_with("fake-hash")
+                        self.assertEqual(mock_stream_decrypt.call_count, 0)
+
+    def test_unit_dedup_decrypt_restore_fail(self):
+        with mock.patch("onedrive_offsite.workers.DownloadDecrypter._get_restore_file_path", return_value="fake/restore.vma.zst") as mock_restore_path:
+            with mock.patch("onedrive_offsite.workers.Crypt") as mock_crypt:
+                with mock.patch("onedrive_offsite.workers.read_manifest", return_value={"chunks": []}) as mock_read_manifest:
+                    with mock.patch("onedrive_offsite.workers.restore_from_manifest", return_value=False) as mock_restore:
+                        with mock.patch("onedrive_offsite.workers.os.remove") as mock_remove:
+                            check_val = DownloadDecrypter._dedup_decrypt("fake-dir_manifest.crypt", ["fake-dir_manifest.crypt"])
+                            self.assertIs(check_val, None)
+                            self.assertEqual(mock_remove.call_count, 0)